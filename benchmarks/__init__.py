@@ -0,0 +1,3 @@
+"""
+Offline benchmarks for ga_dynamic_models.  See README.rst in this directory.
+"""
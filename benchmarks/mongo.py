@@ -0,0 +1,134 @@
+"""
+An in-memory stand-in for the small part of the pymongo Database / Collection API that ga_dynamic_models uses.  It lets
+the benchmarks run without a MongoDB server.  Documents are deep-copied on the way in and out, as they would be by a
+real round trip, so timings include a realistic amount of per-document copying but no network.
+"""
+
+import copy
+
+
+class DuplicateKeyError(Exception):
+    pass
+
+
+OPERATORS = {
+    '$gt' : lambda value, operand: value is not None and value > operand,
+    '$gte' : lambda value, operand: value is not None and value >= operand,
+    '$lt' : lambda value, operand: value is not None and value < operand,
+    '$lte' : lambda value, operand: value is not None and value <= operand,
+}
+
+
+def _matches(doc, spec):
+    for k, v in spec.items():
+        if isinstance(v, dict) and v and all(o in OPERATORS for o in v):
+            if not all(OPERATORS[o](doc.get(k), operand) for o, operand in v.items()):
+                return False
+        elif doc.get(k) != v:
+            return False
+    return True
+
+
+def _project(doc, fields):
+    if fields is None:
+        return copy.deepcopy(doc)
+    ret = dict((k, copy.deepcopy(doc[k])) for k in fields if k in doc)
+    ret['_id'] = doc['_id']
+    return ret
+
+
+class Cursor(object):
+    def __init__(self, docs):
+        self._docs = docs
+
+    def __iter__(self):
+        return iter(self._docs)
+
+    def sort(self, key, direction=1):
+        self._docs.sort(key=lambda d: d.get(key), reverse=direction < 0)
+        return self
+
+
+class Collection(object):
+    def __init__(self, name):
+        self.name = name
+        self._docs = {}
+
+    def _spec(self, spec_or_id):
+        if spec_or_id is None:
+            return {}
+        if isinstance(spec_or_id, dict):
+            return spec_or_id
+        return {'_id' : spec_or_id}
+
+    def find(self, spec=None, fields=None, **kwargs):
+        spec = self._spec(spec)
+        if '_id' in spec and len(spec) == 1 and not isinstance(spec['_id'], dict):
+            docs = [self._docs[spec['_id']]] if spec['_id'] in self._docs else []
+        else:
+            docs = [d for d in self._docs.values() if _matches(d, spec)]
+        return Cursor([_project(d, fields) for d in docs])
+
+    def find_one(self, spec_or_id=None, fields=None, **kwargs):
+        for doc in self.find(spec_or_id, fields):
+            return doc
+        return None
+
+    def insert(self, doc, safe=False, **kwargs):
+        if doc['_id'] in self._docs:
+            raise DuplicateKeyError(doc['_id'])
+        self._docs[doc['_id']] = copy.deepcopy(doc)
+        return doc['_id']
+
+    def save(self, doc, safe=False, **kwargs):
+        self._docs[doc['_id']] = copy.deepcopy(doc)
+        return doc['_id']
+
+    def update(self, spec, document, upsert=False, safe=False, **kwargs):
+        for key, doc in self._docs.items():
+            if _matches(doc, spec):
+                self._apply(key, doc, document)
+                return {'n' : 1, 'updatedExisting' : True}
+        if upsert:
+            doc = dict(spec)
+            self._apply(doc['_id'], doc, document)
+        return {'n' : int(upsert), 'updatedExisting' : False}
+
+    def find_and_modify(self, query, update, upsert=False, new=False, **kwargs):
+        before = self.find_one(query)
+        self.update(query, update, upsert=upsert)
+        return self.find_one(query) if new else before
+
+    def _apply(self, key, doc, document):
+        if not any(k.startswith('$') for k in document):
+            replacement = copy.deepcopy(document)
+            replacement['_id'] = key
+            self._docs[key] = replacement
+            return
+        for k, v in document.get('$set', {}).items():
+            doc[k] = copy.deepcopy(v)
+        for k, v in document.get('$inc', {}).items():
+            doc[k] = doc.get(k, 0) + v
+        self._docs[key] = doc
+
+    def remove(self, spec_or_id=None, safe=False, **kwargs):
+        spec = self._spec(spec_or_id)
+        for key in [k for k, d in self._docs.items() if _matches(d, spec)]:
+            del self._docs[key]
+
+    def count(self):
+        return len(self._docs)
+
+
+class Database(object):
+    def __init__(self, name='ga_dynamic_models'):
+        self.name = name
+        self._collections = {}
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = Collection(name)
+        return self._collections[name]
+
+    def drop_collection(self, name):
+        self._collections.pop(name, None)
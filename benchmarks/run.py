@@ -0,0 +1,245 @@
+"""
+Run the offline benchmarks and write the results as JSON.
+
+Usage::
+
+    python -m benchmarks.run --catalog-sizes 10,100,1000,10000 --rows 10000,100000 --out results.json
+    python -m benchmarks.run --compare old.json new.json
+
+Every benchmark produces one entry in ``results`` with its name, its parameters, the raw samples and a few summary
+statistics.  Entries are written with sorted keys so that two result files can be diffed directly, or compared with
+``--compare``, which prints the ratio of medians for every benchmark the two files have in common.
+"""
+
+import os
+import sys
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+import argparse
+import json
+import platform
+import subprocess
+import tempfile
+import time
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    n = len(ordered)
+    return {
+        'n' : n,
+        'min' : ordered[0],
+        'max' : ordered[-1],
+        'mean' : sum(ordered) / n,
+        'median' : ordered[n // 2] if n % 2 else (ordered[n // 2 - 1] + ordered[n // 2]) / 2.0,
+        'p95' : ordered[min(n - 1, int(round(0.95 * (n - 1))))],
+    }
+
+
+def result(name, params, samples, unit='s', **extra):
+    ret = {
+        'benchmark' : name,
+        'params' : params,
+        'unit' : unit,
+        'samples' : samples,
+        'summary' : summarize(samples),
+    }
+    ret.update(extra)
+    return ret
+
+
+def environment():
+    import django
+    try:
+        revision = subprocess.Popen(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__))).communicate()[0].strip()
+    except OSError:
+        revision = None
+    from django.conf import settings
+    return {
+        'python' : platform.python_version(),
+        'platform' : platform.platform(),
+        'django' : django.get_version(),
+        'database' : settings.DATABASES['default']['ENGINE'],
+        'definition_store' : settings.GA_DYNAMIC_MODELS_DEFINITION_STORE['BACKEND'],
+        'revision' : revision,
+    }
+
+
+def load_catalog(size, prefix):
+    """Replace the contents of the stand-in catalog with a synthetic one."""
+    from benchmarks import synthetic
+    from ga_dynamic_models.stores import get_store
+
+    models, resources = get_store('models'), get_store('api')
+    for store in (models, resources):
+        for definition in store.list():
+            store.delete(definition['name'])
+    for m, r in synthetic.catalog(size, prefix=prefix):
+        models.put(m)
+        resources.put(r)
+
+
+def fresh_import(module):
+    """Import a module from scratch and return how long it took."""
+    for name in [module, 'ga_dynamic_models.api', 'ga_dynamic_models.models']:
+        sys.modules.pop(name, None)
+    start = time.time()
+    __import__(module)
+    return time.time() - start
+
+
+def bench_import(sizes, repeat):
+    ret = []
+    for size in sizes:
+        for module in ['ga_dynamic_models.models', 'ga_dynamic_models.api']:
+            samples = []
+            for r in range(repeat):
+                # fresh names every time, or Django's app cache would hand back the classes from the last round.
+                load_catalog(size, 'Imp{module}{size}r{r}x'.format(module=module[-3:], size=size, r=r))
+                samples.append(fresh_import(module))
+            ret.append(result('import', {'module' : module, 'catalog_size' : size}, samples))
+    return ret
+
+
+def bench_get_model(sizes, repeat, lookups=20):
+    from ga_dynamic_models import utils
+
+    ret = []
+    for size in sizes:
+        prefix = 'Get{size}x'.format(size=size)
+        load_catalog(size, prefix)
+        fresh_import('ga_dynamic_models.models')
+        samples = []
+        for r in range(repeat):
+            for i in range(lookups):
+                name = '{prefix}{i}'.format(prefix=prefix, i=(i * 7919) % size)
+                start = time.time()
+                utils.get_model(name)
+                samples.append(time.time() - start)
+        ret.append(result('get_model', {'catalog_size' : size}, samples))
+    return ret
+
+
+def bench_parse(sizes, repeat):
+    from benchmarks import synthetic
+    from ga_dynamic_models.parser import Parser
+    from django.db.models.base import ModelBase
+
+    ret = []
+    for size in sizes:
+        samples = []
+        for r in range(repeat):
+            definitions = [m for m, _ in synthetic.catalog(size, prefix='Parse{size}r{r}x'.format(size=size, r=r))]
+            p = Parser('ga_dynamic_models.models', ModelBase)
+            start = time.time()
+            for d in definitions:
+                p.parse(**d)
+            samples.append(size / (time.time() - start))
+        ret.append(result('parser_parse', {'catalog_size' : size}, samples, unit='definitions/s'))
+    return ret
+
+
+def upload(path, name):
+    """Push a CSV file through CSVCreateModelView the way a browser upload would."""
+    from django.core.files import File
+    from ga_dynamic_models.views import csv_upload
+
+    with open(path, 'rb') as flo:
+        form = csv_upload.CSVUploadForm(
+            {'model_name' : name, 'model_verbose_name' : name, 'overwrite_existing' : ['overwrite']},
+            {'model_data' : File(flo, name=os.path.basename(path))}
+        )
+        if not form.is_valid():
+            raise ValueError(form.errors)
+        csv_upload.CSVCreateModelView().form_valid(form)
+
+
+def bench_upload(shapes, row_counts, repeat, workdir):
+    from benchmarks import synthetic
+    from ga_dynamic_models import metrics
+
+    ret = []
+    for shape in shapes:
+        for rows in row_counts:
+            path = os.path.join(workdir, '{shape}_{rows}.csv'.format(shape=shape, rows=rows))
+            with open(path, 'wb') as flo:
+                synthetic.write_csv(flo, shape, rows)
+
+            samples = []
+            stages = []
+            for r in range(repeat):
+                metrics.reset()
+                start = time.time()
+                upload(path, 'Upload{shape}{rows}r{r}x'.format(shape=shape, rows=rows, r=r))
+                samples.append(rows / (time.time() - start))
+                stages.append(dict((k, v['total']) for k, v in metrics.snapshot()['spans'].items()
+                                   if k.startswith('upload.')))
+            size = os.path.getsize(path)
+            os.unlink(path)
+            ret.append(result('upload', {'shape' : shape, 'rows' : rows, 'bytes' : size}, samples, unit='rows/s',
+                stages=stages))
+    return ret
+
+
+def compare(old_path, new_path):
+    def key(r):
+        return r['benchmark'], json.dumps(r['params'], sort_keys=True)
+
+    old = dict((key(r), r) for r in json.load(open(old_path))['results'])
+    for r in json.load(open(new_path))['results']:
+        if key(r) in old:
+            before = old[key(r)]['summary']['median']
+            after = r['summary']['median']
+            print '{name:<14} {params:<60} {before:>12.6g} {after:>12.6g} {ratio:>8.3f}x {unit}'.format(
+                name=r['benchmark'], params=key(r)[1], before=before, after=after,
+                ratio=(after / before) if before else float('inf'), unit=r['unit'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmarks for ga_dynamic_models')
+    parser.add_argument('--catalog-sizes', default='10,100,1000', help='comma separated model counts (up to 10000)')
+    parser.add_argument('--rows', default='10000', help='comma separated CSV row counts (10000 to 10000000)')
+    parser.add_argument('--shapes', default='narrow,wide', help='CSV shapes: narrow (5 columns), wide (100 columns)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', default='import,get_model,parse,upload', help='which benchmarks to run')
+    parser.add_argument('--out', default=None, help='write JSON here instead of stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files and exit')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    from django.conf import settings
+    from django.core.management import call_command
+    settings.GA_DYNAMIC_MODELS_METRICS = True
+    call_command('syncdb', interactive=False, verbosity=0)
+
+    sizes = [int(s) for s in args.catalog_sizes.split(',')]
+    row_counts = [int(s) for s in args.rows.split(',')]
+    shapes = args.shapes.split(',')
+    only = args.only.split(',')
+    workdir = tempfile.mkdtemp(prefix='ga_bench_csv_')
+
+    results = []
+    if 'import' in only:
+        results.extend(bench_import(sizes, args.repeat))
+    if 'get_model' in only:
+        results.extend(bench_get_model(sizes, args.repeat))
+    if 'parse' in only:
+        results.extend(bench_parse(sizes, args.repeat))
+    if 'upload' in only:
+        results.extend(bench_upload(shapes, row_counts, args.repeat, workdir))
+
+    output = json.dumps({'environment' : environment(), 'results' : results}, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as flo:
+            flo.write(output)
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Django settings for running the benchmarks offline.  The data goes to a throwaway SQLite database, or SpatiaLite if
+GA_BENCH_SPATIALITE is set in the environment.  The catalog goes to the definition store named by GA_BENCH_STORE: 'mongo'
+(the in-memory Mongo stand-in, the default), 'memory' or 'sql'.
+"""
+
+import os
+import tempfile
+from benchmarks import mongo
+
+_workdir = os.environ.get('GA_BENCH_WORKDIR') or tempfile.mkdtemp(prefix='ga_bench_')
+
+DEBUG = False
+
+DATABASES = {
+    'default' : {
+        'ENGINE' : 'django.contrib.gis.db.backends.spatialite' if os.environ.get('GA_BENCH_SPATIALITE')
+                   else 'django.db.backends.sqlite3',
+        'NAME' : os.path.join(_workdir, 'bench.db'),
+    }
+}
+
+MONGODB_CONNECTIONS = {
+    'default' : mongo.Database('default')
+}
+
+MONGODB_ROUTES = {
+    'default' : MONGODB_CONNECTIONS['default'],
+    'ga_dynamic_models' : MONGODB_CONNECTIONS['default'],
+}
+
+GA_DYNAMIC_MODELS_DEFINITION_STORE = {
+    'BACKEND' : {
+        'mongo' : 'ga_dynamic_models.stores.MongoDefinitionStore',
+        'memory' : 'ga_dynamic_models.stores.MemoryDefinitionStore',
+        'sql' : 'ga_dynamic_models.stores.SQLDefinitionStore',
+    }[os.environ.get('GA_BENCH_STORE', 'mongo')]
+}
+
+CACHES = {
+    'default' : {
+        'BACKEND' : 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+INSTALLED_APPS = (
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'django.contrib.sessions',
+    'tastypie',
+    'ga_dynamic_models',
+)
+
+if os.environ.get('GA_BENCH_SPATIALITE'):
+    INSTALLED_APPS += ('django.contrib.gis',)
+
+SECRET_KEY = 'benchmarks-only'
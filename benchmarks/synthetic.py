@@ -0,0 +1,116 @@
+"""
+Generators for synthetic catalogs and CSV uploads.  Everything is driven by a seeded random.Random so that two runs
+with the same parameters produce the same definitions and the same files.
+"""
+
+from ga_dynamic_models import utils
+import random
+import csv
+
+COUNTIES = ["alamance", "buncombe", "durham", "forsyth", "guilford", "mecklenburg", "new hanover", "orange", "pitt",
+            "wake"]
+
+NARROW_COLUMNS = [
+    ('County', '*CharField'),
+    ('Year', 'IntegerField'),
+    ('Population', 'IntegerField'),
+    ('Median Income', 'FloatField'),
+    ('Urban', 'BooleanField'),
+]
+
+def model_definition(name, geo, rnd, nfields=8):
+    """
+    A random model definition of the kind a user would upload.
+
+    :param name: The model name.
+    :param geo: Whether to make a GeoDjango model.
+    :param rnd: A random.Random
+    :param nfields: How many non-geometry fields to give it.
+    :return: A JSON serializable dict, as returned by simple_model / simple_geomodel.
+    """
+    field = utils.simple_geofield if geo else utils.simple_field
+    fields = {}
+    for i in range(nfields):
+        kind = rnd.choice(['CharField', 'IntegerField', 'FloatField', 'BooleanField'])
+        if kind == 'CharField':
+            fields['f{i}'.format(i=i)] = field(kind, max_length=255, null=True, db_index=rnd.random() < 0.2)
+        else:
+            fields['f{i}'.format(i=i)] = field(kind, null=True)
+    if geo:
+        fields['geom'] = utils.simple_geofield(rnd.choice(['PointField', 'PolygonField', 'MultiPolygonField']), null=True)
+        return utils.simple_geomodel(name, **fields)
+    else:
+        return utils.simple_model(name, **fields)
+
+def resource_definition(name, geo):
+    if geo:
+        return utils.simple_geo_resource('ga_dynamic_models.models', name, name.lower())
+    else:
+        return utils.simple_model_resource('ga_dynamic_models.models', name, name.lower())
+
+def catalog(size, prefix='Bench', geo_fraction=0.3, seed=0):
+    """
+    Generate a catalog of model and resource definitions.
+
+    :param size: The number of models.
+    :param prefix: Prepended to every model name so that catalogs from different runs don't collide in Django's app cache.
+    :param geo_fraction: The fraction of models that are GeoDjango models.
+    :param seed: The random seed.
+    :return: A list of (model definition, resource definition) pairs.
+    """
+    rnd = random.Random(seed)
+    ret = []
+    for i in range(size):
+        name = '{prefix}{i}'.format(prefix=prefix, i=i)
+        geo = rnd.random() < geo_fraction
+        m = model_definition(name, geo, rnd)
+        r = resource_definition(name, geo)
+        m['_id'] = r['_id'] = name
+        m['_owner'] = r['_owner'] = None
+        ret.append((m, r))
+    return ret
+
+def columns(shape):
+    """
+    :param shape: 'narrow' (5 columns) or 'wide' (100 columns)
+    :return: A list of (verbose name, datatype) pairs for the CSV header rows.
+    """
+    if shape == 'narrow':
+        return NARROW_COLUMNS
+    cols = list(NARROW_COLUMNS)
+    kinds = ['CharField', 'IntegerField', 'FloatField', 'BooleanField']
+    for i in range(100 - len(cols)):
+        cols.append(('Measure {i}'.format(i=i), kinds[i % len(kinds)]))
+    return cols
+
+def write_csv(flo, shape, rows, seed=0):
+    """
+    Write a CSV in the two-header-row format that the upload views expect: column names, then data types, then data.
+    Rows are written as they are generated, so even 10M row files do not need to fit in memory.
+
+    :param flo: A file-like object open for writing.
+    :param shape: 'narrow' or 'wide'
+    :param rows: The number of data rows.
+    :param seed: The random seed.
+    """
+    rnd = random.Random(seed)
+    cols = columns(shape)
+    writer = csv.writer(flo)
+    writer.writerow([name for name, _ in cols])
+    writer.writerow([kind for _, kind in cols])
+
+    kinds = [kind.lstrip('*') for _, kind in cols]
+    for r in range(rows):
+        row = []
+        for i, kind in enumerate(kinds):
+            if i == 0:
+                row.append(rnd.choice(COUNTIES))
+            elif kind == 'CharField':
+                row.append('v{n}'.format(n=rnd.randint(0, 1000)))
+            elif kind == 'IntegerField':
+                row.append(rnd.randint(0, 1000000))
+            elif kind == 'FloatField':
+                row.append('{v:.4f}'.format(v=rnd.random() * 100000))
+            else:
+                row.append(rnd.choice(['1', '']))
+        writer.writerow(row)
@@ -2,10 +2,13 @@ import django.contrib.gis.admin as geoadmin
 import django.contrib.admin as admin
 from django.contrib.gis.db.models import GeoManager
 import ga_dynamic_models.models as m
+from ga_dynamic_models import metrics
+from ga_dynamic_models import classcache
 import importlib
 from django.db.models import Model
 
-for model in [m.__getattribute__(x) for x in m.__all__]:
+def register(model):
+    """Register a dynamic model with the admin, with the admin class its Meta names if it names one."""
     try:
         if issubclass(model, Model):
             if hasattr(model._meta, "admin_class"):
@@ -19,3 +22,8 @@ for model in [m.__getattribute__(x) for x in m.__all__]:
     except TypeError:
         pass
 
+# with the class cache on, models are registered as they are built; see ga_dynamic_models.classcache
+if not classcache.enabled():
+    with metrics.span('admin.register'):
+        for model in [m.__getattribute__(x) for x in m.__all__]:
+            register(model)
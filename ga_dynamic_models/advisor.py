@@ -0,0 +1,158 @@
+"""
+Recommends indexes for dynamic model tables from the queries actually made against them, and builds them.
+
+:py:mod:`ga_dynamic_models.querylog` records which fields each resource is filtered and ordered on and how long those
+requests take.  :py:func:`recommend` turns that into a list of single column indexes, for the fields with no index
+yet, most expensive first: a field's cost is the total time of the requests that used it.  :py:func:`build` creates
+one, on PostgreSQL with ``CREATE INDEX CONCURRENTLY`` by default so that the table isn't locked against loads while
+the index is built, and records the field in the 'indexes' kind of definition store so that loads that rebuild the
+table build the index again::
+
+    { 'name' : 'Permits', 'fields' : ['county', 'year'] }
+
+The fields are kept apart from the model's own definition so that building an index doesn't move the model's data
+generation and throw away every response cached for it.
+
+The ``advise_indexes`` management command prints the recommendations and, with ``--build``, builds them.
+"""
+
+from django.db import connections, router
+from ga_dynamic_models.stores import get_store, RevisionConflict
+from ga_dynamic_models import querylog
+from ga_dynamic_models import metrics
+from logging import getLogger
+import hashlib
+
+_log = getLogger(__name__)
+
+ATTEMPTS = 3
+
+
+def _get_model(name):
+    from ga_dynamic_models.utils import get_model
+    try:
+        return get_model(name)
+    except AttributeError:
+        # get_model raises this for a model that has been dropped since its requests were logged
+        return None
+
+
+def recommend(min_requests=10, resource_name=None):
+    """
+    :param min_requests: Leave out fields used by fewer requests than this.
+    :param resource_name: Only look at one resource.
+    :return: A list of dicts with 'model', 'table', 'field', 'column', 'filter', 'order', 'seconds' and 'resources',
+        most expensive first.
+    """
+    logs = querylog.get()
+    if resource_name is not None:
+        logs = dict((name, log) for name, log in logs.items() if name == resource_name)
+
+    candidates = {}
+    for name, log in logs.items():
+        model = _get_model(log['model'])
+        if model is None:
+            continue
+        for field_name, used in log['fields'].items():
+            if querylog.is_indexed(model, field_name):
+                continue
+            try:
+                field = model._meta.get_field(field_name)
+            except Exception:
+                continue
+            candidate = candidates.setdefault((log['model'], field_name), {
+                'model' : log['model'],
+                'table' : model._meta.db_table,
+                'field' : field_name,
+                'column' : field.column,
+                'filter' : 0,
+                'order' : 0,
+                'seconds' : 0.0,
+                'resources' : [],
+            })
+            candidate['filter'] += used['filter']
+            candidate['order'] += used['order']
+            candidate['seconds'] += used['seconds']
+            candidate['resources'].append(name)
+
+    recommendations = [c for c in candidates.values() if c['filter'] + c['order'] >= min_requests]
+    recommendations.sort(key=lambda c: c['seconds'], reverse=True)
+    return recommendations
+
+
+def index_name(table, column):
+    """
+    Name an index after its table and column, within PostgreSQL's limit on identifier length.  The digest covers the
+    whole table name as well as the column, since tables that only differ after the part kept would otherwise clash.
+    """
+    digest = hashlib.md5('{table}.{column}'.format(table=table, column=column)).hexdigest()[:8]
+    return '{table}_{digest}'.format(table=table[:30], digest=digest)
+
+
+def build(recommendation, concurrently=True):
+    """
+    Create an index recommended by :py:func:`recommend`.
+
+    :param recommendation: One of the dicts :py:func:`recommend` returns.
+    :param concurrently: On PostgreSQL, build it without locking the table against writes.  This is slower and can't
+        happen inside a transaction, so the connection is switched to autocommit for the duration.
+    :return: The name of the index.
+    """
+    model = _get_model(recommendation['model'])
+    if model is None:
+        raise ValueError("no model named {model}".format(**recommendation))
+    connection = connections[router.db_for_write(model)]
+    qn = connection.ops.quote_name
+    name = index_name(recommendation['table'], recommendation['column'])
+    concurrently = concurrently and connection.vendor == 'postgresql'
+    sql = 'CREATE INDEX {concurrently}{name} ON {table} ({column})'.format(
+        concurrently='CONCURRENTLY ' if concurrently else '',
+        name=qn(name), table=qn(recommendation['table']), column=qn(recommendation['column']))
+
+    with metrics.span('advisor.build', model=recommendation['model'], field=recommendation['field']):
+        cursor = connection.cursor()
+        if concurrently:
+            level = connection.connection.isolation_level
+            connection.connection.set_isolation_level(0)
+            try:
+                cursor.execute(sql)
+            finally:
+                connection.connection.set_isolation_level(level)
+        else:
+            cursor.execute(sql)
+            connection.commit_unless_managed()
+    _log.info('built index {name} on {table}.{column}'.format(name=name, **recommendation))
+
+    querylog.forget_indexes(model)
+    mark_indexed(recommendation['model'], recommendation['field'])
+    return name
+
+
+def indexed(model_name):
+    """
+    :return: The set of fields of a model that have had an index built by :py:func:`build`.
+    """
+    entry = get_store('indexes').get(model_name)
+    return set(entry['fields']) if entry else set()
+
+
+def mark_indexed(model_name, field_name):
+    """Record that a field of a model has an index, without touching the model's definition."""
+    store = get_store('indexes')
+    for attempt in range(ATTEMPTS):
+        current = store.get(model_name)
+        entry = current or {'name' : model_name, 'fields' : []}
+        if field_name in entry['fields']:
+            return
+        entry['fields'].append(field_name)
+        try:
+            store.put(entry, revision=current.get('_rev') if current else 0)
+            return
+        except RevisionConflict:
+            continue
+    _log.warning('gave up recording the index on {model}.{field}'.format(model=model_name, field=field_name))
+
+
+def forget(model_name):
+    """Forget the indexes of a model that has been dropped."""
+    get_store('indexes').delete(model_name)
@@ -0,0 +1,277 @@
+"""
+Group-by aggregates over dynamic model tables, computed in the database.
+
+Every dynamic resource has an aggregate endpoint that takes the same filters as its list endpoint::
+
+    /api/my_model/aggregate/?group_by=county&metric=count&metric=avg:income&year__gte=2010
+
+``group_by`` may be given any number of times, or not at all to aggregate the whole table, and names a categorical
+column: anything that isn't a floating point, decimal, text or geometry field.  ``metric`` is ``count`` for the number
+of rows, or one of ``count``, ``sum``, ``avg``, ``min`` and ``max`` followed by a colon and a numeric column.  The
+request compiles to a single ``SELECT ... GROUP BY`` and the response lists one object per group, with the group's
+values and a key per metric named like ``avg_income`` (or just ``count``).  Dictionary encoded columns (see
+:py:mod:`ga_dynamic_models.categorical`) are grouped by their codes, which are decoded in the response.
+
+Responses go through the resource's response cache and so are cached per data generation.  For groupings that are asked
+for all the time, a model can also declare *rollups*, which are precomputed after every load::
+
+    aggregation.declare_rollups('MyModel', [['county'], ['county', 'year']])
+
+A rollup holds the row count, the count of every column, and the sum, minimum and maximum of every numeric column for
+each group.  An unfiltered request whose ``group_by`` columns are all in one of the model's rollups, and whose metrics
+the rollup holds, is answered from the rollup without touching the table.  Rollups are cached for
+``GA_DYNAMIC_MODELS_ROLLUP_TIMEOUT`` seconds (a day by default) and computed again when they are next asked for after
+that, so the rollups of past data generations don't stay in the cache.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Sum, Avg, Min, Max
+from ga_dynamic_models.stores import get_store
+from ga_dynamic_models import generations
+from ga_dynamic_models import counting
+from ga_dynamic_models import metrics
+from ga_dynamic_models import categorical
+
+FUNCTIONS = {
+    'count' : Count,
+    'sum' : Sum,
+    'avg' : Avg,
+    'min' : Min,
+    'max' : Max,
+}
+
+NUMERIC_TYPES = (
+    'AutoField', 'IntegerField', 'BigIntegerField', 'SmallIntegerField', 'PositiveIntegerField',
+    'PositiveSmallIntegerField', 'FloatField', 'DecimalField'
+)
+NON_CATEGORICAL_TYPES = ('FloatField', 'DecimalField', 'TextField')
+
+
+def is_numeric(field):
+    return field.get_internal_type() in NUMERIC_TYPES and not field.primary_key and \
+        not getattr(field, 'categorical', False)
+
+
+def is_categorical(field):
+    return not hasattr(field, 'geom_type') and field.get_internal_type() not in NON_CATEGORICAL_TYPES
+
+
+def parse_metrics(values):
+    """
+    :param values: Metric specifications like 'count' and 'avg:income'.  Comma separated lists are split up.
+    :return: A list of (function name, field name or None) pairs.
+    """
+    parsed = []
+    for value in values:
+        for spec in value.split(','):
+            spec = spec.strip()
+            if not spec:
+                continue
+            function, _, field = spec.partition(':')
+            parsed.append((function, field or None))
+    return parsed or [('count', None)]
+
+
+def metric_name(function, field):
+    return function if field is None else '{function}_{field}'.format(function=function, field=field)
+
+
+def validate(model, group_by, requested):
+    """
+    Check a request against a model.
+
+    :raises ValueError: if a column doesn't exist or can't be used the way it's being asked to.
+    """
+    fields = dict((f.name, f) for f in model._meta.local_fields)
+    for name in group_by:
+        if name not in fields:
+            raise ValueError('{model} has no column {name}'.format(model=model.__name__, name=name))
+        if not is_categorical(fields[name]):
+            raise ValueError('{name} is not a categorical column and cannot be grouped by'.format(name=name))
+    for function, name in requested:
+        if function not in FUNCTIONS:
+            raise ValueError('unknown aggregate {function}'.format(function=function))
+        if name is None:
+            if function != 'count':
+                raise ValueError('{function} needs a column, as in {function}:column'.format(function=function))
+        elif name not in fields:
+            raise ValueError('{model} has no column {name}'.format(model=model.__name__, name=name))
+        elif function != 'count' and not is_numeric(fields[name]):
+            raise ValueError('{name} is not a numeric column'.format(name=name))
+
+
+def aggregate(queryset, group_by, requested):
+    """
+    Run an aggregate query.
+
+    :param queryset: The rows to aggregate, already filtered.
+    :param group_by: A list of column names to group by.
+    :param requested: A list of (function name, field name or None), as returned by :py:func:`parse_metrics`.
+    :return: A list of dicts, one per group, ordered by the group columns.
+    """
+    annotations = dict(
+        (metric_name(function, field), FUNCTIONS[function](field or 'pk')) for function, field in requested)
+    with metrics.span('aggregate.query', model=queryset.model.__name__):
+        if not group_by:
+            return [queryset.order_by().aggregate(**annotations)]
+        return list(queryset.order_by().values(*group_by).annotate(**annotations).order_by(*group_by))
+
+
+# Rollups
+
+def rollups(name):
+    """
+    :return: The groupings declared as rollups for a model, as a list of lists of column names.
+    """
+    definition = get_store('models').get(name)
+    return definition.get('_rollups', []) if definition else []
+
+
+def declare_rollups(name, groupings):
+    """
+    Declare the groupings to precompute for a model.  They are computed the next time they are needed and after every
+    load from then on.
+
+    :param name: The name of the model.
+    :param groupings: A list of lists of column names.
+    """
+    get_store('models').update(name, _rollups=[list(g) for g in groupings])
+    generations.forget(name)
+
+
+def rollup_timeout():
+    """How long, in seconds, a computed rollup stays in the cache before it is computed again when next asked for."""
+    return getattr(settings, 'GA_DYNAMIC_MODELS_ROLLUP_TIMEOUT', 24 * 3600)
+
+
+def _rollup_key(name, generation, grouping):
+    return 'ga_dynamic_models:rollup:{name}:{generation}:{grouping}'.format(
+        name=name, generation=generation, grouping='|'.join(grouping))
+
+
+def compute_rollup(model, grouping, generation=None):
+    """
+    Compute and cache a rollup.
+
+    :return: A list of dicts with the grouping's columns, 'rows', count_ of every column, and sum_, min_ and max_ of
+        every numeric column.
+    """
+    annotations = {'rows' : Count('pk')}
+    for name in [f.name for f in model._meta.local_fields]:
+        annotations['count_' + name] = Count(name)
+    for name in [f.name for f in model._meta.local_fields if is_numeric(f)]:
+        annotations['sum_' + name] = Sum(name)
+        annotations['min_' + name] = Min(name)
+        annotations['max_' + name] = Max(name)
+    if generation is None:
+        generation = generations.current(model.__name__)
+    with metrics.span('aggregate.rollup', model=model.__name__):
+        rows = list(model._default_manager.order_by().values(*grouping).annotate(**annotations))
+    cache.set(_rollup_key(model.__name__, generation, grouping), rows, rollup_timeout())
+    return rows
+
+
+def refresh(model, replace=True):
+    """Recompute a model's rollups.  Called by the loader after every load."""
+    generation = generations.current(model.__name__)
+    for grouping in rollups(model.__name__):
+        compute_rollup(model, grouping, generation)
+
+
+def holds(model, requested):
+    """
+    :return: Whether a rollup of the model holds every one of the requested metrics.
+    """
+    fields = dict((f.name, f) for f in model._meta.local_fields)
+    return all(field is None or function == 'count' or (field in fields and is_numeric(fields[field]))
+        for function, field in requested)
+
+
+def from_rollup(model, group_by, requested):
+    """
+    Answer an unfiltered aggregate request from one of the model's rollups.
+
+    :return: The same as :py:func:`aggregate` would, or None if no rollup covers the request.
+    """
+    if not holds(model, requested):
+        return None
+    grouping = None
+    for candidate in rollups(model.__name__):
+        if set(group_by) <= set(candidate) and (grouping is None or len(candidate) < len(grouping)):
+            grouping = candidate
+    if grouping is None:
+        return None
+
+    generation = generations.current(model.__name__)
+    rows = cache.get(_rollup_key(model.__name__, generation, grouping))
+    # rollups cached before every column was counted lack some count_ columns
+    if rows is None or (rows and not all(column in rows[0] for column in _rollup_columns(requested))):
+        rows = compute_rollup(model, grouping, generation)
+
+    groups = {}
+    for row in rows:
+        key = tuple(row[name] for name in group_by)
+        group = groups.get(key)
+        if group is None:
+            groups[key] = dict(row)
+            continue
+        group['rows'] += row['rows']
+        for column in row:
+            if column.startswith('count_'):
+                group[column] += row[column]
+            elif column.startswith('sum_'):
+                group[column] = _combine(group[column], row[column], lambda a, b: a + b)
+            elif column.startswith('min_'):
+                group[column] = _combine(group[column], row[column], min)
+            elif column.startswith('max_'):
+                group[column] = _combine(group[column], row[column], max)
+
+    results = []
+    for key in sorted(groups):
+        group = groups[key]
+        result = dict(zip(group_by, key))
+        for function, field in requested:
+            if field is None:
+                value = group['rows']
+            elif function == 'avg':
+                value = group['sum_' + field] / float(group['count_' + field]) if group['count_' + field] else None
+            else:
+                value = group['{function}_{field}'.format(function=function, field=field)]
+            result[metric_name(function, field)] = value
+        results.append(result)
+    return results
+
+
+def _rollup_columns(requested):
+    columns = []
+    for function, field in requested:
+        if field is None:
+            columns.append('rows')
+        elif function == 'avg':
+            columns.extend(['sum_' + field, 'count_' + field])
+        else:
+            columns.append(metric_name(function, field))
+    return columns
+
+
+def _combine(a, b, op):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return op(a, b)
+
+
+def answer(queryset, group_by, requested):
+    """
+    Aggregate a queryset, from a rollup if the queryset is unfiltered and one covers the grouping.
+
+    :return: A tuple of (rows, whether they came from a rollup).
+    """
+    validate(queryset.model, group_by, requested)
+    if not counting.is_filtered(queryset):
+        rows = from_rollup(queryset.model, group_by, requested)
+        if rows is not None:
+            return categorical.decode_rows(queryset.model, group_by, rows), True
+    return categorical.decode_rows(queryset.model, group_by, aggregate(queryset, group_by, requested)), False
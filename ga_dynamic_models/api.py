@@ -6,22 +6,18 @@ one "parser.py" module and work from there.
 
 from tastypie.api import Api
 from tastypie.resources import ModelDeclarativeMetaclass
-from django.conf import settings
 from ga_dynamic_models.parser import Parser
+from ga_dynamic_models.stores import get_store
+from ga_dynamic_models.models import archived_models
+from ga_dynamic_models.resources import archived_resource, lazy_resource
+from ga_dynamic_models import metrics
+from ga_dynamic_models import classcache
 from logging import getLogger
 
-if not hasattr(settings, "MONGODB_ROUTES"):
-    raise AttributeError('MONGODB_ROUTES must be filled in')
-
 _log = getLogger(__name__)
 
-if 'ga_dynamic_models' in settings.MONGODB_ROUTES:
-    _db = settings.MONGODB_ROUTES['ga_dynamic_models']
-else:
-    _db = settings.MONGODB_ROUTES['default']
-
-_coll = _db['ga_dynamic_models__api']
-_dynamic_model_resources = _coll.find()
+with metrics.span('catalog.fetch', kind='api'):
+    _dynamic_model_resources = get_store('api').list()
 
 __all__ = []
 
@@ -30,9 +26,16 @@ g = globals()
 p = Parser(__name__, ModelDeclarativeMetaclass)
 for res in _dynamic_model_resources:
     try:
-        cls = p.parse(**res)
-        g[res['name']] = cls
-        __all__.append(res['name'])
-        api.register(cls())
+        with metrics.span('api.register', resource=res['name']):
+            queryset = res.get('meta', {}).get('queryset')
+            if isinstance(queryset, dict) and queryset.get('model') in archived_models:
+                cls = archived_resource(res['name'], res['meta']['resource_name'], queryset['model'])
+            elif classcache.enabled() and classcache.model_of(res):
+                cls = lazy_resource(res)
+            else:
+                cls = p.parse(**res)
+            g[res['name']] = cls
+            __all__.append(res['name'])
+            api.register(cls())
     except Exception as e:
-        _log.error(str(e))
+        metrics.failure(res['name'], e)
@@ -0,0 +1,538 @@
+"""
+Cold storage for dynamic models that nobody uses.
+
+A model is *idle* once ``GA_DYNAMIC_MODELS_ARCHIVE_IDLE_DAYS`` days (90 by default) have passed since it was last
+requested through its resource or loaded; see :py:mod:`ga_dynamic_models.usage`.  The ``archive_models`` management
+command archives every idle model, or the ones it is given::
+
+    python manage.py archive_models --idle-days 180 --dry-run
+    python manage.py archive_models Permits2009
+
+Archiving a model writes its table, gzipped, to ``GA_DYNAMIC_MODELS_ARCHIVE_DIR``, reads the archive back to check that
+it holds as many rows as the table, then drops the table and its search indexes and marks the definition ``_archived``.
+Workers don't build the classes of archived models, and :py:mod:`ga_dynamic_models.api` stands an
+:py:class:`ga_dynamic_models.resources.ArchivedResource` in for their resources.  The first request to one starts a
+Celery task that loads the archive back into a new table, rebuilds its indexes and reloads the workers.  Until then
+requests are answered with a 503 and a ``Retry-After`` header of ``GA_DYNAMIC_MODELS_RESTORE_RETRY_AFTER`` seconds (30
+by default).
+
+An archive is a header followed by the rows, each value length prefixed so that strings and binary values come back
+byte for byte.  Decimals are kept as their text and floats as their ``repr``, so no value goes by way of a double it
+wasn't stored as.  Geometries are kept as WKB.  Archives written as columnar snapshots (see
+:py:mod:`ga_dynamic_models.snapshot`) by earlier versions can still be restored.
+
+The dictionaries of categorical columns stay in the database, so values keep their codes across a restore.  Indexes
+built by the advisor are not rebuilt.  Derived and partitioned models, models that derived models read, and models
+whose tables Django doesn't manage are never archived.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.color import no_style
+from django.db import connections, router, transaction
+from django.db.models.base import ModelBase
+from django.http import HttpResponse
+from django.utils import timezone
+from ga_dynamic_models.stores import get_store
+from ga_dynamic_models.parser import Parser
+from ga_dynamic_models import generations
+from ga_dynamic_models import categorical
+from ga_dynamic_models import classcache
+from ga_dynamic_models import counting
+from ga_dynamic_models import derived
+from ga_dynamic_models import export
+from ga_dynamic_models import metrics
+from ga_dynamic_models import search
+from ga_dynamic_models import snapshot
+from ga_dynamic_models import usage
+from logging import getLogger
+from decimal import Decimal
+import datetime
+import calendar
+import tempfile
+import shutil
+import struct
+import json
+import gzip
+import time
+import os
+
+_log = getLogger(__name__)
+
+DYNAMIC_MODULE = 'ga_dynamic_models.models'
+BATCH_SIZE = 5000
+MAGIC = 'GAARCH01'
+_NULL = 0xffffffff
+
+_epoch = datetime.datetime(1970, 1, 1)
+_epoch_date = datetime.date(1970, 1, 1)
+
+
+def _get_model(name):
+    from ga_dynamic_models.utils import get_model
+    return get_model(name)
+
+
+def idle_days():
+    return getattr(settings, 'GA_DYNAMIC_MODELS_ARCHIVE_IDLE_DAYS', 90)
+
+
+def retry_after():
+    return getattr(settings, 'GA_DYNAMIC_MODELS_RESTORE_RETRY_AFTER', 30)
+
+
+def restore_timeout():
+    return getattr(settings, 'GA_DYNAMIC_MODELS_RESTORE_TIMEOUT', 3600)
+
+
+def _ttl():
+    return getattr(settings, 'GA_DYNAMIC_MODELS_ARCHIVE_TTL', 30)
+
+
+def archive_dir():
+    root = getattr(settings, 'MEDIA_ROOT', None) or tempfile.gettempdir()
+    default = os.path.join(root, 'ga_dynamic_models_archive')
+    directory = getattr(settings, 'GA_DYNAMIC_MODELS_ARCHIVE_DIR', default)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return directory
+
+
+def path(name, generation):
+    return os.path.join(archive_dir(), '{name}.{generation}.gasnap.gz'.format(name=name, generation=generation))
+
+
+def _key(name):
+    return 'ga_dynamic_models:archived:{name}'.format(name=name)
+
+
+def _restore_key(name):
+    return 'ga_dynamic_models:restoring:{name}'.format(name=name)
+
+
+def is_archived(name):
+    """
+    :return: Whether a model is archived.  Cached for GA_DYNAMIC_MODELS_ARCHIVE_TTL seconds.
+    """
+    archived = cache.get(_key(name))
+    if archived is None:
+        definition = get_store('models').get(name)
+        archived = bool(definition and definition.get('_archived'))
+        cache.set(_key(name), archived, _ttl())
+    return archived
+
+
+def refusal(definition):
+    """
+    :return: Why a model can't be archived, or None if it can.
+    """
+    if definition.get('derived'):
+        return 'it is derived from other models'
+    if definition.get('partition'):
+        return 'it is partitioned'
+    if definition.get('meta', {}).get('managed') is False:
+        return "its table isn't managed by Django"
+    if derived.dependents(definition['name']):
+        return 'derived models read it'
+    return None
+
+
+def idle_since(definition):
+    """
+    :return: When a model was last used or loaded, or None if its usage isn't being recorded yet.
+    """
+    used = usage.get(definition['name'])
+    if used is None:
+        return None
+    return max(used['last_used'], used['since'], definition.get('_data_changed_at'))
+
+
+def idle(days=None):
+    """
+    Find the models that haven't been used for ``days`` days.  Models whose usage isn't being recorded yet start being
+    recorded, and count as used now.
+
+    :param days: By default GA_DYNAMIC_MODELS_ARCHIVE_IDLE_DAYS.
+    :return: Their names.
+    """
+    cutoff = time.time() - (idle_days() if days is None else days) * 86400
+    found = []
+    for definition in get_store('models').list():
+        if definition.get('_archived') or refusal(definition):
+            continue
+        since = idle_since(definition)
+        if since is None:
+            usage.start(definition['name'])
+        elif since < cutoff:
+            found.append(definition['name'])
+    return sorted(found)
+
+
+class ArchiveMismatch(ValueError):
+    """Raised by :py:func:`archive` when the archive it wrote doesn't read back as the table it was written from."""
+
+
+def _text(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _microseconds(value):
+    if value.tzinfo is not None:
+        value = value.replace(tzinfo=None) - value.utcoffset()
+    return str(calendar.timegm(value.timetuple()) * 1000000 + value.microsecond)
+
+
+def _encoder(field):
+    """
+    :return: A function from a value as the database gives it for the field, geometries as WKB and categorical values
+        decoded, to the bytes an archive stores.
+    """
+    kind = field.get_internal_type()
+    if hasattr(field, 'geom_type') or getattr(field, 'categorical', False):
+        return _text
+    if kind in snapshot.INTEGER_TYPES:
+        return lambda value: str(int(value))
+    if kind in snapshot.FLOAT_TYPES:
+        # repr is exact for a float; a Decimal's text is exact as it is
+        return lambda value: repr(value) if isinstance(value, float) else str(value)
+    if kind in snapshot.BOOLEAN_TYPES:
+        return lambda value: '1' if value else '0'
+    if kind == 'DateTimeField':
+        return _microseconds
+    if kind == 'DateField':
+        return lambda value: str((value - _epoch_date).days)
+    if kind == 'TimeField':
+        return lambda value: str(((value.hour * 60 + value.minute) * 60 + value.second) * 1000000 + value.microsecond)
+    return _text
+
+
+def _write(out, model, generation, using):
+    """
+    Write the rows of a model's table to an archive.
+
+    :return: The number of rows written.
+    """
+    connection = connections[using]
+    fields = model._meta.local_fields
+    names, extra, _ = export.columns(model, 'wkb', connection)
+    encoders = [_encoder(field) for field in fields]
+    header = json.dumps({'model' : model.__name__, 'generation' : generation, 'geometry' : 'wkb',
+        'fields' : [field.name for field in fields]})
+    out.write(MAGIC)
+    out.write(struct.pack('<Q', len(header)))
+    out.write(header)
+    rows = 0
+    for batch in export.rows(model._default_manager.using(using).order_by('pk'), names, extra):
+        out.write(struct.pack('<I', len(batch)))
+        for row in batch:
+            for encode, value in zip(encoders, row):
+                if value is None:
+                    out.write(struct.pack('<I', _NULL))
+                else:
+                    value = encode(value)
+                    out.write(struct.pack('<I', len(value)))
+                    out.write(value)
+        rows += len(batch)
+    out.write(struct.pack('<I', 0))
+    out.write(struct.pack('<Q', rows))
+    return rows
+
+
+def _read_rows(flo, model, batch_size):
+    """Yield the rows of an archive written by :py:func:`_write` as lists of dicts, from just past its magic."""
+    length, = struct.unpack('<Q', flo.read(8))
+    header = json.loads(flo.read(length))
+    fields = dict((f.name, f) for f in model._meta.local_fields)
+    if sorted(header['fields']) != sorted(fields):
+        raise ValueError('the fields of {name} have changed since it was archived'.format(name=model.__name__))
+    columns = [(fields[name].attname, _converter(fields[name], header['geometry'])) for name in header['fields']]
+    batch = []
+    rows = 0
+    while True:
+        count, = struct.unpack('<I', flo.read(4))
+        if not count:
+            break
+        for _ in range(count):
+            row = {}
+            for attname, convert in columns:
+                size, = struct.unpack('<I', flo.read(4))
+                if size == _NULL:
+                    row[attname] = None
+                else:
+                    value = flo.read(size)
+                    if len(value) != size:
+                        raise ValueError('the archive of {name} is truncated'.format(name=model.__name__))
+                    row[attname] = convert(value)
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        rows += count
+    if batch:
+        yield batch
+    if struct.unpack('<Q', flo.read(8))[0] != rows:
+        raise ValueError('the archive of {name} is truncated'.format(name=model.__name__))
+
+
+def archive(name):
+    """
+    Write a model's table to an archive file, drop it from the database and mark the model archived.  The table is only
+    dropped once the archive has been read back and found to hold as many rows as the table.
+
+    :param name: The name of the model.
+    :return: The path of the archive.
+    :raises ValueError: if the model can't be archived.
+    :raises ArchiveMismatch: a ValueError, if the archive doesn't read back whole.  The table is left as it was.
+    """
+    definition = get_store('models').get(name)
+    if definition is None:
+        raise ValueError('there is no model named {name}'.format(name=name))
+    if definition.get('_archived'):
+        raise ValueError('{name} is archived already'.format(name=name))
+    reason = refusal(definition)
+    if reason:
+        raise ValueError("{name} can't be archived: {reason}".format(name=name, reason=reason))
+
+    model = _get_model(name)
+    using = router.db_for_write(model)
+    connection = connections[using]
+    table = connection.ops.quote_name(model._meta.db_table)
+    generation = generations.current(name)
+    destination = path(name, generation)
+
+    with metrics.span('archive.archive', model=name):
+        with transaction.commit_on_success(using=using):
+            cursor = connection.cursor()
+            if connection.vendor == 'postgresql':
+                cursor.execute('LOCK TABLE {table} IN EXCLUSIVE MODE'.format(table=table))
+            fd, partial = tempfile.mkstemp(dir=archive_dir(), suffix='.partial')
+            os.close(fd)
+            try:
+                out = gzip.open(partial, 'wb')
+                try:
+                    rows = _write(out, model, generation, using)
+                finally:
+                    out.close()
+                cursor.execute('SELECT count(*) FROM {table}'.format(table=table))
+                expected = cursor.fetchone()[0]
+                try:
+                    found = sum(len(batch) for batch in read(partial, model))
+                except (ValueError, struct.error) as e:
+                    raise ArchiveMismatch('the archive of {name} could not be read back: {error}'.format(
+                        name=name, error=e))
+                if not rows == found == expected:
+                    raise ArchiveMismatch('the archive of {name} holds {found} rows but the table has '
+                        '{expected}'.format(name=name, found=found, expected=expected))
+                os.rename(partial, destination)
+            except Exception:
+                if os.path.exists(partial):
+                    os.unlink(partial)
+                raise
+            search.drop(model, using=using)
+            cursor.execute('DROP TABLE {table}'.format(table=table))
+            get_store('models').update(name, _archived={
+                'path' : destination, 'generation' : generation, 'rows' : rows, 'at' : time.time()})
+
+    generations.forget(name)
+    classcache.forget(name)
+    cache.set(_key(name), True, _ttl())
+    _log.info('archived {name} ({rows} rows) to {path}'.format(name=name, rows=rows, path=destination))
+    return destination
+
+
+def _datetime(value):
+    value = _epoch + datetime.timedelta(microseconds=value)
+    return value.replace(tzinfo=timezone.utc) if getattr(settings, 'USE_TZ', False) else value
+
+
+def _time(value):
+    return (_epoch + datetime.timedelta(microseconds=value)).time()
+
+
+def _converter(field, geometry='wkb'):
+    """
+    :param geometry: How the archive encodes geometries, from its header: 'wkb', or 'hex' in some older snapshots.
+    :return: A function from a value as an archive stores it to the value for the field.
+    """
+    kind = field.get_internal_type()
+    if hasattr(field, 'geom_type'):
+        from django.contrib.gis.geos import GEOSGeometry
+        if geometry == 'hex':
+            return lambda value: GEOSGeometry(value, field.srid)
+        return lambda value: GEOSGeometry(buffer(value), field.srid)
+    if getattr(field, 'categorical', False):
+        return lambda value: value.decode('utf-8')
+    if kind in snapshot.INTEGER_TYPES:
+        return int
+    if kind in snapshot.BOOLEAN_TYPES:
+        return lambda value: bool(int(value))
+    if kind == 'DecimalField':
+        # snapshots hold decimals as doubles
+        return lambda value: Decimal(repr(value) if isinstance(value, float) else value)
+    if kind in snapshot.FLOAT_TYPES:
+        return float
+    if kind == 'DateTimeField':
+        return lambda value: _datetime(int(value))
+    if kind == 'DateField':
+        return lambda value: _epoch_date + datetime.timedelta(days=int(value))
+    if kind == 'TimeField':
+        return lambda value: _time(int(value))
+    return lambda value: value.decode('utf-8')
+
+
+def read(filename, model, batch_size=BATCH_SIZE):
+    """
+    Yield the rows of an archive as lists of dicts from the model's field attnames to values.
+
+    :param filename: The path of the archive.
+    :param model: The model class it was written from.
+    :param batch_size: How many rows to yield at a time.
+    :raises ValueError: if the archive is damaged or doesn't fit the model.
+    """
+    with tempfile.TemporaryFile(dir=archive_dir()) as flo:
+        compressed = gzip.open(filename, 'rb')
+        try:
+            shutil.copyfileobj(compressed, flo, snapshot.CHUNK_SIZE)
+        finally:
+            compressed.close()
+        flo.seek(0)
+        magic = flo.read(len(MAGIC))
+        rows = _read_rows(flo, model, batch_size) if magic == MAGIC else _read_snapshot(flo, model, batch_size)
+        for batch in rows:
+            yield batch
+
+
+# Archives written as snapshots by earlier versions
+
+def _unpack(dtype, data, count):
+    if dtype.startswith('|S'):
+        width = int(dtype[2:])
+        return [data[i * width:(i + 1) * width].rstrip('\0') for i in range(count)]
+    code = {'|b1' : '?', '<f8' : 'd'}.get(dtype, 'q')
+    return struct.unpack('<{count}{code}'.format(count=count, code=code), data)
+
+
+def _itemsize(dtype):
+    if dtype.startswith('|S'):
+        return int(dtype[2:])
+    return 1 if dtype == '|b1' else 8
+
+
+def _read_snapshot(flo, model, batch_size):
+    fields = dict((f.name, f) for f in model._meta.local_fields)
+    header, data_start = snapshot.read_header(flo)
+    masks = dict((c['field'], c) for c in header['columns'] if c['name'] != c['field'])
+    columns = [(fields[c['field']], c, masks.get(c['field'])) for c in header['columns']
+        if c['name'] == c['field'] and c['field'] in fields]
+
+    def column_values(column, start, count):
+        size = _itemsize(column['dtype'])
+        flo.seek(data_start + column['offset'] + start * size)
+        return _unpack(column['dtype'], flo.read(count * size), count)
+
+    for start in range(0, header['rows'], batch_size):
+        count = min(batch_size, header['rows'] - start)
+        batch = [{} for _ in range(count)]
+        for field, column, mask in columns:
+            convert = _converter(field, header['geometry'])
+            nulls = column_values(mask, start, count) if mask else [False] * count
+            for row, value, null in zip(batch, column_values(column, start, count), nulls):
+                row[field.attname] = None if null else convert(value)
+        yield batch
+
+
+def restore(name):
+    """
+    Load an archived model back into a new table, and rebuild what goes with it.  Called by the restore task.
+
+    :param name: The name of the model.
+    :return: The number of rows restored, or None if the model isn't archived.
+    """
+    from ga_dynamic_models import reloader
+
+    definition = get_store('models').get(name)
+    if definition is None or not definition.get('_archived'):
+        return None
+    archived = definition['_archived']
+    # workers don't build archived models, so build this one here
+    model = Parser(DYNAMIC_MODULE, ModelBase).parse(**definition)
+    using = router.db_for_write(model)
+    connection = connections[using]
+    style = no_style()
+    # bulk inserts on SQLite are limited to 999 parameters
+    batch_size = max(1, 999 // len(model._meta.local_fields)) if connection.vendor == 'sqlite' else BATCH_SIZE
+    rows = 0
+
+    with metrics.span('archive.restore', model=name):
+        with transaction.commit_on_success(using=using):
+            cursor = connection.cursor()
+            statements, _ = connection.creation.sql_create_model(model, style)
+            for sql in statements + connection.creation.sql_indexes_for_model(model, style):
+                cursor.execute(sql)
+            for batch in read(archived['path'], model, batch_size):
+                model._default_manager.using(using).bulk_create([model(**values) for values in batch])
+                rows += len(batch)
+            for sql in connection.ops.sequence_reset_sql(style, [model]):
+                cursor.execute(sql)
+            get_store('models').update(name, _archived=None)
+
+    cache.set(_key(name), False, _ttl())
+    generations.bump(name)
+    counting.record(model, rows)
+    search.build(model)
+    try:
+        os.unlink(archived['path'])
+    except OSError:
+        pass
+    _log.info('restored {name} ({rows} rows) from {path}'.format(name=name, rows=rows, path=archived['path']))
+    reloader.request_reload()
+    return rows
+
+
+def request_restore(name):
+    """
+    Start restoring an archived model in the background, unless that has been started already in the last
+    GA_DYNAMIC_MODELS_RESTORE_TIMEOUT seconds (an hour by default).
+
+    :return: Whether this call started it.
+    """
+    from ga_dynamic_models import tasks
+
+    if not is_archived(name) or not cache.add(_restore_key(name), time.time(), restore_timeout()):
+        return False
+    tasks.restore_model.delay(name)
+    return True
+
+
+def restored(name):
+    """Let the model be restored again.  Called by the restore task when it finishes, however it finishes."""
+    cache.delete(_restore_key(name))
+
+
+def unavailable(name):
+    """
+    Answer a request for an archived model: start restoring it, and tell the client to come back.
+
+    :return: A 503 response with a Retry-After header.
+    """
+    usage.touch(name)
+    request_restore(name)
+    response = HttpResponse(json.dumps({'error' : '{name} is archived and is being restored'.format(name=name)}),
+        content_type='application/json', status=503)
+    response['Retry-After'] = str(retry_after())
+    return response
+
+
+def discard(name):
+    """Delete a model's archive file and its dictionaries.  Called when an archived model is dropped or declared again."""
+    definition = get_store('models').get(name)
+    archived = definition.get('_archived') if definition else None
+    if archived:
+        categorical.drop(Parser(DYNAMIC_MODULE, ModelBase).parse(**definition))
+        try:
+            os.unlink(archived['path'])
+        except OSError:
+            pass
+    cache.delete(_key(name))
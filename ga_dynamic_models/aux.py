@@ -7,5 +7,6 @@ which generally contains helper functions for creating parse-able entities.
 from tastypie.constants import ALL
 
 def universal_filter(model):
-    """Make APIs allow filtering on ALL fields.  This is dangerous for large tables."""
+    """Make APIs allow filtering on ALL fields.  This is dangerous for large tables; see the filter allowlist in
+    :py:mod:`ga_dynamic_models.querylog`."""
     return dict([(f.name, ALL) for f in model._meta.fields])
\ No newline at end of file
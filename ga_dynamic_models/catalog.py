@@ -0,0 +1,26 @@
+"""
+Tables for :py:class:`ga_dynamic_models.stores.SQLDefinitionStore`.  These are ordinary, static Django models.  They are
+imported by :py:mod:`ga_dynamic_models.models` so that syncdb creates them alongside everything else.
+"""
+
+from django.db import models
+
+
+class Definition(models.Model):
+    kind = models.CharField(max_length=16, db_index=True)
+    name = models.CharField(max_length=255)
+    revision = models.IntegerField()
+    document = models.TextField()
+
+    class Meta:
+        app_label = 'ga_dynamic_models'
+        unique_together = (('kind', 'name'),)
+
+
+class DefinitionChange(models.Model):
+    kind = models.CharField(max_length=16, db_index=True)
+    name = models.CharField(max_length=255)
+    deleted = models.BooleanField(default=False)
+
+    class Meta:
+        app_label = 'ga_dynamic_models'
@@ -0,0 +1,331 @@
+"""
+Dictionary encoded categorical columns.
+
+A column of an uploaded table that holds a few distinct strings repeated over and over, such as county names, can be
+given the datatype ``Categorical`` in the second header row of the CSV (``*Categorical`` to index it).  It is then
+stored as a :py:class:`CategoricalField`: a small integer code in the model's table, plus a *dictionary* table of its
+own that maps each code to its string.  The dictionary is named after the model's table and the column, as in
+``my_table__county``, and created the first time a value is encoded.
+
+The loader encodes a batch of values at a time, adding the strings it hasn't seen to the dictionary in a single insert.
+The dictionary table stays locked against other additions until the load's transaction ends, so concurrent loads that
+bring new strings to the same column take turns.
+A value keeps its code for the life of the model, across replacing loads, so rollups and cached responses remain
+consistent.
+
+Everything outside the table sees the strings:
+
+    * Model instances hold the string, and filtering with ``exact`` and ``in`` encodes the values given.
+    * Dynamic resources turn the other text lookups (``icontains``, ``startswith`` and so on) into an ``in`` over the
+      matching codes, and order by the string rather than the code.
+    * Exports, snapshots and aggregates decode the codes, in the database where they can.
+
+A dictionary holds at most 32,767 strings.  A column with more distinct values than that isn't categorical and should
+be a CharField.
+"""
+
+from django.db import connections, router, DatabaseError
+from django.db import models
+from django.db.backends.util import truncate_name
+from logging import getLogger
+import threading
+import time
+import re
+
+_log = getLogger(__name__)
+
+MAX_CODE = 32767
+
+# Text lookups that dynamic resources answer from the dictionary, and how to test a value against each of them.
+TEXT_LOOKUPS = {
+    'iexact' : lambda value, given: value.lower() == given.lower(),
+    'contains' : lambda value, given: given in value,
+    'icontains' : lambda value, given: given.lower() in value.lower(),
+    'startswith' : lambda value, given: value.startswith(given),
+    'istartswith' : lambda value, given: value.lower().startswith(given.lower()),
+    'endswith' : lambda value, given: value.endswith(given),
+    'iendswith' : lambda value, given: value.lower().endswith(given.lower()),
+    'regex' : lambda value, given: re.search(given, value) is not None,
+    'iregex' : lambda value, given: re.search(given, value, re.I) is not None,
+    'gt' : lambda value, given: value > given,
+    'gte' : lambda value, given: value >= given,
+    'lt' : lambda value, given: value < given,
+    'lte' : lambda value, given: value <= given,
+}
+
+
+class Dictionary(object):
+    """
+    The codes and strings of one categorical column, read from its dictionary table and kept in the process.
+
+    :param table: The name of the dictionary table.
+    :param using: The database alias it lives in.
+    """
+
+    # How often a string that isn't in the dictionary may send us back to the database to look for it.
+    reload_interval = 1.0
+
+    def __init__(self, table, using):
+        self.table = table
+        self.using = using
+        self.codes = {}
+        self.values = {}
+        self.loaded_at = 0
+        self.lock = threading.Lock()
+
+    @property
+    def connection(self):
+        return connections[self.using]
+
+    def quoted(self):
+        return self.connection.ops.quote_name(self.table)
+
+    def exists(self):
+        return self.table in self.connection.introspection.table_names()
+
+    def create(self, cursor):
+        cursor.execute('CREATE TABLE IF NOT EXISTS {table} (code integer PRIMARY KEY, value varchar(255) NOT NULL '
+            'UNIQUE)'.format(table=self.quoted()))
+
+    def lock_table(self, cursor):
+        """
+        Keep other transactions from adding to the dictionary until this one ends.  Readers aren't blocked.  On
+        PostgreSQL this takes a lock on the table; SQLite already lets only one transaction write at a time, and the
+        table's unique constraints make any other database refuse a conflicting insert rather than accept it.
+        """
+        if self.connection.vendor == 'postgresql':
+            cursor.execute('LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE'.format(table=self.quoted()))
+
+    def reload(self):
+        codes, values = {}, {}
+        if self.exists():
+            cursor = self.connection.cursor()
+            cursor.execute('SELECT code, value FROM {table}'.format(table=self.quoted()))
+            for code, value in cursor.fetchall():
+                codes[value] = code
+                values[code] = value
+        self.codes, self.values = codes, values
+        self.loaded_at = time.time()
+
+    def clear(self):
+        """Forget what has been read, as after a load that added codes is rolled back."""
+        self.codes, self.values = {}, {}
+        self.loaded_at = 0
+
+    def _reload_if_stale(self):
+        if time.time() - self.loaded_at >= self.reload_interval:
+            self.reload()
+            return True
+        return False
+
+    def decode(self, code):
+        """
+        :return: The string for a code, or None if there is no such code.
+        """
+        value = self.values.get(code)
+        if value is None and code is not None:
+            self.reload()
+            value = self.values.get(code)
+        return value
+
+    def code(self, value):
+        """
+        :return: The code for a string, or None if the string isn't in the dictionary.
+        """
+        if isinstance(value, str):
+            value = value.decode('utf-8')
+        code = self.codes.get(value)
+        if code is None and self._reload_if_stale():
+            code = self.codes.get(value)
+        return code
+
+    def encode(self, values):
+        """
+        Give codes to strings, adding the ones that aren't in the dictionary yet.  The additions are made on the
+        dictionary's connection and so belong to whatever transaction it is in.
+
+        Codes are handed out in the database, not just in this process: the dictionary table is locked (see
+        :py:meth:`lock_table`) and read again before the new strings are inserted, so two loads of the same model in
+        different processes can't give the same code to different strings.
+
+        :param values: An iterable of strings.
+        :return: A dict from each of the strings to its code.
+        """
+        values = set(v.decode('utf-8') if isinstance(v, str) else v for v in values if v is not None)
+        with self.lock:
+            new = [v for v in values if v not in self.codes]
+            if new:
+                cursor = self.connection.cursor()
+                self.create(cursor)
+                self.lock_table(cursor)
+                self.reload()
+                new = sorted(v for v in new if v not in self.codes)
+            if new:
+                first = max(self.values) + 1 if self.values else 0
+                if first + len(new) > MAX_CODE:
+                    raise ValueError('{table} would have more than {max} values; use a CharField instead'.format(
+                        table=self.table, max=MAX_CODE))
+                added = zip(range(first, first + len(new)), new)
+                cursor.executemany('INSERT INTO {table} (code, value) VALUES (%s, %s)'.format(table=self.quoted()),
+                    added)
+                for code, value in added:
+                    self.codes[value] = code
+                    self.values[code] = value
+            return dict((v, self.codes[v]) for v in values)
+
+    def matching(self, lookup, given):
+        """
+        :param lookup: One of TEXT_LOOKUPS.
+        :param given: The value given with the lookup.
+        :return: The sorted codes of the strings that match.
+        """
+        self._reload_if_stale()
+        test = TEXT_LOOKUPS[lookup]
+        return sorted(code for value, code in self.codes.items() if test(value, given))
+
+    def drop(self):
+        if self.exists():
+            self.connection.cursor().execute('DROP TABLE {table}'.format(table=self.quoted()))
+        self.clear()
+
+
+_dictionaries = {}
+_lock = threading.Lock()
+
+
+def table_name(model, field, connection):
+    name = '{table}__{column}'.format(table=model._meta.db_table, column=field.column)
+    return truncate_name(name, connection.ops.max_name_length())
+
+
+def dictionary(model, field, using=None):
+    """
+    :param model: A model class.
+    :param field: One of its :py:class:`CategoricalField` fields.
+    :param using: The database alias; by default the router's choice for writes to the model.
+    :return: The field's :py:class:`Dictionary`.
+    """
+    using = using or router.db_for_write(model)
+    table = table_name(model, field, connections[using])
+    with _lock:
+        if (using, table) not in _dictionaries:
+            _dictionaries[(using, table)] = Dictionary(table, using)
+        return _dictionaries[(using, table)]
+
+
+def categorical_fields(model):
+    return [f for f in model._meta.local_fields if getattr(f, 'categorical', False)]
+
+
+def decode_sql(model, field, connection):
+    """
+    :return: An SQL expression for the string of a categorical field, for use in ``extra(select=...)``.
+    """
+    qn = connection.ops.quote_name
+    return '(SELECT value FROM {dictionary} WHERE code = {table}.{column})'.format(
+        dictionary=qn(table_name(model, field, connection)), table=qn(model._meta.db_table), column=qn(field.column))
+
+
+class CategoricalField(models.SmallIntegerField):
+    """A string stored as a small integer code into a dictionary table."""
+
+    __metaclass__ = models.SubfieldBase
+
+    description = "A categorical string, stored as a code into a dictionary table"
+    categorical = True
+
+    def dictionary(self):
+        return dictionary(self.model, self)
+
+    def to_python(self, value):
+        if isinstance(value, (int, long)):
+            return self.dictionary().decode(value)
+        return value
+
+    def get_prep_value(self, value):
+        if value is None or isinstance(value, (int, long)):
+            return value
+        code = self.dictionary().code(value)
+        return code if code is not None else -1  # no row has this code, so nothing matches
+
+    def get_db_prep_save(self, value, connection):
+        if value is None or isinstance(value, (int, long)):
+            return value
+        return self.dictionary().encode([value]).values()[0]
+
+    def get_prep_lookup(self, lookup_type, value):
+        if lookup_type not in ('exact', 'in', 'isnull'):
+            raise ValueError("{name} is categorical and can't be filtered with {lookup}".format(
+                name=self.name, lookup=lookup_type))
+        return super(CategoricalField, self).get_prep_lookup(lookup_type, value)
+
+
+def rewrite_filters(model, filters):
+    """
+    Replace text lookups on categorical fields with ``in`` lookups over the codes that match.
+
+    :param model: A model class.
+    :param filters: A dict of ORM lookups to values, as built by a resource's ``build_filters``.
+    :return: The rewritten dict.
+    """
+    fields = dict((f.name, f) for f in categorical_fields(model))
+    if not fields:
+        return filters
+    rewritten = {}
+    for key, value in filters.items():
+        parts = key.split('__')
+        if parts[0] in fields and len(parts) == 2 and parts[1] in TEXT_LOOKUPS:
+            codes = fields[parts[0]].dictionary().matching(parts[1], value)
+            key = parts[0] + '__in'
+            if key in rewritten:
+                codes = sorted(set(codes) & set(rewritten[key]))
+            value = codes or [-1]
+        rewritten[key] = value
+    return rewritten
+
+
+def order_by_value(queryset):
+    """
+    :return: The queryset, ordered by the strings of any categorical fields it is ordered by instead of their codes.
+    """
+    fields = dict((f.name, f) for f in categorical_fields(queryset.model))
+    order_by = list(queryset.query.order_by)
+    if not fields or not any(term.lstrip('-') in fields for term in order_by):
+        return queryset
+    connection = connections[queryset.db]
+    select = {}
+    terms = []
+    for term in order_by:
+        name = term.lstrip('-')
+        if name in fields:
+            alias = '{name}__text'.format(name=name)
+            select[alias] = decode_sql(queryset.model, fields[name], connection)
+            term = term[:len(term) - len(name)] + alias
+        terms.append(term)
+    return queryset.extra(select=select).order_by(*terms)
+
+
+def decode_rows(model, names, rows):
+    """
+    Decode the categorical fields among ``names`` in a list of dicts, such as ``values()`` returns, and sort the rows by
+    those names.
+    """
+    fields = [f for f in categorical_fields(model) if f.name in names]
+    if not fields:
+        return rows
+    for field in fields:
+        d = field.dictionary()
+        for row in rows:
+            row[field.name] = d.decode(row[field.name])
+    rows.sort(key=lambda row: tuple(row[name] for name in names))
+    return rows
+
+
+def drop(model):
+    """Drop the dictionary tables of a model's categorical fields."""
+    for field in categorical_fields(model):
+        try:
+            dictionary(model, field).drop()
+        except DatabaseError:
+            _log.exception('could not drop the dictionary of {name}.{field}'.format(
+                name=model.__name__, field=field.name))
@@ -0,0 +1,344 @@
+"""
+A bounded cache of the classes of dynamic models and their resources, for catalogs too big to keep every class in every
+worker.
+
+By default a worker builds the class of every dynamic model and resource when it starts (see
+:py:mod:`ga_dynamic_models.models` and :py:mod:`ga_dynamic_models.api`) and keeps them for the life of the process,
+which with tens of thousands of definitions costs hundreds of MB per worker.  Turn the cache on in settings::
+
+    GA_DYNAMIC_MODELS_CLASS_CACHE = {
+        'MAX_ENTRIES' : 2000,
+        'MAX_MB' : 200,
+    }
+
+and workers build nothing up front:
+
+    * :py:mod:`ga_dynamic_models.models` lists the names of the models in ``__all__``, and builds a model's class the
+      first time it is asked for, as ``models.Permits`` or with :py:func:`ga_dynamic_models.utils.get_model`.
+    * :py:mod:`ga_dynamic_models.api` registers a :py:class:`ga_dynamic_models.resources.LazyResource` for each resource
+      of a dynamic model, which builds the real resource (and its model) on its first request and hands every request
+      to it.
+    * A model is registered with the admin when it is built, if the admin is installed.  The admin only has pages for
+      the models that were built when its URLs were first loaded.
+
+Each entry holds a model's class and the resources built over it.  When there are more than ``MAX_ENTRIES`` entries, or
+their estimated size passes ``MAX_MB`` megabytes, the least recently used are evicted: the model is taken out of
+Django's app registry and the admin, and its resources are dropped, so that nothing refers to them and they can be
+garbage collected.  Requests already using them finish normally.  An entry's size is estimated when it is built, by
+adding up the objects reachable from its classes that belong to no other class or module.  Either limit may be left
+out.
+
+Hits, misses and evictions are counted; :py:func:`stats` reports them along with the size of the cache, and the
+``metrics/`` endpoint serves them.  The worker that declares or drops a model forgets its classes; other workers pick up
+the change when they are reloaded, as before.
+"""
+
+from django.conf import settings
+from django.db.models.base import ModelBase
+from django.db.models.loading import cache as app_cache
+from ga_dynamic_models.stores import get_store
+from ga_dynamic_models.parser import Parser
+from ga_dynamic_models import metrics
+from collections import OrderedDict
+from logging import getLogger
+import threading
+import types
+import gc
+import sys
+
+_log = getLogger(__name__)
+
+DYNAMIC_MODULE = 'ga_dynamic_models.models'
+API_MODULE = 'ga_dynamic_models.api'
+
+# Stop estimating an entry's size after this many objects.
+MAX_WALK = 200000
+
+_SHARED = (types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.CodeType, types.FrameType)
+
+
+def _settings():
+    return getattr(settings, 'GA_DYNAMIC_MODELS_CLASS_CACHE', None)
+
+
+def enabled():
+    return _settings() is not None
+
+
+def model_of(definition):
+    """
+    :return: The name of the dynamic model a resource definition serves, or None.
+    """
+    queryset = definition.get('meta', {}).get('queryset')
+    if isinstance(queryset, dict) and queryset.get('module') == DYNAMIC_MODULE:
+        return queryset.get('model')
+    return None
+
+
+def footprint(roots):
+    """
+    Estimate the memory held by some classes and the objects only they refer to.
+
+    :param roots: The classes and instances to start from.  Other classes, modules and functions are taken to belong to
+        someone else.
+    :return: The size in bytes.
+    """
+    own = set(id(root) for root in roots)
+    seen = set()
+    pending = list(roots)
+    size = 0
+    while pending and len(seen) < MAX_WALK:
+        obj = pending.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, _SHARED) or (isinstance(obj, type) and id(obj) not in own):
+            continue
+        size += sys.getsizeof(obj, 0)
+        pending.extend(gc.get_referents(obj))
+    return size
+
+
+def _register_admin(model):
+    if 'django.contrib.admin' in settings.INSTALLED_APPS:
+        from ga_dynamic_models.admin import register
+        register(model)
+
+
+def _unregister(model):
+    """Take a model out of Django's app registry and the admin."""
+    if 'django.contrib.admin' in settings.INSTALLED_APPS:
+        from django.contrib import admin
+        if model in admin.site._registry:
+            admin.site.unregister(model)
+    app_cache.write_lock.acquire()
+    try:
+        app_cache.app_models.get(model._meta.app_label, {}).pop(model._meta.object_name.lower(), None)
+        app_cache._get_models_cache.clear()
+    finally:
+        app_cache.write_lock.release()
+
+
+class _Entry(object):
+    def __init__(self, model):
+        self.model = model
+        self.resources = {}
+        self.size = 0
+
+    def roots(self):
+        roots = [self.model]
+        for resource in self.resources.values():
+            roots.extend([resource, type(resource), type(resource._meta)])
+        return roots
+
+
+class ClassCache(object):
+    """
+    The least recently used dynamic model classes, and the resources over them.
+
+    Classes are built and measured outside the cache's lock, which is only held to look entries up, insert them and
+    evict them, so that a slow build doesn't hold up every other request.  If two threads build the same class at once,
+    the first to insert it wins and the other uses its class.
+
+    :param max_entries: The most models to keep, or None for no limit.
+    :param max_bytes: The most estimated bytes to keep, or None for no limit.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # how many times a model has been forgotten, so that a class built from a definition that changed while it was
+        # being built isn't kept
+        self.forgotten = {}
+        self.lock = threading.Lock()
+
+    def _hit(self, name):
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            self.entries[name] = entry
+        return entry
+
+    def _entry(self, name):
+        with self.lock:
+            entry = self._hit(name)
+            if entry is not None:
+                self.hits += 1
+                metrics.incr('class_cache.hit')
+                return entry
+            self.misses += 1
+            forgotten = self.forgotten.get(name, 0)
+        metrics.incr('class_cache.miss', model=name)
+
+        definition = get_store('models').get(name)
+        if definition is None or definition.get('_archived'):
+            raise LookupError('there is no model named {name}'.format(name=name))
+        with metrics.span('catalog.parse', model=name):
+            model = Parser(DYNAMIC_MODULE, ModelBase).parse(**definition)
+        entry = _Entry(model)
+        entry.size = footprint(entry.roots())
+
+        with self.lock:
+            existing = self._hit(name)
+            if existing is not None:
+                return existing
+            if self.forgotten.get(name, 0) != forgotten:
+                # the definition changed while the class was being built from it
+                _unregister(model)
+                stale = True
+            else:
+                _register_admin(model)
+                self.entries[name] = entry
+                self.bytes += entry.size
+                self._shrink()
+                stale = False
+        return self._entry(name) if stale else entry
+
+    def _shrink(self):
+        while len(self.entries) > 1 and (
+                (self.max_entries is not None and len(self.entries) > self.max_entries) or
+                (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            name = next(iter(self.entries))
+            self._evict(name)
+            self.evictions += 1
+            metrics.incr('class_cache.evict', model=name)
+
+    def _evict(self, name):
+        entry = self.entries.pop(name)
+        self.bytes -= entry.size
+        _unregister(entry.model)
+
+    def model(self, name):
+        """
+        :return: The class of a dynamic model, built if it isn't in the cache.
+        :raises LookupError: if there is no such model, or it is archived.
+        """
+        return self._entry(name).model
+
+    def resource(self, definition):
+        """
+        :param definition: The definition of a resource of a dynamic model.
+        :return: An instance of the resource, built if it isn't in the cache.
+        """
+        from tastypie.resources import ModelDeclarativeMetaclass
+
+        name = definition['name']
+        entry = self._entry(model_of(definition))
+        with self.lock:
+            resource = entry.resources.get(name)
+        if resource is not None:
+            return resource
+
+        with metrics.span('api.register', resource=name):
+            cls = Parser(API_MODULE, ModelDeclarativeMetaclass).parse(**definition)
+        resource = cls()
+        # the model's class is a type of its own, so it isn't counted again
+        size = footprint([resource, type(resource), type(resource._meta)])
+
+        with self.lock:
+            if name in entry.resources:
+                return entry.resources[name]
+            entry.resources[name] = resource
+            # an entry evicted in the meantime no longer counts towards the cache's size
+            if self.entries.get(model_of(definition)) is entry:
+                entry.size += size
+                self.bytes += size
+                self._shrink()
+        return resource
+
+    def forget(self, name):
+        """Drop a model's classes, as after its definition has changed."""
+        with self.lock:
+            self.forgotten[name] = self.forgotten.get(name, 0) + 1
+            if name in self.entries:
+                self._evict(name)
+
+    def stats(self):
+        """
+        :return: A JSON serializable dict of the cache's size, limits, hits, misses and evictions.
+        """
+        with self.lock:
+            return {
+                'entries' : len(self.entries),
+                'bytes' : self.bytes,
+                'max_entries' : self.max_entries,
+                'max_bytes' : self.max_bytes,
+                'hits' : self.hits,
+                'misses' : self.misses,
+                'evictions' : self.evictions,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """The process's class cache, created from settings on first use."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            configured = _settings() or {}
+            max_mb = configured.get('MAX_MB')
+            _cache = ClassCache(configured.get('MAX_ENTRIES'), max_mb * 1024 * 1024 if max_mb is not None else None)
+        return _cache
+
+
+def get_model(name):
+    """
+    :return: The class of a dynamic model.
+    :raises LookupError: if there is no such model.
+    """
+    return get_cache().model(name)
+
+
+def get_resource(definition):
+    """:return: An instance of the resource a definition declares."""
+    return get_cache().resource(definition)
+
+
+def forget(name):
+    """Drop a model's classes from the cache, if it is on."""
+    if enabled():
+        get_cache().forget(name)
+
+
+def stats():
+    """:return: The cache's statistics, or None if it is off."""
+    return get_cache().stats() if enabled() else None
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stands in for :py:mod:`ga_dynamic_models.models` when the cache is on.  Looking up a model's name on it gets the
+    class from the cache.  ``__getattribute__`` is overridden rather than ``__getattr__`` because the parser calls it
+    directly.
+    """
+
+    def __getattribute__(self, name):
+        try:
+            return types.ModuleType.__getattribute__(self, name)
+        except AttributeError:
+            if name.startswith('_'):
+                raise
+            try:
+                return get_model(name)
+            except LookupError:
+                raise AttributeError(name)
+
+
+def install(module):
+    """
+    Put a :py:class:`LazyModule` in the place of a module.  Called from the module itself as it is imported.
+
+    :param module: The module.
+    :return: The lazy module.
+    """
+    lazy = LazyModule(module.__name__, module.__doc__)
+    lazy.__dict__.update(module.__dict__)
+    sys.modules[module.__name__] = lazy
+    return lazy
@@ -0,0 +1,124 @@
+"""
+Row counts for dynamic model tables that don't always cost a full scan.
+
+Every paginated list response carries a total count, and on a big PostgreSQL table ``COUNT(*)`` reads the whole table.
+:py:func:`count` picks a strategy per query:
+
+    * Unfiltered queries use the row count the loader recorded after the last upload (see :py:func:`record`), or failing
+      that PostgreSQL's ``reltuples`` estimate.
+    * Filtered queries on PostgreSQL ask the planner how many rows it expects.
+    * Whenever the estimate is below ``GA_DYNAMIC_MODELS_EXACT_COUNT_THRESHOLD`` (50,000 by default), or there is no
+      estimate to be had, the query is counted exactly.
+
+The second value returned says whether the count is exact, and paginators put it in the response meta as
+``total_count_exact``.  Recorded counts are kept in the model's definition and cached for
+``GA_DYNAMIC_MODELS_ROW_COUNT_TIMEOUT`` seconds (a day by default).
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, router, DatabaseError
+from ga_dynamic_models.stores import get_store
+import json
+import time
+
+
+def threshold():
+    return getattr(settings, 'GA_DYNAMIC_MODELS_EXACT_COUNT_THRESHOLD', 50000)
+
+
+def timeout():
+    """How long, in seconds, a recorded row count stays in the cache before it is read from the definition again."""
+    return getattr(settings, 'GA_DYNAMIC_MODELS_ROW_COUNT_TIMEOUT', 24 * 3600)
+
+
+def _cache_key(model):
+    return 'ga_dynamic_models:count:{name}'.format(name=model.__name__)
+
+
+def record(model, rows):
+    """
+    Remember the number of rows in a model's table.  Called by the loader after every load.
+
+    :param model: The model class.
+    :param rows: The number of rows in its table.
+    """
+    cache.set(_cache_key(model), rows, timeout())
+    get_store('models').update(model.__name__, _row_count=rows, _counted_at=time.time())
+
+
+def recorded(model):
+    """
+    :param model: The model class.
+    :return: The row count recorded by the last load, or None.
+    """
+    rows = cache.get(_cache_key(model))
+    if rows is None:
+        definition = get_store('models').get(model.__name__)
+        rows = definition.get('_row_count') if definition else None
+        if rows is not None:
+            cache.set(_cache_key(model), rows, timeout())
+    return rows
+
+
+def is_filtered(queryset):
+    query = queryset.query
+    return bool(query.where) or bool(query.having) or bool(query.distinct) or \
+        query.low_mark != 0 or query.high_mark is not None
+
+
+def planner_estimate(queryset):
+    """
+    Ask PostgreSQL how many rows a query will return, without running it.
+
+    :return: The planner's estimate, or None if the database isn't PostgreSQL or there is no estimate.
+    """
+    using = queryset.db
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return None
+
+    cursor = connection.cursor()
+    try:
+        if not is_filtered(queryset):
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+                [connection.ops.quote_name(queryset.model._meta.db_table)])
+            row = cursor.fetchone()
+            return int(row[0]) if row and row[0] > 0 else None
+
+        sql, params = queryset.query.sql_with_params()
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+    except DatabaseError:
+        return None
+
+
+def count(queryset):
+    """
+    Count the rows in a queryset as cheaply as its size allows.
+
+    :param queryset: A queryset over a dynamic model.
+    :return: A tuple of (count, exact).
+    """
+    estimate = None
+    if not is_filtered(queryset):
+        estimate = recorded(queryset.model)
+    if estimate is None:
+        estimate = planner_estimate(queryset)
+    if estimate is None or estimate < threshold():
+        return queryset.count(), True
+    return estimate, False
+
+
+def refresh(model, using=None):
+    """
+    Count a model's table exactly and record the result.
+
+    :return: The row count.
+    """
+    rows = model.objects.using(using or router.db_for_read(model)).count()
+    record(model, rows)
+    return rows
@@ -0,0 +1,497 @@
+"""
+Derived dynamic models: a filter, join or aggregation over other dynamic models, materialized in a table of its own.
+
+A derived model is declared with :py:func:`ga_dynamic_models.utils.derived_model` and exposed like any other model::
+
+    declare_model(derived_model('PermitsByCounty', 'Permits',
+        filters={'issued__gte' : '2010-01-01'},
+        joins=[join('Counties', on={'county' : 'name'}, fields=['population'])],
+        group_by=['county', 'population'],
+        metrics=['count', 'avg:valuation']), syncdb=True)
+    declare_resource(simple_model_resource('ga_dynamic_models.models', 'PermitsByCounty', 'permits_by_county'))
+
+Its fields are copied from the definitions of the models it reads.  An aggregation has a field for each ``group_by``
+column and one per metric, named as on the aggregate endpoint (``count``, ``avg_valuation``; see
+:py:mod:`ga_dynamic_models.aggregation`).  Without ``group_by`` or ``metrics`` it holds the source rows that match its
+filters, under their primary keys in the source, with the source columns listed in ``fields`` (all of them by default)
+and the columns taken from each joined model.  Joins are inner joins on equal columns, compared as stored, so a
+categorical column (see :py:mod:`ga_dynamic_models.categorical`) can't be joined on.
+
+Its rows are the result of a single ``INSERT ... SELECT``, run when the model is declared and again after every load
+of a model it reads.  After an appending load of the source only the new rows are read: a filter adds the ones that
+match, and an aggregation over source columns recomputes just the groups they fall in.  Anything else, such as a
+replacing load or a load of a joined model, rebuilds the table in one transaction, so readers see the old rows until
+the new ones are in.  The data generations (see :py:mod:`ga_dynamic_models.generations`) of the models it was last
+materialized from are kept in its definition, and :py:func:`refresh_stale`, or the ``refresh_derived`` management
+command, catches up derived models whose sources changed some other way.
+
+On PostgreSQL, ``storage='view'`` keeps the rows in a materialized view instead, refreshed with ``REFRESH MATERIALIZED
+VIEW CONCURRENTLY``.  That always recomputes everything, but never blocks readers.  Elsewhere a table is used.
+
+Rows written to a derived model through its resource are lost at its next refresh.
+"""
+
+from django.conf import settings
+from django.db import connection, connections, router, transaction
+from django.db.models import Q, Max
+from ga_dynamic_models.stores import get_store
+from ga_dynamic_models import generations
+from ga_dynamic_models import counting
+from ga_dynamic_models import metrics
+from ga_dynamic_models import aggregation
+from ga_dynamic_models import snapshot
+from ga_dynamic_models import search
+from ga_dynamic_models import categorical
+from logging import getLogger
+import copy
+import time
+
+_log = getLogger(__name__)
+
+STORAGES = ('table', 'view')
+GEO_MODULE = 'django.contrib.gis.db.models'
+INCREMENTAL_KEYS = ('AutoField', 'IntegerField', 'BigIntegerField')
+
+
+def _get_model(name):
+    from ga_dynamic_models.utils import get_model
+    return get_model(name)
+
+
+def max_incremental_groups():
+    """Past this many groups touched by an append, an aggregation is rebuilt rather than patched."""
+    return getattr(settings, 'GA_DYNAMIC_MODELS_DERIVED_MAX_GROUPS', 1000)
+
+
+def _definition(name):
+    definition = get_store('models').get(name)
+    if definition is None:
+        raise ValueError('there is no model named {name}'.format(name=name))
+    return definition
+
+
+def _field(definition, name):
+    """
+    :return: A copy of the **field** a model's definition declares for ``name``, fit to hold the column's values in
+        another table.
+    """
+    fields = definition.get('fields', {})
+    if name == 'objects' or name not in fields:
+        raise ValueError('{model} has no field {name}'.format(model=definition['name'], name=name))
+    field = copy.deepcopy(fields[name])
+    keywords = field.setdefault('parameters', {}).setdefault('keywords', {})
+    for keyword in ('primary_key', 'unique', 'db_column'):
+        keywords.pop(keyword, None)
+    return field
+
+
+def _kind(field):
+    return field.get('callable')
+
+
+def _plain_field(kind, **keywords):
+    return {
+        'type' : 'callable',
+        'module' : 'django.db.models',
+        'callable' : kind,
+        'parameters' : { 'positionals' : [], 'keywords' : keywords }
+    }
+
+
+def spec(source, filters=None, fields=None, joins=None, group_by=None, metrics=None, storage='table'):
+    """
+    Check and normalize the declaration of a derived model.  See :py:func:`ga_dynamic_models.utils.derived_model`.
+
+    :return: The JSON serializable dict kept as 'derived' in the model's definition.
+    """
+    if storage not in STORAGES:
+        raise ValueError('a derived model is stored as a table or a view, not {storage}'.format(storage=storage))
+    if storage == 'view' and connection.vendor != 'postgresql':
+        storage = 'table'
+    normalized = []
+    for j in joins or []:
+        names = j.get('fields') or {}
+        if not isinstance(names, dict):
+            names = dict((name, name) for name in names)
+        normalized.append({'model' : j['model'], 'on' : dict(j['on']), 'fields' : names})
+    if not all(j['on'] for j in normalized):
+        raise ValueError('a join needs at least one pair of columns to join on')
+    declared = {
+        'source' : source,
+        'filters' : dict(filters or {}),
+        'fields' : list(fields) if fields else None,
+        'joins' : normalized,
+        'group_by' : list(group_by or []),
+        'metrics' : list(metrics or []),
+        'storage' : storage,
+    }
+    columns(declared)
+    return declared
+
+
+def is_aggregate(declared):
+    return bool(declared['group_by'] or declared['metrics'])
+
+
+def sources(declared):
+    """
+    :return: The names of the models a derived model reads, its source first.
+    """
+    return [declared['source']] + [j['model'] for j in declared['joins']]
+
+
+def columns(declared):
+    """
+    Work out the fields of a derived model from the definitions of the models it reads.
+
+    :return: A list of (name, **field**, origin) triples, where origin is the (model name, field name) the column's
+        values come from, or None for a metric.
+    :raises ValueError: if a model or column doesn't exist or can't be used the way it's being asked to.
+    """
+    source = _definition(declared['source'])
+    joined = {}
+    for j in declared['joins']:
+        definition = _definition(j['model'])
+        for mine, theirs in j['on'].items():
+            ours, other = _field(source, mine), _field(definition, theirs)
+            # codes come from each column's own dictionary, so equal codes needn't mean equal values
+            if 'CategoricalField' in (_kind(ours), _kind(other)):
+                raise ValueError("{mine} and {model}.{theirs} can't be joined: categorical columns can't be joined on"
+                    .format(mine=mine, model=j['model'], theirs=theirs))
+        for alias, name in j['fields'].items():
+            if alias in joined or alias in source.get('fields', {}):
+                raise ValueError('{alias} is taken twice; give the joined field another name'.format(alias=alias))
+            joined[alias] = (j['model'], definition, name)
+
+    def take(name):
+        if name in joined:
+            model, definition, field = joined[name]
+            return name, _field(definition, field), (model, field)
+        return name, _field(source, name), (declared['source'], name)
+
+    if not is_aggregate(declared):
+        names = declared['fields'] or sorted(n for n in source.get('fields', {}) if n != 'objects')
+        return [take(name) for name in names if name not in joined] + [take(alias) for alias in sorted(joined)]
+
+    taken = []
+    for name in declared['group_by']:
+        taken.append(take(name))
+        if _kind(taken[-1][1]) in aggregation.NON_CATEGORICAL_TYPES or taken[-1][1].get('module') == GEO_MODULE:
+            raise ValueError('{name} is not a categorical column and cannot be grouped by'.format(name=name))
+    for function, name in aggregation.parse_metrics(declared['metrics']):
+        if function not in aggregation.FUNCTIONS:
+            raise ValueError('unknown aggregate {function}'.format(function=function))
+        if name is None and function != 'count':
+            raise ValueError('{function} needs a column, as in {function}:column'.format(function=function))
+        if function == 'count':
+            field = _plain_field('IntegerField', default=0)
+        else:
+            field = _field(source, name)
+            kind = _kind(field)
+            if kind not in aggregation.NUMERIC_TYPES or kind == 'AutoField':
+                raise ValueError('{name} is not a numeric column'.format(name=name))
+            if function == 'avg' or (function == 'sum' and kind in ('FloatField', 'DecimalField')):
+                field = _plain_field('FloatField', null=True)
+            elif function == 'sum':
+                field = _plain_field('BigIntegerField', null=True)
+            else:
+                field['parameters']['keywords']['null'] = True
+        taken.append((aggregation.metric_name(function, name), field, None))
+    return taken
+
+
+def fields(declared):
+    """
+    :return: The fields of a derived model as a dict of name => **field**, and whether any of them is geometry.
+    """
+    taken = columns(declared)
+    return dict((name, field) for name, field, _ in taken), any(f.get('module') == GEO_MODULE for _, f, _ in taken)
+
+
+def declaration(name):
+    """
+    :return: The 'derived' part of a model's definition, or None if it isn't a derived model.
+    """
+    definition = get_store('models').get(name)
+    return definition.get('derived') if definition else None
+
+
+def is_view(model):
+    declared = declaration(model.__name__)
+    return declared is not None and declared['storage'] == 'view'
+
+
+def dependents(name):
+    """
+    :return: The names of the derived models that read a model.
+    """
+    return sorted(d['name'] for d in get_store('models').list() if d.get('derived') and name in sources(d['derived']))
+
+
+class Query(object):
+    """
+    The query a derived model is declared as, against one database.
+
+    :param model: The derived model class.
+    :param declared: Its declaration.
+    :param using: The database alias.
+    """
+
+    def __init__(self, model, declared, using):
+        self.model = model
+        self.declared = declared
+        self.using = using
+        self.connection = connections[using]
+        self.source = _get_model(declared['source'])
+        self.joined = dict((j['model'], _get_model(j['model'])) for j in declared['joins'])
+        self.select = {}
+        self.aliases = set(alias for j in declared['joins'] for alias in j['fields'])
+        self.origins = {}
+        for name, _, origin in columns(declared):
+            if origin is not None:
+                model_name, field_name = origin
+                origin_model = self.source if model_name == declared['source'] else self.joined[model_name]
+                self.origins[name] = (origin_model, origin_model._meta.get_field(field_name))
+
+    def base(self):
+        """
+        :return: A queryset of the source rows, filtered and joined.
+        """
+        qn = self.connection.ops.quote_name
+        qs = self.source._default_manager.using(self.using).all()
+        if self.declared['filters']:
+            qs = qs.filter(**self.declared['filters'])
+        tables, where = [], []
+        for j in self.declared['joins']:
+            other = self.joined[j['model']]
+            tables.append(other._meta.db_table)
+            for mine, theirs in sorted(j['on'].items()):
+                where.append('{table}.{column} = {other}.{other_column}'.format(
+                    table=qn(self.source._meta.db_table), column=qn(self.source._meta.get_field(mine).column),
+                    other=qn(other._meta.db_table), other_column=qn(other._meta.get_field(theirs).column)))
+            for alias, name in j['fields'].items():
+                self.select[alias] = '{table}.{column}'.format(
+                    table=qn(other._meta.db_table), column=qn(other._meta.get_field(name).column))
+        if tables:
+            qs = qs.extra(select=self.select, tables=tables, where=where)
+        return qs
+
+    def rows(self, qs):
+        """
+        :param qs: A queryset from :py:meth:`base`, perhaps restricted further.
+        :return: A values() queryset of the derived model's rows, and a list of (derived model column, column of that
+            queryset) pairs.
+        """
+        pairs = []
+        for name, (_, field) in sorted(self.origins.items()):
+            pairs.append((self.model._meta.get_field(name).column, name if name in self.aliases else field.column))
+        if is_aggregate(self.declared):
+            requested = aggregation.parse_metrics(self.declared['metrics'])
+            annotations = dict(
+                (aggregation.metric_name(function, field), aggregation.FUNCTIONS[function](field or 'pk'))
+                for function, field in requested)
+            for metric in sorted(annotations):
+                pairs.append((self.model._meta.get_field(metric).column, metric))
+            return qs.values(*self.declared['group_by']).annotate(**annotations).order_by(), pairs
+        pairs.insert(0, (self.model._meta.pk.column, self.source._meta.pk.column))
+        return qs.values(*([self.source._meta.pk.name] + sorted(self.origins))).order_by(), pairs
+
+    def sql(self, qs, pairs, id_column=None):
+        """
+        :return: A ``SELECT`` of the derived model's columns from the rows of a values() queryset, and its parameters.
+        """
+        qn = self.connection.ops.quote_name
+        inner, params = qs.query.get_compiler(connection=self.connection).as_sql()
+        selected = ', '.join('{inner} AS {column}'.format(inner=qn(i), column=qn(c)) for c, i in pairs)
+        if id_column is not None:
+            selected = 'row_number() OVER (ORDER BY {order}) AS {id}, {selected}'.format(
+                order=', '.join(qn(i) for _, i in pairs), id=qn(id_column), selected=selected)
+        return 'SELECT {selected} FROM ({inner}) derived_rows'.format(selected=selected, inner=inner), params
+
+    def insert(self, cursor, qs):
+        """Insert the derived model's rows from a queryset from :py:meth:`base`."""
+        rows, pairs = self.rows(qs)
+        select, params = self.sql(rows, pairs)
+        cursor.execute('INSERT INTO {table} ({columns}) {select}'.format(
+            table=self.connection.ops.quote_name(self.model._meta.db_table),
+            columns=', '.join(self.connection.ops.quote_name(c) for c, _ in pairs), select=select), params)
+
+    def copy_dictionaries(self, cursor):
+        """Copy into the derived model's dictionaries the codes of the categorical columns it takes."""
+        qn = self.connection.ops.quote_name
+        for field in categorical.categorical_fields(self.model):
+            if field.name not in self.origins:
+                continue
+            origin_model, origin_field = self.origins[field.name]
+            copied = categorical.dictionary(origin_model, origin_field, self.using)
+            dictionary = categorical.dictionary(self.model, field, self.using)
+            if not copied.exists():
+                continue
+            dictionary.create(cursor)
+            cursor.execute('INSERT INTO {table} (code, value) SELECT code, value FROM {copied} '
+                'WHERE code NOT IN (SELECT code FROM {table})'.format(
+                table=qn(dictionary.table), copied=qn(copied.table)))
+            dictionary.clear()
+
+
+def _watermark(query):
+    return query.source._default_manager.using(query.using).aggregate(watermark=Max('pk'))['watermark']
+
+
+def _groups(query, watermark):
+    """
+    :return: A list of Q objects, one for each group the source rows after ``watermark`` fall in, or None if there are
+        too many of them to patch.  Groups are told apart by their source columns only; columns taken from a joined
+        model just divide them further.
+    """
+    limit = max_incremental_groups()
+    names = [name for name in query.declared['group_by'] if name not in query.aliases]
+    if not names:
+        return None
+    touched = query.base().filter(pk__gt=watermark).values(*names).order_by().distinct()
+    touched = list(touched[:limit + 1])
+    if len(touched) > limit:
+        return None
+    return [Q(**dict((str(name), value) for name, value in group.items())) for group in touched]
+
+
+def _rebuild_table(query, cursor):
+    qn = query.connection.ops.quote_name
+    cursor.execute('DELETE FROM {table}'.format(table=qn(query.model._meta.db_table)))
+    query.insert(cursor, query.base())
+
+
+def _patch_table(query, cursor, watermark):
+    """
+    Bring the table up to date with the source rows after ``watermark``.
+
+    :return: Whether the rows already in the table were kept, or False if they had to be replaced.
+    """
+    if not is_aggregate(query.declared):
+        query.insert(cursor, query.base().filter(pk__gt=watermark))
+        return True
+    groups = _groups(query, watermark)
+    if groups is None:
+        _rebuild_table(query, cursor)
+        return False
+    for start in range(0, len(groups), 200):
+        touched = reduce(lambda a, b: a | b, groups[start:start + 200])
+        query.model._default_manager.using(query.using).filter(touched).delete()
+        query.insert(cursor, query.base().filter(touched))
+    return False
+
+
+def _refresh_view(query, cursor):
+    qn = query.connection.ops.quote_name
+    table = query.model._meta.db_table
+    cursor.execute('SELECT 1 FROM pg_matviews WHERE matviewname = %s', [table])
+    if cursor.fetchone() is not None:
+        cursor.execute('REFRESH MATERIALIZED VIEW CONCURRENTLY {table}'.format(table=qn(table)))
+        return
+    rows, pairs = query.rows(query.base())
+    pk = query.model._meta.pk.column
+    select, params = query.sql(rows, pairs, id_column=pk if is_aggregate(query.declared) else None)
+    cursor.execute('CREATE MATERIALIZED VIEW {table} AS {select}'.format(table=qn(table), select=select), params)
+    # REFRESH ... CONCURRENTLY needs a unique index
+    cursor.execute('CREATE UNIQUE INDEX {index} ON {table} ({pk})'.format(
+        index=qn(table + '_pk'), table=qn(table), pk=qn(pk)))
+
+
+def materialize(name, changed=None, replace=True, _seen=None):
+    """
+    Bring a derived model's rows up to date, and then those of the derived models that read it.
+
+    :param name: The name of the derived model.
+    :param changed: The name of the model whose rows changed, if it is known.
+    :param replace: Whether that model's rows were replaced, rather than appended to.
+    :return: Whether the rows already materialized were kept and only new ones added.
+    """
+    definition = _definition(name)
+    declared = definition.get('derived')
+    if declared is None:
+        raise ValueError('{name} is not a derived model'.format(name=name))
+    model = _get_model(name)
+    using = router.db_for_write(model)
+    query = Query(model, declared, using)
+    state = definition.get('_materialized') or {}
+
+    watermark = state.get('watermark')
+    incremental = declared['storage'] == 'table' and not replace and changed == declared['source'] and \
+        watermark is not None and query.source._meta.pk.get_internal_type() in INCREMENTAL_KEYS and \
+        all(state.get('sources', {}).get(n) == generations.current(n) for n in sources(declared)[1:])
+
+    kept = False
+    with metrics.span('derived.materialize', model=name, incremental=incremental):
+        with transaction.commit_on_success(using=using):
+            cursor = query.connection.cursor()
+            query.copy_dictionaries(cursor)
+            latest = _watermark(query)
+            if declared['storage'] == 'view':
+                _refresh_view(query, cursor)
+            elif incremental:
+                kept = _patch_table(query, cursor, watermark)
+            else:
+                _rebuild_table(query, cursor)
+
+    get_store('models').update(name, _materialized={
+        'watermark' : latest,
+        'sources' : dict((n, generations.current(n)) for n in sources(declared)),
+        'at' : time.time(),
+    })
+    counting.refresh(model, using)
+    generations.bump(name)
+    for after in (snapshot.refresh, aggregation.refresh, search.refresh):
+        try:
+            after(model, not kept)
+        except Exception:
+            _log.exception('{module} could not refresh after materializing {name}'.format(
+                module=after.__module__, name=name))
+    refresh(model, not kept, _seen=_seen)
+    return kept
+
+
+def refresh(model, replace, _seen=None):
+    """
+    Materialize the derived models that read a model, after its rows have changed.  Called by the loader.
+
+    :param model: The model class.
+    :param replace: Whether its rows were replaced, rather than appended to.
+    """
+    name = model.__name__
+    seen = _seen if _seen is not None else set([name])
+    for dependent in dependents(name):
+        if dependent in seen:
+            _log.warning('{dependent} reads itself through {name} and was not refreshed again'.format(
+                dependent=dependent, name=name))
+            continue
+        seen.add(dependent)
+        try:
+            materialize(dependent, changed=name, replace=replace, _seen=seen)
+        except Exception:
+            _log.exception('could not materialize {dependent} after {name} changed'.format(
+                dependent=dependent, name=name))
+
+
+def is_stale(definition):
+    """
+    :return: Whether the data generation of a model a derived model reads has moved since it was materialized.
+    """
+    recorded = (definition.get('_materialized') or {}).get('sources', {})
+    return any(recorded.get(n) != generations.current(n) for n in sources(definition['derived']))
+
+
+def refresh_stale():
+    """
+    Materialize every derived model whose sources have changed since it was last materialized.
+
+    :return: The names of the models materialized.
+    """
+    refreshed = []
+    store = get_store('models')
+    for name in sorted(d['name'] for d in store.list() if d.get('derived')):
+        # materializing one model also refreshes the models that read it, so look again
+        definition = store.get(name)
+        if definition is not None and is_stale(definition):
+            materialize(name)
+            refreshed.append(name)
+    return refreshed
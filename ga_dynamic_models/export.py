@@ -0,0 +1,238 @@
+"""
+Streaming bulk export of dynamic model tables as CSV, NDJSON or GeoJSON.
+
+Every dynamic resource has an export endpoint next to its list endpoint::
+
+    /api/my_model/export.csv
+    /api/my_model/export.ndjson
+    /api/my_model/export.geojson       (GeoDjango models only)
+
+The same filters as the list endpoint apply, but there is no pagination: the whole result is written out in one
+response.  Rows are read through a server-side (named) cursor on PostgreSQL and a chunked iterator elsewhere, encoded a
+batch at a time and, if the client accepts gzip, compressed as they go, so memory use stays flat however big the table
+is.  Geometry is encoded by the database: as GeoJSON for GeoJSON output and as WKT for CSV and NDJSON.
+
+On Django 1.5 and later the response is a StreamingHttpResponse.  Older versions have no such thing, and middleware that
+reads ``response.content`` (GZipMiddleware, or CommonMiddleware with USE_ETAGS) will pull the whole export into memory;
+leave those off for the export URLs.
+"""
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.http import HttpResponse
+from ga_dynamic_models import metrics
+from ga_dynamic_models import categorical
+import cStringIO as StringIO
+from collections import OrderedDict
+import itertools
+import zlib
+import csv
+import re
+
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    StreamingHttpResponse = None
+
+FORMATS = {
+    'csv' : 'text/csv',
+    'ndjson' : 'application/x-ndjson',
+    'geojson' : 'application/vnd.geo+json',
+}
+
+BATCH_SIZE = 2000
+
+
+def geometry_function(connection, format):
+    """
+    :return: The SQL function that turns a geometry into text for the given output format, or into WKB for 'wkb'.
+    """
+    spatialite = getattr(connection.ops, 'spatialite', False)
+    if format == 'wkb':
+        return 'AsBinary' if spatialite else 'ST_AsBinary'
+    if format == 'geojson':
+        return 'AsGeoJSON' if spatialite else 'ST_AsGeoJSON'
+    return 'AsText' if spatialite else 'ST_AsText'
+
+
+def columns(model, format, connection, fields=None):
+    """
+    Work out what to select for an export.
+
+    :param model: The model being exported.
+    :param format: One of FORMATS.
+    :param connection: The database connection the export will read from.
+    :param fields: Field names to limit the export to, or None for all of them.
+    :return: A tuple of (names, extra select dict, geometry field name or None).
+    """
+    names = []
+    extra = {}
+    geometry = None
+    qn = connection.ops.quote_name
+    for field in model._meta.local_fields:
+        if fields is not None and field.name not in fields and not field.primary_key:
+            continue
+        if hasattr(field, 'geom_type'):
+            alias = '{name}__text'.format(name=field.name)
+            extra[alias] = '{fn}({table}.{column})'.format(
+                fn=geometry_function(connection, format), table=qn(model._meta.db_table), column=qn(field.column))
+            names.append(alias)
+            if geometry is None:
+                geometry = alias
+        elif getattr(field, 'categorical', False):
+            alias = '{name}__text'.format(name=field.name)
+            extra[alias] = categorical.decode_sql(model, field, connection)
+            names.append(alias)
+        else:
+            names.append(field.attname)
+    return names, extra, geometry
+
+
+def rows(queryset, names, extra, batch_size=BATCH_SIZE):
+    """
+    Yield lists of value tuples from a queryset without holding the whole result in memory.
+
+    :param queryset: The filtered queryset to export.
+    :param names: The columns to select, as returned by :py:func:`columns`.
+    :param extra: Extra select expressions, as returned by :py:func:`columns`.
+    :param batch_size: How many rows to fetch at a time.
+    """
+    qs = queryset.extra(select=extra).values_list(*names) if extra else queryset.values_list(*names)
+    connection = connections[queryset.db]
+
+    if connection.vendor == 'postgresql':
+        sql, params = qs.query.sql_with_params()
+        connection.cursor()  # make sure the connection is open
+        cursor = connection.connection.cursor(name='ga_dynamic_models_export_{id}'.format(id=id(qs)))
+        cursor.itersize = batch_size
+        try:
+            cursor.execute(sql, params)
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                yield batch
+        finally:
+            cursor.close()
+    else:
+        iterator = qs.iterator()
+        while True:
+            batch = list(itertools.islice(iterator, batch_size))
+            if not batch:
+                break
+            yield batch
+
+
+def _csv_field(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def encode_csv(batches, names):
+    header = [re.sub('__text$', '', name) for name in names]
+    buf = StringIO.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(header)
+    yield buf.getvalue()
+    for batch in batches:
+        buf = StringIO.StringIO()
+        writer = csv.writer(buf)
+        for row in batch:
+            writer.writerow([_csv_field(v) for v in row])
+        yield buf.getvalue()
+
+
+def encode_ndjson(batches, names):
+    keys = [re.sub('__text$', '', name) for name in names]
+    encoder = DjangoJSONEncoder()
+    for batch in batches:
+        yield ''.join(encoder.encode(OrderedDict(zip(keys, row))) + '\n' for row in batch)
+
+
+def encode_geojson(batches, names, geometry):
+    keys = [re.sub('__text$', '', name) for name in names]
+    index = names.index(geometry)
+    encoder = DjangoJSONEncoder()
+    yield '{"type":"FeatureCollection","features":['
+    first = True
+    for batch in batches:
+        features = []
+        for row in batch:
+            properties = OrderedDict((k, v) for i, (k, v) in enumerate(zip(keys, row)) if i != index)
+            features.append('{{"type":"Feature","geometry":{geometry},"properties":{properties}}}'.format(
+                geometry=row[index] or 'null', properties=encoder.encode(properties)))
+        if features:
+            yield ('' if first else ',') + ','.join(features)
+            first = False
+    yield ']}'
+
+
+def gzip_stream(chunks, level=6):
+    """Compress an iterable of strings as a gzip stream, one chunk at a time."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _counted(chunks, model_name):
+    sent = 0
+    with metrics.span('export.stream', model=model_name):
+        for chunk in chunks:
+            sent += len(chunk)
+            yield chunk
+    metrics.incr('export.bytes', sent, model=model_name)
+
+
+def streaming_response(chunks, content_type, status=200):
+    """
+    :return: A StreamingHttpResponse where Django has them, or else an HttpResponse over an iterator, flagged so that
+        the response cache leaves it alone.
+    """
+    if StreamingHttpResponse is not None:
+        return StreamingHttpResponse(chunks, content_type=content_type, status=status)
+    response = HttpResponse(chunks, content_type=content_type, status=status)
+    response.streaming = True
+    return response
+
+
+def export_response(request, queryset, format, filename, fields=None):
+    """
+    Build a streaming response that exports a queryset.
+
+    :param request: The request, consulted for Accept-Encoding.
+    :param queryset: The filtered queryset to export.
+    :param format: One of FORMATS.
+    :param filename: The base name offered to the client for saving, without an extension.
+    :param fields: Field names to limit the export to, or None for all of them.
+    :return: An HttpResponse (or StreamingHttpResponse) whose content is generated as it is sent.
+    """
+    model = queryset.model
+    names, extra, geometry = columns(model, format, connections[queryset.db], fields)
+    if format == 'geojson' and geometry is None:
+        raise ValueError("{model} has no geometry to export as GeoJSON".format(model=model.__name__))
+
+    batches = rows(queryset, names, extra)
+    if format == 'csv':
+        chunks = encode_csv(batches, names)
+    elif format == 'ndjson':
+        chunks = encode_ndjson(batches, names)
+    else:
+        chunks = encode_geojson(batches, names, geometry)
+
+    gzipped = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+    if gzipped:
+        chunks = gzip_stream(chunks)
+    chunks = _counted(chunks, model.__name__)
+
+    response = streaming_response(chunks, FORMATS[format])
+    if gzipped:
+        response['Content-Encoding'] = 'gzip'
+    response['Vary'] = 'Accept-Encoding'
+    response['Content-Disposition'] = 'attachment; filename="{name}.{ext}"'.format(name=filename, ext=format)
+    return response
@@ -0,0 +1,65 @@
+"""
+Data generations of dynamic models.
+
+A model's data generation changes whenever the rows in its table might have: after every load, and when the model is
+declared or dropped.  Anything derived from a table's contents (cached responses, counts, tiles, exports) can be keyed
+on the generation and is then invalidated for free when the data changes.
+
+The generation is the revision of the model's definition in the definition store (see
+:py:mod:`ga_dynamic_models.stores`).  Revisions only ever go up, even across a drop and re-declare, so a generation is
+never reused.  :py:func:`bump` writes to the definition to advance it.  Lookups are cached in Django's cache for
+``GA_DYNAMIC_MODELS_GENERATION_TTL`` seconds (30 by default).  With a shared cache such as memcached, every worker sees a
+bump immediately; with a per-process cache, other workers may see it up to that many seconds late.
+
+A bump also fences the model's reads off from read replicas that haven't caught up with it; see
+:py:mod:`ga_dynamic_models.routers`.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from ga_dynamic_models.stores import get_store
+from ga_dynamic_models import routers
+import time
+
+
+def _key(name):
+    return 'ga_dynamic_models:generation:{name}'.format(name=name)
+
+
+def _ttl():
+    return getattr(settings, 'GA_DYNAMIC_MODELS_GENERATION_TTL', 30)
+
+
+def current(name):
+    """
+    :param name: The name of a dynamic model.
+    :return: Its current data generation, or None if there is no such model.
+    """
+    generation = cache.get(_key(name))
+    if generation is None:
+        definition = get_store('models').get(name)
+        generation = definition.get('_rev', 0) if definition else None
+        if generation is not None:
+            cache.set(_key(name), generation, _ttl())
+    return generation
+
+
+def bump(name):
+    """
+    Advance a model's data generation.  Call this after anything that changes the rows in its table.
+
+    :param name: The name of a dynamic model.
+    :return: The new generation, or None if there is no such model.
+    """
+    generation = get_store('models').update(name, _data_changed_at=time.time())
+    if generation is None:
+        forget(name)
+    else:
+        cache.set(_key(name), generation, _ttl())
+        routers.fence(name, generation)
+    return generation
+
+
+def forget(name):
+    """Drop the cached generation for a model, so the next lookup goes to the definition store."""
+    cache.delete(_key(name))
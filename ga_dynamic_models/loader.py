@@ -0,0 +1,609 @@
+"""
+Bulk loading of CSV rows into the table behind a dynamic model.
+
+The loader converts each CSV row to a tuple of column values once, in Python, and hands them to the database in batches
+rather than building and saving a model instance per row.  Column statistics (see :py:mod:`ga_dynamic_models.stats`)
+are gathered from the converted values in the same pass.
+
+On PostgreSQL a replacing load goes into a *shadow* table created with ``LIKE`` the real one.  Rows are streamed in
+with ``COPY``, the primary key, ordinary indexes and spatial indexes are built once the data is in, and the shadow table
+is then swapped for the real one, all in one transaction.  Readers see the old data until the swap commits.  Appending
+loads COPY straight into the real table.  On other databases the rows are inserted with batched ``executemany``, and on
+SpatiaLite the spatial indexes are dropped for the load and rebuilt after it.
+
+Geometry comes from the CSV in one of two ways, chosen by the datatype in the second header row:
+
+    * A geometry field type (``PointField``, ``PolygonField``, ...) whose cells hold WKT, EWKT or hex encoded (E)WKB.
+    * A pair of ``Latitude`` and ``Longitude`` columns.  These are kept as FloatFields and also combined into a
+      PointField named ``geom``.
+
+A ``Categorical`` column is stored as codes into a dictionary table (see :py:mod:`ga_dynamic_models.categorical`).  Its
+strings are profiled as they are, then each batch is encoded before it goes to the database.  A ``BooleanField`` cell
+reads as true for ``true``, ``t``, ``yes``, ``y`` or ``1`` and as false for ``false``, ``f``, ``no``, ``n`` or ``0``, in
+any case; anything else is a conversion error, and loads as null like any other.
+
+A model with a partition key (see :py:mod:`ga_dynamic_models.partitioning`) has its rows routed to their partitions.  A
+replacing load replaces only the partitions it has rows for: on PostgreSQL each is built in a table of its own and
+attached in place of the old one; elsewhere the old rows of each key are deleted before the first new ones go in.
+
+A geometry datatype may carry an SRID after an ``@``, as in ``PolygonField@2264``; otherwise the SRID is 4326.  No
+geometry objects are ever built in Python.  Points are packed straight to EWKB with struct, WKB gets its SRID spliced
+in, and WKT is passed through as EWKT, leaving the parsing to the database's bulk input path.
+"""
+
+from django.db import connections, router, transaction
+from ga_dynamic_models import metrics
+from ga_dynamic_models import counting
+from ga_dynamic_models import generations
+from ga_dynamic_models import snapshot
+from ga_dynamic_models import aggregation
+from ga_dynamic_models import stats
+from ga_dynamic_models import categorical
+from ga_dynamic_models import partitioning
+from ga_dynamic_models import derived
+from ga_dynamic_models import search
+from ga_dynamic_models import advisor
+from django.db.backends.util import truncate_name
+from ga_ows.utils import parsetime
+from logging import getLogger
+import cStringIO as StringIO
+import binascii
+import struct
+import csv
+import re
+import time
+
+_log = getLogger(__name__)
+
+GEOMETRY_TYPES = (
+    'GeometryField', 'PointField', 'LineStringField', 'PolygonField', 'MultiPointField', 'MultiLineStringField',
+    'MultiPolygonField', 'GeometryCollectionField'
+)
+LATITUDE = 'Latitude'
+LONGITUDE = 'Longitude'
+LATLON_FIELD = 'geom'
+CATEGORICAL = 'Categorical'
+DEFAULT_SRID = 4326
+
+_point = struct.Struct('<BIIdd')
+_hex = re.compile('^[0-9A-Fa-f]+$')
+
+
+def parse_datatype(datatype):
+    """
+    Split a datatype from a CSV header into its kind, whether it is indexed, and its SRID.
+
+    :param datatype: A datatype string such as 'CharField', '*IntegerField' or 'PointField@2264'
+    :return: A tuple of (kind, db_index, srid).  srid is None for non-geometry kinds.
+    """
+    datatype = datatype.strip()
+    db_index = datatype.startswith('*')
+    datatype = datatype.lstrip('*')
+    srid = None
+    if '@' in datatype:
+        datatype, srid = datatype.split('@', 1)
+        srid = int(srid)
+    if datatype in GEOMETRY_TYPES and srid is None:
+        srid = DEFAULT_SRID
+    return datatype, db_index, srid
+
+
+def ewkb_point(x, y, srid):
+    """Hex EWKB for a point, without going through GEOS."""
+    return binascii.hexlify(_point.pack(1, 0x20000001, srid, x, y))
+
+
+def ewkb(value, srid):
+    """
+    Give hex encoded WKB an SRID, unless it already has one.
+
+    :param value: Hex encoded WKB or EWKB.
+    :param srid: The SRID to use.
+    :return: Hex encoded EWKB.
+    """
+    raw = binascii.unhexlify(value)
+    order = '<' if raw[0] == '\x01' else '>'
+    kind, = struct.unpack(order + 'I', raw[1:5])
+    if kind & 0x20000000:
+        return value
+    return binascii.hexlify(raw[0] + struct.pack(order + 'II', kind | 0x20000000, srid) + raw[5:])
+
+
+def ewkt(value, srid):
+    """Prefix WKT with an SRID, unless it already has one."""
+    if value[:5].upper() == 'SRID=':
+        return value
+    return 'SRID={srid};{wkt}'.format(srid=srid, wkt=value)
+
+
+def is_wkb(value):
+    return len(value) % 2 == 0 and _hex.match(value) is not None
+
+
+def _char(value):
+    return value
+
+def _int(value):
+    return int(value) if value != '' else None
+
+def _float(value):
+    return float(value) if value != '' else None
+
+TRUE = ('true', 't', 'yes', 'y', '1')
+FALSE = ('false', 'f', 'no', 'n', '0')
+
+def _bool(value):
+    spelled = value.strip().lower()
+    if spelled == '':
+        return None
+    if spelled in TRUE:
+        return True
+    if spelled in FALSE:
+        return False
+    raise ValueError('{value!r} is neither true nor false'.format(value=value))
+
+def _date(value):
+    return parsetime(value) if value != '' else None
+
+def _category(value):
+    return value if value != '' else None
+
+CONVERTERS = {
+    'CharField' : _char,
+    'TextField' : _char,
+    'IntegerField' : _int,
+    'FloatField' : _float,
+    'BooleanField' : _bool,
+    'DateField' : _date,
+    LATITUDE : _float,
+    LONGITUDE : _float,
+    CATEGORICAL : _category,
+}
+
+
+class Column(object):
+    """One database column the loader fills, and how to get its value from a CSV row."""
+
+    def __init__(self, name, source, convert, kind, srid=None):
+        self.name = name
+        self.source = source
+        self.convert = convert
+        self.kind = kind
+        self.srid = srid
+
+    @property
+    def is_geometry(self):
+        return self.srid is not None
+
+
+class Loader(object):
+    """
+    Loads rows from a CSV reader into a dynamic model's table.
+
+    :param model: The model class.
+    :param spec: A list of (field name, datatype) pairs, one per CSV column, as returned by
+        :py:func:`ga_dynamic_models.views.csv_upload.model_from_csv`.
+    :param using: The database alias.  Defaults to the router's choice for writes to the model.
+    :param batch_size: How many rows to send to the database at a time.
+    """
+
+    batch_size = 10000
+
+    def __init__(self, model, spec, using=None, batch_size=None):
+        self.model = model
+        self.using = using or router.db_for_write(model)
+        self.connection = connections[self.using]
+        if batch_size:
+            self.batch_size = batch_size
+        self.columns = self._columns(spec)
+        fields = dict((f.name, f) for f in categorical.categorical_fields(model))
+        self.dictionaries = dict((i, categorical.dictionary(model, fields[c.name], self.using))
+            for i, c in enumerate(self.columns) if c.name in fields)
+        self.profile = stats.TableProfile(self.columns)
+        self.partitioning = partitioning.Partitioning.of(model)
+        if self.partitioning is not None:
+            names = [c.name for c in self.columns]
+            if self.partitioning.column not in names:
+                raise ValueError('{name} is partitioned by {column}, which the upload has no column for'.format(
+                    name=model.__name__, column=self.partitioning.column))
+            self.partition_index = names.index(self.partitioning.column)
+        self.partition_profiles = {}
+        self.partitions_seen = set()
+        self.clear_partitions = False
+        self.rows_loaded = 0
+        self.rows_seen = 0
+        self.conversion_errors = 0
+
+    def _columns(self, spec):
+        columns = []
+        latlon = {}
+        for i, (name, datatype) in enumerate(spec):
+            kind, _, srid = parse_datatype(datatype)
+            if kind in GEOMETRY_TYPES:
+                srid = getattr(self.model._meta.get_field(name), 'srid', srid)
+                columns.append(Column(name, i, None, kind, srid))
+            elif kind in CONVERTERS:
+                columns.append(Column(name, i, CONVERTERS[kind], kind))
+                if kind in (LATITUDE, LONGITUDE):
+                    latlon[kind] = i
+            else:
+                raise ValueError("don't know how to load a {kind} column ({name})".format(kind=kind, name=name))
+        if len(latlon) == 2:
+            srid = getattr(self.model._meta.get_field(LATLON_FIELD), 'srid', DEFAULT_SRID)
+            columns.append(Column(LATLON_FIELD, (latlon[LONGITUDE], latlon[LATITUDE]), None, 'PointField', srid))
+        return columns
+
+    def _geometry(self, column, row):
+        if isinstance(column.source, tuple):
+            x, y = row[column.source[0]], row[column.source[1]]
+            if x == '' or y == '':
+                return None
+            return ewkb_point(float(x), float(y), column.srid)
+        value = row[column.source].strip()
+        if not value:
+            return None
+        return ewkb(value, column.srid) if is_wkb(value) else ewkt(value, column.srid)
+
+    def convert(self, row):
+        """
+        :param row: A list of strings from the CSV reader.
+        :return: A tuple of database values, in the order of self.columns.
+        """
+        self.rows_seen += 1
+        values = []
+        for column in self.columns:
+            try:
+                if column.is_geometry:
+                    values.append(self._geometry(column, row))
+                else:
+                    values.append(column.convert(row[column.source]))
+            except (ValueError, TypeError, IndexError, struct.error) as e:
+                self.conversion_errors += 1
+                if self.conversion_errors <= 10:
+                    _log.warn('error converting {name} on data row {row}: {e}'.format(
+                        name=column.name, row=self.rows_seen, e=e))
+                values.append(None)
+        return tuple(values)
+
+    def encode(self, batch):
+        """Replace the strings of categorical columns in a batch with their codes."""
+        if not self.dictionaries:
+            return batch
+        codes = dict((i, d.encode(values[i] for values in batch)) for i, d in self.dictionaries.items())
+        encoded = []
+        for values in batch:
+            values = list(values)
+            for i, mapping in codes.items():
+                if values[i] is not None:
+                    values[i] = mapping[values[i].decode('utf-8')]
+            encoded.append(tuple(values))
+        return encoded
+
+    def _profile(self, batch):
+        encoded = self.encode(batch)
+        if self.partitioning is None:
+            self.profile.add_batch(batch)
+        else:
+            for key, rows in self.by_partition(encoded, batch).items():
+                if key not in self.partition_profiles:
+                    self.partition_profiles[key] = stats.TableProfile(self.columns)
+                self.partition_profiles[key].add_batch(rows)
+        return encoded
+
+    def batches(self, reader):
+        batch = []
+        for row in reader:
+            batch.append(self.convert(row))
+            if len(batch) >= self.batch_size:
+                yield self._profile(batch)
+                batch = []
+        if batch:
+            yield self._profile(batch)
+
+    def by_partition(self, batch, rows=None):
+        """
+        Group a batch by partition key.
+
+        :param batch: A batch of database values, after encoding.
+        :param rows: The rows to group, if not the batch itself; the same length and order as it.
+        :return: A dict from partition key to a list of rows.
+        """
+        groups = {}
+        for values, row in zip(batch, rows if rows is not None else batch):
+            groups.setdefault(self.partitioning.key(values[self.partition_index]), []).append(row)
+        return groups
+
+    def load(self, reader, replace=True):
+        """
+        Load every row from ``reader``.
+
+        :param reader: An iterable of lists of strings, such as a csv.reader positioned after the header rows.
+        :param replace: Whether to replace the table's contents or append to them.
+        :return: The number of rows loaded.
+        """
+        try:
+            with transaction.commit_on_success(using=self.using):
+                if self.connection.vendor == 'postgresql':
+                    self._load_postgresql(reader, replace)
+                else:
+                    self._load_generic(reader, replace)
+        except Exception:
+            # codes handed out during the load were rolled back with it
+            for d in self.dictionaries.values():
+                d.clear()
+            raise
+
+        if self.partitioning is not None:
+            counting.record(self.model, self._save_partition_stats(replace))
+        elif replace:
+            counting.record(self.model, self.rows_loaded)
+            self.profile.save(self.model.__name__)
+        else:
+            counting.refresh(self.model, self.using)
+            previous = stats.get(self.model.__name__, sketches=True)
+            if previous:
+                self.profile.merge(previous)
+            self.profile.save(self.model.__name__)
+        generations.bump(self.model.__name__)
+        for refresh in (snapshot.refresh, aggregation.refresh, search.refresh, derived.refresh):
+            try:
+                refresh(self.model, replace)
+            except Exception:
+                _log.exception('{module} could not refresh after loading {name}'.format(
+                    module=refresh.__module__, name=self.model.__name__))
+        return self.rows_loaded
+
+    def _save_partition_stats(self, replace):
+        """
+        Save the statistics of the partitions loaded, and the table's statistics merged from those of every partition.
+
+        :return: The number of rows in the table.
+        """
+        name = self.model.__name__
+        labels = set((stats.get(name) or {}).get('partitions', []))
+        for key, profile in self.partition_profiles.items():
+            label = self.partitioning.label(key)
+            if not replace:
+                previous = stats.get(stats.partition_name(name, label), sketches=True)
+                if previous:
+                    profile.merge(previous)
+            profile.save(stats.partition_name(name, label))
+            labels.add(label)
+        table = stats.TableProfile(self.columns)
+        for label in labels:
+            stored = stats.get(stats.partition_name(name, label), sketches=True)
+            if stored:
+                table.merge(stored)
+        table.save(name, partitions=sorted(labels))
+        return table.rows
+
+    def quote(self, name):
+        return self.connection.ops.quote_name(name)
+
+    def before_batch(self, cursor, table, batch):
+        """
+        Get a partitioned table ready for a batch: create the partitions it needs, or, when replacing the partitions
+        of a table that isn't partitioned in the database, delete the rows of the keys seen for the first time.
+        """
+        if self.partitioning is None:
+            return
+        for key in set(self.partitioning.key(values[self.partition_index]) for values in batch):
+            if key in self.partitions_seen:
+                continue
+            self.partitions_seen.add(key)
+            if self.clear_partitions:
+                where, params = self.partitioning.predicate(key, self.quote)
+                cursor.execute('DELETE FROM {table} WHERE {where}'.format(table=self.quote(table), where=where), params)
+            elif self.connection.vendor == 'postgresql' and partitioning.is_partitioned(self.connection, table):
+                self._create_partition(cursor, table, key)
+
+    # PostgreSQL: COPY into a shadow table, index it, and swap it in.
+
+    def _load_postgresql(self, reader, replace):
+        cursor = self.connection.cursor()
+        table = self.model._meta.db_table
+        if self.partitioning is not None:
+            if replace and partitioning.is_partitioned(self.connection, table):
+                self._load_partitions(cursor, table, reader)
+            else:
+                self.clear_partitions = replace
+                self._copy(cursor, table, reader)
+        elif replace:
+            shadow = self._shadow_name(table)
+            cursor.execute('CREATE TABLE {shadow} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'.format(
+                shadow=self.quote(shadow), table=self.quote(table)))
+            self._copy(cursor, shadow, reader)
+            with metrics.span('upload.index', model=self.model.__name__):
+                self._build_indexes(cursor, shadow)
+            self._swap(cursor, table, shadow)
+        else:
+            self._copy(cursor, table, reader)
+
+    def _shadow_name(self, table):
+        return '{table}__{stamp}'.format(table=table[:40], stamp=int(time.time() * 1000))
+
+    def _copy(self, cursor, table, reader):
+        sql = self._copy_sql(table)
+
+        for batch in self.batches(reader):
+            self.before_batch(cursor, table, batch)
+            self._copy_batch(cursor, sql, batch)
+
+    def _copy_sql(self, table):
+        chars = [self.quote(c.name) for i, c in enumerate(self.columns)
+            if c.convert is _char and i not in self.dictionaries]
+        return 'COPY {table} ({columns}) FROM STDIN WITH CSV{force}'.format(
+            table=self.quote(table),
+            columns=', '.join(self.quote(c.name) for c in self.columns),
+            force=(' FORCE NOT NULL ' + ', '.join(chars)) if chars else '')
+
+    def _copy_batch(self, cursor, sql, batch):
+        buf = StringIO.StringIO()
+        writer = csv.writer(buf)
+        for values in batch:
+            writer.writerow([_copy_value(v) for v in values])
+        buf.seek(0)
+        cursor.copy_expert(sql, buf)
+        self.rows_loaded += len(batch)
+
+    def _load_partitions(self, cursor, table, reader):
+        """Build each partition the upload has rows for as a table of its own, and swap them in."""
+        shadows = {}
+        for batch in self.batches(reader):
+            for key, rows in self.by_partition(batch).items():
+                if key not in shadows:
+                    shadows[key] = truncate_name(self.partitioning.table(table, key, self.connection) + '__new',
+                        self.connection.ops.max_name_length())
+                    cursor.execute('CREATE TABLE {shadow} (LIKE {table} INCLUDING DEFAULTS INCLUDING '
+                        'CONSTRAINTS)'.format(shadow=self.quote(shadows[key]), table=self.quote(table)))
+                self._copy_batch(cursor, self._copy_sql(shadows[key]), rows)
+        with metrics.span('upload.index', model=self.model.__name__):
+            for shadow in shadows.values():
+                self._build_indexes(cursor, shadow)
+        existing = set(partitioning.partitions(self.connection, table))
+        for key, shadow in shadows.items():
+            name = self.partitioning.table(table, key, self.connection)
+            if name in existing:
+                cursor.execute('ALTER TABLE {table} DETACH PARTITION {name}'.format(
+                    table=self.quote(table), name=self.quote(name)))
+                cursor.execute('DROP TABLE {name}'.format(name=self.quote(name)))
+            cursor.execute('ALTER TABLE {shadow} RENAME TO {name}'.format(
+                shadow=self.quote(shadow), name=self.quote(name)))
+            bounds, params = self.partitioning.bounds(key)
+            cursor.execute('ALTER TABLE {table} ATTACH PARTITION {name} {bounds}'.format(
+                table=self.quote(table), name=self.quote(name), bounds=bounds), params)
+
+    def _create_partition(self, cursor, table, key):
+        name = self.partitioning.table(table, key, self.connection)
+        if name in partitioning.partitions(self.connection, table):
+            return
+        bounds, params = self.partitioning.bounds(key)
+        cursor.execute('CREATE TABLE {name} PARTITION OF {table} {bounds}'.format(
+            name=self.quote(name), table=self.quote(table), bounds=bounds), params)
+        self._build_indexes(cursor, name)
+
+    def _index_name(self, table, column):
+        return truncate_name('{table}_{column}_{stamp}'.format(table=table, column=column,
+            stamp=int(time.time() * 1000)), self.connection.ops.max_name_length())
+
+    def _build_indexes(self, cursor, table):
+        pk = self.model._meta.pk.column
+        cursor.execute('ALTER TABLE {table} ADD PRIMARY KEY ({pk})'.format(table=self.quote(table), pk=self.quote(pk)))
+        advised = advisor.indexed(self.model.__name__)
+        for field in self.model._meta.local_fields:
+            if field.primary_key:
+                continue
+            unique = ''
+            if hasattr(field, 'geom_type') and getattr(field, 'spatial_index', True):
+                using = ' USING GIST'
+            elif field.db_index or field.unique or field.name in advised:
+                using = ''
+                # the swap drops the table syncdb made, and its unique constraints with it
+                unique = 'UNIQUE ' if field.unique else ''
+            else:
+                continue
+            cursor.execute('CREATE {unique}INDEX {name} ON {table}{using} ({column})'.format(
+                unique=unique, name=self.quote(self._index_name(table, field.column)), table=self.quote(table),
+                using=using, column=self.quote(field.column)))
+        cursor.execute('ANALYZE {table}'.format(table=self.quote(table)))
+
+    def _swap(self, cursor, table, shadow):
+        pk = self.model._meta.pk.column
+        cursor.execute('LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE'.format(table=self.quote(table)))
+        cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [table, pk])
+        sequence = cursor.fetchone()[0]
+        if sequence:
+            # the shadow's id default points at the old table's sequence; keep it alive past the DROP.
+            cursor.execute('ALTER SEQUENCE {sequence} OWNED BY {shadow}.{pk}'.format(
+                sequence=sequence, shadow=self.quote(shadow), pk=self.quote(pk)))
+        cursor.execute('DROP TABLE {table}'.format(table=self.quote(table)))
+        cursor.execute('ALTER TABLE {shadow} RENAME TO {table}'.format(
+            shadow=self.quote(shadow), table=self.quote(table)))
+
+    # Everything else: batched executemany, with SpatiaLite's spatial indexes rebuilt afterwards.
+
+    def _load_generic(self, reader, replace):
+        cursor = self.connection.cursor()
+        table = self.model._meta.db_table
+        spatialite = getattr(self.connection.ops, 'spatialite', False)
+        geometry = [c for c in self.columns if c.is_geometry]
+
+        if replace and self.partitioning is not None:
+            self.clear_partitions = True
+        elif replace:
+            cursor.execute('DELETE FROM {table}'.format(table=self.quote(table)))
+        if spatialite:
+            for c in geometry:
+                cursor.execute('SELECT DisableSpatialIndex(%s, %s)', [table, c.name])
+                cursor.execute('DROP TABLE IF EXISTS {idx}'.format(idx=self.quote('idx_{t}_{c}'.format(t=table, c=c.name))))
+
+        statements = {}
+        for batch in self.batches(reader):
+            self.before_batch(cursor, table, batch)
+            for ewkt, rows in self._by_geometry_format(batch, spatialite).items():
+                if ewkt not in statements:
+                    statements[ewkt] = self._insert_sql(table, ewkt)
+                cursor.executemany(statements[ewkt], rows)
+            self.rows_loaded += len(batch)
+
+        if spatialite:
+            with metrics.span('upload.index', model=self.model.__name__):
+                for c in geometry:
+                    cursor.execute('SELECT CreateSpatialIndex(%s, %s)', [table, c.name])
+
+    def _by_geometry_format(self, batch, spatialite):
+        """
+        Split a batch by whether each of its geometries is EWKT or hex EWKB, since SpatiaLite needs a different
+        function for each.
+
+        :return: A dict from a tuple with a flag for each geometry column, True where it holds EWKT, to the rows.  The
+            tuple is empty unless the database is SpatiaLite.
+        """
+        positions = [i for i, column in enumerate(self.columns) if column.is_geometry] if spatialite else []
+        if not positions:
+            return {() : batch}
+        groups = {}
+        for values in batch:
+            ewkt = tuple(values[i] is not None and values[i][:5].upper() == 'SRID=' for i in positions)
+            groups.setdefault(ewkt, []).append(values)
+        return groups
+
+    def _insert_sql(self, table, ewkt):
+        placeholders = []
+        geometries = iter(ewkt)
+        for column in self.columns:
+            if column.is_geometry and ewkt:
+                placeholders.append('GeomFromEWKT(%s)' if next(geometries) else 'GeomFromEWKB(%s)')
+            else:
+                placeholders.append('%s')
+        return 'INSERT INTO {table} ({columns}) VALUES ({placeholders})'.format(
+            table=self.quote(table),
+            columns=', '.join(self.quote(c.name) for c in self.columns),
+            placeholders=', '.join(placeholders))
+
+
+def _copy_value(value):
+    if value is None:
+        return None
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, float):
+        return repr(value)
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def load(model, spec, reader, replace=True, using=None):
+    """
+    Shortcut for ``Loader(model, spec, using).load(reader, replace)``.
+
+    :return: The Loader, which has rows_loaded and conversion_errors.
+    """
+    loader = Loader(model, spec, using)
+    loader.load(reader, replace)
+    return loader
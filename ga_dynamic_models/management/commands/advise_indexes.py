@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from ga_dynamic_models import advisor
+
+
+class Command(BaseCommand):
+    help = "Recommend indexes for dynamic model tables from the filters and orderings their resources are queried with."
+    option_list = BaseCommand.option_list + (
+        make_option('--build', action='store_true', dest='build', default=False,
+            help='Build the recommended indexes.'),
+        make_option('--no-concurrently', action='store_false', dest='concurrently', default=True,
+            help="On PostgreSQL, build with a plain CREATE INDEX, which locks the table against writes."),
+        make_option('--min-requests', type='int', dest='min_requests', default=10,
+            help='Leave out fields used by fewer requests than this.'),
+        make_option('--resource', dest='resource', default=None,
+            help='Only consider one resource.'),
+    )
+
+    def handle(self, *args, **options):
+        recommendations = advisor.recommend(options['min_requests'], options['resource'])
+        if not recommendations:
+            self.stdout.write('No indexes to recommend.\n')
+            return
+        for r in recommendations:
+            line = '{table}.{column}: {filter} filters, {order} orderings, {seconds:.1f}s in {names}\n'
+            self.stdout.write(line.format(names=', '.join(r['resources']), **r))
+            if options['build']:
+                name = advisor.build(r, concurrently=options['concurrently'])
+                self.stdout.write('  built {name}\n'.format(name=name))
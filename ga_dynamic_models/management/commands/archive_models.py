@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from ga_dynamic_models import archive
+
+
+class Command(BaseCommand):
+    args = '[model ...]'
+    help = "Archive the named dynamic models, or with no names, every model that has been idle long enough."
+    option_list = BaseCommand.option_list + (
+        make_option('--idle-days', type='int', dest='idle_days', default=None,
+            help='How many days without use make a model idle; by default GA_DYNAMIC_MODELS_ARCHIVE_IDLE_DAYS.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='List the models that would be archived without archiving them.'),
+    )
+
+    def handle(self, *args, **options):
+        names = list(args) or archive.idle(options['idle_days'])
+        if not names:
+            self.stdout.write('No models are idle.\n')
+        archived = 0
+        for name in names:
+            if options['dry_run']:
+                self.stdout.write('would archive {name}\n'.format(name=name))
+                continue
+            try:
+                self.stdout.write('archived {name} to {path}\n'.format(name=name, path=archive.archive(name)))
+                archived += 1
+            except ValueError as e:
+                self.stderr.write('skipped {name}: {error}\n'.format(name=name, error=e))
+        if archived:
+            # workers still have the archived models' classes until they are reloaded
+            from ga_dynamic_models import reloader
+            reloader.request_reload()
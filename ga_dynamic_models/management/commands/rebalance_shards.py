@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from ga_dynamic_models import shards
+
+
+class Command(BaseCommand):
+    args = '<owner> [owner ...]'
+    help = "Move the owners' dynamic models to another database or schema, and put their new models there too."
+    option_list = BaseCommand.option_list + (
+        make_option('--database', dest='database', default=None,
+            help='The database alias to move to; by default the primary.'),
+        make_option('--schema', dest='schema', default=None,
+            help='The PostgreSQL schema in that database to move to.'),
+        make_option('--keep', action='store_true', dest='keep', default=False,
+            help='Leave the old tables in place for good rather than retiring them.'),
+        make_option('--drop-retired', action='store_true', dest='drop_retired', default=False,
+            help='Drop the old tables of earlier moves that no worker can still be using.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['drop_retired']:
+            self.stdout.write('dropped {count} old tables\n'.format(count=shards.drop_retired()))
+        elif not args:
+            raise CommandError('name at least one owner, or give --drop-retired')
+        for owner in args:
+            shard = shards.assign(owner, options['database'], options['schema'])
+            for name in shards.models_of(owner):
+                try:
+                    rows = shards.move(name, shard, keep=options['keep'])
+                except ValueError as e:
+                    self.stderr.write('skipped {name}: {error}\n'.format(name=name, error=e))
+                    continue
+                if rows is None:
+                    self.stdout.write('{name} is already there\n'.format(name=name))
+                else:
+                    self.stdout.write('moved {name} ({rows} rows)\n'.format(name=name, rows=rows))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from ga_dynamic_models import derived
+
+
+class Command(BaseCommand):
+    args = '[model ...]'
+    help = "Rebuild the named derived models, or with no names, those whose sources changed since they were last built."
+
+    def handle(self, *args, **options):
+        if args:
+            for name in args:
+                derived.materialize(name)
+            refreshed = list(args)
+        else:
+            refreshed = derived.refresh_stale()
+        if not refreshed:
+            self.stdout.write('Every derived model is up to date.\n')
+        for name in refreshed:
+            self.stdout.write('materialized {name}\n'.format(name=name))
@@ -0,0 +1,178 @@
+"""
+Timing spans and counters for the expensive parts of this app: building the catalog at import time and loading uploads.
+
+Instrumentation is off unless ``GA_DYNAMIC_MODELS_METRICS = True`` is in settings.  When it is off, :py:func:`span`
+returns a shared do-nothing context manager and :py:func:`incr` returns immediately, so the instrumented code pays for
+little more than a function call.
+
+When it is on, every span and counter is aggregated in-process (count, total, min and max per name) and can be read
+back with :py:func:`snapshot`, which is what the ``metrics/`` endpoint serves to staff (see
+:py:class:`ga_dynamic_models.views.status.MetricsView`).  Each event is also passed to the hook named in
+``GA_DYNAMIC_MODELS_METRICS_HOOK``, if there is one.  The hook is the dotted name of a callable taking ``(kind, name,
+value, tags)``, where kind is 'span' (value in seconds) or 'counter'.  :py:func:`log_hook` is provided as an example and
+sends everything to the logging system.
+
+The names used in this app are:
+
+    * catalog.fetch - reading definitions out of the definition store
+    * catalog.parse - parsing one model definition (tagged with the model name)
+    * catalog.failed - counter of definitions that failed to build (tagged with the model name)
+    * api.register - parsing and registering one resource (tagged with the resource name)
+    * admin.register - registering all the dynamic models with the admin
+    * class_cache.hit, class_cache.miss, class_cache.evict - counters of the class cache (see
+      :py:mod:`ga_dynamic_models.classcache`)
+    * upload.parse, upload.validate, upload.ddl, upload.load, upload.index - the stages of a CSV upload
+"""
+
+from django.conf import settings
+from logging import getLogger
+import threading
+import importlib
+import time
+
+_log = getLogger(__name__)
+
+MAX_FAILURES = 100
+
+_lock = threading.Lock()
+_spans = {}
+_counters = {}
+_failures = []
+_hook = None
+_hook_loaded = False
+
+
+def enabled():
+    return getattr(settings, 'GA_DYNAMIC_MODELS_METRICS', False)
+
+
+def _get_hook():
+    global _hook, _hook_loaded
+    if not _hook_loaded:
+        path = getattr(settings, 'GA_DYNAMIC_MODELS_METRICS_HOOK', None)
+        if path:
+            module, name = path.rsplit('.', 1)
+            _hook = importlib.import_module(module).__getattribute__(name)
+        _hook_loaded = True
+    return _hook
+
+
+def log_hook(kind, name, value, tags):
+    """A metrics hook that writes every event to this module's logger."""
+    _log.info("{kind} {name} {value} {tags}".format(kind=kind, name=name, value=value, tags=tags))
+
+
+def record(kind, name, value, tags):
+    """Aggregate an event and hand it to the configured hook."""
+    with _lock:
+        if kind == 'span':
+            agg = _spans.get(name)
+            if agg is None:
+                _spans[name] = {'count' : 1, 'total' : value, 'min' : value, 'max' : value}
+            else:
+                agg['count'] += 1
+                agg['total'] += value
+                agg['min'] = min(agg['min'], value)
+                agg['max'] = max(agg['max'], value)
+        else:
+            _counters[name] = _counters.get(name, 0) + value
+
+    hook = _get_hook()
+    if hook:
+        try:
+            hook(kind, name, value, tags)
+        except Exception as e:
+            _log.error("metrics hook failed: {e}".format(e=e))
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_null_span = _NullSpan()
+
+
+class Span(object):
+    """Times the body of a with statement.  Spans whose body raises are tagged with ``error=True``."""
+
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.tags['error'] = True
+        record('span', self.name, time.time() - self.start, self.tags)
+        return False
+
+
+def span(name, **tags):
+    """
+    Time a block of code::
+
+        with metrics.span('catalog.parse', model=name):
+            ...
+
+    :param name: The name to aggregate the timing under.
+    :param tags: Extra information passed along to the hook.
+    :return: A context manager.
+    """
+    if not enabled():
+        return _null_span
+    return Span(name, tags)
+
+
+def incr(name, value=1, **tags):
+    """
+    Increment a counter.
+
+    :param name: The counter name.
+    :param value: How much to add.
+    :param tags: Extra information passed along to the hook.
+    """
+    if enabled():
+        record('counter', name, value, tags)
+
+
+def failure(name, error):
+    """
+    Note that a named definition failed to build.  Failures are always logged; the most recent ones are kept for the
+    snapshot when metrics are enabled.
+
+    :param name: The name of the model or resource.
+    :param error: The exception raised.
+    """
+    _log.error("Error creating {name}: {error}".format(name=name, error=error))
+    if enabled():
+        with _lock:
+            _failures.append({'name' : name, 'error' : str(error), 'time' : time.time()})
+            del _failures[:-MAX_FAILURES]
+        record('counter', 'catalog.failed', 1, {'name' : name})
+
+
+def snapshot():
+    """
+    :return: A JSON serializable dict of everything recorded so far in this process.
+    """
+    with _lock:
+        return {
+            'enabled' : enabled(),
+            'spans' : dict((k, dict(v)) for k, v in _spans.items()),
+            'counters' : dict(_counters),
+            'failures' : list(_failures)
+        }
+
+
+def reset():
+    """Forget everything recorded so far in this process."""
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+        del _failures[:]
@@ -1,7 +1,8 @@
 # IAH! IAH!
 # Hastur, Hastur, Hastur!
 """
-This module is insane.  What it does, effectively, is construct Models from objects  listed in a MongoDB database.
+This module is insane.  What it does, effectively, is construct Models from objects  listed in a definition store
+(MongoDB unless you configure otherwise, see :py:mod:`ga_dynamic_models.stores`).
 Quite a lot of functionality you'd expect could only be achieved through actual physical declaration of a class can be
 done here.  One thing that's essential right now, thoguh is that the WSGI container **must** be restarted after a model
 is declared.  There's probably a way around it, but right now I don't know it.  A task for doing this, if you're using
@@ -72,34 +73,43 @@ A model can be constructed from a dictionary modeled on the following structure:
 Additionally, look for how to expose modules in wms/wfs in ows.py and in Tastypie in api.py.
 """
 
-from django.conf import settings
 from django.db.models.base import ModelBase
 from logging import getLogger
 from ga_dynamic_models.parser import Parser
+from ga_dynamic_models.stores import get_store
+from ga_dynamic_models import metrics
+from ga_dynamic_models import classcache
+import sys
 
-
-if not hasattr(settings, "MONGODB_ROUTES"):
-    raise AttributeError('MONGODB_ROUTES must be filled in')
+# static tables for the SQL definition store.  Imported here so syncdb creates them.
+from ga_dynamic_models.catalog import Definition, DefinitionChange
 
 _log = getLogger(__name__)
 
-if 'ga_dynamic_models' in settings.MONGODB_ROUTES:
-    _db = settings.MONGODB_ROUTES['ga_dynamic_models']
-else:
-    _db = settings.MONGODB_ROUTES['default']
-
-_coll = _db['ga_dynamic_models__models']
-_dynamic_models = _coll.find()
+with metrics.span('catalog.fetch', kind='models'):
+    _dynamic_models = get_store('models').list()
 
 __all__ = []
 
-g = globals()
-p = Parser(__name__, ModelBase)
-for model in _dynamic_models:
-    try:
-        g[model['name']] = p.parse(**model)
-        __all__.append(model['name'])
-    except Exception as e:
-        _log.error("Error creating {model}".format(model=model), str(e))
-        print e
+# archived models have no table; api.py stands a placeholder in for their resources.  See ga_dynamic_models.archive.
+archived_models = []
 
+if classcache.enabled():
+    # classes are built on demand and evicted when they haven't been used in a while.  See ga_dynamic_models.classcache.
+    for model in _dynamic_models:
+        (archived_models if model.get('_archived') else __all__).append(model['name'])
+    del _dynamic_models
+    classcache.install(sys.modules[__name__])
+else:
+    g = globals()
+    p = Parser(__name__, ModelBase)
+    for model in _dynamic_models:
+        if model.get('_archived'):
+            archived_models.append(model['name'])
+            continue
+        try:
+            with metrics.span('catalog.parse', model=model['name']):
+                g[model['name']] = p.parse(**model)
+            __all__.append(model['name'])
+        except Exception as e:
+            metrics.failure(model['name'], e)
@@ -0,0 +1,192 @@
+"""
+Paginators for dynamic model resources.
+
+Tastypie's default Paginator slices the queryset with OFFSET / LIMIT, so the database has to read and throw away every
+row before the page being asked for, and deep pages into big uploaded tables get slower and slower.
+:py:class:`KeysetPaginator` pages with ``WHERE key > last_key`` instead, which costs the same on every page as long as
+the key is indexed.  Turn it on for a resource with ``cursor_pagination=True``::
+
+    declare_resource(simple_model_resource('ga_dynamic_models.models', 'MyModel', 'my_model', cursor_pagination=True))
+
+Pages are keyed on the primary key unless the request has ``order_by`` naming an indexed column (prefix it with ``-`` for
+descending order), in which case the primary key breaks ties.  Geometry columns can't be used, and neither can
+categorical ones (see :py:mod:`ga_dynamic_models.categorical`), whose codes don't sort like their strings; page those
+with ``offset``.  NULLs in a nullable column sort after every other value, and before them in descending order,
+whatever the database's own habit.  Each page's meta carries a ``next`` URI with an opaque ``cursor`` parameter; follow
+it to get the next page.  A request with ``offset`` and no ``cursor`` is paged the old way.
+
+Both paginators here fill in ``total_count`` through :py:func:`ga_dynamic_models.counting.count`, which avoids a full
+``COUNT(*)`` on big tables, and add ``total_count_exact`` to the meta to say whether the count is exact or an estimate.
+:py:class:`EstimatedCountPaginator` is the offset paginator with just that change, and is what dynamic resources use
+unless they ask for cursor pagination.
+"""
+
+from django.db import connections
+from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
+from tastypie.paginator import Paginator
+from tastypie.exceptions import BadRequest
+from ga_dynamic_models import counting
+from urllib import urlencode
+import base64
+import json
+import datetime
+
+
+def encode_cursor(values):
+    """Turn the key values of the last row on a page into an opaque, URL safe token."""
+    return base64.urlsafe_b64encode(json.dumps([_jsonable(v) for v in values]))
+
+
+def decode_cursor(token):
+    """The inverse of :py:func:`encode_cursor`."""
+    try:
+        return json.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError):
+        raise BadRequest("invalid cursor")
+
+
+def _jsonable(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+class EstimatedCountPaginator(Paginator):
+    """Tastypie's offset paginator, with the total count estimated for big tables."""
+
+    count_is_exact = True
+
+    def get_count(self):
+        try:
+            count, self.count_is_exact = counting.count(self.objects)
+            return count
+        except AttributeError:
+            return len(self.objects)
+
+    def page(self):
+        ret = super(EstimatedCountPaginator, self).page()
+        ret['meta']['total_count_exact'] = self.count_is_exact
+        return ret
+
+
+class KeysetPaginator(EstimatedCountPaginator):
+    """
+    Pages on the primary key, or an indexed ``order_by`` column with the primary key breaking ties, using an opaque
+    cursor rather than an offset.
+    """
+
+    def __init__(self, request_data, objects, resource_uri=None, limit=None, offset=0, **kwargs):
+        super(KeysetPaginator, self).__init__(request_data, objects, resource_uri=resource_uri, limit=limit,
+            offset=offset, **kwargs)
+        self.cursor = request_data.get('cursor')
+
+    def key_fields(self):
+        """
+        :return: A list of (field, descending) pairs that define the order of the pages.
+        """
+        meta = self.objects.model._meta
+        order_by = self.request_data.get('order_by')
+        if hasattr(self.request_data, 'getlist') and len(self.request_data.getlist('order_by')) > 1:
+            raise BadRequest("cursor pagination can only order by one field")
+
+        if not order_by or order_by.lstrip('-') in ('pk', meta.pk.name):
+            return [(meta.pk, bool(order_by) and order_by.startswith('-'))]
+
+        descending = order_by.startswith('-')
+        try:
+            field = meta.get_field(order_by.lstrip('-').split('__')[0])
+        except FieldDoesNotExist:
+            raise BadRequest("there is no field named {name} to order by".format(name=order_by.lstrip('-')))
+        if hasattr(field, 'geom_type'):
+            raise BadRequest("cursor pagination can't order by a geometry, and {name} is one".format(name=field.name))
+        if getattr(field, 'categorical', False):
+            raise BadRequest("cursor pagination can't order by a categorical field, and {name} is one; use offset "
+                "instead".format(name=field.name))
+        if not (field.db_index or field.unique):
+            raise BadRequest("cursor pagination can only order by an indexed field, and {name} is not indexed".format(
+                name=field.name))
+        return [(field, descending), (meta.pk, descending)]
+
+    def _past(self, field, descending, value):
+        """
+        :return: A pair of Qs, for the rows whose key comes strictly after ``value`` in the page order and for those
+            whose key is equal to it.  The first is None if no key can come after it.
+        """
+        name = field.attname
+        if value is None:
+            return (Q(**{name + '__isnull' : False}) if descending else None), Q(**{name + '__isnull' : True})
+        after = Q(**{'{name}__{op}'.format(name=name, op='lt' if descending else 'gt') : value})
+        if field.null and not descending:
+            after |= Q(**{name + '__isnull' : True})
+        return after, Q(**{name : value})
+
+    def _after(self, keys, values):
+        # (k1, k2) > (v1, v2)  ==>  k1 > v1 OR (k1 = v1 AND k2 > v2)
+        condition = None
+        equal = Q()
+        for (field, descending), value in zip(keys, values):
+            after, same = self._past(field, descending, value)
+            if after is not None:
+                step = after & equal
+                condition = step if condition is None else condition | step
+            equal &= same
+        # nothing comes after the last NULL of the last key
+        return condition if condition is not None else Q(pk__in=[])
+
+    def _ordered(self, keys):
+        # databases disagree on where NULLs sort, so sort on IS NULL first to put them last
+        qn = connections[self.objects.db].ops.quote_name
+        select, order = {}, []
+        for i, (field, descending) in enumerate(keys):
+            if field.null:
+                alias = '_key_{i}_null'.format(i=i)
+                select[alias] = '{table}.{column} IS NULL'.format(table=qn(self.objects.model._meta.db_table),
+                    column=qn(field.column))
+                order.append(('-' if descending else '') + alias)
+            order.append(('-' if descending else '') + field.attname)
+        objects = self.objects.extra(select=select) if select else self.objects
+        return objects.order_by(*order)
+
+    def get_keyset_slice(self, limit):
+        keys = self.key_fields()
+        objects = self._ordered(keys)
+        if self.cursor:
+            values = decode_cursor(self.cursor)
+            if len(values) != len(keys):
+                raise BadRequest("cursor does not match the requested order")
+            objects = objects.filter(self._after(keys, values))
+
+        page = list(objects[:limit + 1]) if limit else list(objects)
+        more = bool(limit) and len(page) > limit
+        page = page[:limit] if limit else page
+        last = encode_cursor([getattr(page[-1], f.attname) for f, _ in keys]) if (more and page) else None
+        return page, last
+
+    def get_cursor_uri(self, limit, cursor):
+        if self.resource_uri is None or cursor is None:
+            return None
+        request_params = dict((k, v.encode('utf-8') if isinstance(v, unicode) else v)
+                              for k, v in self.request_data.items() if k not in ('offset', 'cursor', 'limit'))
+        request_params['limit'] = limit
+        request_params['cursor'] = cursor
+        return '{uri}?{params}'.format(uri=self.resource_uri, params=urlencode(request_params))
+
+    def page(self):
+        if 'offset' in self.request_data and not self.cursor:
+            return super(KeysetPaginator, self).page()
+
+        limit = self.get_limit()
+        objects, cursor = self.get_keyset_slice(limit)
+        meta = {
+            'limit' : limit,
+            'cursor' : self.cursor,
+            'next' : self.get_cursor_uri(limit, cursor),
+            'previous' : None,
+            'total_count' : self.get_count(),
+        }
+        meta['total_count_exact'] = self.count_is_exact
+        return {
+            getattr(self, 'collection_name', 'objects') : objects,
+            'meta' : meta,
+        }
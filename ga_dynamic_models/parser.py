@@ -11,6 +11,11 @@ define class attributes all you want.  For more on how to do this, see :py:mod:`
 import importlib
 import ga_ows.utils
 
+# Top-level keys of a definition that describe the model to the rest of ga_dynamic_models rather than being attributes
+# of the class: how its table is partitioned (see ga_dynamic_models.partitioning) and what it is derived from (see
+# ga_dynamic_models.derived).  Keys that start with an underscore are bookkeeping and are skipped as well.
+CATALOG_KEYS = ('partition', 'derived')
+
 class Parser(object):
     def __init__(self, module_name, result_metaclass=type):
         self._imports = {}
@@ -114,6 +119,6 @@ class Parser(object):
     
         t = type(name, self._parse_bases(bases), fs)
         for k, v in kwargs.items():
-            if not k.startswith('_'):
-                t.__setattr__(k, self._parse_item(v))
-            return t
\ No newline at end of file
+            if not k.startswith('_') and k not in CATALOG_KEYS:
+                setattr(t, k, self._parse_item(v))
+        return t
\ No newline at end of file
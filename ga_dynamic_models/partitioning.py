@@ -0,0 +1,204 @@
+"""
+Declarative partitioning of large dynamic model tables on PostgreSQL.
+
+A model definition may name a partition key, built with :py:func:`ga_dynamic_models.utils.list_partition` or
+:py:func:`ga_dynamic_models.utils.range_partition`::
+
+    declare_model(simple_model('Permits', partition=list_partition('county'), county=..., issued=..., ...))
+    declare_model(simple_model('Readings', partition=range_partition('taken', 'month'), taken=..., ...))
+
+A *list* partition holds the rows with one value of the column.  A *range* partition holds an interval of a date column
+(``'year'`` or ``'month'``), or of a numeric column (a number, the width of the interval).  Rows whose key is null go in
+a list partition of their own, or the default partition of a range partitioned table.
+
+On PostgreSQL the table is created ``PARTITION BY`` its key when the model is declared, and partitions named
+``<table>__p_<key>`` are created as loads need them.  The loader routes rows to their partitions, and a replacing load
+replaces only the partitions it has rows for: each is built as a separate table, indexed, and swapped in with ``DETACH``
+and ``ATTACH PARTITION`` in the load's transaction, leaving the other partitions as they were.  Uploading one county's
+rows again replaces that county and nothing else.
+
+Other databases have no partitions, but a replacing load keeps the same meaning there: it deletes the rows of the keys
+it loads, rather than the whole table.
+"""
+
+from django.db import connections, router, transaction
+from django.db.backends.util import truncate_name
+from ga_dynamic_models.stores import get_store
+from logging import getLogger
+import datetime
+import hashlib
+import re
+
+_log = getLogger(__name__)
+
+KINDS = ('list', 'range')
+DATE_INTERVALS = ('year', 'month')
+
+
+class Partitioning(object):
+    """
+    How a model's table is partitioned.
+
+    :param column: The name of the partition key column.
+    :param kind: 'list' or 'range'.
+    :param interval: For range partitions, 'year', 'month' or the width of a numeric interval.
+    """
+
+    def __init__(self, column, kind='list', interval=None):
+        if kind not in KINDS:
+            raise ValueError('partitions are by list or by range, not {kind}'.format(kind=kind))
+        if kind == 'range' and interval not in DATE_INTERVALS and not isinstance(interval, (int, long, float)):
+            raise ValueError("a range partition's interval is 'year', 'month' or a number, not {interval!r}".format(
+                interval=interval))
+        self.column = column
+        self.kind = kind
+        self.interval = interval
+
+    @classmethod
+    def of(cls, model):
+        """
+        :return: The Partitioning declared for a model, or None.
+        """
+        definition = get_store('models').get(model.__name__)
+        spec = definition.get('partition') if definition else None
+        return cls(**spec) if spec else None
+
+    def key(self, value):
+        """
+        :param value: A value of the partition column, as the loader converts it.
+        :return: The key of the partition it belongs in: the value itself for a list partition, or the lower bound of
+            its interval for a range partition.
+        """
+        if value is None or self.kind == 'list':
+            return value
+        if self.interval == 'year':
+            return datetime.date(value.year, 1, 1)
+        if self.interval == 'month':
+            return datetime.date(value.year, value.month, 1)
+        return value - value % self.interval
+
+    def upper(self, key):
+        if self.interval == 'year':
+            return datetime.date(key.year + 1, 1, 1)
+        if self.interval == 'month':
+            return datetime.date(key.year + key.month // 12, key.month % 12 + 1, 1)
+        return key + self.interval
+
+    def label(self, key):
+        """
+        :return: A short string for a partition key, safe to use in a table name.
+        """
+        if key is None:
+            return 'null' if self.kind == 'list' else 'default'
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        if self.interval == 'year':
+            return key.strftime('%Y')
+        if self.interval == 'month':
+            return key.strftime('%Y_%m')
+        text = str(key)
+        slug = re.sub('[^a-z0-9]+', '_', text.lower()).strip('_')[:20]
+        if slug == text:
+            return slug
+        return '{slug}_{digest}'.format(slug=slug, digest=hashlib.md5(text).hexdigest()[:6])
+
+    def table(self, table, key, connection):
+        """
+        :return: The name of the partition of ``table`` for a key.
+        """
+        name = '{table}__p_{label}'.format(table=table, label=self.label(key))
+        return truncate_name(name, connection.ops.max_name_length())
+
+    def bounds(self, key):
+        """
+        :return: The ``FOR VALUES`` clause (or ``DEFAULT``) of a partition, and its parameters.
+        """
+        if self.kind == 'list':
+            return ('FOR VALUES IN (NULL)', []) if key is None else ('FOR VALUES IN (%s)', [_literal(key)])
+        if key is None:
+            return 'DEFAULT', []
+        return 'FOR VALUES FROM (%s) TO (%s)', [_literal(key), _literal(self.upper(key))]
+
+    def predicate(self, key, qn):
+        """
+        :return: A WHERE clause selecting the rows of a partition, and its parameters.
+        """
+        column = qn(self.column)
+        if key is None:
+            return '{column} IS NULL'.format(column=column), []
+        if self.kind == 'list':
+            return '{column} = %s'.format(column=column), [key]
+        return '{column} >= %s AND {column} < %s'.format(column=column), [key, self.upper(key)]
+
+    def as_dict(self):
+        spec = {'column' : self.column, 'kind' : self.kind}
+        if self.interval is not None:
+            spec['interval'] = self.interval
+        return spec
+
+
+def _literal(value):
+    # Before PostgreSQL 12 partition bounds must be plain literals, not the casts psycopg2 writes dates as.
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def is_partitioned(connection, table):
+    """
+    :return: Whether a table is a PostgreSQL partitioned table.
+    """
+    if connection.vendor != 'postgresql':
+        return False
+    cursor = connection.cursor()
+    cursor.execute('SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid '
+                   'WHERE c.oid = %s::regclass', [connection.ops.quote_name(table)])
+    return cursor.fetchone() is not None
+
+
+def partitions(connection, table):
+    """
+    :return: The names of a partitioned table's partitions.
+    """
+    cursor = connection.cursor()
+    cursor.execute('SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+                   'WHERE i.inhparent = %s::regclass', [connection.ops.quote_name(table)])
+    return [row[0] for row in cursor.fetchall()]
+
+
+def create_parent(model, using=None):
+    """
+    Turn a partitioned model's table, as ``syncdb`` created it, into a PostgreSQL partitioned table.  Only an empty
+    table is converted.  The primary key becomes a constraint on each partition, since PostgreSQL only allows one on
+    the whole table if it includes the partition key.
+
+    :return: Whether the table is now partitioned.
+    """
+    partitioning = Partitioning.of(model)
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    if partitioning is None or connection.vendor != 'postgresql':
+        return False
+    table = model._meta.db_table
+    if is_partitioned(connection, table):
+        return True
+
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    cursor.execute('SELECT EXISTS (SELECT 1 FROM {table})'.format(table=qn(table)))
+    if cursor.fetchone()[0]:
+        _log.warn('{table} already has rows and was not partitioned'.format(table=table))
+        return False
+
+    parent = truncate_name(table + '__parent', connection.ops.max_name_length())
+    pk = model._meta.pk.column
+    cursor.execute('CREATE TABLE {parent} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) '
+                   'PARTITION BY {kind} ({column})'.format(
+        parent=qn(parent), table=qn(table), kind=partitioning.kind.upper(), column=qn(partitioning.column)))
+    cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [table, pk])
+    sequence = cursor.fetchone()[0]
+    if sequence:
+        cursor.execute('ALTER SEQUENCE {sequence} OWNED BY {parent}.{pk}'.format(
+            sequence=sequence, parent=qn(parent), pk=qn(pk)))
+    cursor.execute('DROP TABLE {table}'.format(table=qn(table)))
+    cursor.execute('ALTER TABLE {parent} RENAME TO {table}'.format(parent=qn(parent), table=qn(table)))
+    transaction.commit_unless_managed(using=using)
+    return True
@@ -0,0 +1,231 @@
+"""
+Records which columns dynamic resources are actually filtered and ordered on, and how long those list requests take.
+
+:py:class:`ga_dynamic_models.resources.DynamicResourceMixin` calls :py:func:`record` after every list request that
+wasn't answered from the response cache.  Each process adds up what it sees and merges its totals into Django's cache
+every ``GA_DYNAMIC_MODELS_QUERY_LOG_FLUSH`` seconds (30 by default), so that with a shared cache the totals cover every
+worker.  The totals are kept for ``GA_DYNAMIC_MODELS_QUERY_LOG_TIMEOUT`` seconds (30 days by default) after they last
+changed.  Requests slower than ``GA_DYNAMIC_MODELS_SLOW_QUERY_MS`` (500 by default) are kept as samples along with the
+database's plan for their query.  Set ``GA_DYNAMIC_MODELS_QUERY_LOG = False`` to record nothing.
+
+:py:mod:`ga_dynamic_models.advisor` reads the totals to recommend indexes.
+
+This module also holds the filter allowlist.  With ``GA_DYNAMIC_MODELS_FILTER_ALLOWLIST = True`` in settings, or
+``filter_allowlist = True`` in a resource's Meta, filtering or ordering on a column with no index is refused once the
+table has more than ``GA_DYNAMIC_MODELS_UNINDEXED_FILTER_ROWS`` rows (100,000 by default), instead of letting the
+request scan the whole table.  This matters most for resources declared with
+:py:func:`ga_dynamic_models.aux.universal_filter`.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, DatabaseError
+from ga_dynamic_models import counting
+from logging import getLogger
+import threading
+import time
+
+_log = getLogger(__name__)
+
+MAX_SLOW_SAMPLES = 20
+
+
+def enabled():
+    return getattr(settings, 'GA_DYNAMIC_MODELS_QUERY_LOG', True)
+
+
+def slow_seconds():
+    return getattr(settings, 'GA_DYNAMIC_MODELS_SLOW_QUERY_MS', 500) / 1000.0
+
+
+def timeout():
+    return getattr(settings, 'GA_DYNAMIC_MODELS_QUERY_LOG_TIMEOUT', 30 * 24 * 3600)
+
+
+def _key(resource_name):
+    return 'ga_dynamic_models:querylog:{name}'.format(name=resource_name)
+
+
+_RESOURCES_KEY = 'ga_dynamic_models:querylog:resources'
+
+_pending = {}
+_last_flush = [time.time()]
+_lock = threading.Lock()
+
+
+def fields_of(lookups):
+    """
+    :param lookups: ORM lookups such as 'county__exact', or order_by arguments such as '-year'.
+    :return: The set of field names they use.
+    """
+    return set(lookup.lstrip('-').split('__')[0] for lookup in lookups)
+
+
+def explain(queryset):
+    """
+    :return: The database's plan for a queryset as text, or None if it couldn't be had.
+    """
+    connection = connections[queryset.db]
+    try:
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        if connection.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        else:
+            cursor.execute('EXPLAIN ' + sql, params)
+        return '\n'.join(' '.join(unicode(c) for c in row) for row in cursor.fetchall())
+    except DatabaseError:
+        return None
+
+
+def _empty(model_name, table):
+    return {'model' : model_name, 'table' : table, 'requests' : 0, 'seconds' : 0.0, 'fields' : {}, 'slow' : []}
+
+
+def record(resource_name, model, filters, order_by, seconds, queryset=None):
+    """
+    Record one list request.
+
+    :param resource_name: The resource it was made to.
+    :param model: The resource's model class.
+    :param filters: The ORM lookups it filtered with.
+    :param order_by: The order_by arguments it sorted with.
+    :param seconds: How long it took.
+    :param queryset: The query it ran, for the plan of a slow request.
+    """
+    if not enabled():
+        return
+    filtered, ordered = fields_of(filters), fields_of(order_by)
+    slow = seconds >= slow_seconds()
+    sample = None
+    if slow:
+        sample = {
+            'filters' : sorted(filters),
+            'order_by' : list(order_by),
+            'ms' : int(seconds * 1000),
+            'at' : time.time(),
+            'plan' : explain(queryset) if queryset is not None else None,
+        }
+        _log.info('slow query on {name} ({ms} ms): {filters} {order_by}'.format(name=resource_name, **sample))
+
+    with _lock:
+        entry = _pending.setdefault(resource_name, _empty(model.__name__, model._meta.db_table))
+        entry['requests'] += 1
+        entry['seconds'] += seconds
+        for name in filtered | ordered:
+            field = entry['fields'].setdefault(name, {'filter' : 0, 'order' : 0, 'seconds' : 0.0})
+            field['filter'] += name in filtered
+            field['order'] += name in ordered
+            field['seconds'] += seconds
+        if sample:
+            entry['slow'].append(sample)
+    if slow or time.time() - _last_flush[0] >= getattr(settings, 'GA_DYNAMIC_MODELS_QUERY_LOG_FLUSH', 30):
+        flush()
+
+
+def flush():
+    """Merge this process's totals into the shared ones."""
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _last_flush[0] = time.time()
+
+    resources = cache.get(_RESOURCES_KEY) or set()
+    for name, entry in pending.items():
+        total = cache.get(_key(name)) or _empty(entry['model'], entry['table'])
+        total['requests'] += entry['requests']
+        total['seconds'] += entry['seconds']
+        for field, counts in entry['fields'].items():
+            into = total['fields'].setdefault(field, {'filter' : 0, 'order' : 0, 'seconds' : 0.0})
+            for k, v in counts.items():
+                into[k] += v
+        total['slow'] = (total['slow'] + entry['slow'])[-MAX_SLOW_SAMPLES:]
+        cache.set(_key(name), total, timeout())
+        resources.add(name)
+    if pending:
+        cache.set(_RESOURCES_KEY, resources, timeout())
+
+
+def get(resource_name=None):
+    """
+    :param resource_name: A resource, or None for all of them.
+    :return: The recorded totals for the resource, or a dict of them keyed by resource name.
+    """
+    flush()
+    if resource_name is not None:
+        return cache.get(_key(resource_name))
+    names = cache.get(_RESOURCES_KEY) or set()
+    return dict((name, cache.get(_key(name))) for name in names if cache.get(_key(name)))
+
+
+def reset(resource_name=None):
+    names = [resource_name] if resource_name else list(cache.get(_RESOURCES_KEY) or [])
+    for name in names:
+        cache.delete(_key(name))
+    if resource_name is None:
+        cache.delete(_RESOURCES_KEY)
+
+
+# The filter allowlist
+
+def _indexes_key(table):
+    return 'ga_dynamic_models:indexes:{table}'.format(table=table)
+
+
+def indexed_columns(model):
+    """
+    :return: The set of the model's columns that lead an index, found by introspecting the database.
+    """
+    table = model._meta.db_table
+    columns = cache.get(_indexes_key(table))
+    if columns is None:
+        connection = connections[model._default_manager.db]
+        cursor = connection.cursor()
+        try:
+            if connection.vendor == 'sqlite':
+                # Django's introspection reports every column of an SQLite table, so ask SQLite directly.
+                columns = set()
+                cursor.execute('PRAGMA index_list({table})'.format(table=connection.ops.quote_name(table)))
+                for index in [row[1] for row in cursor.fetchall()]:
+                    cursor.execute('PRAGMA index_info({index})'.format(index=connection.ops.quote_name(index)))
+                    columns.update(row[2] for row in cursor.fetchall() if row[0] == 0)
+            else:
+                columns = set(connection.introspection.get_indexes(cursor, table).keys())
+        except (DatabaseError, NotImplementedError):
+            columns = set()
+        cache.set(_indexes_key(table), columns, 300)
+    return columns
+
+
+def forget_indexes(model):
+    cache.delete(_indexes_key(model._meta.db_table))
+
+
+def is_indexed(model, name):
+    """
+    :return: Whether filtering or ordering on a field can use an index.
+    """
+    try:
+        field = model._meta.get_field(name)
+    except Exception:
+        return False
+    if field.primary_key or field.unique or field.db_index or hasattr(field, 'geom_type'):
+        return True
+    return field.column in indexed_columns(model)
+
+
+def unindexed_row_limit():
+    return getattr(settings, 'GA_DYNAMIC_MODELS_UNINDEXED_FILTER_ROWS', 100000)
+
+
+def disallowed(model, names):
+    """
+    :param model: A model class.
+    :param names: The field names a request filters or orders on.
+    :return: The ones it may not use because they aren't indexed and the table is too big, sorted.
+    """
+    unindexed = sorted(name for name in names if not is_indexed(model, name))
+    if not unindexed:
+        return []
+    rows = counting.count(model._default_manager.all())[0]
+    return unindexed if rows > unindexed_row_limit() else []
@@ -0,0 +1,216 @@
+"""
+Rolling reloads for the WSGI workers that serve dynamic models.
+
+Model and resource classes are built when a worker imports :py:mod:`ga_dynamic_models.models` and
+:py:mod:`ga_dynamic_models.api`, so a worker only sees a new declaration after it has been restarted.  Restarting the
+whole supervisor group at once takes the site down, so instead the coordinator here cycles workers one at a time.
+
+Workers are listed in settings like this::
+
+    GA_DYNAMIC_MODELS_WORKERS = [
+        { 'process' : 'ga:ga_8001', 'ready_url' : 'http://127.0.0.1:8001/ga_dynamic_models/ready/' },
+        { 'process' : 'ga:ga_8002', 'ready_url' : 'http://127.0.0.1:8002/ga_dynamic_models/ready/' },
+        { 'process' : 'ga:ga_8003', 'ready_url' : 'http://127.0.0.1:8003/ga_dynamic_models/ready/' },
+    ]
+
+Every process should be in the load balancer's upstream list.  If one of them is left stopped in supervisor, it is used
+as a spare: the coordinator starts the spare, waits for it to report ready, and only then stops an old worker, which
+becomes the spare for the next step.  Without a spare, each worker is restarted in place and the next one is not
+touched until the restarted worker reports ready again.  If no workers are configured at all, the old behavior of
+restarting the whole ``ga`` group is kept.
+
+Reload requests are coalesced.  :py:func:`request_reload` hands out a ticket and schedules the Celery task after
+``GA_DYNAMIC_MODELS_RELOAD_DELAY`` seconds; when the task runs, only the newest ticket actually reloads, so a burst of
+uploads produces a single reload.  A request that arrives while a reload is running is picked up by another reload
+once the current one finishes.
+
+The tickets are kept in Django's default cache, which the web workers and the Celery workers must share (memcached,
+say), so a per-process cache is refused.  They are kept for ``GA_DYNAMIC_MODELS_RELOAD_TICKET_TIMEOUT`` seconds, 30 days
+by default; an explicit timeout is needed because Django 1.4 reads None as the cache's default of 300 seconds.  A reload
+in which some worker didn't come back up isn't recorded as done, so the next request reloads again.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.exceptions import ImproperlyConfigured
+from logging import getLogger
+import subprocess
+import urllib2
+import json
+import time
+
+_log = getLogger(__name__)
+
+REQUESTED_KEY = 'ga_dynamic_models:reload:requested'
+COMPLETED_KEY = 'ga_dynamic_models:reload:completed'
+LOCK_KEY = 'ga_dynamic_models:reload:lock'
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def ticket_timeout():
+    # the longest relative timeout memcached accepts; longer ones are read as timestamps.
+    return _setting('GA_DYNAMIC_MODELS_RELOAD_TICKET_TIMEOUT', 60 * 60 * 24 * 30)
+
+
+def _check_cache():
+    if isinstance(cache, (LocMemCache, DummyCache)):
+        raise ImproperlyConfigured(
+            'reload tickets need a cache shared by the web and Celery workers, not {backend}'.format(
+                backend=type(cache).__name__))
+
+
+def workers():
+    """The list of configured worker processes, possibly empty."""
+    return _setting('GA_DYNAMIC_MODELS_WORKERS', [])
+
+
+def supervisorctl(*args):
+    """
+    Run a supervisorctl command.
+
+    :param args: The command and its arguments, e.g. ``('start', 'ga:ga_8001')``
+    :return: The output of the command as a string.
+    """
+    command = [_setting('GA_DYNAMIC_MODELS_SUPERVISORCTL', 'supervisorctl')] + list(args)
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out, _ = proc.communicate()
+    return out
+
+
+def is_running(worker):
+    """Whether supervisor reports the worker's process as RUNNING."""
+    return 'RUNNING' in supervisorctl('status', worker['process'])
+
+
+def boot_id(worker):
+    """
+    Ask a worker which boot it is on.
+
+    :param worker: A worker dict from GA_DYNAMIC_MODELS_WORKERS
+    :return: The boot id the worker reports from its ready endpoint, or None if it is not ready.
+    """
+    try:
+        response = urllib2.urlopen(worker['ready_url'], timeout=_setting('GA_DYNAMIC_MODELS_READY_POLL_TIMEOUT', 2))
+        if response.getcode() != 200:
+            return None
+        return json.loads(response.read())['boot_id']
+    except Exception:
+        return None
+
+
+def wait_until_ready(worker, previous_boot=None):
+    """
+    Poll a worker's ready endpoint until it answers on a boot other than ``previous_boot``.
+
+    :param worker: A worker dict from GA_DYNAMIC_MODELS_WORKERS
+    :param previous_boot: The boot id the worker had before it was restarted, if any.
+    :return: True if the worker became ready before GA_DYNAMIC_MODELS_READY_TIMEOUT expired.
+    """
+    deadline = time.time() + _setting('GA_DYNAMIC_MODELS_READY_TIMEOUT', 120)
+    interval = _setting('GA_DYNAMIC_MODELS_READY_INTERVAL', 0.5)
+    while time.time() < deadline:
+        current = boot_id(worker)
+        if current is not None and current != previous_boot:
+            return True
+        time.sleep(interval)
+    return False
+
+
+class ReloadCoordinator(object):
+    """
+    Cycles the configured workers one at a time so that at least N-1 of them are serving throughout a reload.
+    """
+
+    def __init__(self, worker_list=None):
+        self.workers = list(worker_list if worker_list is not None else workers())
+
+    def reload(self):
+        """
+        :return: True if every worker was reloaded and came back up.
+        """
+        if not self.workers:
+            return subprocess.call("supervisorctl restart ga", shell=True) == 0
+
+        running = [w for w in self.workers if is_running(w)]
+        spares = [w for w in self.workers if w not in running]
+
+        ok = True
+        for old in running:
+            if spares:
+                ok = self._swap(old, spares) and ok
+            else:
+                ok = self._restart_in_place(old) and ok
+        return ok
+
+    def _swap(self, old, spares):
+        new = spares.pop(0)
+        supervisorctl('start', new['process'])
+        if not wait_until_ready(new):
+            # never retire a healthy worker in favor of one that didn't come up.
+            _log.error('worker {process} did not become ready; leaving {old} running'.format(
+                process=new['process'], old=old['process']))
+            supervisorctl('stop', new['process'])
+            spares.append(new)
+            return False
+        supervisorctl('stop', old['process'])
+        spares.append(old)
+        return True
+
+    def _restart_in_place(self, worker):
+        previous = boot_id(worker)
+        supervisorctl('restart', worker['process'])
+        if not wait_until_ready(worker, previous):
+            _log.error('worker {process} did not become ready after restart'.format(process=worker['process']))
+            return False
+        return True
+
+
+def request_reload():
+    """
+    Ask for the workers to be reloaded.  Requests made within GA_DYNAMIC_MODELS_RELOAD_DELAY seconds of each other are
+    collapsed into a single reload.
+
+    :return: The ticket number for this request.
+    :raises ImproperlyConfigured: if the default cache isn't shared between processes.
+    """
+    from ga_dynamic_models import tasks
+
+    _check_cache()
+    cache.add(REQUESTED_KEY, 0, ticket_timeout())
+    ticket = cache.incr(REQUESTED_KEY)
+    tasks.restart_ga.apply_async(args=[ticket], countdown=_setting('GA_DYNAMIC_MODELS_RELOAD_DELAY', 2))
+    return ticket
+
+
+def run_reload(ticket=None):
+    """
+    Carry out a reload on behalf of ``ticket``.
+
+    :param ticket: The ticket from :py:func:`request_reload`.  If None the reload is unconditional.
+    :return: 'superseded' if a newer ticket will do the work, 'busy' if another reload holds the lock (the caller should
+        try again later), 'failed' if some worker didn't come back up, or 'reloaded'.
+    :raises ImproperlyConfigured: if the default cache isn't shared between processes.
+    """
+    _check_cache()
+    if ticket is not None and ticket < (cache.get(REQUESTED_KEY) or 0):
+        return 'superseded'
+
+    if not cache.add(LOCK_KEY, ticket or 0, _setting('GA_DYNAMIC_MODELS_RELOAD_LOCK_TIMEOUT', 600)):
+        return 'busy'
+
+    try:
+        if ticket is not None and ticket <= (cache.get(COMPLETED_KEY) or 0):
+            return 'superseded'
+        # anything requested after this point needs another reload, so record what this one covers before starting.
+        covered = cache.get(REQUESTED_KEY) or 0
+        if not ReloadCoordinator().reload():
+            return 'failed'
+        cache.set(COMPLETED_KEY, covered, ticket_timeout())
+        return 'reloaded'
+    finally:
+        cache.delete(LOCK_KEY)
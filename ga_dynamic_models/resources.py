@@ -0,0 +1,504 @@
+"""
+Base classes for the Tastypie resources that :py:func:`ga_dynamic_models.utils.simple_model_resource` and
+:py:func:`ga_dynamic_models.utils.simple_geo_resource` declare.  They behave like Tastypie's ModelResource and
+ga_ows' GeoResource, with the additions in :py:class:`DynamicResourceMixin`.
+
+Resources declared before these existed still name ModelResource or GeoResource directly and don't get the additions
+until they are declared again.
+
+These are written against Tastypie 0.9.11, which ga_ows' GeoResource is built on: the resource level ``is_authorized``,
+``override_urls``, ``obj_get_list(request=...)`` and ``full_dehydrate(bundle)``.
+"""
+
+from django.conf import settings
+from django.conf.urls.defaults import url
+from django.core.urlresolvers import RegexURLResolver, Resolver404
+from django.http import HttpResponse, HttpResponseNotModified, HttpResponseNotFound, HttpResponseForbidden, Http404
+from django.utils.cache import patch_vary_headers
+from django.views.decorators.csrf import csrf_exempt
+from tastypie.resources import Resource, ModelResource
+from tastypie import fields
+from tastypie.exceptions import BadRequest, ImmediateHttpResponse
+from tastypie.authorization import Authorization, ReadOnlyAuthorization
+from tastypie.utils import trailing_slash
+from ga_ows.tastyhacks import GeoResource
+from ga_dynamic_models import generations
+from ga_dynamic_models import response_cache
+from ga_dynamic_models import metrics
+from ga_dynamic_models import export
+from ga_dynamic_models import snapshot
+from ga_dynamic_models import tiles
+from ga_dynamic_models import aggregation
+from ga_dynamic_models import stats
+from ga_dynamic_models import querylog
+from ga_dynamic_models import categorical
+from ga_dynamic_models import search
+from ga_dynamic_models import usage
+from ga_dynamic_models import archive
+from ga_dynamic_models import classcache
+import threading
+import json
+import time
+import os
+
+_observed = threading.local()
+
+
+class DynamicResourceMixin(object):
+    """
+    Adds a response cache to a resource.  GET responses are cached and tagged with an ETag that changes with the
+    model's data generation; see :py:mod:`ga_dynamic_models.response_cache`.  Requests are authenticated, authorized
+    and throttled before the cache is looked at, and unless the resource's authorization is Tastypie's
+    ``Authorization`` or ``ReadOnlyAuthorization``, which give everyone the same rows, responses are cached per user.
+    Set ``cache_responses = False`` in the resource's Meta to turn this off for one resource.
+
+    Also adds the streaming export endpoints described in :py:mod:`ga_dynamic_models.export`, the columnar snapshot
+    endpoints described in :py:mod:`ga_dynamic_models.snapshot`, the aggregate endpoint described in
+    :py:mod:`ga_dynamic_models.aggregation`, the column statistics endpoint described in
+    :py:mod:`ga_dynamic_models.stats`, the search endpoint described in :py:mod:`ga_dynamic_models.search` and, for
+    models with geometry, the vector tile endpoint described in :py:mod:`ga_dynamic_models.tiles`.
+
+    List requests are timed and the fields they filter and order on recorded; see :py:mod:`ga_dynamic_models.querylog`.
+    Set ``filter_allowlist = True`` in the resource's Meta to refuse filtering or ordering a large table on a field with
+    no index.
+
+    Dictionary encoded columns (see :py:mod:`ga_dynamic_models.categorical`) are served, filtered and ordered by their
+    strings.
+
+    A ``fields`` parameter, given any number of times or as a comma separated list, limits a response to the fields it
+    names (and ``resource_uri``).  Only those columns are read from the database and serialized, so leaving out wide
+    text or geometry columns shrinks both.  Exports and searches take it too.
+
+    Every request is counted towards the model's usage (see :py:mod:`ga_dynamic_models.usage`), and requests for a
+    model that has been archived since the worker started are answered as :py:class:`ArchivedResource` answers them.
+    """
+
+    def model_name(self):
+        return self._meta.object_class.__name__ if self._meta.object_class else None
+
+    def response_cache_backend(self, view):
+        """
+        :return: The cache for a view's responses, or None if they aren't cached.  Tiles have a cache of their own.
+        """
+        if not getattr(self._meta, 'cache_responses', True):
+            return None
+        return tiles.get_cache() if view == 'tile' else response_cache.get_backend()
+
+    def shares_rows(self):
+        """
+        :return: Whether the resource's authorization gives everyone the same rows: it is Tastypie's ``Authorization``
+            or ``ReadOnlyAuthorization``.
+        """
+        return type(self._meta.authorization) in (Authorization, ReadOnlyAuthorization)
+
+    def refuse_limited(self, what):
+        """
+        Refuse a view that reads the table without going through the authorization's limits, unless there are none.
+
+        :param what: What the view serves, for the error.
+        :raises ImmediateHttpResponse: with a 403, if the resource's authorization limits the rows a user sees.
+        """
+        if not self.shares_rows():
+            raise ImmediateHttpResponse(response=HttpResponseForbidden(json.dumps({
+                'error' : "{what} can't be limited to the rows you may see, and this resource limits them".format(
+                    what=what)}), content_type='application/json'))
+
+    def cache_scope(self, request):
+        """
+        :return: Who a cached response may be shared with: '' for everyone, or the user it was made for.
+        """
+        if self.shares_rows():
+            return ''
+        user = getattr(request, 'user', None)
+        if user is None or not user.is_authenticated():
+            return 'anonymous'
+        return 'user:{pk}'.format(pk=user.pk)
+
+    @classmethod
+    def api_field_from_django_field(cls, f, default=fields.CharField):
+        if getattr(f, 'categorical', False):
+            return fields.CharField
+        return super(DynamicResourceMixin, cls).api_field_from_django_field(f, default=default)
+
+    def sparse_fields(self, query):
+        """
+        :param query: A request's GET parameters.
+        :return: The set of resource fields asked for with ``fields``, or None for all of them.
+        """
+        names = [name.strip() for value in query.getlist('fields') for name in value.split(',') if name.strip()]
+        if not names:
+            return None
+        unknown = [name for name in names if name not in self.fields]
+        if unknown:
+            raise BadRequest("There is no field {names} in {resource}.".format(
+                names=', '.join(unknown), resource=self._meta.resource_name))
+        return set(names + [name for name in ('resource_uri',) if name in self.fields])
+
+    def model_fields(self, requested):
+        """
+        :param requested: A set of resource fields, from :py:meth:`sparse_fields`.
+        :return: The names of the model fields they are read from, or None if one of them isn't simply a model field.
+        """
+        if requested is None or self._meta.object_class is None:
+            return None
+        concrete = set(f.name for f in self._meta.object_class._meta.fields)
+        names = []
+        for name in requested:
+            if name == 'resource_uri':
+                continue
+            attribute = getattr(self.fields[name], 'attribute', None)
+            if attribute not in concrete:
+                return None
+            names.append(attribute)
+        return names
+
+    def only_requested(self, objects, requested):
+        """Defer loading the columns of the fields that weren't asked for."""
+        names = self.model_fields(requested)
+        return objects.only(*names) if names is not None and hasattr(objects, 'only') else objects
+
+    def full_dehydrate(self, bundle):
+        requested = self.sparse_fields(bundle.request.GET) if bundle.request is not None else None
+        if requested is None:
+            return super(DynamicResourceMixin, self).full_dehydrate(bundle)
+        for field_name, field_object in self.fields.items():
+            if field_name not in requested:
+                continue
+            if getattr(field_object, 'dehydrated_type', None) == 'related':
+                field_object.api_name = self._meta.api_name
+                field_object.resource_name = self._meta.resource_name
+            bundle.data[field_name] = field_object.dehydrate(bundle)
+            method = getattr(self, "dehydrate_%s" % field_name, None)
+            if method:
+                bundle.data[field_name] = method(bundle)
+        return self.dehydrate(bundle)
+
+    def filter_allowlist(self):
+        return getattr(self._meta, 'filter_allowlist', getattr(settings, 'GA_DYNAMIC_MODELS_FILTER_ALLOWLIST', False))
+
+    def check_indexed(self, lookups, what):
+        if not self.filter_allowlist() or self._meta.object_class is None:
+            return
+        refused = querylog.disallowed(self._meta.object_class, querylog.fields_of(lookups))
+        if refused:
+            raise BadRequest("{what} on {fields} isn't allowed because {plural} no index.".format(
+                what=what, fields=', '.join(refused), plural='it has' if len(refused) == 1 else 'they have'))
+
+    def build_filters(self, filters=None):
+        applicable = super(DynamicResourceMixin, self).build_filters(filters)
+        self.check_indexed(applicable.keys(), 'Filtering')
+        if self._meta.object_class is not None:
+            applicable = categorical.rewrite_filters(self._meta.object_class, applicable)
+        _observed.filters = applicable.keys()
+        return applicable
+
+    def apply_sorting(self, obj_list, options=None):
+        objects = super(DynamicResourceMixin, self).apply_sorting(obj_list, options)
+        if options is not None:
+            objects = self.only_requested(objects, self.sparse_fields(options))
+        if hasattr(objects, 'query'):
+            self.check_indexed(objects.query.order_by, 'Ordering')
+            objects = categorical.order_by_value(objects)
+            _observed.queryset = objects
+        return objects
+
+    def get_list(self, request, **kwargs):
+        _observed.filters = ()
+        _observed.queryset = None
+        started = time.time()
+        response = super(DynamicResourceMixin, self).get_list(request, **kwargs)
+        if self._meta.object_class is not None:
+            queryset = _observed.queryset
+            querylog.record(self._meta.resource_name, self._meta.object_class, _observed.filters,
+                queryset.query.order_by if queryset is not None else (), time.time() - started, queryset)
+        _observed.queryset = None
+        return response
+
+    def override_urls(self):
+        urls = [
+            url(r"^(?P<resource_name>{name})/export\.(?P<format>csv|ndjson|geojson){slash}$".format(
+                name=self._meta.resource_name, slash=trailing_slash()),
+                self.wrap_view('export'), name='api_export_{name}'.format(name=self._meta.resource_name)),
+            url(r"^(?P<resource_name>{name})/snapshot\.gasnap{slash}$".format(
+                name=self._meta.resource_name, slash=trailing_slash()),
+                self.wrap_view('snapshot'), name='api_snapshot_{name}'.format(name=self._meta.resource_name)),
+            url(r"^(?P<resource_name>{name})/snapshot/(?P<column>[\w.]+)\.npy{slash}$".format(
+                name=self._meta.resource_name, slash=trailing_slash()),
+                self.wrap_view('snapshot'), name='api_snapshot_column_{name}'.format(name=self._meta.resource_name)),
+            url(r"^(?P<resource_name>{name})/aggregate{slash}$".format(
+                name=self._meta.resource_name, slash=trailing_slash()),
+                self.wrap_view('aggregate'), name='api_aggregate_{name}'.format(name=self._meta.resource_name)),
+            url(r"^(?P<resource_name>{name})/stats{slash}$".format(
+                name=self._meta.resource_name, slash=trailing_slash()),
+                self.wrap_view('stats'), name='api_stats_{name}'.format(name=self._meta.resource_name)),
+            url(r"^(?P<resource_name>{name})/search{slash}$".format(
+                name=self._meta.resource_name, slash=trailing_slash()),
+                self.wrap_view('search'), name='api_search_{name}'.format(name=self._meta.resource_name)),
+        ]
+        if self._meta.object_class is not None and tiles.geometry_field(self._meta.object_class) is not None:
+            urls.append(url(r"^(?P<resource_name>{name})/tiles/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.mvt$".format(
+                name=self._meta.resource_name),
+                self.wrap_view('tile'), name='api_tile_{name}'.format(name=self._meta.resource_name)))
+        return urls
+
+    def export(self, request, format=None, **kwargs):
+        """Stream every row matching the request's filters, unpaginated."""
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+        self.log_throttled_access(request)
+
+        objects = self.obj_get_list(request=request, **self.remove_api_resource_names(kwargs))
+        requested = self.sparse_fields(request.GET)
+        try:
+            return export.export_response(request, objects, format, self._meta.resource_name,
+                fields=self.model_fields(requested) if requested is not None else None)
+        except ValueError as e:
+            raise BadRequest(str(e))
+
+    def snapshot(self, request, column=None, **kwargs):
+        """
+        Serve the model's columnar snapshot, or one column of it as a .npy file.  A snapshot holds every row, so it is
+        refused if the resource's authorization limits them.
+        """
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.is_authorized(request)
+        self.refuse_limited('Snapshots')
+        self.throttle_check(request)
+        self.log_throttled_access(request)
+
+        try:
+            path = snapshot.get(self._meta.object_class)
+        except snapshot.Building as e:
+            response = HttpResponse(json.dumps({'error' : str(e)}), content_type='application/json', status=503)
+            response['Retry-After'] = str(snapshot.retry_after())
+            return response
+        etag = '"{name}"'.format(name=os.path.basename(path))
+        if column is None:
+            return snapshot.serve(request, path, 0, os.path.getsize(path), 'application/octet-stream', etag,
+                '{name}.gasnap'.format(name=self._meta.resource_name))
+        try:
+            start, end = snapshot.column_range(path, column)
+        except KeyError:
+            return HttpResponseNotFound()
+        return snapshot.serve(request, path, start, end, 'application/octet-stream', etag,
+            '{name}.{column}.npy'.format(name=self._meta.resource_name, column=column))
+
+    def aggregate(self, request, **kwargs):
+        """Group and aggregate the rows matching the request's filters."""
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+        self.log_throttled_access(request)
+
+        objects = self.obj_get_list(request=request, **self.remove_api_resource_names(kwargs))
+        group_by = [name for value in request.GET.getlist('group_by') for name in value.split(',') if name]
+        requested = aggregation.parse_metrics(request.GET.getlist('metric'))
+        try:
+            rows, rollup = aggregation.answer(objects, group_by, requested)
+        except ValueError as e:
+            raise BadRequest(str(e))
+        return self.create_response(request, {
+            'meta' : {
+                'group_by' : group_by,
+                'metrics' : [aggregation.metric_name(f, c) for f, c in requested],
+                'rollup' : rollup,
+                'total_count' : len(rows),
+            },
+            'objects' : rows,
+        })
+
+    def stats(self, request, **kwargs):
+        """Serve the column statistics recorded when the model's table was last loaded."""
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+        self.log_throttled_access(request)
+
+        profile = stats.get(self.model_name())
+        if profile is None:
+            return HttpResponseNotFound()
+        return self.create_response(request, profile)
+
+    def search(self, request, **kwargs):
+        """Find the rows matching the request's filters that best match its ``q``, best first."""
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+        self.log_throttled_access(request)
+
+        text = request.GET.get('q', '').strip()
+        if not text:
+            raise BadRequest('Searching needs a q parameter.')
+        try:
+            limit = min(int(request.GET.get('limit', 20)), search.max_limit())
+        except ValueError:
+            raise BadRequest('limit must be a number.')
+        objects = self.obj_get_list(request=request, **self.remove_api_resource_names(kwargs))
+        try:
+            found = list(self.only_requested(search.search(objects, text), self.sparse_fields(request.GET))[:limit])
+        except ValueError as e:
+            raise BadRequest(str(e))
+        bundles = []
+        for obj in found:
+            bundle = self.full_dehydrate(self.build_bundle(obj=obj, request=request))
+            bundle.data['search_rank'] = obj.search_rank
+            bundles.append(bundle)
+        return self.create_response(request, {
+            'meta' : {
+                'q' : text,
+                'limit' : limit,
+                'method' : search.declaration(self.model_name())['method'],
+                'total_count' : len(bundles),
+            },
+            'objects' : bundles,
+        })
+
+    def tile(self, request, z, x, y, **kwargs):
+        """
+        Serve a vector tile of the model's rows.  Tiles are read with SQL of their own, which authorization limits on
+        the list can't be applied to, so they are refused if there are any.
+        """
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.is_authorized(request)
+        self.refuse_limited('Tiles')
+        self.throttle_check(request)
+        self.log_throttled_access(request)
+
+        try:
+            content, truncated = tiles.render(self._meta.object_class, self._meta.resource_name, int(z), int(x), int(y))
+        except ValueError:
+            return HttpResponseNotFound()
+        response = HttpResponse(content, content_type=tiles.CONTENT_TYPE)
+        if truncated:
+            response['X-Tile-Truncated'] = 'true'
+        return response
+
+    def wrap_view(self, view):
+        wrapped = super(DynamicResourceMixin, self).wrap_view(view)
+
+        @csrf_exempt
+        def wrapper(request, *args, **kwargs):
+            name = self.model_name()
+            usage.touch(name)
+            if name is not None and archive.is_archived(name):
+                return archive.unavailable(name)
+
+            backend = self.response_cache_backend(view)
+            if request.method != 'GET' or backend is None:
+                return wrapped(request, *args, **kwargs)
+
+            # a cached response must not get past what the view itself would have refused
+            try:
+                self.is_authenticated(request)
+                self.is_authorized(request)
+                self.throttle_check(request)
+            except ImmediateHttpResponse as e:
+                return e.response
+
+            scope = self.cache_scope(request)
+            generation = generations.current(name)
+            etag = '"{key}"'.format(key=response_cache.key(
+                self._meta.resource_name, view, request, args, kwargs, generation, scope))
+            vary = ('Accept', 'Authorization', 'Cookie') if scope else ('Accept',)
+
+            if response_cache.etag_matches(request, etag):
+                metrics.incr('response_cache.not_modified', resource=self._meta.resource_name)
+                self.log_throttled_access(request)
+                response = HttpResponseNotModified()
+                response['ETag'] = etag
+                patch_vary_headers(response, vary)
+                return response
+
+            cached = backend.get(etag)
+            if cached is not None:
+                metrics.incr('response_cache.hit', resource=self._meta.resource_name)
+                self.log_throttled_access(request)
+                content, headers = cached
+                response = HttpResponse(content)
+                for header, value in headers:
+                    response[header] = value
+            else:
+                metrics.incr('response_cache.miss', resource=self._meta.resource_name)
+                response = wrapped(request, *args, **kwargs)
+                if response.status_code != 200 or getattr(response, 'streaming', False):
+                    return response
+                backend.set(etag, (response.content, [(header, value) for header, value in response.items()
+                    if header.lower() not in ('etag', 'vary')]))
+
+            response['ETag'] = etag
+            patch_vary_headers(response, vary)
+            return response
+
+        return wrapper
+
+
+class DynamicModelResource(DynamicResourceMixin, ModelResource):
+    pass
+
+
+class DynamicGeoResource(DynamicResourceMixin, GeoResource):
+    pass
+
+
+class ArchivedResource(Resource):
+    """
+    Stands in for the resource of an archived model; see :py:mod:`ga_dynamic_models.archive`.  Any request to it starts
+    restoring the model and is answered with a 503 until the workers have been reloaded with the model back.
+    """
+
+    class Meta:
+        archived_model = None
+
+    def override_urls(self):
+        return [url(r'^(?P<resource_name>{name})(?:/.*)?$'.format(name=self._meta.resource_name),
+            self.wrap_view('unavailable'))]
+
+    def unavailable(self, request, **kwargs):
+        return archive.unavailable(self._meta.archived_model)
+
+
+def archived_resource(name, resource_name, model_name):
+    """
+    :return: An :py:class:`ArchivedResource` class for the resource of an archived model.
+    """
+    meta = type('Meta', (object,), {'resource_name' : resource_name, 'archived_model' : model_name})
+    return type(str(name), (ArchivedResource,), {'Meta' : meta})
+
+
+class LazyResource(Resource):
+    """
+    Stands in for the resource of a dynamic model when the class cache is on; see
+    :py:mod:`ga_dynamic_models.classcache`.  It answers every request by getting the real resource from the cache,
+    building it and its model if need be, and handing the request to it.  Its own URLs only serve to be reversed.
+    """
+
+    class Meta:
+        definition = None
+
+    def override_urls(self):
+        return [url(r'^(?P<resource_name>{name})(?P<path>/.*)?$'.format(name=self._meta.resource_name),
+            csrf_exempt(self.dispatch_lazily))]
+
+    def dispatch_lazily(self, request, resource_name, path=None, **kwargs):
+        resource = classcache.get_resource(self._meta.definition)
+        resource._meta.api_name = self._meta.api_name
+        try:
+            match = RegexURLResolver(r'^', resource.urls).resolve(resource_name + (path or ''))
+        except Resolver404:
+            raise Http404()
+        kwargs.update(match.kwargs)
+        return match.func(request, *match.args, **kwargs)
+
+
+def lazy_resource(definition):
+    """
+    :return: A :py:class:`LazyResource` class for the resource a definition declares.
+    """
+    attrs = {'definition' : definition}
+    if definition['meta'].get('resource_name'):
+        attrs['resource_name'] = definition['meta']['resource_name']
+    meta = type('Meta', (object,), attrs)
+    return type(str(definition['name']), (LazyResource,), {'Meta' : meta})
@@ -0,0 +1,152 @@
+"""
+A cache for GET responses from dynamic model resources.
+
+Uploaded tables only change when someone uploads again, so a response can be reused until the table's data generation
+(see :py:mod:`ga_dynamic_models.generations`) moves on.  Responses are keyed on the resource, the view, the URL arguments,
+the query string with its parameters sorted, the Accept header, the generation and who the response may be shared with
+(see :py:meth:`ga_dynamic_models.resources.DynamicResourceMixin.cache_scope`).  The key doubles as the response's ETag,
+so clients and proxies can revalidate with If-None-Match and get a 304 back without anything being rendered.  A cached
+response keeps the headers it was made with.
+
+Two backends are provided, and settings pick one::
+
+    GA_DYNAMIC_MODELS_RESPONSE_CACHE = {
+        'BACKEND' : 'ga_dynamic_models.response_cache.LRUBackend',
+        'OPTIONS' : { 'max_bytes' : 64 * 1024 * 1024, 'max_entries' : 10000 }
+    }
+
+:py:class:`LRUBackend`, the default, keeps responses in each worker's memory up to a byte and entry limit.
+:py:class:`DjangoCacheBackend` shares them between workers through one of Django's CACHES, named by its 'alias' option.
+Set ``'BACKEND' : None`` to turn response caching off.
+
+Resources whose authorization limits the rows each user sees have their responses cached per user.  If a resource's
+output depends on who is asking in some other way, declare it with ``cache_responses=False``.
+"""
+
+from django.conf import settings
+from logging import getLogger
+from collections import OrderedDict
+import threading
+import importlib
+import hashlib
+
+_log = getLogger(__name__)
+
+
+class LRUBackend(object):
+    """Least recently used eviction, bounded by the total size of the cached content and by the number of entries."""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entries=10000):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        size = len(value[0])
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old[0])
+            self._entries[key] = value
+            self.bytes += size
+            while self.bytes > self.max_bytes or len(self._entries) > self.max_entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= len(evicted[0])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+
+class DjangoCacheBackend(object):
+    """Keeps responses in one of Django's configured caches, so that all workers share them."""
+
+    def __init__(self, alias='default', timeout=None):
+        from django.core.cache import get_cache
+        self.cache = get_cache(alias)
+        self.timeout = timeout
+
+    def get(self, key):
+        return self.cache.get('ga_dynamic_models:response:' + key)
+
+    def set(self, key, value):
+        self.cache.set('ga_dynamic_models:response:' + key, value, self.timeout)
+
+    def clear(self):
+        pass
+
+
+def backend_from_settings(setting, default_options=None):
+    """
+    Instantiate the backend a setting names, in the form described above.
+
+    :param setting: The name of the setting.
+    :param default_options: Options for the default backend, used if the setting doesn't exist.
+    :return: The backend, or None if the setting turns caching off.
+    """
+    config = getattr(settings, setting, {'OPTIONS' : default_options or {}})
+    path = config.get('BACKEND', 'ga_dynamic_models.response_cache.LRUBackend')
+    if not path:
+        return None
+    module, cls = path.rsplit('.', 1)
+    return importlib.import_module(module).__getattribute__(cls)(**config.get('OPTIONS', {}))
+
+
+_backend = None
+_backend_loaded = False
+
+def get_backend():
+    """
+    :return: The configured response cache backend, or None if response caching is off.
+    """
+    global _backend, _backend_loaded
+    if not _backend_loaded:
+        _backend = backend_from_settings('GA_DYNAMIC_MODELS_RESPONSE_CACHE')
+        _backend_loaded = True
+    return _backend
+
+
+def normalized_query(request):
+    """The request's query parameters as a canonical string, so that parameter order doesn't matter."""
+    items = []
+    for key in sorted(request.GET.keys()):
+        for value in sorted(request.GET.getlist(key)):
+            items.append(u'{key}={value}'.format(key=key, value=value))
+    return u'&'.join(items)
+
+
+def key(resource_name, view, request, args, kwargs, generation, scope=''):
+    """
+    :param scope: Who the response may be shared with; '' for everyone.
+    :return: The cache key for a request, which is also used as its ETag.
+    """
+    parts = [
+        resource_name,
+        view,
+        repr(args),
+        repr(sorted(kwargs.items())),
+        normalized_query(request),
+        request.META.get('HTTP_ACCEPT', ''),
+        repr(generation),
+        scope,
+    ]
+    return hashlib.sha1(u'\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def etag_matches(request, etag):
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    return header.strip() == '*' or etag in [t.strip() for t in header.split(',')]
@@ -0,0 +1,193 @@
+"""
+A database router that sends reads of dynamic models to read replicas, and everything else to the primary.
+
+Add it and name the databases in ``settings.py``::
+
+    DATABASE_ROUTERS = ['ga_dynamic_models.routers.ReplicaRouter']
+    GA_DYNAMIC_MODELS_PRIMARY_DATABASE = 'default'
+    GA_DYNAMIC_MODELS_READ_REPLICAS = ['replica1', 'replica2']
+
+Reads of dynamic models, as the API, exports, snapshots and tiles make them, then go to a replica chosen at random.
+Loads, DDL and every other write go to the primary, as do reads of the app's own tables such as the SQL definition
+store.  ``syncdb`` only creates the app's tables on the primary.
+
+Replicas run behind the primary, so a read right after a load could find the table as it was before, or find no table
+at all if the load swapped in a new one.  So whenever a model's data generation moves on (see
+:py:mod:`ga_dynamic_models.generations`) or its table is created, the primary's position in its write-ahead log is
+noted as the model's *fence*.  A replica only serves reads of the model once it has replayed past the fence, and until
+then they go to the primary.  Each process asks a replica for its replay position at most every
+``GA_DYNAMIC_MODELS_REPLICA_CHECK_INTERVAL`` seconds (1 by default), and leaves out a replica it can't reach until the
+next check.  Without log positions to compare, as on databases other than PostgreSQL, a replica is taken to have caught
+up ``GA_DYNAMIC_MODELS_REPLICA_LAG`` seconds (5 by default) after the change.
+
+Fences are kept in Django's cache for ``GA_DYNAMIC_MODELS_FENCE_TTL`` seconds (an hour by default), and older changes
+are assumed to have reached every replica.  With a per-process cache only the process that made a change knows its
+fence, so use a shared cache with replicas.
+
+A dynamic model whose owner has been given a shard (see :py:mod:`ga_dynamic_models.shards`) lives on that shard rather
+than the primary, and all its reads and writes go there.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, DatabaseError, DEFAULT_DB_ALIAS
+from ga_dynamic_models import metrics
+from logging import getLogger
+import threading
+import random
+import time
+
+_log = getLogger(__name__)
+
+APP_LABEL = 'ga_dynamic_models'
+DYNAMIC_MODULE = 'ga_dynamic_models.models'
+
+
+def primary():
+    return getattr(settings, 'GA_DYNAMIC_MODELS_PRIMARY_DATABASE', DEFAULT_DB_ALIAS)
+
+
+def replicas():
+    return list(getattr(settings, 'GA_DYNAMIC_MODELS_READ_REPLICAS', ()))
+
+
+def check_interval():
+    return getattr(settings, 'GA_DYNAMIC_MODELS_REPLICA_CHECK_INTERVAL', 1)
+
+
+def replica_lag():
+    return getattr(settings, 'GA_DYNAMIC_MODELS_REPLICA_LAG', 5)
+
+
+def _fence_ttl():
+    return getattr(settings, 'GA_DYNAMIC_MODELS_FENCE_TTL', 3600)
+
+
+def _fence_key(name):
+    return 'ga_dynamic_models:fence:{name}'.format(name=name)
+
+
+def _shard_of(model):
+    from ga_dynamic_models.shards import database
+    return database(model.__name__)
+
+
+def is_dynamic(model):
+    """Whether a model class is a dynamic model, rather than one of the app's own tables."""
+    return model._meta.app_label == APP_LABEL and model.__module__ == DYNAMIC_MODULE
+
+
+def wal_position(alias, replayed=False):
+    """
+    :param alias: A database alias.
+    :param replayed: Ask for how far a replica has replayed the log, rather than how far the primary has written it.
+    :return: The position in bytes, or None if the database has no such position.
+    """
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        return None
+    cursor = connection.cursor()
+    cursor.execute("SELECT {function}() - '0/0'::pg_lsn".format(
+        function='pg_last_wal_replay_lsn' if replayed else 'pg_current_wal_lsn'))
+    position = cursor.fetchone()[0]
+    return long(position) if position is not None else None
+
+
+def fence(name, generation=None):
+    """
+    Note that a model's rows have just changed on the primary, so that its reads stay there until the replicas have
+    caught up.  Called when its data generation moves on and when its table is created.
+
+    :param name: The name of the model.
+    :param generation: Its new data generation, if known.
+    """
+    if not replicas():
+        return
+    try:
+        position = wal_position(primary())
+    except DatabaseError:
+        _log.exception('could not read the write-ahead log position of {alias}'.format(alias=primary()))
+        position = None
+    cache.set(_fence_key(name), {'generation' : generation, 'position' : position, 'at' : time.time()},
+        _fence_ttl())
+
+
+def get_fence(name):
+    """
+    :return: The fence of a model's latest change, as a dict with 'generation', 'position' and 'at', or None.
+    """
+    return cache.get(_fence_key(name))
+
+
+_replayed = {}
+_lock = threading.Lock()
+
+
+def replayed(alias):
+    """
+    :return: How far a replica has replayed the primary's log, as (checked at, position or None, reachable).  Asked of
+        the replica at most every check_interval() seconds.
+    """
+    with _lock:
+        checked = _replayed.get(alias)
+        if checked is not None and time.time() - checked[0] < check_interval():
+            return checked
+    try:
+        checked = (time.time(), wal_position(alias, replayed=True), True)
+    except DatabaseError:
+        _log.warning('read replica {alias} could not be reached'.format(alias=alias))
+        checked = (time.time(), None, False)
+    with _lock:
+        _replayed[alias] = checked
+    return checked
+
+
+def caught_up(alias, latest):
+    """
+    :param alias: A replica.
+    :param latest: The fence of the change a read must see, or None.
+    :return: Whether the replica has it.
+    """
+    _, position, reachable = replayed(alias)
+    if not reachable:
+        return False
+    if latest is None:
+        return True
+    if position is not None and latest['position'] is not None:
+        return position >= latest['position']
+    return time.time() - latest['at'] >= replica_lag()
+
+
+class ReplicaRouter(object):
+    """
+    Reads of dynamic models go to replicas that have caught up with them, and everything a sharded model does goes to
+    its shard; all else goes to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != APP_LABEL:
+            return None
+        if not is_dynamic(model):
+            return primary()
+        home = _shard_of(model)
+        if home != primary() or not replicas():
+            return home
+        latest = get_fence(model.__name__)
+        current = [alias for alias in replicas() if caught_up(alias, latest)]
+        if not current:
+            metrics.incr('replicas.primary_read', model=model.__name__)
+            return primary()
+        return random.choice(current)
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != APP_LABEL:
+            return None
+        return _shard_of(model) if is_dynamic(model) else primary()
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return None
+
+    def allow_syncdb(self, db, model):
+        if model._meta.app_label != APP_LABEL:
+            return None
+        return db == (_shard_of(model) if is_dynamic(model) else primary())
@@ -0,0 +1,270 @@
+"""
+Ranked text search over chosen text columns of dynamic models.
+
+Searching a large table with ``icontains`` filters reads every row.  Instead, a model's text columns can be declared
+searchable::
+
+    search.declare_search('Permits', ['description', 'address'])
+    search.declare_search('Permits', ['description'], method='fulltext', language='english')
+
+and every dynamic resource then has a search endpoint that takes the same filters as its list endpoint::
+
+    /api/permits/search/?q=roof+repair&limit=20&county=wake
+
+It returns up to ``limit`` rows (20 by default, at most ``GA_DYNAMIC_MODELS_SEARCH_MAX_LIMIT``), best first, each with
+a ``search_rank``.
+
+On PostgreSQL:
+
+    * ``trigram`` search, the default, finds the rows where any of the columns contains the query, ignoring case, and
+      ranks them by trigram similarity.  Each column gets a GIN index with the ``pg_trgm`` operator class, which also
+      serves ``icontains`` filters on it.  It suits names, addresses and codes.
+    * ``fulltext`` search finds the rows that have all the words of the query, stemmed in the declared language, in the
+      columns taken together, and ranks them with ``ts_rank``.  The columns share a single GIN index.  It suits prose.
+
+On SQLite the columns are copied into an FTS5 table named ``<table>__search`` and ranked by bm25, so search can be
+tried out locally.  With the ``trigram`` method, and an SQLite that has the trigram tokenizer, it
+matches substrings as PostgreSQL does; otherwise it matches words.
+
+Other databases have no search: declaring it, or searching, raises ValueError.
+
+Indexes are built when search is declared and again after every load, since a replacing load swaps in a new table.
+The FTS table is rebuilt after a replacing load and extended with the new rows after an appending one.
+"""
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.backends.util import truncate_name
+from django.utils.datastructures import SortedDict
+from ga_dynamic_models.stores import get_store
+from ga_dynamic_models import generations
+from ga_dynamic_models import metrics
+from logging import getLogger
+import sqlite3
+import re
+
+_log = getLogger(__name__)
+
+METHODS = ('trigram', 'fulltext')
+TEXT_TYPES = ('CharField', 'TextField', 'SlugField', 'EmailField', 'URLField')
+
+
+def _get_model(name):
+    from ga_dynamic_models.utils import get_model
+    return get_model(name)
+
+
+def max_limit():
+    return getattr(settings, 'GA_DYNAMIC_MODELS_SEARCH_MAX_LIMIT', 100)
+
+
+def declaration(name):
+    """
+    :return: The search declared for a model, as a dict with 'fields', 'method' and 'language', or None.
+    """
+    definition = get_store('models').get(name)
+    return definition.get('_search') if definition else None
+
+
+def declare_search(name, fields, method='trigram', language='english'):
+    """
+    Make text columns of a model searchable, and build their indexes.
+
+    :param name: The name of the model.
+    :param fields: The names of the text fields to search.
+    :param method: 'trigram' or 'fulltext'.
+    :param language: The text search configuration that full text search stems words with.
+    :raises ValueError: if the declaration is invalid or the model's database is neither PostgreSQL nor SQLite.
+    """
+    if method not in METHODS:
+        raise ValueError('search is by trigram or fulltext, not {method}'.format(method=method))
+    if not re.match(r'^[a-z_]+$', language):
+        raise ValueError('{language} is not the name of a text search configuration'.format(language=language))
+    if not fields:
+        raise ValueError('search needs at least one column')
+    model = _get_model(name)
+    for field_name in fields:
+        field = model._meta.get_field(field_name)
+        if field.get_internal_type() not in TEXT_TYPES or getattr(field, 'categorical', False):
+            raise ValueError('{name} is not a text column and cannot be searched'.format(name=field_name))
+    _check_vendor(connections[router.db_for_write(model)])
+
+    drop(model)
+    get_store('models').update(name, _search={'fields' : list(fields), 'method' : method, 'language' : language})
+    generations.forget(name)
+    build(model)
+
+
+def forget_search(name):
+    """Stop searching a model, and drop its indexes."""
+    drop(_get_model(name))
+    get_store('models').update(name, _search=None)
+    generations.forget(name)
+
+
+def _quoted(model, connection, names):
+    qn = connection.ops.quote_name
+    return ['{table}.{column}'.format(table=qn(model._meta.db_table), column=qn(model._meta.get_field(name).column))
+        for name in names]
+
+
+def index_name(model, connection, suffix):
+    return truncate_name('{table}__search_{suffix}'.format(table=model._meta.db_table, suffix=suffix),
+        connection.ops.max_name_length())
+
+
+def fts_table(model, connection):
+    return truncate_name('{table}__search'.format(table=model._meta.db_table), connection.ops.max_name_length())
+
+
+def _document(columns, language):
+    """The tsvector of a row's searched columns, written the same way for the index and the query."""
+    return "to_tsvector('{language}', {text})".format(language=language,
+        text=" || ' ' || ".join("coalesce({column}, '')".format(column=c) for c in columns))
+
+
+VENDORS = ('postgresql', 'sqlite')
+
+
+def _check_vendor(connection):
+    if connection.vendor not in VENDORS:
+        raise ValueError('search needs PostgreSQL or SQLite, not {vendor}'.format(vendor=connection.vendor))
+
+
+def _has_trigram_tokenizer():
+    return sqlite3.sqlite_version_info >= (3, 34, 0)
+
+
+def build(model, replace=True):
+    """
+    Build or bring up to date a model's search indexes, if it has search declared.
+
+    :param model: The model class.
+    :param replace: Whether the table's rows may all have changed, rather than had rows added.
+    :raises ValueError: if the model's database is neither PostgreSQL nor SQLite.
+    """
+    declared = declaration(model.__name__)
+    if declared is None:
+        return
+    using = router.db_for_write(model)
+    connection = connections[using]
+    _check_vendor(connection)
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    with metrics.span('search.build', model=model.__name__):
+        with transaction.commit_on_success(using=using):
+            cursor = connection.cursor()
+            if connection.vendor == 'postgresql':
+                columns = [qn(model._meta.get_field(name).column) for name in declared['fields']]
+                if declared['method'] == 'trigram':
+                    cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+                    for name, column in zip(declared['fields'], columns):
+                        cursor.execute('CREATE INDEX IF NOT EXISTS {name} ON {table} USING gin ({column} '
+                            'gin_trgm_ops)'.format(name=qn(index_name(model, connection, name)), table=table,
+                            column=column))
+                else:
+                    cursor.execute('CREATE INDEX IF NOT EXISTS {name} ON {table} USING gin (({document}))'.format(
+                        name=qn(index_name(model, connection, 'document')), table=table,
+                        document=_document(columns, declared['language'])))
+            elif connection.vendor == 'sqlite':
+                _build_fts(cursor, model, connection, declared, replace)
+
+
+def _build_fts(cursor, model, connection, declared, replace):
+    qn = connection.ops.quote_name
+    fts = qn(fts_table(model, connection))
+    columns = [qn(model._meta.get_field(name).column) for name in declared['fields']]
+    options = list(columns)
+    if declared['method'] == 'trigram' and _has_trigram_tokenizer():
+        options.append("tokenize='trigram'")
+    cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({options})'.format(
+        fts=fts, options=', '.join(options)))
+    pk = qn(model._meta.pk.column)
+    select = 'INSERT INTO {fts} (rowid, {columns}) SELECT {pk}, {columns} FROM {table}'.format(
+        fts=fts, columns=', '.join(columns), pk=pk, table=qn(model._meta.db_table))
+    if replace:
+        cursor.execute('DELETE FROM {fts}'.format(fts=fts))
+        cursor.execute(select)
+    else:
+        cursor.execute(select + ' WHERE {pk} > (SELECT coalesce(max(rowid), 0) FROM {fts})'.format(pk=pk, fts=fts))
+
+
+def refresh(model, replace):
+    """Bring a model's search indexes up to date after a load.  Called by the loader."""
+    build(model, replace)
+
+
+def drop(model, using=None):
+    """Drop a model's search indexes, or its FTS table, from the database given or the router's choice."""
+    declared = declaration(model.__name__)
+    if declared is None:
+        return
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    if connection.vendor == 'postgresql':
+        for suffix in declared['fields'] + ['document']:
+            cursor.execute('DROP INDEX IF EXISTS {name}'.format(name=qn(index_name(model, connection, suffix))))
+    elif connection.vendor == 'sqlite':
+        cursor.execute('DROP TABLE IF EXISTS {fts}'.format(fts=qn(fts_table(model, connection))))
+    transaction.commit_unless_managed(using=using)
+
+
+def _like(text):
+    return '%{text}%'.format(text=re.sub(r'([\\%_])', r'\\\1', text))
+
+
+def _match(text, declared):
+    """An FTS5 query for the text: the whole of it as a phrase for trigrams, otherwise each of its words."""
+    if declared['method'] == 'trigram' and _has_trigram_tokenizer():
+        terms = [text]
+    else:
+        terms = re.findall(r'\w+', text, re.U)
+    return ' '.join('"{term}"'.format(term=term.replace('"', '""')) for term in terms)
+
+
+def search(queryset, text):
+    """
+    Restrict a queryset to the rows that match a search, best first.  Each row gets a ``search_rank``.
+
+    :param queryset: The rows to search, perhaps already filtered.
+    :param text: What to search for.
+    :return: The queryset, ordered by descending rank.
+    :raises ValueError: if the model has no search declared, or its database is neither PostgreSQL nor SQLite.
+    """
+    model = queryset.model
+    declared = declaration(model.__name__)
+    if declared is None:
+        raise ValueError('{name} is not searchable'.format(name=model.__name__))
+    connection = connections[queryset.db]
+    _check_vendor(connection)
+    qn = connection.ops.quote_name
+    columns = _quoted(model, connection, declared['fields'])
+
+    if connection.vendor == 'postgresql' and declared['method'] == 'trigram':
+        where = ['({matches})'.format(matches=' OR '.join("{column} ILIKE %s".format(column=c) for c in columns))]
+        params = [_like(text)] * len(columns)
+        rank = 'GREATEST({similarities})'.format(similarities=', '.join(
+            'coalesce(similarity({column}, %s), 0)'.format(column=c) for c in columns))
+        rank_params = [text] * len(columns)
+    elif connection.vendor == 'postgresql':
+        document = _document(columns, declared['language'])
+        query = "plainto_tsquery('{language}', %s)".format(language=declared['language'])
+        where = ['{document} @@ {query}'.format(document=document, query=query)]
+        params = [text]
+        rank = 'ts_rank({document}, {query})'.format(document=document, query=query)
+        rank_params = [text]
+    else:
+        match = _match(text, declared)
+        if not match:
+            return queryset.none()
+        fts = qn(fts_table(model, connection))
+        pk = '{table}.{pk}'.format(table=qn(model._meta.db_table), pk=qn(model._meta.pk.column))
+        where = ['{pk} IN (SELECT rowid FROM {fts} WHERE {fts} MATCH %s)'.format(pk=pk, fts=fts)]
+        params = [match]
+        rank = '(SELECT -rank FROM {fts} WHERE {fts} MATCH %s AND rowid = {pk})'.format(fts=fts, pk=pk)
+        rank_params = [match]
+
+    return queryset.extra(select=SortedDict([('search_rank', rank)]), select_params=rank_params,
+        where=where, params=params).order_by('-search_rank')
@@ -0,0 +1,333 @@
+"""
+Sharding of dynamic models by owner, across databases or PostgreSQL schemas.
+
+The 'shards' kind of definition store (see :py:mod:`ga_dynamic_models.stores`) maps an owner to the place their models
+live::
+
+    shards.assign(user.pk, database='shard2')
+    shards.assign(user.pk, database='default', schema='tenant_42')
+
+When a model is declared, the shard of its owner is recorded in its definition as ``_shard`` and its table is created
+there.  Models without an owner, and owners without a shard, stay on ``GA_DYNAMIC_MODELS_PRIMARY_DATABASE``.
+:py:class:`ga_dynamic_models.routers.ReplicaRouter`, which has to be in ``DATABASE_ROUTERS`` for shards to work, sends
+every query of a model to its shard.  Which shard a model is on is cached in Django's cache for
+``GA_DYNAMIC_MODELS_SHARD_TTL`` seconds (30 by default).
+
+A schema is reached through a database alias of its own, ``<database>__<schema>``, added on first use as a copy of the
+database's settings with the ``search_path`` set to the schema and then ``public``, where PostGIS lives.  The schema is
+created if it doesn't exist.  Everything that names a model's table then works unchanged inside the shard.
+
+Assigning an owner a shard doesn't move the models they already have.  :py:func:`move`, and the ``rebalance_shards``
+management command, do that one table at a time.  The old table is locked against writes, and a new table with the
+same name and indexes is created on the new shard.  Its rows are bulk copied, with ``COPY`` between PostgreSQL
+databases.  The dictionaries of categorical columns are copied with them.  Then ``_shard`` is flipped in the definition
+and the model's data generation moves on, so cached responses are invalidated.  Partitioned and derived models can't be
+moved this way, and neither can a model that derived models read, since a derived model has to be on the same shard as
+the models it reads.
+
+Other workers may have the old shard cached for up to ``GA_DYNAMIC_MODELS_SHARD_TTL`` seconds after the flip, so the old
+table isn't dropped straight away.  It is *retired*: recorded in the 'shards' kind of definition store under
+``retired:<model>`` and dropped by :py:func:`drop_retired` once that long has passed, which ``rebalance_shards
+--drop-retired`` and every later move do.  Rows written to the old table in the meantime, by a worker that hasn't seen
+the move yet, are dropped with it, so models are best moved while nothing loads them.  A model can't be moved back onto
+a shard where its old table is still waiting to be dropped.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.color import no_style
+from django.db import connections, transaction
+from ga_dynamic_models.stores import get_store, RevisionConflict
+from ga_dynamic_models.routers import primary
+from ga_dynamic_models import generations
+from ga_dynamic_models import categorical
+from ga_dynamic_models import metrics
+from ga_dynamic_models import search
+from ga_dynamic_models import derived
+from logging import getLogger
+import threading
+import tempfile
+import copy
+import time
+import re
+
+_log = getLogger(__name__)
+
+BATCH_SIZE = 5000
+
+_lock = threading.Lock()
+
+
+def _get_model(name):
+    from ga_dynamic_models.utils import get_model
+    return get_model(name)
+
+
+def _ttl():
+    return getattr(settings, 'GA_DYNAMIC_MODELS_SHARD_TTL', 30)
+
+
+def _key(name):
+    return 'ga_dynamic_models:shard:{name}'.format(name=name)
+
+
+def _retired_name(name):
+    return 'retired:{name}'.format(name=name)
+
+
+def assign(owner, database=None, schema=None):
+    """
+    Put an owner's new models on a shard.
+
+    :param owner: The owner, as the ``_owner`` of their model definitions (a user's primary key).
+    :param database: A database alias; by default the primary.
+    :param schema: A PostgreSQL schema in that database, or None for the database's own.
+    :return: The shard, as a dict with 'database' and 'schema'.
+    """
+    shard = {'database' : database or primary(), 'schema' : schema}
+    alias_for(shard)
+    store = get_store('shards')
+    name = str(owner)
+    current = store.get(name)
+    store.put(dict(shard, name=name), revision=current.get('_rev') if current else 0)
+    return shard
+
+
+def of_owner(owner):
+    """
+    :return: The shard assigned to an owner, or None.
+    """
+    if owner is None:
+        return None
+    assigned = get_store('shards').get(str(owner))
+    return {'database' : assigned['database'], 'schema' : assigned['schema']} if assigned else None
+
+
+def alias_for(shard):
+    """
+    :param shard: A shard, or None for the primary.
+    :return: The database alias to reach it with, added to the connections if it is a schema's.
+    """
+    if not shard:
+        return primary()
+    database = shard.get('database') or primary()
+    if database not in connections.databases:
+        raise ValueError('there is no database {database}'.format(database=database))
+    schema = shard.get('schema')
+    if not schema:
+        return database
+    if not re.match(r'^[a-z_][a-z0-9_]*$', schema):
+        raise ValueError('{schema} is not a schema name'.format(schema=schema))
+    alias = '{database}__{schema}'.format(database=database, schema=schema)
+    with _lock:
+        if alias not in connections.databases:
+            if 'postgresql' not in connections.databases[database]['ENGINE']:
+                raise ValueError('{database} is not a PostgreSQL database and has no schemas'.format(
+                    database=database))
+            copied = copy.deepcopy(connections.databases[database])
+            copied.setdefault('OPTIONS', {})['options'] = '-c search_path={schema},public'.format(schema=schema)
+            connections.databases[alias] = copied
+    return alias
+
+
+def prepare(shard):
+    """
+    Make sure a shard can take tables: create its schema if it has one.
+
+    :return: Its database alias.
+    """
+    alias = alias_for(shard)
+    if shard and shard.get('schema'):
+        connection = connections[alias]
+        connection.cursor().execute('CREATE SCHEMA IF NOT EXISTS {schema}'.format(
+            schema=connection.ops.quote_name(shard['schema'])))
+        transaction.commit_unless_managed(using=alias)
+    return alias
+
+
+def of_model(name):
+    """
+    :return: The shard a dynamic model's table is in, or None for the primary.
+    """
+    shard = cache.get(_key(name))
+    if shard is None:
+        definition = get_store('models').get(name)
+        shard = (definition.get('_shard') if definition else None) or {}
+        cache.set(_key(name), shard, _ttl())
+    return shard or None
+
+
+def database(name):
+    """
+    :return: The database alias of a dynamic model's table.
+    """
+    return alias_for(of_model(name))
+
+
+def forget(name):
+    """Drop the cached shard of a model."""
+    cache.delete(_key(name))
+
+
+def models_of(owner):
+    """
+    :return: The names of an owner's models.
+    """
+    return sorted(d['name'] for d in get_store('models').list() if str(d.get('_owner')) == str(owner))
+
+
+def _copy_rows(cursor, target_cursor, source, target, table, columns):
+    qn = source.ops.quote_name
+    names = ', '.join(qn(c) for c in columns)
+    if source.vendor == 'postgresql' and target.vendor == 'postgresql':
+        buf = tempfile.TemporaryFile()
+        cursor.copy_expert('COPY (SELECT {names} FROM {table}) TO STDOUT'.format(names=names, table=qn(table)), buf)
+        buf.seek(0)
+        target_cursor.copy_expert('COPY {table} ({names}) FROM STDIN'.format(table=qn(table), names=names), buf)
+        buf.close()
+        target_cursor.execute('SELECT count(*) FROM {table}'.format(table=qn(table)))
+        return target_cursor.fetchone()[0]
+    cursor.execute('SELECT {names} FROM {table}'.format(names=names, table=qn(table)))
+    insert = 'INSERT INTO {table} ({names}) VALUES ({params})'.format(
+        table=qn(table), names=names, params=', '.join(['%s'] * len(columns)))
+    copied = 0
+    while True:
+        rows = cursor.fetchmany(BATCH_SIZE)
+        if not rows:
+            return copied
+        target_cursor.executemany(insert, rows)
+        copied += len(rows)
+
+
+def retired(name):
+    """
+    :return: The old tables of a model that are waiting to be dropped, as a list of dicts with 'shard', 'tables' and
+        'drop_after'.
+    """
+    entry = get_store('shards').get(_retired_name(name))
+    return entry['retired'] if entry else []
+
+
+def _retire(name, shard, tables):
+    store = get_store('shards')
+    current = store.get(_retired_name(name))
+    entry = current or {'name' : _retired_name(name), 'retired' : []}
+    entry['retired'].append({'shard' : shard or None, 'tables' : tables, 'drop_after' : time.time() + _ttl()})
+    store.put(entry, revision=current.get('_rev') if current else 0)
+
+
+def drop_retired(name=None, everything=False):
+    """
+    Drop the old tables left behind by :py:func:`move` once no worker can still be routing to them.
+
+    :param name: A model, or None for every model.
+    :param everything: Drop them whether or not their time has come, as when the model itself is dropped.
+    :return: The number of tables dropped.
+    """
+    store = get_store('shards')
+    if name is None:
+        entries = [e for e in store.list() if e['name'].startswith(_retired_name(''))]
+    else:
+        entries = filter(None, [store.get(_retired_name(name))])
+    dropped = 0
+    now = time.time()
+    for entry in entries:
+        remaining = []
+        for old in entry['retired']:
+            if not everything and old['drop_after'] > now:
+                remaining.append(old)
+                continue
+            using = alias_for(old['shard'])
+            connection = connections[using]
+            cursor = connection.cursor()
+            for table in old['tables']:
+                cursor.execute('DROP TABLE IF EXISTS {table}'.format(table=connection.ops.quote_name(table)))
+                dropped += 1
+            transaction.commit_unless_managed(using=using)
+        try:
+            if not remaining:
+                store.delete(entry['name'], revision=entry.get('_rev'))
+            elif len(remaining) < len(entry['retired']):
+                store.put(dict(entry, retired=remaining), revision=entry.get('_rev'))
+        except RevisionConflict:
+            pass  # another worker dropped some of them, or retired another table, at the same time; it's recorded
+    return dropped
+
+
+def _old_tables(model, connection, using):
+    """The tables a model has on a database: its own, its categorical dictionaries' and its SQLite search table."""
+    tables = [model._meta.db_table]
+    for field in categorical.categorical_fields(model):
+        dictionary = categorical.dictionary(model, field, using)
+        if dictionary.exists():
+            tables.append(dictionary.table)
+    if connection.vendor == 'sqlite' and search.declaration(model.__name__):
+        tables.append(search.fts_table(model, connection))
+    return tables
+
+
+def move(name, shard, keep=False):
+    """
+    Move a model's table to another shard and point its definition at it.
+
+    :param name: The name of the model.
+    :param shard: The shard to move it to, or None for the primary.
+    :param keep: Leave the old table where it is for good rather than retiring it.
+    :return: The number of rows moved, or None if the table is on that shard already.
+    """
+    definition = get_store('models').get(name)
+    if definition is None:
+        raise ValueError('there is no model named {name}'.format(name=name))
+    if definition.get('partition') or definition.get('derived'):
+        raise ValueError("{name} is partitioned or derived and can't be moved; declare it again instead".format(
+            name=name))
+    readers = derived.dependents(name)
+    if readers:
+        raise ValueError("{name} is read by the derived models {readers} and can't be moved away from them".format(
+            name=name, readers=', '.join(readers)))
+    model = _get_model(name)
+    old, new = database(name), prepare(shard)
+    if old == new:
+        return None
+    drop_retired()
+    if any(alias_for(r['shard']) == new for r in retired(name)):
+        raise ValueError('the old table of {name} on {new} is still waiting to be dropped; try again in {ttl} '
+            'seconds'.format(name=name, new=new, ttl=_ttl()))
+    old_shard = definition.get('_shard')
+    source, target = connections[old], connections[new]
+    table = model._meta.db_table
+    style = no_style()
+
+    with metrics.span('shards.move', model=name, source=old, target=new):
+        with transaction.commit_on_success(using=old):
+            cursor = source.cursor()
+            if source.vendor == 'postgresql':
+                cursor.execute('LOCK TABLE {table} IN EXCLUSIVE MODE'.format(table=source.ops.quote_name(table)))
+            with transaction.commit_on_success(using=new):
+                target_cursor = target.cursor()
+                statements, _ = target.creation.sql_create_model(model, style)
+                for sql in statements + target.creation.sql_indexes_for_model(model, style):
+                    target_cursor.execute(sql)
+                rows = _copy_rows(cursor, target_cursor, source, target, table,
+                    [f.column for f in model._meta.local_fields])
+                for field in categorical.categorical_fields(model):
+                    copied = categorical.dictionary(model, field, old)
+                    if copied.exists():
+                        dictionary = categorical.dictionary(model, field, new)
+                        dictionary.create(target_cursor)
+                        _copy_rows(cursor, target_cursor, source, target, copied.table, ['code', 'value'])
+                        dictionary.clear()
+                for sql in target.ops.sequence_reset_sql(style, [model]):
+                    target_cursor.execute(sql)
+
+            get_store('models').update(name, _shard=shard or None)
+            forget(name)
+            if not keep:
+                _retire(name, old_shard, _old_tables(model, source, old))
+            for field in categorical.categorical_fields(model):
+                categorical.dictionary(model, field, old).clear()
+
+    _log.info('moved {name} ({rows} rows) from {old} to {new}'.format(name=name, rows=rows, old=old, new=new))
+    generations.bump(name)
+    search.build(model)
+    return rows
@@ -0,0 +1,508 @@
+"""
+Columnar binary snapshots of dynamic model tables, for consumers that want the whole table in NumPy or pandas without
+parsing JSON or CSV.
+
+A snapshot is a single file laid out so that every column can be memory mapped in place::
+
+    8 bytes     magic, "GASNAP01"
+    8 bytes     header length, little endian unsigned
+    header      JSON, padded with spaces so that the data section starts on a 64 byte boundary
+    data        one complete .npy blob per column, each padded to 64 bytes
+
+The header has the model name, its data generation, the row count, how geometries are encoded (``geometry``, always
+``hex``) and a list of columns, each with its ``name``, the
+model ``field`` it came from, its NumPy ``dtype``, and ``npy_offset`` / ``offset`` / ``length``, the positions of the
+column's .npy blob and of its raw data relative to the start of the data section.  A column can be mapped with::
+
+    numpy.memmap(path, dtype=column['dtype'], mode='r', offset=data_start + column['offset'], shape=(header['rows'],))
+
+Numbers become ``<i8`` or ``<f8``, booleans ``|b1``, dates ``<M8[D]``, datetimes ``<M8[us]`` (UTC), times ``<m8[us]``,
+text fixed width UTF-8 ``|S<n>`` and geometry hex encoded WKB, also as ``|S<n>``.  Shorter values are padded with NULs,
+which is why WKB, whose last byte is often 0, is hex encoded.  A nullable field gets a ``<name>.mask`` column alongside
+it that is true where the value is null; the value column holds 0, NaN or an empty string there.
+
+Snapshots are built the first time they are asked for in a data generation (see :py:mod:`ga_dynamic_models.generations`)
+and kept in ``GA_DYNAMIC_MODELS_SNAPSHOT_DIR`` until the generation moves on.  Only one request builds a snapshot: it
+holds a lock file next to it while it does, and other requests for it are refused with :py:class:`Building` meanwhile,
+which resources answer with a 503 and a ``Retry-After`` of ``GA_DYNAMIC_MODELS_SNAPSHOT_RETRY_AFTER`` seconds (10 by
+default).  A lock older than ``GA_DYNAMIC_MODELS_SNAPSHOT_BUILD_TIMEOUT`` seconds (an hour by default) is taken to have
+been left by a builder that died.  Once a model has a snapshot, the loader
+keeps it up to date: after an appending load only the new rows are read from the database and added to the columns of
+the old snapshot, and after a replacing load it is rebuilt.
+
+Dynamic resources serve snapshots at ``/<resource>/snapshot.gasnap`` and single columns as plain .npy files at
+``/<resource>/snapshot/<column>.npy``, with support for Range requests.  A snapshot holds every row, so a resource
+whose authorization limits the rows a user sees refuses them with a 403.
+"""
+
+from django.conf import settings
+from django.db import connections, router
+from django.http import HttpResponse
+from ga_dynamic_models import generations
+from ga_dynamic_models import metrics
+from ga_dynamic_models import export
+from logging import getLogger
+import datetime
+import binascii
+import errno
+import time
+import tempfile
+import calendar
+import struct
+import json
+import glob
+import os
+import re
+
+_log = getLogger(__name__)
+
+MAGIC = 'GASNAP01'
+ALIGN = 64
+CHUNK_SIZE = 64 * 1024
+# Snapshots written before geometries were hex encoded have no 'geometry' in their header.
+GEOMETRY_ENCODING = 'hex'
+
+INTEGER_TYPES = (
+    'AutoField', 'IntegerField', 'BigIntegerField', 'SmallIntegerField', 'PositiveIntegerField',
+    'PositiveSmallIntegerField', 'ForeignKey', 'OneToOneField'
+)
+FLOAT_TYPES = ('FloatField', 'DecimalField')
+BOOLEAN_TYPES = ('BooleanField', 'NullBooleanField')
+
+_epoch_date = datetime.date(1970, 1, 1)
+
+
+class Building(Exception):
+    """Raised by :py:func:`get` while another request is building the snapshot."""
+    pass
+
+
+def retry_after():
+    return getattr(settings, 'GA_DYNAMIC_MODELS_SNAPSHOT_RETRY_AFTER', 10)
+
+
+def build_timeout():
+    return getattr(settings, 'GA_DYNAMIC_MODELS_SNAPSHOT_BUILD_TIMEOUT', 3600)
+
+
+def snapshot_dir():
+    root = getattr(settings, 'MEDIA_ROOT', None) or tempfile.gettempdir()
+    default = os.path.join(root, 'ga_dynamic_models_snapshots')
+    directory = getattr(settings, 'GA_DYNAMIC_MODELS_SNAPSHOT_DIR', default)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return directory
+
+
+def path(name, generation):
+    return os.path.join(snapshot_dir(), '{name}.{generation}.gasnap'.format(name=name, generation=generation))
+
+
+def existing(name):
+    """
+    :return: A list of (generation, path) for every snapshot of a model on disk, newest first.
+    """
+    found = []
+    for p in glob.glob(os.path.join(snapshot_dir(), '{name}.*.gasnap'.format(name=name))):
+        m = re.match(r'^(\d+)$', os.path.basename(p)[len(name) + 1:-len('.gasnap')])
+        if m:
+            found.append((int(m.group(1)), p))
+    return sorted(found, reverse=True)
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def _itemsize(dtype):
+    if dtype.startswith('|S'):
+        return int(dtype[2:])
+    return 1 if dtype == '|b1' else 8
+
+
+# Conversions from database values to packed column values
+
+def _int(value):
+    return struct.pack('<q', 0 if value is None else int(value))
+
+def _float(value):
+    return struct.pack('<d', float('nan') if value is None else float(value))
+
+def _bool(value):
+    return struct.pack('?', bool(value))
+
+def _date(value):
+    return struct.pack('<q', 0 if value is None else (value - _epoch_date).days)
+
+def _datetime(value):
+    if value is None:
+        return struct.pack('<q', 0)
+    if value.tzinfo is not None:
+        value = value.replace(tzinfo=None) - value.utcoffset()
+    return struct.pack('<q', calendar.timegm(value.timetuple()) * 1000000 + value.microsecond)
+
+def _time(value):
+    if value is None:
+        return struct.pack('<q', 0)
+    return struct.pack('<q', ((value.hour * 60 + value.minute) * 60 + value.second) * 1000000 + value.microsecond)
+
+def _bytes(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def _hex(value):
+    return binascii.hexlify(_bytes(value))
+
+
+class _ColumnBuilder(object):
+    """
+    Accumulates one column's values in a temporary file.  Fixed width values are stored packed, and strings length
+    prefixed until the widest one is known.  For strings, ``pack`` turns a database value into the bytes stored.
+    """
+
+    def __init__(self, name, field, dtype, pack, directory):
+        self.name = name
+        self.field = field
+        self.dtype = dtype
+        self.pack = pack
+        self.rows = 0
+        self.width = 1
+        self.file = tempfile.TemporaryFile(dir=directory)
+
+    @property
+    def is_string(self):
+        return self.dtype == '|S'
+
+    def append(self, value):
+        if self.is_string:
+            value = self.pack(value)
+            self.width = max(self.width, len(value))
+            self.file.write(struct.pack('<I', len(value)))
+            self.file.write(value)
+        else:
+            self.file.write(self.pack(value))
+        self.rows += 1
+
+    def append_stored(self, flo, offset, dtype, rows):
+        """Copy in the values of the same column from an older snapshot."""
+        flo.seek(offset)
+        if self.is_string:
+            width = _itemsize(dtype)
+            for _ in xrange(rows):
+                # only the padding can end in NUL: text doesn't and geometries are hex
+                value = flo.read(width).rstrip('\0')
+                self.width = max(self.width, len(value))
+                self.file.write(struct.pack('<I', len(value)))
+                self.file.write(value)
+        else:
+            remaining = rows * _itemsize(dtype)
+            while remaining:
+                data = flo.read(min(remaining, CHUNK_SIZE))
+                self.file.write(data)
+                remaining -= len(data)
+        self.rows += rows
+
+    @property
+    def final_dtype(self):
+        return '|S{width}'.format(width=self.width) if self.is_string else self.dtype
+
+    @property
+    def length(self):
+        return self.rows * _itemsize(self.final_dtype)
+
+    def npy_header(self):
+        header = "{{'descr': '{dtype}', 'fortran_order': False, 'shape': ({rows},), }}".format(
+            dtype=self.final_dtype, rows=self.rows)
+        total = _align(10 + len(header) + 1)
+        header = header.ljust(total - 10 - 1) + '\n'
+        return '\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header
+
+    def write_data(self, out):
+        self.file.seek(0)
+        if self.is_string:
+            for _ in xrange(self.rows):
+                n, = struct.unpack('<I', self.file.read(4))
+                out.write(self.file.read(n).ljust(self.width, '\0'))
+        else:
+            while True:
+                data = self.file.read(CHUNK_SIZE)
+                if not data:
+                    break
+                out.write(data)
+
+    def close(self):
+        self.file.close()
+
+
+def _builders(model, directory):
+    """
+    :return: A list of (builder, index of the value in a row, is_mask) for a model, and the names to select.
+    """
+    connection = connections[router.db_for_read(model)]
+    names, extra, _ = export.columns(model, 'wkb', connection)
+    builders = []
+    for index, field in enumerate(model._meta.local_fields):
+        kind = field.get_internal_type()
+        if hasattr(field, 'geom_type'):
+            dtype, pack = '|S', _hex
+        elif getattr(field, 'categorical', False):
+            dtype, pack = '|S', _bytes
+        elif kind in INTEGER_TYPES:
+            dtype, pack = '<i8', _int
+        elif kind in FLOAT_TYPES:
+            dtype, pack = '<f8', _float
+        elif kind in BOOLEAN_TYPES:
+            dtype, pack = '|b1', _bool
+        elif kind == 'DateTimeField':
+            dtype, pack = '<M8[us]', _datetime
+        elif kind == 'DateField':
+            dtype, pack = '<M8[D]', _date
+        elif kind == 'TimeField':
+            dtype, pack = '<m8[us]', _time
+        else:
+            dtype, pack = '|S', _bytes
+        builders.append((_ColumnBuilder(field.name, field.name, dtype, pack, directory), index, False))
+        if field.null or kind == 'NullBooleanField':
+            mask = _ColumnBuilder(field.name + '.mask', field.name, '|b1', lambda v: struct.pack('?', v is None),
+                directory)
+            builders.append((mask, index, True))
+    return builders, names, extra
+
+
+def read_header(flo):
+    """
+    :param flo: A snapshot file, open for reading.
+    :return: A tuple of (header dict, offset of the data section).  The header's 'geometry' is 'wkb' for snapshots
+        written before geometries were hex encoded.
+    """
+    flo.seek(0)
+    if flo.read(8) != MAGIC:
+        raise ValueError('not a snapshot file')
+    length, = struct.unpack('<Q', flo.read(8))
+    header = json.loads(flo.read(length))
+    header.setdefault('geometry', 'wkb')
+    return header, _align(16 + length)
+
+
+def build(model, generation=None, previous=None):
+    """
+    Write a snapshot of a model's table.
+
+    :param model: The model class.
+    :param generation: The data generation to label it with; by default the current one.
+    :param previous: The path of an older snapshot of the same model.  If given, only rows with a primary key greater
+        than any in it are read from the database, and the rest are copied from it.
+    :return: The path of the new snapshot.
+    """
+    name = model.__name__
+    if generation is None:
+        generation = generations.current(name)
+    directory = snapshot_dir()
+    builders, names, extra = _builders(model, directory)
+    queryset = model._default_manager.using(router.db_for_read(model)).order_by('pk')
+    pk_index = [f.name for f in model._meta.local_fields].index(model._meta.pk.name)
+    max_pk = None
+
+    with metrics.span('snapshot.build', model=name, incremental=previous is not None):
+        try:
+            if previous is not None:
+                with open(previous, 'rb') as old:
+                    header, data_start = read_header(old)
+                    stored = dict((c['name'], c) for c in header['columns'])
+                    if sorted(stored) != sorted(b.name for b, _, _ in builders):
+                        raise ValueError('the columns of {name} have changed'.format(name=name))
+                    if header['geometry'] != GEOMETRY_ENCODING:
+                        raise ValueError('the old snapshot of {name} encodes geometries as {encoding}'.format(
+                            name=name, encoding=header['geometry']))
+                    for builder, _, _ in builders:
+                        column = stored[builder.name]
+                        builder.append_stored(old, data_start + column['offset'], column['dtype'], header['rows'])
+                    max_pk = header['max_pk']
+                if max_pk is not None:
+                    queryset = queryset.filter(pk__gt=max_pk)
+
+            for batch in export.rows(queryset, names, extra):
+                for row in batch:
+                    for builder, index, is_mask in builders:
+                        builder.append(row[index])
+                max_pk = batch[-1][pk_index]
+
+            rows = builders[0][0].rows
+            offset = 0
+            columns = []
+            for builder, _, _ in builders:
+                npy_header = builder.npy_header()
+                columns.append({
+                    'name' : builder.name,
+                    'field' : builder.field,
+                    'dtype' : builder.final_dtype,
+                    'npy_offset' : offset,
+                    'offset' : offset + len(npy_header),
+                    'length' : builder.length,
+                })
+                offset = _align(offset + len(npy_header) + builder.length)
+
+            header = json.dumps({
+                'model' : name,
+                'generation' : generation,
+                'rows' : rows,
+                'geometry' : GEOMETRY_ENCODING,
+                'max_pk' : max_pk if isinstance(max_pk, (int, long)) else None,
+                'columns' : columns,
+            })
+            header = header.ljust(_align(16 + len(header)) - 16)
+
+            destination = path(name, generation)
+            fd, partial = tempfile.mkstemp(dir=directory, suffix='.partial')
+            with os.fdopen(fd, 'wb') as out:
+                out.write(MAGIC)
+                out.write(struct.pack('<Q', len(header)))
+                out.write(header)
+                for (builder, _, _), column in zip(builders, columns):
+                    out.write(builder.npy_header())
+                    builder.write_data(out)
+                    out.write('\0' * (_align(out.tell()) - out.tell()))
+            os.rename(partial, destination)
+            return destination
+        finally:
+            for builder, _, _ in builders:
+                builder.close()
+
+
+def _lock(filename):
+    """
+    Take a lock file, or take it over if it is older than GA_DYNAMIC_MODELS_SNAPSHOT_BUILD_TIMEOUT.
+
+    :return: Whether the lock was taken.
+    """
+    for attempt in range(2):
+        try:
+            os.close(os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        try:
+            if time.time() - os.path.getmtime(filename) < build_timeout():
+                return False
+            os.unlink(filename)
+        except OSError:
+            pass
+    return False
+
+
+def get(model):
+    """
+    :param model: The model class.
+    :return: The path of the snapshot for the model's current data generation, building it if need be.
+    :raises Building: if another request is building it.
+    """
+    generation = generations.current(model.__name__)
+    p = path(model.__name__, generation)
+    if os.path.exists(p):
+        return p
+    lock = p + '.lock'
+    if not _lock(lock):
+        raise Building('the snapshot of {name} is being built'.format(name=model.__name__))
+    try:
+        if not os.path.exists(p):
+            build(model, generation)
+            prune(model.__name__, keep=generation)
+    finally:
+        os.unlink(lock)
+    return p
+
+
+def prune(name, keep=None):
+    """Delete a model's snapshots, except the one for generation ``keep``."""
+    for generation, p in existing(name):
+        if generation != keep:
+            try:
+                os.unlink(p)
+            except OSError:
+                pass
+
+
+def refresh(model, replace):
+    """
+    Bring a model's snapshot up to date after a load, if it has one.  Called by the loader.
+
+    :param model: The model class.
+    :param replace: Whether the load replaced the table's contents.  If not, the snapshot is extended with the new rows
+        rather than rebuilt.
+    """
+    name = model.__name__
+    found = existing(name)
+    if not found:
+        return
+    generation = generations.current(name)
+    incremental = not replace and model._meta.pk.get_internal_type() in INTEGER_TYPES
+    previous = found[0][1] if incremental else None
+    try:
+        build(model, generation, previous=previous)
+    except ValueError as e:
+        _log.warning('rebuilding the snapshot of {name} from scratch: {error}'.format(name=name, error=e))
+        build(model, generation)
+    prune(name, keep=generation)
+
+
+def column_range(snapshot, column):
+    """
+    :return: The (start, end) byte offsets of a column's .npy blob within a snapshot file, end exclusive.
+    """
+    with open(snapshot, 'rb') as flo:
+        header, data_start = read_header(flo)
+    for c in header['columns']:
+        if c['name'] == column:
+            return data_start + c['npy_offset'], data_start + c['offset'] + c['length']
+    raise KeyError(column)
+
+
+def _file_range(filename, start, end):
+    with open(filename, 'rb') as flo:
+        flo.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = flo.read(min(remaining, CHUNK_SIZE))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+def serve(request, filename, start, end, content_type, etag, download_name):
+    """
+    Serve the bytes of ``filename`` from ``start`` to ``end`` (exclusive), honouring a single range Range header.
+
+    :return: A 200, 206 or 416 response.
+    """
+    size = end - start
+    status = 200
+    first, last = 0, size - 1
+    requested = request.META.get('HTTP_RANGE', '')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    m = re.match(r'^bytes=(\d*)-(\d*)$', requested.strip())
+    if m and (not if_range or if_range == etag) and (m.group(1) or m.group(2)):
+        if m.group(1):
+            first = int(m.group(1))
+            last = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+        else:
+            first = max(size - int(m.group(2)), 0)
+        if first > last or first >= size:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */{size}'.format(size=size)
+            return response
+        status = 206
+
+    response = export.streaming_response(_file_range(filename, start + first, start + last + 1), content_type,
+        status=status)
+    if status == 206:
+        response['Content-Range'] = 'bytes {first}-{last}/{size}'.format(first=first, last=last, size=size)
+    response['Content-Length'] = str(last - first + 1)
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Content-Disposition'] = 'attachment; filename="{name}"'.format(name=download_name)
+    return response
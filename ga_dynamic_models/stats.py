@@ -0,0 +1,292 @@
+"""
+Column statistics for dynamic model tables, computed by the loader in the same pass that converts the rows.
+
+For every column the loader records the number of values and of nulls, and for everything but geometry an approximate
+count of distinct values from a HyperLogLog sketch (within a few percent).  Numeric, date and text columns also get
+their minimum and maximum, and numeric columns their mean and a histogram with a fixed number of equal width bins.
+The histogram's range is found as the values stream past: it starts out narrow and doubles its bin width, merging
+neighbouring bins, whenever a value falls outside it.  NaN and infinite values of float columns are counted as
+``non_finite`` and left out of the minimum, maximum, mean and histogram.
+
+Statistics are kept in the definition store, under the 'stats' kind and the model's name, so that catalog pages and the
+API can show a profile of a table without reading it.  After a replacing load they describe the new contents; after an
+appending load the new rows are merged into what was there.  Dynamic resources serve them at ``/<resource>/stats/``.
+
+A partitioned model (see :py:mod:`ga_dynamic_models.partitioning`) also keeps statistics for each partition, and its
+table's statistics are merged from them, so that a load that replaces one partition leaves the others' counted as they
+were.
+"""
+
+from ga_dynamic_models.stores import get_store
+import datetime
+import hashlib
+import struct
+import base64
+import math
+
+HISTOGRAM_BINS = 20
+HLL_PRECISION = 11
+
+_m = 1 << HLL_PRECISION
+_alpha = 0.7213 / (1 + 1.079 / _m)
+
+
+class HyperLogLog(object):
+    """A HyperLogLog distinct value counter with 2 ** HLL_PRECISION one byte registers."""
+
+    def __init__(self, registers=None):
+        self.registers = bytearray(registers) if registers is not None else bytearray(_m)
+
+    def add(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        h, = struct.unpack('<Q', hashlib.md5(str(value)).digest()[:8])
+        index = h >> (64 - HLL_PRECISION)
+        rest = (h << HLL_PRECISION) & 0xffffffffffffffff
+        rank = 1
+        while rank <= 64 - HLL_PRECISION and not rest & 0x8000000000000000:
+            rest <<= 1
+            rank += 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        for i, r in enumerate(other.registers):
+            if r > self.registers[i]:
+                self.registers[i] = r
+
+    def count(self):
+        estimate = _alpha * _m * _m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count('\0')
+        if estimate <= 2.5 * _m and zeros:
+            estimate = _m * math.log(float(_m) / zeros)
+        return int(round(estimate))
+
+    def dumps(self):
+        return base64.b64encode(str(self.registers))
+
+    @classmethod
+    def loads(cls, data):
+        return cls(base64.b64decode(data))
+
+
+class Histogram(object):
+    """Counts values in HISTOGRAM_BINS equal width bins, widening the bins as needed to take in every value."""
+
+    def __init__(self, bins=HISTOGRAM_BINS):
+        self.counts = [0] * bins
+        self.low = None
+        self.width = None
+        self._pending = {}
+
+    @property
+    def high(self):
+        return self.low + self.width * len(self.counts)
+
+    def add(self, value, weight=1):
+        if self.low is None:
+            # Until there are two different values there is no range to base the bins on.
+            self._pending[value] = self._pending.get(value, 0) + weight
+            if len(self._pending) < 2:
+                return
+            self.low = min(self._pending)
+            self.width = float(max(self._pending) - self.low) / (len(self.counts) - 1)
+            pending, self._pending = self._pending, {}
+            for v, w in pending.items():
+                self.add(v, w)
+            return
+
+        while value < self.low:
+            self._widen(downwards=True)
+        while value >= self.high:
+            self._widen(downwards=False)
+        self.counts[min(int((value - self.low) / self.width), len(self.counts) - 1)] += weight
+
+    def _widen(self, downwards):
+        n = len(self.counts)
+        merged = [self.counts[i] + (self.counts[i + 1] if i + 1 < n else 0) for i in xrange(0, n, 2)]
+        padding = [0] * (n - len(merged))
+        if downwards:
+            self.low -= self.width * n
+            self.counts = padding + merged
+        else:
+            self.counts = merged + padding
+        self.width *= 2
+
+    def as_dict(self):
+        if self.low is None:
+            if not self._pending:
+                return None
+            value, count = self._pending.items()[0]
+            return {'edges' : [value, value], 'counts' : [count]}
+        # Trim empty bins from the ends so the range reflects the data.
+        first = next(i for i, c in enumerate(self.counts) if c)
+        last = len(self.counts) - next(i for i, c in enumerate(reversed(self.counts)) if c)
+        return {
+            'edges' : [self.low + self.width * i for i in xrange(first, last + 1)],
+            'counts' : self.counts[first:last],
+        }
+
+
+def _comparable(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+class ColumnProfile(object):
+    """Statistics for one column, accumulated a value at a time."""
+
+    def __init__(self, name, kind, is_geometry=False):
+        self.name = name
+        self.kind = kind
+        self.is_geometry = is_geometry
+        self.count = 0
+        self.nulls = 0
+        self.minimum = None
+        self.maximum = None
+        self.total = 0.0
+        self.non_finite = 0
+        self.distinct = HyperLogLog() if not self.is_geometry else None
+        self.histogram = Histogram() if self.is_numeric else None
+
+    @property
+    def is_numeric(self):
+        return self.kind in ('IntegerField', 'FloatField', 'Latitude', 'Longitude')
+
+    def add(self, value):
+        self.count += 1
+        if value is None or value == '':
+            self.nulls += 1
+            return
+        if self.is_geometry:
+            return
+        self.distinct.add(value)
+        if self.kind == 'BooleanField':
+            return
+        if isinstance(value, float) and (math.isnan(value) or math.isinf(value)):
+            self.non_finite += 1
+            return
+        value = _comparable(value)
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        if self.is_numeric:
+            self.total += value
+            self.histogram.add(value)
+
+    def merge(self, stored):
+        """Fold in the statistics of the same column from an earlier load, as returned by :py:meth:`as_dict`."""
+        self.count += stored['count']
+        self.nulls += stored['nulls']
+        self.non_finite += stored.get('non_finite', 0)
+        for key, better in (('min', min), ('max', max)):
+            if stored.get(key) is not None:
+                mine = self.minimum if key == 'min' else self.maximum
+                value = stored[key] if mine is None else better(mine, stored[key])
+                if key == 'min':
+                    self.minimum = value
+                else:
+                    self.maximum = value
+        if self.is_numeric:
+            if stored.get('mean') is not None:
+                self.total += stored['mean'] * (stored['count'] - stored['nulls'] - stored.get('non_finite', 0))
+            histogram = stored.get('histogram')
+            if histogram:
+                edges = histogram['edges']
+                for i, count in enumerate(histogram['counts']):
+                    if count:
+                        self.histogram.add((edges[i] + edges[i + 1]) / 2.0, count)
+
+    def as_dict(self):
+        profile = {
+            'kind' : self.kind,
+            'count' : self.count,
+            'nulls' : self.nulls,
+        }
+        if self.distinct is not None:
+            profile['distinct'] = min(self.distinct.count(), self.count - self.nulls)
+        if not self.is_geometry and self.kind != 'BooleanField':
+            profile['min'] = self.minimum
+            profile['max'] = self.maximum
+        if self.is_numeric:
+            values = self.count - self.nulls - self.non_finite
+            profile['non_finite'] = self.non_finite
+            profile['mean'] = self.total / values if values else None
+            profile['histogram'] = self.histogram.as_dict()
+        return profile
+
+
+class TableProfile(object):
+    """
+    Statistics for every column the loader fills.
+
+    :param columns: The loader's columns; see :py:class:`ga_dynamic_models.loader.Column`.
+    """
+
+    def __init__(self, columns):
+        self.columns = [ColumnProfile(c.name, c.kind, c.is_geometry) for c in columns]
+
+    def add_batch(self, batch):
+        for row in batch:
+            for profile, value in zip(self.columns, row):
+                profile.add(value)
+
+    def merge(self, stored):
+        """Fold in an earlier load's statistics, as returned by :py:func:`get` with ``sketches=True``."""
+        sketches = stored.get('_distinct', {})
+        for profile in self.columns:
+            column = stored.get('columns', {}).get(profile.name)
+            if column is None or column.get('kind') != profile.kind:
+                continue
+            profile.merge(column)
+            if profile.distinct is not None and profile.name in sketches:
+                profile.distinct.merge(HyperLogLog.loads(sketches[profile.name]))
+
+    @property
+    def rows(self):
+        return self.columns[0].count if self.columns else 0
+
+    def save(self, name, partitions=None):
+        """
+        Write the statistics to the definition store for the model called ``name``.
+
+        :param partitions: For a partitioned model, the labels of its partitions, each of which has statistics of its
+            own under :py:func:`partition_name`.
+        """
+        columns = dict((p.name, p.as_dict()) for p in self.columns)
+        document = {
+            'name' : name,
+            'rows' : self.rows,
+            'columns' : columns,
+            '_distinct' : dict((p.name, p.distinct.dumps()) for p in self.columns if p.distinct is not None),
+        }
+        if partitions is not None:
+            document['partitions'] = partitions
+        get_store('stats').put(document)
+
+
+def get(name, sketches=False):
+    """
+    :param name: The name of a dynamic model.
+    :param sketches: Whether to include the serialized distinct value sketches that merging needs.
+    :return: The model's column statistics, or None if it has never been loaded.
+    """
+    stats = get_store('stats').get(name)
+    if stats is not None and not sketches:
+        stats.pop('_distinct', None)
+    return stats
+
+
+def partition_name(name, label):
+    """The name the statistics of one partition of a model are kept under."""
+    return u'{name}:{label}'.format(name=name, label=label)
+
+
+def forget(name):
+    store = get_store('stats')
+    stats = store.get(name)
+    for label in (stats or {}).get('partitions', []):
+        store.delete(partition_name(name, label))
+    store.delete(name)
@@ -0,0 +1,391 @@
+"""
+Definition stores hold the JSON definitions of dynamic models and resources that :py:mod:`ga_dynamic_models.models`
+and :py:mod:`ga_dynamic_models.api` build classes from.  All catalog access goes through the interface defined by
+:py:class:`DefinitionStore`, so where the definitions live is a deployment decision.  Three stores are provided:
+
+    * :py:class:`MongoDefinitionStore` - the original layout, in MONGODB_ROUTES.  This is the default.
+    * :py:class:`SQLDefinitionStore` - two tables in a Django database, normally the same one the data lives in, which
+      saves a network hop to MongoDB on every catalog read.  The tables are created by syncdb.
+    * :py:class:`MemoryDefinitionStore` - process local.  For tests and benchmarks that should run with no services.
+
+Choose one in settings like this::
+
+    GA_DYNAMIC_MODELS_DEFINITION_STORE = {
+        'BACKEND' : 'ga_dynamic_models.stores.SQLDefinitionStore',
+        'OPTIONS' : { 'using' : 'default' }
+    }
+
+There is one store per *kind* of definition: 'models' for models and 'api' for resources.  Four more kinds hold
+bookkeeping under each model's name or owner: 'stats' the column statistics of a model's table (see
+:py:mod:`ga_dynamic_models.stats`), 'shards' the database or schema an owner's models are put in (see
+:py:mod:`ga_dynamic_models.shards`), 'usage' when a model was last used (see :py:mod:`ga_dynamic_models.usage`) and
+'indexes' the fields that have had an index built on them (see :py:mod:`ga_dynamic_models.advisor`).
+
+Every write to a store bumps a revision counter that is shared by all kinds, and every definition carries the revision
+it was last written at in ``_rev``.  Passing ``revision`` to :py:meth:`DefinitionStore.put` or
+:py:meth:`DefinitionStore.delete` makes the write conditional on the definition still being at that revision (0 meaning
+that it must not exist yet), and a :py:class:`RevisionConflict` is raised otherwise.  Changes are logged, so a worker can
+ask for everything that changed since the revision it last saw with :py:meth:`DefinitionStore.changes`, or block for
+them with :py:meth:`DefinitionStore.watch`.
+
+Definitions that were written to MongoDB before revisions were kept have no ``_rev``.  They read as being at revision
+0 (see :py:func:`ga_dynamic_models.generations.current`) and callers pass ``revision=None`` for them, so the first
+write to each is unconditional and stamps it with a revision.
+"""
+
+from django.conf import settings
+import threading
+import importlib
+import copy
+import json
+import time
+
+KINDS = ('models', 'api', 'stats', 'shards', 'usage', 'indexes')
+
+
+class RevisionConflict(Exception):
+    """Raised when a conditional write finds the definition at a different revision than expected."""
+    pass
+
+
+class DefinitionStore(object):
+    """
+    The interface all definition stores implement.  Definitions are dicts as produced by the grammar in
+    :py:mod:`ga_dynamic_models.utils`, keyed by their 'name'.
+    """
+
+    def __init__(self, kind):
+        if kind not in KINDS:
+            raise ValueError("kind must be one of {kinds}".format(kinds=', '.join(KINDS)))
+        self.kind = kind
+
+    def get(self, name):
+        """
+        :param name: The name of the definition.
+        :return: The definition, or None if there isn't one.
+        """
+        raise NotImplementedError()
+
+    def list(self):
+        """
+        :return: A list of all the definitions of this kind.
+        """
+        raise NotImplementedError()
+
+    def put(self, definition, revision=None):
+        """
+        Insert or replace a definition.
+
+        :param definition: The definition.  Its '_id' is set to its name and its '_rev' to the new revision.
+        :param revision: If not None, the revision the stored definition must be at for the write to happen.  Use 0 to
+            require that no definition by that name exists.
+        :return: The new revision.
+        """
+        raise NotImplementedError()
+
+    def delete(self, name, revision=None):
+        """
+        Remove a definition.  Removing a definition that doesn't exist is not an error unless revision is given.
+
+        :param name: The name of the definition.
+        :param revision: If not None, the revision the stored definition must be at for the delete to happen.
+        :return: The new revision.
+        """
+        raise NotImplementedError()
+
+    def update(self, name, **values):
+        """
+        Set top-level keys on a stored definition without touching the rest of it.  This is meant for the bookkeeping
+        keys that start with an underscore, which the parser ignores.
+
+        :param name: The name of the definition.
+        :param values: The keys to set.
+        :return: The new revision, or None if there is no such definition.
+        """
+        definition = self.get(name)
+        if definition is None:
+            return None
+        definition.update(values)
+        return self.put(definition, revision=definition.get('_rev'))
+
+    def revision(self):
+        """
+        :return: The most recent revision written to any store sharing this one's backend.
+        """
+        raise NotImplementedError()
+
+    def changes(self, since=0):
+        """
+        :param since: A revision.
+        :return: A list of dicts with 'revision', 'name' and 'deleted' for every change to this kind of definition after
+            ``since``, oldest first.
+        """
+        raise NotImplementedError()
+
+    def watch(self, since=0, timeout=None, interval=1.0):
+        """
+        Yield changes as they happen, by polling :py:meth:`changes`.
+
+        :param since: Only yield changes after this revision.
+        :param timeout: Stop after this many seconds.  None means never.
+        :param interval: Seconds between polls.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while deadline is None or time.time() < deadline:
+            for change in self.changes(since):
+                since = max(since, change['revision'])
+                yield change
+            time.sleep(interval)
+
+    def _check(self, name, current, revision):
+        if revision is not None and (current or 0) != revision:
+            raise RevisionConflict("{kind} definition {name} is at revision {current}, not {revision}".format(
+                kind=self.kind, name=name, current=current or 0, revision=revision))
+
+
+class MemoryDefinitionStore(DefinitionStore):
+    """Keeps definitions in this process.  Stores of all kinds share one revision counter."""
+
+    _lock = threading.RLock()
+    _revision = [0]
+    _log = []
+    _definitions = dict((kind, {}) for kind in KINDS)
+
+    def get(self, name):
+        with self._lock:
+            return copy.deepcopy(self._definitions[self.kind].get(name))
+
+    def list(self):
+        with self._lock:
+            return copy.deepcopy(self._definitions[self.kind].values())
+
+    def _write(self, name, definition, revision):
+        with self._lock:
+            current = self._definitions[self.kind].get(name)
+            self._check(name, current and current.get('_rev'), revision)
+            self._revision[0] += 1
+            rev = self._revision[0]
+            if definition is None:
+                self._definitions[self.kind].pop(name, None)
+            else:
+                definition['_id'] = name
+                definition['_rev'] = rev
+                self._definitions[self.kind][name] = copy.deepcopy(definition)
+            self._log.append({'kind' : self.kind, 'revision' : rev, 'name' : name, 'deleted' : definition is None})
+            return rev
+
+    def put(self, definition, revision=None):
+        return self._write(definition['name'], definition, revision)
+
+    def delete(self, name, revision=None):
+        return self._write(name, None, revision)
+
+    def revision(self):
+        return self._revision[0]
+
+    def changes(self, since=0):
+        with self._lock:
+            return [dict((k, v) for k, v in c.items() if k != 'kind') for c in self._log
+                    if c['kind'] == self.kind and c['revision'] > since]
+
+    @classmethod
+    def clear(cls):
+        """Forget every definition.  Useful between tests."""
+        with cls._lock:
+            for kind in KINDS:
+                cls._definitions[kind].clear()
+            del cls._log[:]
+
+
+class MongoDefinitionStore(DefinitionStore):
+    """
+    Keeps definitions in the ga_dynamic_models__models and ga_dynamic_models__api collections of the
+    'ga_dynamic_models' route in MONGODB_ROUTES, or the 'default' route if there isn't one.  Revisions come from a
+    counter document in ga_dynamic_models__revisions and changes are logged to ga_dynamic_models__changes.
+    """
+
+    def __init__(self, kind, route=None):
+        super(MongoDefinitionStore, self).__init__(kind)
+        if not hasattr(settings, "MONGODB_ROUTES"):
+            raise AttributeError('MONGODB_ROUTES must be filled in')
+        if route is None:
+            route = 'ga_dynamic_models' if 'ga_dynamic_models' in settings.MONGODB_ROUTES else 'default'
+        self.db = settings.MONGODB_ROUTES[route]
+        self.collection = self.db['ga_dynamic_models__' + kind]
+
+    def get(self, name):
+        return self.collection.find_one(name)
+
+    def list(self):
+        return list(self.collection.find())
+
+    def _next_revision(self):
+        counter = self.db['ga_dynamic_models__revisions'].find_and_modify(
+            {'_id' : 'revision'}, {'$inc' : {'value' : 1}}, upsert=True, new=True)
+        return counter['value']
+
+    def _log_change(self, rev, name, deleted):
+        self.db['ga_dynamic_models__changes'].insert(
+            {'_id' : rev, 'kind' : self.kind, 'name' : name, 'deleted' : deleted}, safe=True)
+
+    def put(self, definition, revision=None):
+        name = definition['name']
+        rev = self._next_revision()
+        definition['_id'] = name
+        definition['_rev'] = rev
+        if revision is None:
+            self.collection.save(definition, safe=True)
+        elif revision == 0:
+            try:
+                self.collection.insert(definition, safe=True)
+            except Exception:
+                self._check(name, (self.get(name) or {}).get('_rev'), revision)
+                raise
+        else:
+            result = self.collection.update({'_id' : name, '_rev' : revision}, definition, safe=True)
+            if not result or not result.get('n'):
+                self._check(name, (self.get(name) or {}).get('_rev'), revision)
+        self._log_change(rev, name, False)
+        return rev
+
+    def delete(self, name, revision=None):
+        if revision is not None:
+            self._check(name, (self.get(name) or {}).get('_rev'), revision)
+            self.collection.remove({'_id' : name, '_rev' : revision}, safe=True)
+        else:
+            self.collection.remove(name, safe=True)
+        rev = self._next_revision()
+        self._log_change(rev, name, True)
+        return rev
+
+    def revision(self):
+        counter = self.db['ga_dynamic_models__revisions'].find_one('revision')
+        return counter['value'] if counter else 0
+
+    def changes(self, since=0):
+        found = self.db['ga_dynamic_models__changes'].find({'kind' : self.kind, '_id' : {'$gt' : since}})
+        return [{'revision' : c['_id'], 'name' : c['name'], 'deleted' : c['deleted']} for c in found.sort('_id', 1)]
+
+
+class SQLDefinitionStore(DefinitionStore):
+    """
+    Keeps definitions as JSON in the ga_dynamic_models_definition table of a Django database and logs changes to
+    ga_dynamic_models_definitionchange, whose autoincrementing id doubles as the revision counter.  Both tables are
+    created by syncdb.  Until they exist, the store reads as empty; any other database error is raised.
+    """
+
+    def __init__(self, kind, using='default'):
+        super(SQLDefinitionStore, self).__init__(kind)
+        self.using = using
+
+    def _models(self):
+        from ga_dynamic_models.catalog import Definition, DefinitionChange
+        return Definition, DefinitionChange
+
+    def _decode(self, row):
+        definition = json.loads(row.document)
+        definition['_id'] = row.name
+        definition['_rev'] = row.revision
+        return definition
+
+    def _read(self, read, empty):
+        """
+        :return: What ``read()`` returns, or ``empty`` if the definition table hasn't been created yet.
+        :raises DatabaseError: if the read fails for any other reason.  Either way it is rolled back to a savepoint
+            first, so that a transaction it was part of can go on.
+        """
+        from django.db import connections, transaction, DatabaseError
+        Definition, _ = self._models()
+        sid = transaction.savepoint(using=self.using)
+        try:
+            result = read()
+        except DatabaseError:
+            transaction.savepoint_rollback(sid, using=self.using)
+            if Definition._meta.db_table in connections[self.using].introspection.table_names():
+                raise
+            return empty
+        transaction.savepoint_commit(sid, using=self.using)
+        return result
+
+    def get(self, name):
+        Definition, _ = self._models()
+
+        def read():
+            try:
+                return self._decode(Definition.objects.using(self.using).get(kind=self.kind, name=name))
+            except Definition.DoesNotExist:
+                return None
+        return self._read(read, None)
+
+    def list(self):
+        Definition, _ = self._models()
+        return self._read(
+            lambda: [self._decode(row) for row in Definition.objects.using(self.using).filter(kind=self.kind)], [])
+
+    def _write(self, name, definition, revision):
+        from django.db import IntegrityError
+        try:
+            return self._write_once(name, definition, revision)
+        except IntegrityError:
+            # another writer inserted the definition between the check and the insert
+            if revision is None:
+                return self._write_once(name, definition, revision)
+            raise RevisionConflict("{kind} definition {name} was created by another writer first".format(
+                kind=self.kind, name=name))
+
+    def _write_once(self, name, definition, revision):
+        from django.db import transaction
+        Definition, DefinitionChange = self._models()
+
+        with transaction.commit_on_success(using=self.using):
+            rows = Definition.objects.using(self.using).filter(kind=self.kind, name=name)
+            if hasattr(rows, 'select_for_update'):
+                rows = rows.select_for_update()
+            current = rows[0].revision if rows else None
+            self._check(name, current, revision)
+
+            change = DefinitionChange(kind=self.kind, name=name, deleted=definition is None)
+            change.save(using=self.using)
+            if definition is None:
+                rows.delete()
+            else:
+                definition['_id'] = name
+                definition['_rev'] = change.pk
+                document = json.dumps(dict((k, v) for k, v in definition.items() if k not in ('_id', '_rev')))
+                if current is None:
+                    Definition(kind=self.kind, name=name, revision=change.pk, document=document).save(using=self.using)
+                else:
+                    rows.update(revision=change.pk, document=document)
+            return change.pk
+
+    def put(self, definition, revision=None):
+        return self._write(definition['name'], definition, revision)
+
+    def delete(self, name, revision=None):
+        return self._write(name, None, revision)
+
+    def revision(self):
+        from django.db.models import Max
+        _, DefinitionChange = self._models()
+        return DefinitionChange.objects.using(self.using).aggregate(rev=Max('id'))['rev'] or 0
+
+    def changes(self, since=0):
+        _, DefinitionChange = self._models()
+        return [{'revision' : c.pk, 'name' : c.name, 'deleted' : c.deleted} for c in
+                DefinitionChange.objects.using(self.using).filter(kind=self.kind, pk__gt=since).order_by('pk')]
+
+
+_stores = {}
+
+def get_store(kind):
+    """
+    Get the configured definition store for a kind of definition.  Stores are created once per process.
+
+    :param kind: 'models', 'api', 'stats', 'shards', 'usage' or 'indexes'
+    :return: A DefinitionStore
+    """
+    if kind not in _stores:
+        config = getattr(settings, 'GA_DYNAMIC_MODELS_DEFINITION_STORE', {})
+        module, cls = config.get('BACKEND', 'ga_dynamic_models.stores.MongoDefinitionStore').rsplit('.', 1)
+        _stores[kind] = importlib.import_module(module).__getattribute__(cls)(kind, **config.get('OPTIONS', {}))
+    return _stores[kind]
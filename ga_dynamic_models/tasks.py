@@ -1,7 +1,20 @@
 from celery.task import task
-import subprocess
+from django.conf import settings
+from ga_dynamic_models import reloader
+from ga_dynamic_models import archive
 
-@task
-def restart_ga():
-    """This is hideous. Make ga_dynamic_models work without restarting the server"""
-    subprocess.call("sleep 2 && supervisorctl restart ga", shell=True)
\ No newline at end of file
+@task(max_retries=None)
+def restart_ga(ticket=None):
+    """Reload the workers one at a time.  Call ga_dynamic_models.reloader.request_reload rather than this directly, so
+    that a burst of requests collapses into a single reload."""
+    if reloader.run_reload(ticket) == 'busy':
+        restart_ga.retry(args=[ticket], countdown=getattr(settings, 'GA_DYNAMIC_MODELS_RELOAD_DELAY', 2))
+
+@task(ignore_result=True)
+def restore_model(name):
+    """Load an archived model back into the database.  Call ga_dynamic_models.archive.request_restore rather than this
+    directly, so that a model is only restored once however many requests ask for it."""
+    try:
+        archive.restore(name)
+    finally:
+        archive.restored(name)
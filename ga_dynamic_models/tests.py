@@ -1,29 +1,1239 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import unittest
 from ga_dynamic_models.utils import *
+from ga_dynamic_models.stores import MemoryDefinitionStore, MongoDefinitionStore, SQLDefinitionStore, RevisionConflict
+from ga_dynamic_models.catalog import Definition, DefinitionChange
+from ga_dynamic_models import generations
+from ga_dynamic_models import loader
+from django.db import connections, models, transaction, DatabaseError
+from django.test import TestCase, TransactionTestCase
+from tastypie.exceptions import BadRequest
+from tastypie.constants import ALL
+from ga_dynamic_models.pagination import KeysetPaginator, encode_cursor, decode_cursor
+from urlparse import urlparse, parse_qs
+from django.contrib.auth.models import User, AnonymousUser
+from django.test.client import RequestFactory
+from tastypie.authentication import Authentication
+from tastypie.authorization import Authorization, ReadOnlyAuthorization
+from ga_dynamic_models.resources import DynamicModelResource
+from ga_dynamic_models import response_cache
+from ga_dynamic_models import snapshot
+from ga_dynamic_models import tiles
+from ga_dynamic_models import export
+from ga_dynamic_models import aggregation
+from ga_dynamic_models import counting
+from ga_dynamic_models import advisor
+from ga_dynamic_models import categorical
+from ga_dynamic_models import derived
+from ga_dynamic_models.parser import Parser
+from ga_dynamic_models import search
+from ga_dynamic_models import shards
+from ga_dynamic_models import routers
+from ga_dynamic_models import archive
+from ga_dynamic_models import classcache
+from ga_dynamic_models.views import status
+from ga_dynamic_models.stats import HyperLogLog, Histogram, ColumnProfile
+from ga_dynamic_models.partitioning import Partitioning
+from ga_dynamic_models.validators import column_letter, ValidationReport, BloomFilter, SortedValues
+from decimal import Decimal
+import cStringIO as StringIO
+import datetime
+import hashlib
+import zlib
+import csv
+from django.core.management.color import no_style
+from ga_dynamic_models.stores import get_store
+from django.test.utils import override_settings
+import tempfile
+import shutil
+import json
+import time
+import os
 
-drop_model("MyGeoModel")
-drop_model("MyRegularModel")
-drop_resource("MyGeoModel")
-drop_resource("MyRegularModel")
-
-declare_model(simple_geomodel('MyGeoModel',
-    geom = simple_geofield('PointField'),
-    some_name = simple_geofield('CharField', max_length=255, default='', null=True, db_index=True),
-    some_integer = simple_geofield("IntegerField", default=10)
-))
-
-declare_model(simple_model("MyRegularModel",
-    some_name = simple_field('CharField', max_length=255, default='', null=True, db_index=True),
-    some_integer = simple_field("IntegerField", default=10)
-))
-
-declare_resource(simple_model_resource(
-    'ga_dynamic_models.models',
-    'MyRegularModel',
-    "my_regular_model"
-))
-
-declare_resource(simple_geo_resource(
-    'ga_dynamic_models.models',
-    'MyGeoModel',
-    'my_geo_model'
-))
+
+def declare_examples():
+    """Declare a geographic and a regular example model with resources over them, replacing any left from before."""
+    drop_model("MyGeoModel")
+    drop_model("MyRegularModel")
+    drop_resource("MyGeoModel")
+    drop_resource("MyRegularModel")
+
+    declare_model(simple_geomodel('MyGeoModel',
+        geom = simple_geofield('PointField'),
+        some_name = simple_geofield('CharField', max_length=255, default='', null=True, db_index=True),
+        some_integer = simple_geofield("IntegerField", default=10)
+    ))
+
+    declare_model(simple_model("MyRegularModel",
+        some_name = simple_field('CharField', max_length=255, default='', null=True, db_index=True),
+        some_integer = simple_field("IntegerField", default=10)
+    ))
+
+    declare_resource(simple_model_resource(
+        'ga_dynamic_models.models',
+        'MyRegularModel',
+        "my_regular_model"
+    ))
+
+    declare_resource(simple_geo_resource(
+        'ga_dynamic_models.models',
+        'MyGeoModel',
+        'my_geo_model'
+    ))
+
+
+class MemoryDefinitionStoreTest(unittest.TestCase):
+    def setUp(self):
+        MemoryDefinitionStore.clear()
+        self.store = MemoryDefinitionStore('models')
+
+    def tearDown(self):
+        MemoryDefinitionStore.clear()
+
+    def legacy(self, name):
+        # as written before definitions carried revisions
+        self.store._definitions['models'][name] = {'_id' : name, 'name' : name, 'fields' : {}}
+
+    def test_put_stamps_revision(self):
+        rev = self.store.put({'name' : 'A'}, revision=0)
+        self.assertEqual(self.store.get('A')['_rev'], rev)
+        self.assertEqual(self.store.revision(), rev)
+
+    def test_put_new_conflicts_with_existing(self):
+        self.store.put({'name' : 'A'}, revision=0)
+        self.assertRaises(RevisionConflict, self.store.put, {'name' : 'A'}, revision=0)
+
+    def test_put_stale_revision_conflicts(self):
+        first = self.store.put({'name' : 'A'}, revision=0)
+        self.store.put({'name' : 'A', 'x' : 1}, revision=first)
+        self.assertRaises(RevisionConflict, self.store.put, {'name' : 'A', 'x' : 2}, revision=first)
+        self.assertEqual(self.store.get('A')['x'], 1)
+
+    def test_delete_conditional(self):
+        rev = self.store.put({'name' : 'A'}, revision=0)
+        self.assertRaises(RevisionConflict, self.store.delete, 'A', revision=rev + 1)
+        self.store.delete('A', revision=rev)
+        self.assertEqual(self.store.get('A'), None)
+
+    def test_update_keeps_other_keys(self):
+        self.store.put({'name' : 'A', 'fields' : {'x' : 1}}, revision=0)
+        rev = self.store.update('A', _row_count=10)
+        definition = self.store.get('A')
+        self.assertEqual(definition['fields'], {'x' : 1})
+        self.assertEqual(definition['_row_count'], 10)
+        self.assertEqual(definition['_rev'], rev)
+        self.assertEqual(self.store.update('Missing', _row_count=1), None)
+
+    def test_changes(self):
+        first = self.store.put({'name' : 'A'}, revision=0)
+        second = self.store.delete('A')
+        self.assertEqual(self.store.changes(), [
+            {'revision' : first, 'name' : 'A', 'deleted' : False},
+            {'revision' : second, 'name' : 'A', 'deleted' : True},
+        ])
+        self.assertEqual(self.store.changes(first), [{'revision' : second, 'name' : 'A', 'deleted' : True}])
+        self.assertEqual(MemoryDefinitionStore('api').changes(), [])
+
+    def test_legacy_definition_without_revision(self):
+        self.legacy('Old')
+        rev = self.store.update('Old', _data_changed_at=1.0)
+        self.assertEqual(self.store.get('Old')['_rev'], rev)
+
+        self.legacy('Old')
+        one = self.store.get('Old')
+        self.store.put(dict(one, fields={'x' : 1}), revision=one.get('_rev'))
+        self.assertEqual(self.store.get('Old')['fields'], {'x' : 1})
+
+        self.legacy('Old')
+        self.store.delete('Old', revision=self.store.get('Old').get('_rev'))
+        self.assertEqual(self.store.get('Old'), None)
+
+    def test_legacy_generation(self):
+        self.legacy('Old')
+        get_store = generations.get_store
+        generations.get_store = lambda kind: self.store
+        try:
+            generations.forget('Old')
+            self.assertEqual(generations.current('Old'), 0)
+            generations.forget('Old')
+            self.assertEqual(generations.current('Missing'), None)
+        finally:
+            generations.get_store = get_store
+            generations.forget('Old')
+
+
+@unittest.skipUnless(hasattr(settings, 'MONGODB_ROUTES'), 'MONGODB_ROUTES is not configured')
+class MongoDefinitionStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.store = MongoDefinitionStore('models')
+        self.store.collection.remove({'_id' : 'Old'}, safe=True)
+        self.store.collection.save({'_id' : 'Old', 'name' : 'Old', 'fields' : {}}, safe=True)
+
+    def tearDown(self):
+        self.store.collection.remove({'_id' : 'Old'}, safe=True)
+
+    def test_legacy_update(self):
+        rev = self.store.update('Old', _row_count=3)
+        definition = self.store.get('Old')
+        self.assertEqual(definition['_rev'], rev)
+        self.assertEqual(definition['_row_count'], 3)
+
+    def test_legacy_replace_and_delete(self):
+        one = self.store.get('Old')
+        self.store.put(dict(one, fields={'x' : 1}), revision=one.get('_rev'))
+        self.assertEqual(self.store.get('Old')['fields'], {'x' : 1})
+        self.store.collection.save({'_id' : 'Old', 'name' : 'Old'}, safe=True)
+        self.store.delete('Old', revision=self.store.get('Old').get('_rev'))
+        self.assertEqual(self.store.get('Old'), None)
+
+    def test_changes_since(self):
+        first = self.store.put({'name' : 'Old'})
+        second = self.store.delete('Old')
+        self.assertEqual(self.store.changes(first - 1)[-2:], [{'revision' : first, 'name' : 'Old', 'deleted' : False},
+            {'revision' : second, 'name' : 'Old', 'deleted' : True}])
+        self.assertEqual(self.store.changes(second), [])
+
+
+class DefinitionColumns(models.Model):
+    kind = models.CharField(max_length=16)
+    name = models.CharField(max_length=255)
+    revision = models.IntegerField()
+    document = models.TextField()
+
+    class Meta:
+        abstract = True
+
+
+class NoTable(DefinitionColumns):
+    class Meta:
+        app_label = 'ga_dynamic_models'
+        db_table = 'ga_dynamic_models_no_such_table'
+        managed = False
+
+
+class BrokenDefinition(DefinitionColumns):
+    no_such_column = models.TextField()
+
+    class Meta:
+        app_label = 'ga_dynamic_models'
+        db_table = 'ga_dynamic_models_definition'
+        managed = False
+
+
+class RacingStore(SQLDefinitionStore):
+    """Lets another writer insert a definition just after the store has checked that there isn't one."""
+    def _check(self, name, current, revision):
+        Definition.objects.create(kind=self.kind, name=name, revision=1, document='{}')
+        super(RacingStore, self)._check(name, current, revision)
+
+
+class SQLDefinitionStoreTest(TransactionTestCase):
+    # writes commit their own transactions
+    def test_put_and_changes(self):
+        store = SQLDefinitionStore('models')
+        rev = store.put({'name' : 'Thing', 'fields' : {}}, revision=0)
+        self.assertEqual(store.get('Thing')['_rev'], rev)
+        self.assertRaises(RevisionConflict, store.put, {'name' : 'Thing'}, revision=0)
+        self.assertEqual([c['name'] for c in store.changes(rev - 1)], ['Thing'])
+
+    def test_concurrent_create_conflicts(self):
+        self.assertRaises(RevisionConflict, RacingStore('models').put, {'name' : 'Thing'}, revision=0)
+        self.assertEqual(SQLDefinitionStore('models').get('Thing'), None)
+
+    def test_missing_table_reads_empty(self):
+        store = SQLDefinitionStore('models')
+        store._models = lambda: (NoTable, DefinitionChange)
+        self.assertEqual(store.get('Thing'), None)
+        self.assertEqual(store.list(), [])
+
+    def test_other_errors_raised(self):
+        store = SQLDefinitionStore('models')
+        store._models = lambda: (BrokenDefinition, DefinitionChange)
+        self.assertRaises(DatabaseError, store.get, 'Thing')
+        self.assertRaises(DatabaseError, store.list)
+
+
+class GeometryFormatTest(unittest.TestCase):
+    def setUp(self):
+        self.loader = object.__new__(loader.Loader)
+        self.loader.connection = connections['default']
+        self.loader.columns = [
+            loader.Column('name', 0, loader._char, 'CharField'),
+            loader.Column('geom', 1, None, 'PointField', 4326),
+        ]
+        self.wkt = loader.ewkt('POINT (1 2)', 4326)
+        self.wkb = loader.ewkb_point(1.0, 2.0, 4326)
+
+    def test_mixed_batch_split_by_format(self):
+        batch = [('a', self.wkt), ('b', self.wkb), ('c', None), ('d', self.wkt)]
+        groups = self.loader._by_geometry_format(batch, True)
+        self.assertEqual(groups[(True,)], [('a', self.wkt), ('d', self.wkt)])
+        self.assertEqual(groups[(False,)], [('b', self.wkb), ('c', None)])
+        self.assertTrue('GeomFromEWKT(%s)' in self.loader._insert_sql('t', (True,)))
+        self.assertTrue('GeomFromEWKB(%s)' in self.loader._insert_sql('t', (False,)))
+
+    def test_no_split_without_spatialite(self):
+        batch = [('a', self.wkt), ('b', self.wkb)]
+        self.assertEqual(self.loader._by_geometry_format(batch, False), {() : batch})
+        self.assertFalse('Geom' in self.loader._insert_sql('t', ()))
+
+
+class BooleanColumnTest(unittest.TestCase):
+    def test_spellings(self):
+        for value in ('true', 'T', 'Yes', 'y', '1', ' TRUE '):
+            self.assertTrue(loader._bool(value) is True, value)
+        for value in ('false', 'F', 'NO', 'n', '0'):
+            self.assertTrue(loader._bool(value) is False, value)
+        self.assertEqual(loader._bool(''), None)
+        for value in ('2', 'maybe', 'nope'):
+            self.assertRaises(ValueError, loader._bool, value)
+
+
+class PagedRow(models.Model):
+    name = models.CharField(max_length=10, null=True, db_index=True)
+    size = models.IntegerField(null=True)
+
+    class Meta:
+        app_label = 'ga_dynamic_models'
+
+
+class CategoricalRow(models.Model):
+    county = categorical.CategoricalField(null=True, db_index=True)
+    size = models.IntegerField(null=True)
+
+    class Meta:
+        app_label = 'ga_dynamic_models'
+
+
+class KeysetPaginatorTest(TestCase):
+    def setUp(self):
+        for name in ['b', None, 'a', 'c', None, 'b', 'a']:
+            PagedRow.objects.create(name=name)
+
+    def pages(self, **params):
+        params.setdefault('limit', 2)
+        seen = []
+        while True:
+            page = KeysetPaginator(params, PagedRow.objects.all(), resource_uri='/rows/', limit=2).page()
+            seen.extend((row.name, row.pk) for row in page['objects'])
+            if not page['meta']['next']:
+                return seen
+            params['cursor'] = parse_qs(urlparse(page['meta']['next']).query)['cursor'][0]
+
+    def test_cursor_round_trip(self):
+        self.assertEqual(decode_cursor(encode_cursor([u'a', 3, None])), [u'a', 3, None])
+        self.assertRaises(BadRequest, decode_cursor, 'not a cursor')
+
+    def test_pages_by_pk(self):
+        self.assertEqual([pk for _, pk in self.pages()], sorted(PagedRow.objects.values_list('pk', flat=True)))
+
+    def test_nulls_sort_last(self):
+        seen = self.pages(order_by='name')
+        self.assertEqual(len(seen), 7)
+        self.assertEqual([name for name, _ in seen], ['a', 'a', 'b', 'b', 'c', None, None])
+        self.assertEqual(seen, sorted(seen, key=lambda (name, pk): (name is None, name, pk)))
+
+    def test_nulls_sort_first_descending(self):
+        seen = self.pages(order_by='-name')
+        self.assertEqual([name for name, _ in seen], [None, None, 'c', 'b', 'b', 'a', 'a'])
+        self.assertEqual(len(set(seen)), 7)
+
+    def test_rejected_keys(self):
+        for order_by in ('size', 'nope'):
+            paginator = KeysetPaginator({'order_by' : order_by}, PagedRow.objects.all(), limit=2)
+            self.assertRaises(BadRequest, paginator.page)
+
+
+
+class CategoricalKeyTest(TransactionTestCase):
+    # encoding a new value creates the dictionary table, which commits on SQLite
+    def test_rejected(self):
+        for county in ('wake', 'durham', 'orange'):
+            CategoricalRow.objects.create(county=county)
+        paginator = KeysetPaginator({'order_by' : 'county'}, CategoricalRow.objects.all(), limit=2)
+        self.assertRaises(BadRequest, paginator.page)
+        paginator = KeysetPaginator({}, CategoricalRow.objects.all(), limit=2)
+        self.assertEqual([row.county for row in paginator.page()['objects']], ['wake', 'durham'])
+        categorical.drop(CategoricalRow)
+
+
+class HeaderAuthentication(Authentication):
+    def is_authenticated(self, request, **kwargs):
+        name = request.META.get('HTTP_X_USER')
+        if name == 'nobody':
+            return False
+        if name:
+            request.user = User.objects.get(username=name)
+        return True
+
+
+class OwnRowsAuthorization(Authorization):
+    def apply_limits(self, request, object_list):
+        return object_list.filter(name=request.user.username if request.user.is_authenticated() else None)
+
+
+class NobodyAuthorization(ReadOnlyAuthorization):
+    def is_authorized(self, request, object=None):
+        return False
+
+
+def row_resource(authorization, **options):
+    """A resource over PagedRow, authenticated by HeaderAuthentication, with any other Meta options given."""
+    options.update({'queryset' : PagedRow.objects.all(), 'resource_name' : 'rows',
+        'authentication' : HeaderAuthentication(), 'authorization' : authorization})
+    meta = type('Meta', (object,), options)
+    return type('RowResource', (DynamicModelResource,), {
+        'Meta' : meta,
+        # no URLconf to reverse from
+        'get_resource_list_uri' : lambda self: '/rows/',
+        'get_resource_uri' : lambda self, bundle_or_obj=None: '/rows/',
+    })()
+
+
+class CachedResponseTest(TestCase):
+    def setUp(self):
+        response_cache.get_backend().clear()
+        for name in ('alice', 'bob'):
+            User.objects.create_user(name, name + '@example.com', 'x')
+            PagedRow.objects.create(name=name)
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        response_cache.get_backend().clear()
+
+    def get(self, view, user=None, z=None, x=None, y=None, **headers):
+        request = self.factory.get('/rows/', HTTP_ACCEPT='application/json', **headers)
+        request.user = AnonymousUser()
+        if user:
+            request.META['HTTP_X_USER'] = user
+        if z is not None:
+            return view(request, resource_name='rows', z=z, x=x, y=y)
+        return view(request, resource_name='rows')
+
+    def names(self, response):
+        return [row['name'] for row in json.loads(response.content)['objects']]
+
+    def test_cached_per_user(self):
+        view = row_resource(OwnRowsAuthorization()).wrap_view('dispatch_list')
+        self.assertEqual(self.names(self.get(view, 'alice')), ['alice'])
+        self.assertEqual(self.names(self.get(view, 'bob')), ['bob'])
+        self.assertEqual(self.names(self.get(view)), [])
+        hit = self.get(view, 'alice')
+        self.assertEqual(self.names(hit), ['alice'])
+        self.assertTrue('Cookie' in hit['Vary'])
+
+    def test_refused_before_cache(self):
+        view = row_resource(OwnRowsAuthorization()).wrap_view('dispatch_list')
+        etag = self.get(view, 'alice')['ETag']
+        self.assertEqual(self.get(view, 'nobody').status_code, 401)
+        self.assertEqual(self.get(view, 'nobody', HTTP_IF_NONE_MATCH=etag).status_code, 401)
+        self.assertEqual(self.get(view, 'alice', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_shared_and_headers_kept(self):
+        view = row_resource(Authorization()).wrap_view('dispatch_list')
+        first = self.get(view, 'alice')
+        first_headers = dict(first.items())
+        second = self.get(view, 'bob')
+        self.assertEqual(second['ETag'], first['ETag'])
+        self.assertEqual(dict(second.items()), first_headers)
+        self.assertEqual(sorted(self.names(second)), ['alice', 'bob'])
+
+    def test_tiles_refused_when_rows_are_limited(self):
+        view = row_resource(OwnRowsAuthorization()).wrap_view('tile')
+        self.assertEqual(self.get(view, 'alice', z='0', x='0', y='0').status_code, 403)
+        view = row_resource(NobodyAuthorization()).wrap_view('tile')
+        self.assertEqual(self.get(view, 'alice', z='0', x='0', y='0').status_code, 401)
+        view = row_resource(ReadOnlyAuthorization()).wrap_view('tile')
+        # past authorization, on to a tile that doesn't exist
+        self.assertEqual(self.get(view, 'alice', z='1', x='2', y='0').status_code, 404)
+
+
+class SparseFieldsTest(TestCase):
+    def setUp(self):
+        PagedRow.objects.create(name='a', size=1)
+        self.view = row_resource(Authorization()).wrap_view('dispatch_list')
+
+    def get(self, **query):
+        request = RequestFactory().get('/rows/', query, HTTP_ACCEPT='application/json')
+        request.user = AnonymousUser()
+        return self.view(request, resource_name='rows')
+
+    def test_fields_limit_keys(self):
+        self.assertEqual(sorted(json.loads(self.get().content)['objects'][0]), ['id', 'name', 'resource_uri', 'size'])
+        for fields in ('size', 'size,,', ' size '):
+            objects = json.loads(self.get(fields=fields).content)['objects']
+            self.assertEqual(objects, [{'size' : 1, 'resource_uri' : '/rows/'}])
+        objects = json.loads(self.get(fields=['size', 'name']).content)['objects']
+        self.assertEqual(sorted(objects[0]), ['name', 'resource_uri', 'size'])
+
+    def test_unknown_field_rejected(self):
+        response = self.get(fields='size,nope')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('nope', response.content)
+
+
+class ExportTest(TransactionTestCase):
+    # encoding a categorical value creates its dictionary table, which commits on SQLite
+    def setUp(self):
+        for name in ('alice', 'bob'):
+            User.objects.create_user(name, name + '@example.com', 'x')
+        for name, size in [('alice', 1), ('alice', None), ('bob', 3)]:
+            PagedRow.objects.create(name=name, size=size)
+        self.factory = RequestFactory()
+
+    def export(self, view, format, user='alice', **query):
+        request = self.factory.get('/rows/export.' + format, query)
+        request.user = AnonymousUser()
+        request.META['HTTP_X_USER'] = user
+        return view(request, resource_name='rows', format=format)
+
+    def test_csv_honours_filters_and_authorization(self):
+        view = row_resource(OwnRowsAuthorization(), filtering={'size' : ALL}).wrap_view('export')
+        response = self.export(view, 'csv', size__isnull='false')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(list(csv.reader(StringIO.StringIO(response.content))), [['id', 'name', 'size'],
+            [str(PagedRow.objects.get(size=1).pk), 'alice', '1']])
+        response = self.export(view, 'csv', fields='size')
+        self.assertEqual([row[1] for row in csv.reader(StringIO.StringIO(response.content))], ['size', '1', ''])
+        self.assertEqual(self.export(view, 'csv', fields='nope').status_code, 400)
+
+    def test_ndjson_gzipped(self):
+        view = row_resource(Authorization()).wrap_view('export')
+        plain = self.export(view, 'ndjson').content
+        self.assertEqual([json.loads(line)['size'] for line in plain.splitlines()], [1, None, 3])
+        request = self.factory.get('/rows/export.ndjson', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        response = export.export_response(request, PagedRow.objects.all(), 'ndjson', 'rows')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(response.content, zlib.MAX_WBITS | 16), plain)
+
+    def test_geojson(self):
+        self.assertRaises(ValueError, export.export_response, self.factory.get('/'), PagedRow.objects.all(),
+            'geojson', 'rows')
+        names = ['id', 'geom__text', 'name']
+        batches = [[(1, '{"type":"Point","coordinates":[1,2]}', u'a')], [], [(2, None, None)]]
+        collection = json.loads(''.join(export.encode_geojson(iter(batches), names, 'geom__text')))
+        self.assertEqual(collection['features'], [
+            {'type' : 'Feature', 'geometry' : {'type' : 'Point', 'coordinates' : [1, 2]},
+             'properties' : {'id' : 1, 'name' : 'a'}},
+            {'type' : 'Feature', 'geometry' : None, 'properties' : {'id' : 2, 'name' : None}}])
+
+    def test_categorical_values_decoded(self):
+        for county in ('wake', None, 'durham'):
+            CategoricalRow.objects.create(county=county)
+        request = self.factory.get('/')
+        rows = CategoricalRow.objects.order_by('pk')
+        try:
+            content = export.export_response(request, rows, 'csv', 'rows').content
+            self.assertEqual([row[1] for row in csv.reader(StringIO.StringIO(content))],
+                ['county', 'wake', '', 'durham'])
+            content = export.export_response(request, rows, 'ndjson', 'rows').content
+            self.assertEqual([json.loads(line)['county'] for line in content.splitlines()], ['wake', None, 'durham'])
+        finally:
+            categorical.drop(CategoricalRow)
+
+
+class SnapshotTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings = override_settings(GA_DYNAMIC_MODELS_SNAPSHOT_DIR=self.directory)
+        self.settings.enable()
+        PagedRow.objects.create(name='a', size=1)
+        PagedRow.objects.create(name=None, size=2)
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.directory)
+
+    def test_refused_when_rows_are_limited(self):
+        request = RequestFactory().get('/rows/snapshot.gasnap')
+        request.user = AnonymousUser()
+        for authorization, status in [(OwnRowsAuthorization(), 403), (NobodyAuthorization(), 401),
+                                      (ReadOnlyAuthorization(), 200)]:
+            view = row_resource(authorization).wrap_view('snapshot')
+            self.assertEqual(view(request, resource_name='rows').status_code, status)
+        self.assertEqual(view(request, resource_name='rows', column='size').status_code, 200)
+
+    def test_trailing_nul_kept(self):
+        builder = snapshot._ColumnBuilder('geom', 'geom', '|S', snapshot._hex, self.directory)
+        builder.append('\x01\x00\x00')
+        builder.append(None)
+        out = tempfile.TemporaryFile()
+        builder.write_data(out)
+        builder.close()
+        out.seek(0)
+        self.assertEqual(builder.final_dtype, '|S6')
+        self.assertEqual(out.read(), '010000' + '\0' * 6)
+
+    def test_build(self):
+        path = snapshot.get(PagedRow)
+        with open(path, 'rb') as flo:
+            header, _ = snapshot.read_header(flo)
+        self.assertEqual(header['rows'], 2)
+        self.assertEqual(header['geometry'], 'hex')
+        self.assertTrue('name.mask' in [c['name'] for c in header['columns']])
+
+    def test_one_builder_at_a_time(self):
+        lock = snapshot.path('PagedRow', generations.current('PagedRow')) + '.lock'
+        open(lock, 'w').close()
+        self.assertRaises(snapshot.Building, snapshot.get, PagedRow)
+        stale = time.time() - snapshot.build_timeout() - 1
+        os.utime(lock, (stale, stale))
+        self.assertTrue(os.path.exists(snapshot.get(PagedRow)))
+        self.assertFalse(os.path.exists(lock))
+
+
+class TileLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.features = tiles.features
+        self.settings = override_settings(GA_DYNAMIC_MODELS_TILE_MAX_FEATURES=2)
+        self.settings.enable()
+
+    def tearDown(self):
+        tiles.features = self.features
+        self.settings.disable()
+
+    def rows(self, count):
+        def features(model, bounds, using=None, limit=None):
+            for i in range(min(count, limit)):
+                yield (i, tiles.POINT, [9, 0, 0], {'id' : i})
+            if count > limit:
+                yield None
+        tiles.features = features
+
+    def test_full_tile_truncated(self):
+        self.rows(3)
+        content, truncated = tiles.render(PagedRow, 'rows', 0, 0, 0)
+        self.assertTrue(truncated)
+        self.assertEqual(content, tiles.encode_layer('rows', [(i, tiles.POINT, [9, 0, 0], {'id' : i}) for i in (0, 1)]))
+
+    def test_tile_under_limit(self):
+        self.rows(2)
+        self.assertFalse(tiles.render(PagedRow, 'rows', 0, 0, 0)[1])
+        self.assertRaises(ValueError, tiles.render, PagedRow, 'rows', 1, 2, 0)
+
+    def test_categorical_properties_decoded(self):
+        class Geometry(object):
+            column, srid = 'geom', tiles.WEB_MERCATOR
+
+        connection = connections['default']
+        sql, names, _ = tiles._sql(CategoricalRow, Geometry(), connection, False)
+        self.assertEqual(names, ['id', 'county', 'size'])
+        decoded = categorical.decode_sql(CategoricalRow, CategoricalRow._meta.get_field('county'), connection)
+        self.assertIn(', {decoded}, '.format(decoded=decoded), sql)
+
+
+class RecordingCache(object):
+    """Stands in for Django's cache, remembering the timeout of every value set and never finding anything."""
+    def __init__(self):
+        self.timeouts = {}
+
+    def get(self, key, default=None):
+        return default
+
+    def set(self, key, value, timeout=None):
+        self.timeouts[key] = timeout
+
+
+class CountingTest(unittest.TestCase):
+    def setUp(self):
+        self.store = get_store('models')
+        self.store.put({'name' : 'PagedRow'})
+        self.cache = counting.cache
+        counting.cache = RecordingCache()
+
+    def tearDown(self):
+        counting.cache = self.cache
+        self.store.delete('PagedRow')
+        generations.forget('PagedRow')
+
+    def test_cached_with_timeout(self):
+        counting.record(PagedRow, 3)
+        self.assertEqual(counting.cache.timeouts.values(), [24 * 3600])
+        with override_settings(GA_DYNAMIC_MODELS_ROW_COUNT_TIMEOUT=60):
+            self.assertEqual(counting.recorded(PagedRow), 3)
+        self.assertEqual(counting.cache.timeouts.values(), [60])
+
+
+class AggregationTest(TestCase):
+    def setUp(self):
+        for name, size in [('a', 1), ('a', 3), ('b', 2), (None, 5), ('b', None)]:
+            PagedRow.objects.create(name=name, size=size)
+        self.store = get_store('models')
+        self.store.put({'name' : 'PagedRow'})
+        generations.forget('PagedRow')
+
+    def tearDown(self):
+        self.store.delete('PagedRow')
+        generations.forget('PagedRow')
+
+    def test_parse_metrics(self):
+        self.assertEqual(aggregation.parse_metrics([]), [('count', None)])
+        self.assertEqual(aggregation.parse_metrics(['count,avg:size', 'max:size']),
+            [('count', None), ('avg', 'size'), ('max', 'size')])
+
+    def test_validate(self):
+        aggregation.validate(PagedRow, ['name'], [('count', 'name'), ('sum', 'size')])
+        for group_by, requested in [(['nope'], [('count', None)]), ([], [('sum', 'name')]), ([], [('median', 'size')]),
+                                    ([], [('sum', None)]), ([], [('count', 'nope')])]:
+            self.assertRaises(ValueError, aggregation.validate, PagedRow, group_by, requested)
+
+    def test_rollup_matches_query(self):
+        aggregation.declare_rollups('PagedRow', [['name', 'size']])
+        requested = [('count', None), ('count', 'name'), ('count', 'size'), ('avg', 'size'), ('min', 'size'),
+                     ('max', 'size'), ('sum', 'size')]
+        for group_by in (['name'], []):
+            live = aggregation.aggregate(PagedRow.objects.all(), group_by, requested)
+            rolled = aggregation.from_rollup(PagedRow, group_by, requested)
+            self.assertEqual(rolled, sorted(live, key=lambda row: [row[name] for name in group_by]))
+
+    def test_rollup_cached_with_timeout(self):
+        cache = aggregation.cache
+        aggregation.cache = RecordingCache()
+        try:
+            with override_settings(GA_DYNAMIC_MODELS_ROLLUP_TIMEOUT=60):
+                aggregation.compute_rollup(PagedRow, ['name'])
+            self.assertEqual(aggregation.cache.timeouts.values(), [60])
+        finally:
+            aggregation.cache = cache
+
+    def test_rollup_not_declared(self):
+        self.assertEqual(aggregation.from_rollup(PagedRow, ['name'], [('count', None)]), None)
+        rows, rollup = aggregation.answer(PagedRow.objects.all(), ['name'], [('count', 'name')])
+        self.assertFalse(rollup)
+        self.assertEqual([row['count_name'] for row in rows], [0, 2, 2])
+
+
+class LargeRow(models.Model):
+    name = models.CharField(max_length=10, null=True)
+    size = models.IntegerField(null=True)
+
+    class Meta:
+        app_label = 'ga_dynamic_models'
+
+
+class SizeByName(models.Model):
+    name = models.CharField(max_length=10, null=True)
+    count = models.IntegerField(default=0)
+    sum_size = models.BigIntegerField(null=True)
+
+    class Meta:
+        app_label = 'ga_dynamic_models'
+
+
+class DerivedTest(TransactionTestCase):
+    # materializing commits, which ends a TestCase's transaction on SQLite
+    def setUp(self):
+        for name, size in [('a', 1), ('a', 3), ('b', 2)]:
+            PagedRow.objects.create(name=name, size=size)
+        self.store = get_store('models')
+        self.store.put({'name' : 'PagedRow', 'fields' : {
+            'name' : simple_field('CharField', max_length=10, null=True, db_index=True),
+            'size' : simple_field('IntegerField', null=True)}})
+        self.store.put({'name' : 'LargeRow', 'derived' : derived.spec('PagedRow', filters={'size__gte' : 2})})
+        self.store.put({'name' : 'SizeByName',
+            'derived' : derived.spec('PagedRow', group_by=['name'], metrics=['count', 'sum:size'])})
+        self.get_model = derived._get_model
+        classes = {'PagedRow' : PagedRow, 'LargeRow' : LargeRow, 'SizeByName' : SizeByName}
+        derived._get_model = lambda name: classes[name]
+
+    def tearDown(self):
+        derived._get_model = self.get_model
+        for name in ('PagedRow', 'LargeRow', 'SizeByName', 'CategoricalRow'):
+            self.store.delete(name)
+            generations.forget(name)
+
+    def sizes(self):
+        return sorted(SizeByName.objects.values_list('name', 'count', 'sum_size'))
+
+    def test_materialize(self):
+        self.assertFalse(derived.materialize('LargeRow'))
+        self.assertEqual(sorted(LargeRow.objects.values_list('id', 'name', 'size')),
+            sorted(PagedRow.objects.filter(size__gte=2).values_list('id', 'name', 'size')))
+        derived.materialize('SizeByName')
+        self.assertEqual(self.sizes(), [('a', 2, 4), ('b', 1, 2)])
+
+    def test_append_is_patched(self):
+        derived.materialize('LargeRow')
+        derived.materialize('SizeByName')
+        # a row no rebuild would keep, to tell a patch from a rebuild
+        LargeRow.objects.create(id=1000, name='kept', size=0)
+        PagedRow.objects.create(name='a', size=5)
+        PagedRow.objects.create(name='c', size=1)
+        self.assertTrue(derived.materialize('LargeRow', changed='PagedRow', replace=False))
+        self.assertEqual(sorted(LargeRow.objects.values_list('name', 'size')), [('a', 3), ('a', 5), ('b', 2),
+            ('kept', 0)])
+        derived.materialize('SizeByName', changed='PagedRow', replace=False)
+        self.assertEqual(self.sizes(), [('a', 3, 9), ('b', 1, 2), ('c', 1, 1)])
+
+        self.assertFalse(derived.materialize('LargeRow', changed='PagedRow', replace=True))
+        self.assertNotIn('kept', LargeRow.objects.values_list('name', flat=True))
+
+    def test_refresh_stale(self):
+        derived.materialize('LargeRow')
+        derived.materialize('SizeByName')
+        self.assertEqual(derived.refresh_stale(), [])
+        PagedRow.objects.create(name='b', size=7)
+        generations.bump('PagedRow')
+        self.assertEqual(derived.refresh_stale(), ['LargeRow', 'SizeByName'])
+        self.assertEqual(self.sizes(), [('a', 2, 4), ('b', 2, 9)])
+        self.assertEqual(derived.refresh_stale(), [])
+
+    def test_categorical_join_refused(self):
+        self.store.put({'name' : 'CategoricalRow', 'fields' : {'county' : {'type' : 'callable',
+            'module' : 'ga_dynamic_models.categorical', 'callable' : 'CategoricalField',
+            'parameters' : {'positionals' : [], 'keywords' : {'null' : True}}}}})
+        self.assertRaises(ValueError, derived.spec, 'CategoricalRow',
+            joins=[join('PagedRow', on={'county' : 'name'}, fields=['size'])])
+        self.assertRaises(ValueError, derived.spec, 'PagedRow',
+            joins=[join('CategoricalRow', on={'name' : 'county'})])
+
+
+class AdvisorTest(unittest.TestCase):
+    def setUp(self):
+        self.store = get_store('models')
+        self.store.put({'name' : 'PagedRow'})
+        generations.forget('PagedRow')
+
+    def tearDown(self):
+        advisor.forget('PagedRow')
+        self.store.delete('PagedRow')
+        generations.forget('PagedRow')
+
+    def test_mark_indexed_keeps_generation(self):
+        generation = generations.current('PagedRow')
+        advisor.mark_indexed('PagedRow', 'size')
+        advisor.mark_indexed('PagedRow', 'size')
+        generations.forget('PagedRow')
+        self.assertEqual(generations.current('PagedRow'), generation)
+        self.assertEqual(advisor.indexed('PagedRow'), set(['size']))
+        advisor.forget('PagedRow')
+        self.assertEqual(advisor.indexed('PagedRow'), set())
+
+    def test_index_names_differ_by_table(self):
+        prefix = 'ga_dynamic_models_' + 'x' * 20
+        names = set(advisor.index_name(prefix + suffix, 'county') for suffix in ('_2019', '_2020'))
+        self.assertEqual(len(names), 2)
+        self.assertTrue(all(len(name) <= 63 for name in names))
+
+    def test_missing_model(self):
+        self.assertEqual(advisor._get_model('NoSuchModel'), None)
+        self.assertRaises(ValueError, advisor.build, {'model' : 'NoSuchModel', 'table' : 'nope', 'column' : 'nope'})
+
+
+class DictionaryTest(TestCase):
+    def test_codes_come_from_the_table(self):
+        first = categorical.Dictionary('test_dictionary', 'default')
+        second = categorical.Dictionary('test_dictionary', 'default')
+        second.reload()
+        self.assertEqual(first.encode(['a', 'b']), {u'a' : 0, u'b' : 1})
+        # the second process hasn't seen the first one's additions, and must not hand out their codes again
+        self.assertEqual(second.encode(['c', 'a']), {u'a' : 0, u'c' : 2})
+        self.assertEqual(first.decode(2), u'c')
+        first.drop()
+
+
+class ParserTest(unittest.TestCase):
+    def test_catalog_keys_are_not_attributes(self):
+        cls = Parser(__name__).parse(
+            name=u'Parsed',
+            bases=[{'type' : 'attribute', 'module' : '__builtin__', 'attribute' : 'object'}],
+            fields={},
+            meta={},
+            partition=list_partition('year'),
+            derived={'source' : 'Permits', 'filters' : {}},
+            _rev=3,
+            first={'type' : 'attribute', 'module' : 'os', 'attribute' : 'sep'},
+            second=u'7')
+        self.assertEqual(cls.__name__, 'Parsed')
+        self.assertEqual((cls.first, cls.second), (os.sep, 7))
+        for name in ('partition', 'derived', '_rev'):
+            self.assertFalse(hasattr(cls, name))
+
+
+class SearchVendorTest(TransactionTestCase):
+    def setUp(self):
+        self.store = get_store('models')
+        self.store.put({'name' : 'PagedRow', '_search' : {'fields' : ['name'], 'method' : 'trigram',
+            'language' : 'english'}})
+        self.vendor = connections['default'].vendor
+
+    def tearDown(self):
+        connections['default'].vendor = self.vendor
+        self.store.delete('PagedRow')
+
+    def test_sqlite(self):
+        PagedRow.objects.create(name='roof repair', size=1)
+        PagedRow.objects.create(name='window', size=2)
+        search.build(PagedRow)
+        self.assertEqual([row.name for row in search.search(PagedRow.objects.all(), 'roof')], ['roof repair'])
+        search.drop(PagedRow)
+
+    def test_other_vendors_refused(self):
+        connections['default'].vendor = 'mysql'
+        self.assertRaises(ValueError, search.build, PagedRow)
+        self.assertRaises(ValueError, search.search, PagedRow.objects.all(), 'roof')
+
+
+class RoutedRow(object):
+    """Stands in for a dynamic model class; the router only looks at its name, module and app label."""
+    __module__ = routers.DYNAMIC_MODULE
+    _meta = type('Options', (object,), {'app_label' : routers.APP_LABEL})()
+
+
+class ReplicaRouterTest(unittest.TestCase):
+    def setUp(self):
+        self.settings = override_settings(GA_DYNAMIC_MODELS_READ_REPLICAS=['replica1', 'replica2'],
+            GA_DYNAMIC_MODELS_REPLICA_CHECK_INTERVAL=0, GA_DYNAMIC_MODELS_REPLICA_LAG=5)
+        self.settings.enable()
+        self.positions = {'default' : 100, 'replica1' : 50, 'replica2' : 50}
+        self.wal_position = routers.wal_position
+        routers.wal_position = self.position
+        routers._replayed.clear()
+        cache.delete(routers._fence_key('RoutedRow'))
+        self.router = routers.ReplicaRouter()
+
+    def tearDown(self):
+        routers.wal_position = self.wal_position
+        routers._replayed.clear()
+        cache.delete(routers._fence_key('RoutedRow'))
+        self.settings.disable()
+
+    def position(self, alias, replayed=False):
+        self.assertEqual(replayed, alias != 'default')
+        if self.positions[alias] is DatabaseError:
+            raise DatabaseError('unreachable')
+        return self.positions[alias]
+
+    def reads(self):
+        return set(self.router.db_for_read(RoutedRow) for _ in range(20))
+
+    def test_no_fence(self):
+        self.assertEqual(self.reads(), set(['replica1', 'replica2']))
+        self.assertEqual(self.router.db_for_write(RoutedRow), 'default')
+        self.assertEqual(self.router.db_for_read(PagedRow), 'default')
+
+    def test_fence_not_passed_reads_primary(self):
+        routers.fence('RoutedRow')
+        self.assertEqual(routers.get_fence('RoutedRow')['position'], 100)
+        self.assertEqual(self.reads(), set(['default']))
+        self.positions['replica2'] = 100
+        self.assertEqual(self.reads(), set(['replica2']))
+        self.positions['replica1'] = 150
+        self.assertEqual(self.reads(), set(['replica1', 'replica2']))
+
+    def test_unreachable_replica_skipped(self):
+        self.positions.update(replica1=DatabaseError, replica2=200)
+        self.assertEqual(self.reads(), set(['replica2']))
+        routers.fence('RoutedRow')
+        self.assertEqual(self.reads(), set(['replica2']))
+        self.positions['replica2'] = DatabaseError
+        self.assertEqual(self.reads(), set(['default']))
+
+    def test_lag_without_positions(self):
+        self.positions = dict.fromkeys(self.positions, None)
+        routers.fence('RoutedRow')
+        self.assertEqual(self.reads(), set(['default']))
+        cache.set(routers._fence_key('RoutedRow'), dict(routers.get_fence('RoutedRow'), at=time.time() - 6))
+        self.assertEqual(self.reads(), set(['replica1', 'replica2']))
+
+
+class ShardMoveTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for alias in ('shard_a', 'shard_b'):
+            connections.databases[alias] = dict(connections.databases['default'],
+                NAME=os.path.join(self.directory, alias + '.db'))
+        connection = connections['shard_a']
+        cursor = connection.cursor()
+        for sql in connection.creation.sql_create_model(PagedRow, no_style())[0]:
+            cursor.execute(sql)
+        cursor.executemany('INSERT INTO ga_dynamic_models_pagedrow (name, size) VALUES (%s, %s)', [('a', 1), ('b', 2)])
+        transaction.commit_unless_managed(using='shard_a')
+        self.store = get_store('models')
+        self.store.put({'name' : 'PagedRow', '_shard' : {'database' : 'shard_a', 'schema' : None}})
+        self.get_model = shards._get_model
+        shards._get_model = lambda name: PagedRow
+
+    def tearDown(self):
+        shards._get_model = self.get_model
+        shards.drop_retired('PagedRow', everything=True)
+        shards.forget('PagedRow')
+        self.store.delete('PagedRow')
+        for alias in ('shard_a', 'shard_b'):
+            connections[alias].close()
+            delattr(connections._connections, alias)
+            del connections.databases[alias]
+        shutil.rmtree(self.directory)
+
+    def tables(self, alias):
+        return connections[alias].introspection.table_names()
+
+    def test_old_table_is_retired(self):
+        self.assertEqual(shards.move('PagedRow', {'database' : 'shard_b', 'schema' : None}), 2)
+        self.assertIn('ga_dynamic_models_pagedrow', self.tables('shard_a'))
+        self.assertEqual(shards.database('PagedRow'), 'shard_b')
+        self.assertEqual([r['tables'] for r in shards.retired('PagedRow')], [['ga_dynamic_models_pagedrow']])
+
+        self.assertEqual(shards.drop_retired(), 0)
+        self.assertRaises(ValueError, shards.move, 'PagedRow', {'database' : 'shard_a', 'schema' : None})
+        self.assertEqual(shards.drop_retired('PagedRow', everything=True), 1)
+        self.assertNotIn('ga_dynamic_models_pagedrow', self.tables('shard_a'))
+        self.assertEqual(shards.retired('PagedRow'), [])
+
+    def test_model_read_by_derived_model(self):
+        self.store.put({'name' : 'Sizes', 'derived' : {'source' : 'PagedRow', 'joins' : []}})
+        try:
+            self.assertRaises(ValueError, shards.move, 'PagedRow', {'database' : 'shard_b', 'schema' : None})
+        finally:
+            self.store.delete('Sizes')
+        self.assertNotIn('ga_dynamic_models_pagedrow', self.tables('shard_b'))
+
+
+class ArchivedRow(models.Model):
+    text = models.TextField(null=True)
+    amount = models.DecimalField(max_digits=30, decimal_places=12, null=True)
+    ratio = models.FloatField(null=True)
+    at = models.DateTimeField(null=True)
+    day = models.DateField(null=True)
+    flag = models.NullBooleanField()
+
+    class Meta:
+        app_label = 'ga_dynamic_models'
+
+
+class ArchiveTest(TransactionTestCase):
+    def setUp(self):
+        self.store = get_store('models')
+        self.store.put({'name' : 'ArchivedRow'})
+        self.get_model = archive._get_model
+        archive._get_model = lambda name: ArchivedRow
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        archive._get_model = self.get_model
+        self.store.delete('ArchivedRow')
+        generations.forget('ArchivedRow')
+        shutil.rmtree(self.directory)
+
+    def test_values_are_kept_exactly(self):
+        values = {'text' : u'ends in NUL\0', 'amount' : Decimal('123456789012345678.000000000001'),
+            'ratio' : 0.1 + 0.2, 'at' : datetime.datetime(2001, 2, 3, 4, 5, 6, 7), 'day' : datetime.date(1960, 1, 2),
+            'flag' : False}
+        for field in ArchivedRow._meta.local_fields:
+            if field.name in values:
+                decoded = archive._converter(field)(archive._encoder(field)(values[field.name]))
+                self.assertEqual((field.name, decoded), (field.name, values[field.name]))
+
+    def test_round_trip(self):
+        ArchivedRow.objects.create(text=u'caf\xe9', amount=Decimal('1.5'), flag=True)
+        ArchivedRow.objects.create()
+        out = StringIO.StringIO()
+        self.assertEqual(archive._write(out, ArchivedRow, 1, 'default'), 2)
+        flo = StringIO.StringIO(out.getvalue())
+        self.assertEqual(flo.read(len(archive.MAGIC)), archive.MAGIC)
+        rows = [row for batch in archive._read_rows(flo, ArchivedRow, 1) for row in batch]
+        self.assertEqual([(row['text'], row['amount'], row['flag'], row['ratio']) for row in rows],
+            [(u'caf\xe9', Decimal('1.5'), True, None), (None, None, None, None)])
+
+    def test_table_kept_when_archive_reads_back_short(self):
+        ArchivedRow.objects.create(text=u'one')
+        ArchivedRow.objects.create(text=u'two')
+        read = archive.read
+        archive.read = lambda filename, model: iter([[{}]])
+        try:
+            with override_settings(GA_DYNAMIC_MODELS_ARCHIVE_DIR=self.directory):
+                self.assertRaises(archive.ArchiveMismatch, archive.archive, 'ArchivedRow')
+        finally:
+            archive.read = read
+        self.assertEqual(ArchivedRow.objects.count(), 2)
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertFalse(self.store.get('ArchivedRow').get('_archived'))
+
+
+class MetricsViewTest(TestCase):
+    def get(self, user):
+        request = RequestFactory().get('/metrics/')
+        request.user = user
+        return status.MetricsView.as_view()(request)
+
+    def test_staff_only(self):
+        user = User.objects.create_user('alice', 'alice@example.com', 'x')
+        self.assertEqual(self.get(AnonymousUser()).status_code, 403)
+        self.assertEqual(self.get(user).status_code, 403)
+        user.is_staff = True
+        response = self.get(user)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('class_cache', json.loads(response.content))
+        with override_settings(GA_DYNAMIC_MODELS_METRICS_PUBLIC=True):
+            self.assertEqual(self.get(AnonymousUser()).status_code, 200)
+
+
+class ClassCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.store = get_store('models')
+        self.store.put(simple_model('CachedThing', size=simple_field('IntegerField', null=True)))
+        self.cache = classcache.ClassCache(max_entries=1)
+        self.footprint = classcache.footprint
+
+    def tearDown(self):
+        classcache.footprint = self.footprint
+        self.cache.forget('CachedThing')
+        self.store.delete('CachedThing')
+
+    def test_built_outside_the_lock(self):
+        held = []
+
+        def footprint(roots):
+            free = self.cache.lock.acquire(False)
+            if free:
+                self.cache.lock.release()
+            held.append(not free)
+            return self.footprint(roots)
+
+        classcache.footprint = footprint
+        model = self.cache.model('CachedThing')
+        self.assertEqual(held, [False])
+        self.assertIs(self.cache.model('CachedThing'), model)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_forgotten_while_building(self):
+        def footprint(roots):
+            classcache.footprint = self.footprint
+            self.cache.forget('CachedThing')
+            return self.footprint(roots)
+
+        classcache.footprint = footprint
+        self.cache.model('CachedThing')
+        self.assertEqual(self.cache.misses, 2)
+        self.assertEqual(list(self.cache.entries), ['CachedThing'])
+
+
+class ValidatorsTest(unittest.TestCase):
+    def test_column_letter(self):
+        self.assertEqual([column_letter(i) for i in (0, 25, 26, 51, 52, 53, 701, 702)],
+            ['A', 'Z', 'AA', 'AZ', 'BA', 'BB', 'ZZ', 'AAA'])
+
+    def test_report_caps_examples(self):
+        report = ValidationReport(max_examples=2, max_errors=100)
+        for row in range(3, 8):
+            report.add('not_valid', row, 52, 'county', 'Wke')
+        report.add('invalid', 9, 0, 'name', 'x')
+        self.assertEqual(report.errors, 6)
+        self.assertFalse(report.exceeded)
+        entries = report.entries()
+        self.assertEqual([(e['letter'], e['rule'], e['count']) for e in entries], [('A', 'invalid', 1),
+            ('BA', 'not_valid', 5)])
+        self.assertEqual([e['row'] for e in entries[1]['examples']], [3, 4])
+
+    def test_report_aborts(self):
+        report = ValidationReport(max_examples=1, max_errors=3)
+        self.assertFalse(report)
+        for row in range(3):
+            report.add('not_valid', row, 1, 'county', 'x')
+        report.rows_checked = 3
+        self.assertTrue(report.exceeded)
+        self.assertTrue(report.as_dict()['aborted'])
+        self.assertEqual(report.messages()[-1], 'Stopped checking after 3 errors in 3 rows.')
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000)
+        values = ['value{i}'.format(i=i) for i in range(1000)]
+        for value in values:
+            bloom.add(value)
+        self.assertTrue(all(value in bloom for value in values))
+        false_positives = sum('other{i}'.format(i=i) in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_sorted_values(self):
+        values = SortedValues(['wake', 'durham', 'wake', '', 'orange'])
+        self.assertEqual(len(values), 4)
+        self.assertEqual([values[i] for i in range(len(values))], ['', 'durham', 'orange', 'wake'])
+        for value in ('', 'durham', 'wake'):
+            self.assertIn(value, values)
+        for value in ('dur', 'wakes', 'zebra', 'a'):
+            self.assertNotIn(value, values)
+
+
+class SketchTest(unittest.TestCase):
+    def test_hyperloglog(self):
+        first, second = HyperLogLog(), HyperLogLog()
+        for i in range(20000):
+            first.add(i)
+            second.add(i + 10000)
+        self.assertLess(abs(first.count() - 20000), 20000 * 0.05)
+        first.merge(second)
+        self.assertLess(abs(first.count() - 30000), 30000 * 0.05)
+        self.assertEqual(HyperLogLog.loads(first.dumps()).count(), first.count())
+        self.assertEqual(HyperLogLog().count(), 0)
+
+    def test_hyperloglog_small_counts(self):
+        counter = HyperLogLog()
+        for value in [u'caf\xe9', 'a', 'b', 'a', 3]:
+            counter.add(value)
+        self.assertEqual(counter.count(), 4)
+
+    def test_histogram(self):
+        histogram = Histogram(bins=4)
+        self.assertEqual(histogram.as_dict(), None)
+        histogram.add(5)
+        histogram.add(5)
+        self.assertEqual(histogram.as_dict(), {'edges' : [5, 5], 'counts' : [2]})
+        histogram.add(8)
+        for value in (-10, 30):
+            histogram.add(value)
+        result = histogram.as_dict()
+        self.assertEqual(sum(result['counts']), 5)
+        self.assertEqual(len(result['edges']), len(result['counts']) + 1)
+        self.assertLessEqual(result['edges'][0], -10)
+        self.assertGreater(result['edges'][-1], 30)
+
+    def test_profile_skips_non_finite_floats(self):
+        profile = ColumnProfile('ratio', 'FloatField')
+        for value in [1.0, float('nan'), float('inf'), float('-inf'), 3.0, None]:
+            profile.add(value)
+        result = profile.as_dict()
+        self.assertEqual((result['count'], result['nulls'], result['non_finite']), (6, 1, 3))
+        self.assertEqual((result['min'], result['max'], result['mean']), (1.0, 3.0, 2.0))
+        self.assertEqual(sum(result['histogram']['counts']), 2)
+
+        merged = ColumnProfile('ratio', 'FloatField')
+        merged.add(float('nan'))
+        merged.add(5.0)
+        merged.merge(result)
+        self.assertEqual((merged.as_dict()['non_finite'], merged.as_dict()['mean']), (4, 3.0))
+
+
+class PartitioningTest(unittest.TestCase):
+    def test_list(self):
+        partitioning = Partitioning('county')
+        self.assertEqual(partitioning.key(u'Wake'), u'Wake')
+        self.assertEqual(partitioning.label(None), 'null')
+        self.assertEqual(partitioning.label(u'wake'), 'wake')
+        self.assertEqual(partitioning.label(u'New Hanover'),
+            'new_hanover_' + hashlib.md5('New Hanover').hexdigest()[:6])
+        self.assertNotEqual(partitioning.label(u'new hanover'), partitioning.label(u'New Hanover'))
+
+    def test_dates(self):
+        yearly = Partitioning('day', 'range', 'year')
+        monthly = Partitioning('day', 'range', 'month')
+        day = datetime.date(2019, 12, 31)
+        self.assertEqual(yearly.key(day), datetime.date(2019, 1, 1))
+        self.assertEqual(yearly.upper(yearly.key(day)), datetime.date(2020, 1, 1))
+        self.assertEqual(monthly.key(day), datetime.date(2019, 12, 1))
+        self.assertEqual(monthly.upper(monthly.key(day)), datetime.date(2020, 1, 1))
+        self.assertEqual(monthly.upper(datetime.date(2019, 11, 1)), datetime.date(2019, 12, 1))
+        self.assertEqual((yearly.label(yearly.key(day)), monthly.label(monthly.key(day))), ('2019', '2019_12'))
+        self.assertEqual(yearly.label(None), 'default')
+
+    def test_numbers(self):
+        partitioning = Partitioning('size', 'range', 100)
+        self.assertEqual([partitioning.key(v) for v in (0, 99, 100, -1)], [0, 0, 100, -100])
+        self.assertEqual(partitioning.upper(-100), 0)
+        self.assertEqual(partitioning.label(-100), '100_' + hashlib.md5('-100').hexdigest()[:6])
+        self.assertRaises(ValueError, Partitioning, 'size', 'range', 'week')
+        self.assertRaises(ValueError, Partitioning, 'size', 'hash')
+
+
+if __name__ == '__main__':
+    declare_examples()
@@ -0,0 +1,402 @@
+"""
+Mapbox Vector Tiles for dynamic models with geometry.
+
+Every geographic dynamic resource serves tiles in the spherical mercator (EPSG:3857) tiling scheme at::
+
+    /api/my_model/tiles/{z}/{x}/{y}.mvt
+
+Each tile holds one layer, named after the resource, with a feature per row whose geometry falls in the tile and the
+row's other fields as properties, categorical ones as their strings.  Rows are found with a bounding box query against
+the table's spatial index, and the database transforms line and polygon geometries to web mercator and simplifies them
+to the tile's pixel size before they are sent back, so that low zoom tiles of detailed shapes stay small.  The tile
+encoding itself is done here in plain Python, which means it works the same on SpatiaLite as it does on PostGIS.
+Since every user gets the same tiles, a resource whose authorization limits the rows a user sees refuses them with a
+403.
+
+No tile holds more than ``GA_DYNAMIC_MODELS_TILE_MAX_FEATURES`` features (10,000 by default), so that a low zoom tile of
+a big table doesn't load and encode the whole table in one request.  Which features a full tile keeps is up to the
+database.  A tile that was cut short is served with an ``X-Tile-Truncated: true`` header; zoom in for the rest.
+
+Encoded tiles go in a tile cache keyed on the model's data generation (see :py:mod:`ga_dynamic_models.generations`), so
+a new upload invalidates all of a model's tiles at once.  The cache is configured just like the response cache in
+:py:mod:`ga_dynamic_models.response_cache`, but with its own setting and limits::
+
+    GA_DYNAMIC_MODELS_TILE_CACHE = {
+        'BACKEND' : 'ga_dynamic_models.response_cache.LRUBackend',
+        'OPTIONS' : { 'max_bytes' : 128 * 1024 * 1024, 'max_entries' : 50000 }
+    }
+"""
+
+from django.conf import settings
+from django.db import connections, router, DatabaseError
+from ga_dynamic_models import response_cache
+from ga_dynamic_models import metrics
+from ga_dynamic_models import categorical
+import struct
+
+CONTENT_TYPE = 'application/vnd.mapbox-vector-tile'
+EXTENT = 4096
+BUFFER = 64
+MAX_ZOOM = 24
+WEB_MERCATOR = 3857
+WORLD = 20037508.342789244
+
+POINT, LINESTRING, POLYGON = 1, 2, 3
+MOVE_TO, LINE_TO, CLOSE_PATH = 1, 2, 7
+
+
+def max_features():
+    return getattr(settings, 'GA_DYNAMIC_MODELS_TILE_MAX_FEATURES', 10000)
+
+
+_cache = None
+_cache_loaded = False
+
+def get_cache():
+    """
+    :return: The configured tile cache backend, or None if tile caching is off.
+    """
+    global _cache, _cache_loaded
+    if not _cache_loaded:
+        _cache = response_cache.backend_from_settings('GA_DYNAMIC_MODELS_TILE_CACHE',
+            {'max_bytes' : 128 * 1024 * 1024, 'max_entries' : 50000})
+        _cache_loaded = True
+    return _cache
+
+
+def tile_bounds(z, x, y):
+    """
+    :return: The (minx, miny, maxx, maxy) of a tile in web mercator metres.
+    """
+    size = 2 * WORLD / (1 << z)
+    minx = -WORLD + x * size
+    maxy = WORLD - y * size
+    return minx, maxy - size, minx + size, maxy
+
+
+def geometry_field(model):
+    """
+    :return: The model's first geometry field, or None.
+    """
+    for field in model._meta.local_fields:
+        if hasattr(field, 'geom_type'):
+            return field
+    return None
+
+
+# Reading WKB
+
+def _read_wkb(data, offset=0):
+    """
+    Parse one WKB geometry.
+
+    :return: A tuple of (type, parts, offset after the geometry), where type is POINT, LINESTRING or POLYGON and parts
+        is a list of coordinate lists: one per point, one per line, or one per ring with the rings of a polygon grouped
+        in their own lists.
+    """
+    order = '<' if data[offset] == '\x01' else '>'
+    kind, = struct.unpack_from(order + 'I', data, offset + 1)
+    offset += 5
+    if kind & 0x20000000:  # EWKB SRID
+        offset += 4
+    kind &= 0xff
+
+    def points(n, offset):
+        coords = struct.unpack_from(order + 'd' * (2 * n), data, offset)
+        return zip(coords[0::2], coords[1::2]), offset + 16 * n
+
+    if kind == 1:
+        coords, offset = points(1, offset)
+        return POINT, [coords], offset
+    if kind == 2:
+        n, = struct.unpack_from(order + 'I', data, offset)
+        coords, offset = points(n, offset + 4)
+        return LINESTRING, [coords], offset
+    if kind == 3:
+        rings = []
+        count, = struct.unpack_from(order + 'I', data, offset)
+        offset += 4
+        for _ in xrange(count):
+            n, = struct.unpack_from(order + 'I', data, offset)
+            ring, offset = points(n, offset + 4)
+            rings.append(ring)
+        return POLYGON, [rings], offset
+    if kind in (4, 5, 6, 7):
+        count, = struct.unpack_from(order + 'I', data, offset)
+        offset += 4
+        result_type, parts = None, []
+        for _ in xrange(count):
+            part_type, part, offset = _read_wkb(data, offset)
+            if result_type is None or result_type == part_type:
+                result_type = part_type
+                parts.extend(part)
+        return result_type, parts, offset
+    raise ValueError('unsupported WKB geometry type {kind}'.format(kind=kind))
+
+
+# Protocol buffer encoding
+
+def _varint(n):
+    out = []
+    while True:
+        byte = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(chr(byte | 0x80))
+        else:
+            out.append(chr(byte))
+            return ''.join(out)
+
+
+def _zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+
+def _field(number, wire_type):
+    return _varint((number << 3) | wire_type)
+
+
+def _bytes(number, data):
+    return _field(number, 2) + _varint(len(data)) + data
+
+
+def _packed(number, values):
+    return _bytes(number, ''.join(_varint(v) for v in values))
+
+
+def _value(value):
+    if isinstance(value, bool):
+        return _field(7, 0) + _varint(int(value))
+    if isinstance(value, (int, long)):
+        return _field(6, 0) + _varint(_zigzag(value))
+    if isinstance(value, float):
+        return _field(3, 1) + struct.pack('<d', value)
+    if isinstance(value, unicode):
+        return _bytes(1, value.encode('utf-8'))
+    if hasattr(value, 'isoformat'):
+        return _bytes(1, value.isoformat())
+    return _bytes(1, str(value))
+
+
+# Tile geometry
+
+def _ring_area(ring):
+    return sum(x0 * y1 - x1 * y0 for (x0, y0), (x1, y1) in zip(ring, ring[1:] + ring[:1]))
+
+
+class _Cursor(object):
+    """Quantizes coordinates to the tile grid and writes geometry commands relative to the previous point."""
+
+    def __init__(self, bounds):
+        self.minx, _, _, self.maxy = bounds
+        self.scale = EXTENT / (bounds[2] - bounds[0])
+        self.x = self.y = 0
+        self.commands = []
+
+    def quantize(self, coords):
+        out = []
+        for x, y in coords:
+            point = (int(round((x - self.minx) * self.scale)), int(round((self.maxy - y) * self.scale)))
+            if not out or out[-1] != point:
+                out.append(point)
+        return out
+
+    def draw(self, command, points):
+        self.commands.append(command | (len(points) << 3))
+        for x, y in points:
+            self.commands.append(_zigzag(x - self.x))
+            self.commands.append(_zigzag(y - self.y))
+            self.x, self.y = x, y
+
+    def points(self, parts):
+        points = [self.quantize(p)[0] for p in parts if p]
+        if points:
+            self.draw(MOVE_TO, points)
+
+    def line(self, coords):
+        coords = self.quantize(coords)
+        if len(coords) >= 2:
+            self.draw(MOVE_TO, coords[:1])
+            self.draw(LINE_TO, coords[1:])
+
+    def ring(self, coords, exterior):
+        coords = self.quantize(coords)
+        if len(coords) > 1 and coords[0] == coords[-1]:
+            coords = coords[:-1]
+        if len(coords) < 3:
+            return False
+        area = _ring_area(coords)
+        if area == 0:
+            return False
+        if (area > 0) != exterior:
+            coords.reverse()
+        self.draw(MOVE_TO, coords[:1])
+        self.draw(LINE_TO, coords[1:])
+        self.commands.append(CLOSE_PATH | (1 << 3))
+        return True
+
+
+def encode_geometry(wkb, bounds):
+    """
+    :param wkb: A geometry in web mercator as WKB.
+    :param bounds: The tile's bounds, from :py:func:`tile_bounds`.
+    :return: A tuple of (MVT geometry type, list of command integers), or None if nothing is left at this zoom.
+    """
+    kind, parts, _ = _read_wkb(str(wkb))
+    cursor = _Cursor(bounds)
+    if kind == POINT:
+        cursor.points(parts)
+    elif kind == LINESTRING:
+        for line in parts:
+            cursor.line(line)
+    elif kind == POLYGON:
+        for rings in parts:
+            if rings and cursor.ring(rings[0], True):
+                for hole in rings[1:]:
+                    cursor.ring(hole, False)
+    return (kind, cursor.commands) if cursor.commands else None
+
+
+def encode_layer(name, features):
+    """
+    :param name: The name of the layer.
+    :param features: An iterable of (id, geometry type, geometry commands, properties dict).
+    :return: The layer encoded as a complete tile.
+    """
+    keys, key_index = [], {}
+    values, value_index = [], {}
+    body = []
+    for fid, kind, commands, properties in features:
+        tags = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+            if key not in key_index:
+                key_index[key] = len(keys)
+                keys.append(key)
+            encoded = _value(value)
+            if encoded not in value_index:
+                value_index[encoded] = len(values)
+                values.append(encoded)
+            tags.extend((key_index[key], value_index[encoded]))
+        feature = ''
+        if isinstance(fid, (int, long)) and fid >= 0:
+            feature += _field(1, 0) + _varint(fid)
+        if tags:
+            feature += _packed(2, tags)
+        feature += _field(3, 0) + _varint(kind) + _packed(4, commands)
+        body.append(_bytes(2, feature))
+
+    if not body:
+        return ''
+    layer = _field(15, 0) + _varint(2) + _bytes(1, name.encode('utf-8')) + ''.join(body)
+    layer += ''.join(_bytes(3, k.encode('utf-8')) for k in keys)
+    layer += ''.join(_bytes(4, v) for v in values)
+    layer += _field(5, 0) + _varint(EXTENT)
+    return _bytes(3, layer)
+
+
+# Querying
+
+def _sql(model, field, connection, simplify):
+    qn = connection.ops.quote_name
+    spatialite = getattr(connection.ops, 'spatialite', False)
+    table = qn(model._meta.db_table)
+    column = '{table}.{column}'.format(table=table, column=qn(field.column))
+    others = [f for f in model._meta.local_fields if f is not field and not hasattr(f, 'geom_type')]
+
+    transform = 'Transform' if spatialite else 'ST_Transform'
+    envelope = 'BuildMbr(%s, %s, %s, %s, {srid})' if spatialite else 'ST_MakeEnvelope(%s, %s, %s, %s, {srid})'
+    envelope = envelope.format(srid=WEB_MERCATOR)
+    geometry = column
+    if field.srid != WEB_MERCATOR:
+        geometry = '{fn}({geometry}, {srid})'.format(fn=transform, geometry=geometry, srid=WEB_MERCATOR)
+        envelope = '{fn}({envelope}, {srid})'.format(fn=transform, envelope=envelope, srid=field.srid)
+    if simplify:
+        geometry = '{fn}({geometry}, %s)'.format(
+            fn='SimplifyPreserveTopology' if spatialite else 'ST_SimplifyPreserveTopology', geometry=geometry)
+    geometry = '{fn}({geometry})'.format(fn='AsBinary' if spatialite else 'ST_AsBinary', geometry=geometry)
+
+    # categorical values go out as their strings, as exports and snapshots do
+    columns = ', '.join(categorical.decode_sql(model, f, connection) if getattr(f, 'categorical', False)
+        else '{table}.{column}'.format(table=table, column=qn(f.column)) for f in others)
+    select = 'SELECT {geometry}, {columns} FROM {table} WHERE '.format(geometry=geometry, columns=columns, table=table)
+    if spatialite:
+        where = ('MbrIntersects({column}, {envelope}) AND {table}.ROWID IN (SELECT ROWID FROM SpatialIndex '
+                 'WHERE f_table_name = %s AND f_geometry_column = %s AND search_frame = {envelope})').format(
+            column=column, envelope=envelope, table=table)
+    else:
+        where = '{column} && {envelope}'.format(column=column, envelope=envelope)
+    return select + where, [f.attname for f in others], spatialite
+
+
+def features(model, bounds, using=None, limit=None):
+    """
+    Yield the features of a model that fall in a tile.
+
+    :param model: A model with a geometry field.
+    :param bounds: The tile's bounds, from :py:func:`tile_bounds`.
+    :param using: The database alias to read from.
+    :param limit: The most rows to read, or None for all of them.
+    :return: An iterator of (id, geometry type, geometry commands, properties), ending with None if more than
+        ``limit`` rows fall in the tile.
+    """
+    field = geometry_field(model)
+    connection = connections[using or router.db_for_read(model)]
+    simplify = field.geom_type not in ('POINT', 'MULTIPOINT')
+    sql, names, spatialite = _sql(model, field, connection, simplify)
+
+    margin = (bounds[2] - bounds[0]) * BUFFER / EXTENT
+    box = [bounds[0] - margin, bounds[1] - margin, bounds[2] + margin, bounds[3] + margin]
+    params = ([(bounds[2] - bounds[0]) / EXTENT] if simplify else []) + box
+    if spatialite:
+        params += [model._meta.db_table, field.column] + box
+    limited = ' LIMIT {limit}'.format(limit=int(limit) + 1) if limit is not None else ''
+
+    cursor = connection.cursor()
+    try:
+        cursor.execute(sql + limited, params)
+    except DatabaseError:
+        if not spatialite:
+            raise
+        # No spatial index on this table; fall back to the bounding box test alone.
+        sql = sql[:sql.index(' AND ')]
+        cursor.execute(sql + limited, params[:-6])
+
+    pk = model._meta.pk.attname
+    read = 0
+    while True:
+        rows = cursor.fetchmany(1000)
+        if not rows:
+            break
+        for row in rows:
+            read += 1
+            if limit is not None and read > limit:
+                yield None
+                return
+            if row[0] is None:
+                continue
+            geometry = encode_geometry(row[0], bounds)
+            if geometry is None:
+                continue
+            properties = dict(zip(names, row[1:]))
+            yield (properties.get(pk), geometry[0], geometry[1], properties)
+
+
+def render(model, layer, z, x, y, using=None):
+    """
+    :param model: A model with a geometry field.
+    :param layer: The name to give the tile's layer.
+    :return: A tuple of the encoded tile, possibly empty, and whether features were left out of it to keep it under
+        GA_DYNAMIC_MODELS_TILE_MAX_FEATURES.
+    """
+    if not (0 <= z <= MAX_ZOOM and 0 <= x < (1 << z) and 0 <= y < (1 << z)):
+        raise ValueError('there is no tile {z}/{x}/{y}'.format(z=z, x=x, y=y))
+    limit = max_features()
+    with metrics.span('tiles.render', model=model.__name__, z=z):
+        found = list(features(model, tile_bounds(z, x, y), using, limit))
+        truncated = bool(found) and found[-1] is None
+        if truncated:
+            metrics.incr('tiles.truncated', model=model.__name__)
+            found.pop()
+        return encode_layer(layer, found), truncated
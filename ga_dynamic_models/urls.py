@@ -2,6 +2,7 @@ from django.conf.urls.defaults import patterns, url, include
 from ga_dynamic_models.api import api
 from ga_dynamic_models.views import csv_upload
 from ga_dynamic_models.views import iei_commons
+from ga_dynamic_models.views import status
 
 #
 # This file maps views to actual URL endpoints.
@@ -13,5 +14,8 @@ urlpatterns = patterns('',
     url(r'^csv_success/', csv_upload.CSVSuccessView.as_view()),
     url(r'^$', iei_commons.CountyRestrictedUploadPage.as_view()),
     url(r'^upload/', iei_commons.CountyRestrictedCSVUpload.as_view()),
-    url(r'^schema_editor/', iei_commons.CSVSchemaEditor.as_view())
+    url(r'^upload_report/', csv_upload.CSVValidationReportView.as_view()),
+    url(r'^schema_editor/', iei_commons.CSVSchemaEditor.as_view()),
+    url(r'^ready/', status.ReadyView.as_view()),
+    url(r'^metrics/', status.MetricsView.as_view())
 )
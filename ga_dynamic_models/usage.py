@@ -0,0 +1,99 @@
+"""
+When each dynamic model was last used, so that the ones nobody uses can be archived (see
+:py:mod:`ga_dynamic_models.archive`).
+
+:py:class:`ga_dynamic_models.resources.DynamicResourceMixin` calls :py:func:`touch` on every request to a dynamic
+resource, whether or not it is answered from the response cache.  Each process notes the time and adds up the requests,
+and every ``GA_DYNAMIC_MODELS_USAGE_FLUSH`` seconds (300 by default) writes what it has seen to the 'usage' kind of
+definition store, one entry per model::
+
+    { 'name' : 'Permits', 'last_used' : 1700000000.0, 'requests' : 1234, 'since' : 1690000000.0 }
+
+Usage is kept apart from the model's own definition so that recording it doesn't move the model's data generation.
+Set ``GA_DYNAMIC_MODELS_USAGE = False`` to record nothing.
+"""
+
+from django.conf import settings
+from ga_dynamic_models.stores import get_store, RevisionConflict
+from logging import getLogger
+import threading
+import time
+
+_log = getLogger(__name__)
+
+ATTEMPTS = 3
+
+_pending = {}
+_last_flush = [time.time()]
+_lock = threading.Lock()
+
+
+def enabled():
+    return getattr(settings, 'GA_DYNAMIC_MODELS_USAGE', True)
+
+
+def flush_interval():
+    return getattr(settings, 'GA_DYNAMIC_MODELS_USAGE_FLUSH', 300)
+
+
+def touch(name):
+    """
+    Note that a model has just been used.
+
+    :param name: The name of the model.
+    """
+    if not enabled() or name is None:
+        return
+    now = time.time()
+    with _lock:
+        seen = _pending.setdefault(name, [now, 0])
+        seen[0] = now
+        seen[1] += 1
+        due = now - _last_flush[0] >= flush_interval()
+        if due:
+            _last_flush[0] = now
+    if due:
+        flush()
+
+
+def _record(name, last_used, requests):
+    store = get_store('usage')
+    for attempt in range(ATTEMPTS):
+        current = store.get(name)
+        entry = current or {'name' : name, 'last_used' : None, 'requests' : 0, 'since' : time.time()}
+        entry['last_used'] = max(entry['last_used'], last_used)
+        entry['requests'] += requests
+        try:
+            store.put(entry, revision=current.get('_rev') if current else 0)
+            return
+        except RevisionConflict:
+            continue
+    _log.warning('gave up recording the usage of {name}'.format(name=name))
+
+
+def flush():
+    """Write the usage this process has seen to the definition store."""
+    with _lock:
+        seen = dict(_pending)
+        _pending.clear()
+    for name, (last_used, requests) in seen.items():
+        _record(name, last_used, requests)
+
+
+def get(name):
+    """
+    :return: The usage recorded for a model, as a dict with 'last_used', 'requests' and 'since' (when recording began),
+        or None.
+    """
+    return get_store('usage').get(name)
+
+
+def start(name):
+    """Begin recording a model's usage, if that hasn't begun already, so that its idle time counts from now."""
+    if get(name) is None:
+        _record(name, None, 0)
+
+
+def forget(name):
+    """Drop the usage recorded for a model."""
+    get_store('usage').delete(name)
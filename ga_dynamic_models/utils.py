@@ -1,7 +1,8 @@
 """
 Utilities for creating dynamic models.
 
-This module is insane.  What it does, effectively, is construct Models from objects  listed in a MongoDB database.
+This module is insane.  What it does, effectively, is construct Models from objects  listed in a definition store
+(MongoDB unless you configure otherwise, see :py:mod:`ga_dynamic_models.stores`).
 Quite a lot of functionality you'd expect could only be achieved through actual physical declaration of a class can be
 done here.  One thing that's essential right now, thoguh is that the WSGI container **must** be restarted after a model
 is declared.  There's probably a way around it, but right now I don't know it.  A task for doing this, if you're using
@@ -67,8 +68,15 @@ A model can be constructed from a dictionary modeled on the following structure:
           'managed' : boolean<managed by django>,
           'order_with_respect_to' : string<foreign key field name>
       },
+      'partition' : { 'column' : string, 'kind' : 'list' or 'range', 'interval' : 'year', 'month' or number },
+      'derived' : { 'source' : string, 'filters' : { lookup : value }, 'fields' : [ string ], 'joins' : [ join ],
+                    'group_by' : [ string ], 'metrics' : [ string ], 'storage' : 'table' or 'view' }
     }
 
+``partition`` is optional; see **list_partition**, **range_partition** and :py:mod:`ga_dynamic_models.partitioning`.
+``derived`` is set by **derived_model** for a model materialized from others; see :py:mod:`ga_dynamic_models.derived`.
+Neither becomes an attribute of the model class.  Any other top-level key is parsed as an **item** and set on the class.
+
 Additionally, look for how to expose modules in wms/wfs in ows.py and in Tastypie in api.py.
 
 Usage is similar to this::
@@ -99,7 +107,20 @@ import importlib
 import sys
 from datetime import datetime
 from django.core.management import call_command
-from django.db import connection, transaction
+from django.db import connections, router, transaction
+from ga_dynamic_models.stores import get_store
+from ga_dynamic_models import generations
+from ga_dynamic_models import stats
+from ga_dynamic_models import categorical
+from ga_dynamic_models import partitioning
+from ga_dynamic_models import derived
+from ga_dynamic_models import search
+from ga_dynamic_models import routers
+from ga_dynamic_models import shards
+from ga_dynamic_models import usage
+from ga_dynamic_models import archive
+from ga_dynamic_models import classcache
+from ga_dynamic_models import advisor
 
 def method(method, *parameters):
     """
@@ -210,7 +231,7 @@ def class_method(module, cls, method, *args, **kwargs):
         "parameters" : { "positionals" : args, "keywords" : kwargs }
     }
 
-def model(name, bases, fields, **meta):
+def model(name, bases, fields, partition=None, **meta):
     """
     Part of the grammar of dynamic models.  A model class declaration.  This function should encapsulate any model
     definition.
@@ -218,6 +239,7 @@ def model(name, bases, fields, **meta):
     :param name:  The name of the model to declare
     :param bases: The base classes of the model
     :param fields: The fields of the model as a dict of name => **field**
+    :param partition: How to partition the model's table, from **list_partition** or **range_partition**, or None.
     :param meta: The metadata attributes of the model.  Keyword => **item**.
     :return:  A JSON serializable dict.
     """
@@ -228,12 +250,76 @@ def model(name, bases, fields, **meta):
     if not isinstance(bases, list):
         bases = [bases]
 
-    return {
+    definition = {
         "name" : name,
         "bases" : bases,
         "fields" : fields,
         "meta" : meta
     }
+    if partition is not None:
+        definition["partition"] = partition
+    return definition
+
+def list_partition(column):
+    """
+    Part of the grammar of dynamic models.  Partition a model's table with one partition per value of a column.
+
+    :param column: The name of the partition key column.
+    :return: A JSON serializable dict.
+    """
+    return partitioning.Partitioning(column, 'list').as_dict()
+
+def range_partition(column, interval):
+    """
+    Part of the grammar of dynamic models.  Partition a model's table by intervals of a column.
+
+    :param column: The name of the partition key column, a date or a number.
+    :param interval: 'year' or 'month' for a date column, or the width of each interval for a numeric one.
+    :return: A JSON serializable dict.
+    """
+    return partitioning.Partitioning(column, 'range', interval).as_dict()
+
+def derived_model(name, source, filters=None, fields=None, joins=None, group_by=None, metrics=None, storage='table'):
+    """
+    Part of the grammar of dynamic models.  A model whose rows are materialized from a query over other dynamic models,
+    and kept up to date as they are loaded.  See :py:mod:`ga_dynamic_models.derived`.
+
+    :param name: The name of the model to declare.
+    :param source: The name of the model whose rows it is derived from.
+    :param filters: A dict of ORM lookups on the source, like the keyword arguments to ``filter()``.
+    :param fields: The source fields to keep, if not all of them.  Ignored by an aggregation.
+    :param joins: Other models to join to the source, from **join**.
+    :param group_by: The columns to group by, from the source or taken from a joined model.
+    :param metrics: Aggregates over the source, as on the aggregate endpoint: 'count', 'avg:income' and so on.
+    :param storage: 'table', or 'view' for a materialized view on PostgreSQL.
+    :return: A JSON serializable dict.
+    """
+    declared = derived.spec(source, filters, fields, joins, group_by, metrics, storage)
+    columns, geographic = derived.fields(declared)
+    if geographic:
+        columns['objects'] = callable("django.contrib.gis.db.models", "GeoManager")
+        base = attribute('django.contrib.gis.db.models', 'Model')
+    else:
+        base = attribute('django.db.models', 'Model')
+    definition = model(name, base, columns, managed=declared['storage'] == 'table', app_label='ga_dynamic_models')
+    definition["derived"] = declared
+    return definition
+
+def join(model, on, fields=()):
+    """
+    Part of the grammar of dynamic models.  A model to join to the source of a **derived_model**.
+
+    :param model: The name of the model to join.
+    :param on: A dict of source column => column of the joined model; rows are joined where all of them are equal.
+    :param fields: The fields of the joined model to take, as a list of names or a dict of name in the derived model
+        => name in the joined model.
+    :return: A JSON serializable dict.
+    """
+    return {
+        "model" : model,
+        "on" : on,
+        "fields" : fields
+    }
 
 def resource(name, bases, fields, **meta):
     """
@@ -260,47 +346,57 @@ def resource(name, bases, fields, **meta):
         "meta" : meta
     }
 
-def simple_model_resource(module, model, resource_name, **meta):
+def simple_model_resource(module, model, resource_name, cursor_pagination=False, **meta):
     """
-    A simplification for common TastyPie resource declarations.  Calls **resource** to declare a ModelResource.
+    A simplification for common TastyPie resource declarations.  Calls **resource** to declare a ModelResource, with
+    the additions in :py:mod:`ga_dynamic_models.resources`.
 
     :param module: The name of the module the model is in.
     :param model: The model to make the API from.
     :param resource_name: The endpoint name of the resource.
+    :param cursor_pagination: Page with a cursor on an indexed key instead of an offset.  See
+        :py:mod:`ga_dynamic_models.pagination`.
     :param meta: The meta attributes of the resource.
     :return: A JSON serlizable dict.
     """
 
     meta['queryset'] = queryset(module, model, method('all', []))
     meta['resource_name'] = resource_name
+    meta['paginator_class'] = attribute('ga_dynamic_models.pagination',
+        'KeysetPaginator' if cursor_pagination else 'EstimatedCountPaginator')
 
-    return resource(model, attribute('tastypie.resources', 'ModelResource'), {}, **meta)
+    return resource(model, attribute('ga_dynamic_models.resources', 'DynamicModelResource'), {}, **meta)
 
-def simple_geo_resource(module, model, resource_name, **meta):
+def simple_geo_resource(module, model, resource_name, cursor_pagination=False, **meta):
     """
     Part of the grammar of dynamic models. A simplification for common TastyPie resource declarations.  Calls **resource**
-    to declare a GeoModelResource (as defined in :py:mod:`ga_ows.tastyhacks` ).  A GeoResource sends GeoJSOn instead of
-    JSON.
+    to declare a GeoModelResource (as defined in :py:mod:`ga_ows.tastyhacks` ), with the additions in
+    :py:mod:`ga_dynamic_models.resources`.  A GeoResource sends GeoJSOn instead of JSON.
 
     :param module: The name of the module the model is in.
     :param model: The model to make the API from
     :param resource_name: The endpoint name of the resource
+    :param cursor_pagination: Page with a cursor on an indexed key instead of an offset.  See
+        :py:mod:`ga_dynamic_models.pagination`.
     :param meta: The meta attributes of the resource
     :return: A JSON serializable dict.
     """
 
     meta['queryset'] = queryset(module, model, method('all', []))
     meta['resource_name'] = resource_name
+    meta['paginator_class'] = attribute('ga_dynamic_models.pagination',
+        'KeysetPaginator' if cursor_pagination else 'EstimatedCountPaginator')
 
-    return resource(model, attribute('ga_ows.tastyhacks', 'GeoResource'), {}, **meta)
+    return resource(model, attribute('ga_dynamic_models.resources', 'DynamicGeoResource'), {}, **meta)
 
-def simple_geomodel(name, managed=True, db_table=None, **fields):
+def simple_geomodel(name, managed=True, db_table=None, partition=None, **fields):
     """
     A simplification of the **model** function that declares a GeoDjango model.
 
     :param name: The name of the model
     :param managed: default True. The model's "managed" attribute.  See Django's model reference.
     :param db_table: The database table to point at.  Safe to leeave this as None unless you have a specific table.
+    :param partition: How to partition the table.  See **list_partition** and **range_partition**.
     :param fields: The fields to put in the model, as keyword arguments. See **simple_field** or **simple_geofield**
     :return: A JSON Serializable dict.
     """
@@ -309,18 +405,20 @@ def simple_geomodel(name, managed=True, db_table=None, **fields):
         name,
         attribute('django.contrib.gis.db.models', 'Model'),
         fields,
+        partition=partition,
         managed=managed,
         db_table=db_table,
         app_label='ga_dynamic_models'
     )
 
-def simple_model(name, managed=True, db_table=None, **fields):
+def simple_model(name, managed=True, db_table=None, partition=None, **fields):
     """
     A simplification of the **model** function that declares a Django model.
 
     :param name: The name of the model
     :param managed: default True. The model's "managed" attribute.  See Django's model reference.
     :param db_table: The database table to point at.  Safe to leeave this as None unless you have a specific table.
+    :param partition: How to partition the table.  See **list_partition** and **range_partition**.
     :param fields: The fields to put in the model, as keyword arguments. See **simple_field**.
     :return: A JSON Serializable dict.
     """
@@ -328,6 +426,7 @@ def simple_model(name, managed=True, db_table=None, **fields):
         name,
         attribute('django.db.models', 'Model'),
         fields,
+        partition=partition,
         managed=managed,
         db_table=db_table,
         app_label='ga_dynamic_models'
@@ -377,21 +476,28 @@ def declare_model(model, replace=False, user=None, syncdb=False):
     """
     model['_id'] = model['name']
 
-    _db = get_connection()
+    store = get_store('models')
 
     if user:
         model['_owner'] = user.pk
     else:
         model['_owner'] = None
 
-    one = _db['ga_dynamic_models__models'].find_one(model['name'], fields=['_id', '_owner'])
+    one = store.get(model['name'])
     print "found old model"
+    # a model stays on its shard when it is declared again; rebalance_shards is what moves it
+    model['_shard'] = one.get('_shard') if one else shards.of_owner(model['_owner'])
     if not one:
-        _db['ga_dynamic_models__models'].insert(model, safe=True)
-    elif replace and ((not one['owner']) or user.pk == one['owner']):
-        _db['ga_dynamic_models__models'].save(model, safe=True)
+        store.put(model, revision=0)
+    elif replace and ((not one['_owner']) or user.pk == one['_owner']):
+        if one.get('_archived'):
+            archive.discard(model['name'])
+        store.put(model, revision=one.get('_rev'))
     else:
         raise Exception("Cannot insert model record")
+    generations.forget(model['name'])
+    shards.forget(model['name'])
+    classcache.forget(model['name'])
 
     print "inserted new model"
     print "syncdb"
@@ -400,6 +506,13 @@ def declare_model(model, replace=False, user=None, syncdb=False):
 
 
         call_command('syncdb', interactive=False)
+        if model['_shard']:
+            call_command('syncdb', interactive=False, database=shards.prepare(model['_shard']))
+        if model.get('partition'):
+            partitioning.create_parent(m)
+        routers.fence(model['name'])
+        if model.get('derived'):
+            derived.materialize(model['name'])
     print "syncdb finished"
 
 def drop_resource(resource, user=None):
@@ -410,16 +523,16 @@ def drop_resource(resource, user=None):
     :param user: The user requesting the drop, if relevant.
     :return:
     """
-    _db = get_connection()
+    store = get_store('api')
 
-    if isinstance(model, str) or isinstance(model, unicode):
-        one = _db['ga_dynamic_models__api'].find_one(model, fields=['_id', '_owner'])
+    if isinstance(resource, str) or isinstance(resource, unicode):
+        one = store.get(resource)
     else:
-        one = _db['ga_dynamic_models__api'].find_one(model['name'], fields=['_id', '_owner'])
+        one = store.get(resource['name'])
 
     if one:
         if '_owner' not in one or not one['_owner'] or one['_owner'] == user.pk:
-            _db['ga_dynamic_models__api'].remove(model)
+            store.delete(one['_id'], revision=one.get('_rev'))
         else:
             raise Exception("Cannot delete resource record")
 
@@ -436,18 +549,18 @@ def declare_resource(resource, replace=False, user=None):
     """
     resource['_id'] = resource['name']
 
-    _db = get_connection()
+    store = get_store('api')
 
     if user:
         resource['_owner'] = user.pk
     else:
         resource['_owner'] = None
 
-    one = _db['ga_dynamic_models__api'].find_one(resource['name'], fields=['_id', '_owner'])
+    one = store.get(resource['name'])
     if not one:
-        _db['ga_dynamic_models__api'].insert(resource, safe=True)
+        store.put(resource, revision=0)
     elif replace and ((not one['_owner']) or user.pk == one['_owner']):
-        _db['ga_dynamic_models__api'].save(resource, safe=True)
+        store.put(resource, revision=one.get('_rev'))
     else:
         raise Exception("Cannot insert resource record")
 
@@ -460,29 +573,43 @@ def drop_model(model, user=None):
     :param user: The user who owns the model, if relevant.
     :return:
     """
-    _db = get_connection()
+    store = get_store('models')
 
-    one = _db['ga_dynamic_models__models'].find_one(model, fields=['_id', 'owner'])
+    one = store.get(model)
 
     if one:
         if '_owner' not in one or not one['_owner'] or one['_owner'] == user.pk:
             try:
-                m = get_model(model)
-                cursor = connection.cursor()
-                cursor.execute("DROP TABLE " + m._meta.db_table)
-                transaction.commit_unless_managed()
-                print "deleted table"
-                _db['ga_dynamic_models__models'].remove(model)
+                if one.get('_archived'):
+                    archive.discard(model)
+                else:
+                    m = get_model(model)
+                    categorical.drop(m)
+                    search.drop(m)
+                    using = router.db_for_write(m)
+                    cursor = connections[using].cursor()
+                    cursor.execute(("DROP MATERIALIZED VIEW " if derived.is_view(m) else "DROP TABLE ") +
+                        m._meta.db_table)
+                    transaction.commit_unless_managed(using=using)
+                    print "deleted table"
+                store.delete(model, revision=one.get('_rev'))
+                generations.forget(model)
+                shards.drop_retired(model, everything=True)
+                shards.forget(model)
+                stats.forget(model)
+                usage.forget(model)
+                advisor.forget(model)
+                classcache.forget(model)
             except AttributeError:
                 pass
         else:
             raise Exception("Cannot delete model record")
-        declare_updated()
         call_command('syncdb', interactive=False)
 
 def get_connection():
     """
-    Get the MongoDB connection associated with this app.
+    Get the MongoDB connection associated with this app.  Only meaningful when the definitions are kept in MongoDB; the
+    rest of the app goes through :py:func:`ga_dynamic_models.stores.get_store` instead.
 
     :return: A MongoDB database.
     """
@@ -499,6 +626,12 @@ def get_model(model):
     :param model:  The name of the model to return.
     :return: The model class as a Python class.
     """
+    if classcache.enabled():
+        try:
+            return classcache.get_model(model)
+        except LookupError:
+            raise AttributeError("No such model")
+
     try:
         del sys.modules['ga_dynamic_models.models']
     except KeyError:
@@ -0,0 +1,268 @@
+"""
+Validation of uploaded CSV files.
+
+:py:class:`ValidationReport` collects the problems found while
+:py:class:`ga_dynamic_models.views.csv_upload.CSVUploadAccept` checks a file.  Rather than a message per bad cell it
+keeps a count per column and rule and the first few examples of each, and tells the view to stop checking once the total
+passes a limit, so a badly broken file gives a short report quickly.  The limits are settings::
+
+    GA_DYNAMIC_MODELS_VALIDATION_EXAMPLES = 10      # examples kept per column and rule
+    GA_DYNAMIC_MODELS_VALIDATION_MAX_ERRORS = 1000  # stop checking after this many errors
+
+Columns are reported by name and by spreadsheet letter (A to Z, then AA, AB and so on).
+
+:py:class:`ReferenceValues` validates uploaded values against a column of another dynamic model.
+
+:py:class:`ga_dynamic_models.views.csv_upload.CSVUploadAccept` checks columns against ``column_valid_values``, which
+used to have to be a literal set in the view.  A :py:class:`ReferenceValues` can stand in for that set when the valid
+values live in a table of their own, such as FIPS codes or parcel IDs::
+
+    class ParcelUpload(csv_upload.CSVUploadAccept):
+        file_must_contain_columns = {'parcel'}
+        column_valid_values = {
+            'parcel' : validators.ReferenceValues('NCParcels', 'parcel_id'),
+        }
+
+The first check reads the whole reference column once, with a single query, into a compact lookup.  The values are kept
+sorted in one string, with an array of offsets to search them, and a bloom filter answers most misses without a search.
+The lookup is kept in the process until the reference model's data generation changes (see
+:py:mod:`ga_dynamic_models.generations`), so every row of every upload after that is checked in memory.
+
+Values are compared as text, the way they appear in the CSV, so a reference column of integers matches '37001' but a
+column of floats holds '37001.0'.
+"""
+
+from django.conf import settings
+from ga_dynamic_models import generations
+from ga_dynamic_models import metrics
+from array import array
+import threading
+import importlib
+import hashlib
+import struct
+import bisect
+import math
+
+
+def column_letter(index):
+    """
+    :param index: A zero based column index.
+    :return: The column's letter as a spreadsheet shows it: A to Z, then AA to ZZ, then AAA and so on.
+    """
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+class ValidationReport(object):
+    """
+    The problems found in an upload, capped in size.
+
+    :param max_examples: How many examples to keep for each column and rule.
+    :param max_errors: How many errors to take before :py:attr:`exceeded` becomes true.
+    """
+
+    MESSAGES = {
+        'not_valid' : 'not in the list of valid values',
+        'invalid' : 'in the list of invalid values',
+    }
+
+    def __init__(self, max_examples=None, max_errors=None):
+        self.max_examples = max_examples or getattr(settings, 'GA_DYNAMIC_MODELS_VALIDATION_EXAMPLES', 10)
+        self.max_errors = max_errors or getattr(settings, 'GA_DYNAMIC_MODELS_VALIDATION_MAX_ERRORS', 1000)
+        self.errors = 0
+        self.rows_checked = 0
+        self._entries = {}
+
+    def add(self, rule, row, index, column, value):
+        """
+        Record one bad cell.
+
+        :param rule: The rule it broke, a key of MESSAGES.
+        :param row: The row number as a spreadsheet shows it, counting the header rows.
+        :param index: The zero based column index.
+        :param column: The column's name.
+        :param value: The offending value.
+        """
+        self.errors += 1
+        entry = self._entries.get((index, rule))
+        if entry is None:
+            entry = self._entries[(index, rule)] = {
+                'column' : column,
+                'letter' : column_letter(index),
+                'rule' : rule,
+                'count' : 0,
+                'examples' : [],
+            }
+        entry['count'] += 1
+        if len(entry['examples']) < self.max_examples:
+            entry['examples'].append({'row' : row, 'value' : value})
+
+    @property
+    def exceeded(self):
+        return self.errors >= self.max_errors
+
+    def __nonzero__(self):
+        return self.errors > 0
+
+    def entries(self):
+        return [self._entries[key] for key in sorted(self._entries)]
+
+    def as_dict(self):
+        return {
+            'errors' : self.errors,
+            'rows_checked' : self.rows_checked,
+            'aborted' : self.exceeded,
+            'columns' : self.entries(),
+        }
+
+    def messages(self):
+        """
+        :return: A short list of human readable lines summarizing the report.
+        """
+        lines = []
+        for entry in self.entries():
+            lines.append("Column {letter} ({column}): {count} value{s} {message}, for example {examples}. "
+                         "Check spelling and capitalization.".format(
+                letter=entry['letter'], column=entry['column'], count=entry['count'],
+                s='' if entry['count'] == 1 else 's', message=self.MESSAGES[entry['rule']],
+                examples=', '.join("row {row} '{value}'".format(**e) for e in entry['examples'])))
+        if self.exceeded:
+            lines.append('Stopped checking after {errors} errors in {rows} rows.'.format(
+                errors=self.errors, rows=self.rows_checked))
+        return lines
+
+
+def _text(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+class BloomFilter(object):
+    """A bloom filter sized for ``capacity`` values at a false positive rate of about ``error``."""
+
+    def __init__(self, capacity, error=0.01):
+        capacity = max(capacity, 1)
+        self.bits = max(int(-capacity * math.log(error) / (math.log(2) ** 2)), 8)
+        self.hashes = max(int(round(self.bits / float(capacity) * math.log(2))), 1)
+        self.array = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, value):
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(value).digest())
+        return [(h1 + i * h2) % self.bits for i in xrange(self.hashes)]
+
+    def add(self, value):
+        for p in self._positions(value):
+            self.array[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, value):
+        return all(self.array[p >> 3] & (1 << (p & 7)) for p in self._positions(value))
+
+
+class SortedValues(object):
+    """
+    A sorted, de-duplicated set of strings held in one string and an array of offsets into it, which takes far less
+    memory than a Python set of the same strings.
+    """
+
+    def __init__(self, values):
+        values = sorted(set(values))
+        self.data = ''.join(values)
+        self.offsets = array('I', [0])
+        for value in values:
+            self.offsets.append(self.offsets[-1] + len(value))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+    def __contains__(self, value):
+        i = bisect.bisect_left(self, value)
+        return i < len(self) and self[i] == value
+
+
+class Lookup(object):
+    """A :py:class:`SortedValues` behind a :py:class:`BloomFilter`."""
+
+    def __init__(self, values):
+        self.values = SortedValues(values)
+        self.bloom = BloomFilter(len(self.values))
+        for i in xrange(len(self.values)):
+            self.bloom.add(self.values[i])
+
+    def __contains__(self, value):
+        value = _text(value)
+        return value in self.bloom and value in self.values
+
+    def __len__(self):
+        return len(self.values)
+
+
+_lookups = {}
+_lock = threading.Lock()
+
+
+class ReferenceValues(object):
+    """
+    The values in one column of a dynamic model, usable anywhere a set of valid values is.
+
+    :param model: The name of the reference model.
+    :param column: The name of the column holding the valid values.
+    """
+
+    def __init__(self, model, column):
+        self.model = model
+        self.column = column
+
+    def get_model(self):
+        models = importlib.import_module('ga_dynamic_models.models')
+        if hasattr(models, self.model):
+            return getattr(models, self.model)
+        from ga_dynamic_models.utils import get_model
+        return get_model(self.model)
+
+    def lookup(self):
+        """
+        :return: The :py:class:`Lookup` for the reference column at the model's current data generation.
+        """
+        key = (self.model, self.column)
+        generation = generations.current(self.model)
+        cached = _lookups.get(key)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+
+        with _lock:
+            cached = _lookups.get(key)
+            if cached is not None and cached[0] == generation:
+                return cached[1]
+            model = self.get_model()
+            if model is None:
+                raise ValueError('there is no reference model {name}'.format(name=self.model))
+            with metrics.span('validators.load', model=self.model, column=self.column):
+                values = model._default_manager.values_list(self.column, flat=True).distinct().iterator()
+                field = model._meta.get_field(self.column)
+                if getattr(field, 'categorical', False):
+                    values = (field.dictionary().decode(code) for code in values)
+                lookup = Lookup(_text(v) for v in values if v is not None)
+            _lookups[key] = (generation, lookup)
+            return lookup
+
+    def __contains__(self, value):
+        return value in self.lookup()
+
+    def missing(self, values):
+        """
+        :param values: An iterable of values to check.
+        :return: The set of those that aren't valid.
+        """
+        lookup = self.lookup()
+        return set(v for v in set(values) if v not in lookup)
+
+    def __repr__(self):
+        return '{model}.{column}'.format(model=self.model, column=self.column)
@@ -4,16 +4,22 @@ from django.db import transaction
 from django import forms
 from django import shortcuts
 from django.template.context import RequestContext
-from ga_dynamic_models import tasks
+from ga_dynamic_models import reloader
 
 from ga_dynamic_models import utils
+from ga_dynamic_models import metrics
+from ga_dynamic_models import loader
+from ga_dynamic_models import validators
+from ga_dynamic_models import search
+from ga_dynamic_models.stores import get_store
+import json
 import csv
 import re
-from django.views.generic import TemplateView, FormView
+from django.views.generic import TemplateView, FormView, View
+from django.http import HttpResponse, HttpResponseNotFound, HttpResponseBadRequest
 from django.views.generic.edit import BaseFormView
 from django import forms
 from logging import getLogger
-from ga_ows.utils import parsetime
 from django.core.validators import RegexValidator
 import cStringIO as StringIO
 
@@ -33,85 +39,90 @@ def casify(name):
     name = re.sub(r'([A-Z])', r'_\1', name).lower()
     return name
 
-def model_from_csv(model_short_name, model_verbose_name, flo):
+def is_geographic(spec):
+    """Whether a CSV spec has geometry columns, or a latitude / longitude pair to make a point from."""
+    kinds = [loader.parse_datatype(datatype)[0] for _, datatype in spec]
+    return any(kind in loader.GEOMETRY_TYPES for kind in kinds) or (loader.LATITUDE in kinds and loader.LONGITUDE in kinds)
+
+def partition_from_form(column, interval):
+    """
+    :param column: The name of the partition key column as the CSV header has it, or blank for no partitioning.
+    :param interval: Blank for a partition per value, or 'year', 'month' or a number for ranges.
+    :return: A partition for :py:func:`ga_dynamic_models.utils.model`, or None.
+    """
+    if not column:
+        return None
+    column = munge_col_to_name(column.strip())
+    interval = (interval or '').strip()
+    if not interval:
+        return utils.list_partition(column)
+    if interval not in ('year', 'month'):
+        interval = float(interval) if '.' in interval else int(interval)
+    return utils.range_partition(column, interval)
+
+def search_columns_from_form(columns):
+    """
+    :param columns: The names of the columns to search as the CSV header has them, separated by commas.
+    :return: A list of field names.
+    """
+    return [munge_col_to_name(column.strip()) for column in (columns or '').split(',') if column.strip()]
+
+def model_from_csv(model_short_name, model_verbose_name, flo, partition=None):
     csv_reader = csv.reader(StringIO.StringIO(re.sub("\r", "\n", flo.read())))
     column_verbose_names = [name.strip() for name in csv_reader.next()]
     column_short_names = [munge_col_to_name(name) for name in column_verbose_names]
     datatypes = [t.strip() for t in csv_reader.next()]
+    if partition and partition['column'] not in column_short_names:
+        raise ValueError('There is no column {column} to partition by'.format(column=partition['column']))
 
     fields = {}
     for x in range(len(column_verbose_names)):
-        db_index = datatypes[x][0] == '*'
-        if datatypes[x][0] == '*':
-            datatypes[x] = datatypes[x][1:]
-
-        if datatypes[x] == 'CharField':
+        kind, db_index, srid = loader.parse_datatype(datatypes[x])
+        datatypes[x] = datatypes[x].lstrip('*')
+
+        if kind in loader.GEOMETRY_TYPES:
+            fields[ column_short_names[x] ] = utils.simple_geofield(kind, verbose_name=column_verbose_names[x], help_text=column_verbose_names[x], srid=srid, null=True)
+        elif kind in (loader.LATITUDE, loader.LONGITUDE):
+            fields[ column_short_names[x] ] = utils.simple_field('FloatField', verbose_name=column_verbose_names[x], help_text=column_verbose_names[x], null=True, db_index=db_index)
+        elif kind == loader.CATEGORICAL:
+            fields[ column_short_names[x] ] = utils.callable('ga_dynamic_models.categorical', 'CategoricalField', verbose_name=column_verbose_names[x], help_text=column_verbose_names[x], null=True, db_index=db_index)
+        elif kind == 'CharField':
             fields[ column_short_names[x] ] = utils.simple_field('CharField', verbose_name=column_verbose_names[x], help_text=column_verbose_names[x], max_length=255, null=True, db_index=db_index)
         else:
-            fields[ column_short_names[x] ] = utils.simple_field(datatypes[x], verbose_name=column_verbose_names[x], help_text=column_verbose_names[x], null=True, db_index=db_index)
+            fields[ column_short_names[x] ] = utils.simple_field(kind, verbose_name=column_verbose_names[x], help_text=column_verbose_names[x], null=True, db_index=db_index)
+
+    spec = zip(column_short_names, datatypes)
+    if is_geographic(spec):
+        kinds = [loader.parse_datatype(d)[0] for d in datatypes]
+        if loader.LATITUDE in kinds and loader.LONGITUDE in kinds:
+            fields[loader.LATLON_FIELD] = utils.simple_geofield('PointField', srid=loader.DEFAULT_SRID, null=True)
+        fields['objects'] = utils.callable("django.contrib.gis.db.models", "GeoManager")
+        base = utils.attribute('django.contrib.gis.db.models', 'Model')
+    else:
+        base = utils.attribute('django.db.models', 'Model')
 
     model = utils.model(
         model_short_name,
-        [utils.attribute('django.db.models', 'Model')],
+        [base],
         fields,
+        partition=partition,
         verbose_name=model_verbose_name,
         managed=True
     )
 
-    return zip(column_short_names, datatypes), model, csv_reader
-
-def maybe(fun):
-    global _log
-    def wrapper(value, err):
-        try:
-            if value is not None:
-                return fun(value)
-            else:
-                return None
-        except ValueError:
-            _log.warn(err)
-    return wrapper
-
-@maybe
-def maybeint(value):
-    return int(value)
-
-@maybe
-def maybebool(value):
-    return bool(value)
-
-@maybe
-def maybefloat(value):
-    return float(value)
-
-@maybe
-def maybedate(value):
-    return parsetime(value)
-
-def instances_from_rows(model, spec, reader):
-    for row in reader:
-        kwargs = {}
-        for i, value in enumerate(row):
-            field_name, data_type = spec[i]
-
-            if data_type == 'CharField':
-                    kwargs[field_name] = value
-            elif data_type == 'IntegerField':
-                kwargs[field_name] = maybeint(value, 'error converting {field_name} to int ({value})'.format(field_name=field_name,value=value))
-            elif data_type == 'FloatField':
-                kwargs[field_name] = maybefloat(value, "error converting {field_name} to float ({value})".format(field_name=field_name, value=value))
-            elif data_type == 'DateField':
-                kwargs[field_name] = maybedate(value, "error converting {field_name} to date ({value})".format(field_name=field_name, value=value))
-            elif data_type == 'BooleanField':
-                kwargs[field_name] = maybebool(value, "error converting {field_name} to boolean ({value})".format(field_name=field_name, value=value))
-
-        yield model(**kwargs)
+    return spec, model, csv_reader
 
 class CSVUploadForm(forms.Form):
     model_name = forms.CharField(max_length=255, validators=[RegexValidator('[A-z][A-z0-9]*')], label='Name of table (no spaces)')
     model_verbose_name = forms.CharField(max_length=255)
     model_data = forms.FileField()
     overwrite_existing = forms.MultipleChoiceField(choices=(('overwrite','overwrite'),('append','append'),('fail if already exists', 'fail')))
+    partition_by = forms.CharField(max_length=255, required=False, label='Partition by column (optional)')
+    partition_interval = forms.CharField(max_length=32, required=False,
+        help_text="Blank for a partition per value, or 'year', 'month' or a number for ranges")
+    search_columns = forms.CharField(max_length=1024, required=False, label='Searchable columns (optional)',
+        help_text='Text columns to build a search index on, separated by commas')
+    search_method = forms.ChoiceField(choices=(('trigram', 'names and codes'), ('fulltext', 'words')), required=False)
 
 class CSVCreateModelView(FormView):
     form_class = CSVUploadForm
@@ -121,36 +132,54 @@ class CSVCreateModelView(FormView):
     #@user_passes_test(lambda u: u.has_perm('ga_dynamic_models.can_upload_data'))
 
     def form_valid(self, form):
-        print "form valid called. creating model from CSV file."
-        spec, model, rows = model_from_csv(
-            form.cleaned_data['model_name'],
-            form.cleaned_data['model_verbose_name'],
-            form.cleaned_data['model_data']
-        )
-        utils.drop_model(form.cleaned_data['model_name'])
-        utils.drop_resource(form.cleaned_data['model_name'])
-        utils.declare_model(model, syncdb=True)
-        utils.declare_resource(utils.simple_model_resource(
-            'ga_dynamic_models.models',
-            form.cleaned_data['model_name'],
-            casify(form.cleaned_data['model_name'])
-        ))
-        self.load_data(model['name'], spec, rows)
+        with metrics.span('upload.parse', model=form.cleaned_data['model_name']):
+            spec, model, rows = model_from_csv(
+                form.cleaned_data['model_name'],
+                form.cleaned_data['model_verbose_name'],
+                form.cleaned_data['model_data'],
+                partition_from_form(form.cleaned_data.get('partition_by'), form.cleaned_data.get('partition_interval'))
+            )
+        if self.replaces_partitions(model):
+            # The same partitioned table again: replace the partitions this file has rows for, keep the rest.
+            with metrics.span('upload.load', model=model['name']):
+                self.load_data(model['name'], spec, rows)
+            return super(CSVCreateModelView, self).form_valid(form)
+        with metrics.span('upload.ddl', model=model['name']):
+            utils.drop_model(form.cleaned_data['model_name'])
+            utils.drop_resource(form.cleaned_data['model_name'])
+            utils.declare_model(model, syncdb=True)
+            declare = utils.simple_geo_resource if is_geographic(spec) else utils.simple_model_resource
+            utils.declare_resource(declare(
+                'ga_dynamic_models.models',
+                form.cleaned_data['model_name'],
+                casify(form.cleaned_data['model_name']),
+                cursor_pagination=True
+            ))
+            searched = search_columns_from_form(form.cleaned_data.get('search_columns'))
+            if searched:
+                search.declare_search(model['name'], searched, form.cleaned_data.get('search_method') or 'trigram')
+        with metrics.span('upload.load', model=model['name']):
+            self.load_data(model['name'], spec, rows)
         return super(CSVCreateModelView, self).form_valid(form)
 
-    @transaction.commit_on_success
     def load_data(self, model, spec, rows):
         m = utils.get_model(model)
-        m.objects.all().delete()
-        for instance in instances_from_rows(m, spec, rows):
-            instance.save()
+        return loader.load(m, spec, rows)
+
+    def replaces_partitions(self, model):
+        """Whether an uploaded model is partitioned, with the same partitioning and columns as the declared one."""
+        declared = get_store('models').get(model['name'])
+        if not model.get('partition') or not declared or declared.get('partition') != model['partition']:
+            return False
+        kinds = lambda definition: dict((name, field.get('callable')) for name, field in definition['fields'].items())
+        return kinds(declared) == kinds(model)
 
 class CSVSuccessView(TemplateView):
     template_name = 'ga_dynamic_models/csv_load_data_success.template.html'
 
     def render_to_response(self, context, **response_kwargs):
-        tasks.restart_ga.delay()
-        return super(CSVSuccessView.render_to_response(context, **response_kwargs))
+        reloader.request_reload()
+        return super(CSVSuccessView, self).render_to_response(context, **response_kwargs)
 
 class CSVUploadView2(TemplateView):
     template_name = 'ga_dynamic_models/csv_upload_view2.template.html'
@@ -169,6 +198,12 @@ class CSVUploadAcceptForm(forms.Form):
 
 
 class CSVUploadAccept(FormView):
+    """
+    Checks an uploaded CSV file and shows the first rows for a spot check.  Problems are summarized by a
+    :py:class:`ga_dynamic_models.validators.ValidationReport`, which is also kept in the session for
+    :py:class:`CSVValidationReportView` to serve in full.
+    """
+    report_url = '../upload_report/'
     file_must_contain_columns = set()
     column_valid_values = {}
     column_invalid_values = {}
@@ -195,37 +230,42 @@ class CSVUploadAccept(FormView):
                 if self.file_must_contain_columns.intersection(column_short_names) != self.file_must_contain_columns:
                     raise ValueError("File must contain columns: {cols}".format(cols=', '.join(self.file_must_contain_columns)))
 
-            rowcount = 1
-            errors = []
-            rows = [csv_reader.next()]
-            for row in csv_reader:
-                if rowcount <= 5:
-                    rows.append(row)
-                rowcount += 1
-                if self.column_valid_values:
-                    for col in self.column_valid_values:
+            # Reference tables are looked up once per upload, not once per row.
+            valid_values = dict((col, values.lookup() if hasattr(values, 'lookup') else values)
+                                for col, values in self.column_valid_values.items())
+            invalid_values = dict((col, values.lookup() if hasattr(values, 'lookup') else values)
+                                  for col, values in self.column_invalid_values.items())
+
+            rowcount = 0
+            rows = []
+            report = validators.ValidationReport()
+            with metrics.span('upload.validate'):
+                # Data starts on the third line of the file, after the names and the datatypes.
+                for line, row in enumerate(csv_reader, 3):
+                    if rowcount <= 5:
+                        rows.append(row)
+                    rowcount += 1
+                    for col, values in valid_values.items():
                         ix = col_indices[col]
-                        if row[ix] not in self.column_valid_values[col]:
-                            errors.append("Error on row {row}, column {col}: '{val}' is not in the list of valid values. Check its spelling and capitalization.".format(
-                                row = rowcount,
-                                col = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"[ix],
-                                val = row[ix]
-                            ))
-
-                if self.column_invalid_values:
-                    for col in self.column_invalid_values:
+                        if row[ix] not in values:
+                            report.add('not_valid', line, ix, col, row[ix])
+                    for col, values in invalid_values.items():
                         ix = col_indices[col]
-                        if row[ix]  in self.column_invalid_values[col]:
-                            errors.append("Error on row {row}, column {col}: '{val}' is an invalid value. Check its spelling and capitalization.".format(
-                                row = rowcount,
-                                col = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"[ix],
-                                val = row[ix]
-                            ))
-
-            if errors:
-                return shortcuts.render_to_response('ga_dynamic_models/upload_error.template.html', { 'errors' : errors })
+                        if row[ix] in values:
+                            report.add('invalid', line, ix, col, row[ix])
+                    report.rows_checked = rowcount
+                    if report.exceeded:
+                        break
+
+            if report:
+                self.request.session['validation_report'] = report.as_dict()
+                return shortcuts.render_to_response('ga_dynamic_models/upload_error.template.html', {
+                    'errors' : report.messages(),
+                    'report_url' : self.report_url,
+                })
 
             indexed = []
+            loadable_types = sorted(loader.CONVERTERS.keys()) + list(loader.GEOMETRY_TYPES)
             for col_num, datatype in enumerate(datatypes):
                 if not datatype:
                     raise ValueError("data in column '{colname}' has no data type associated with it".format(colname=column_verbose_names[col_num]))
@@ -236,10 +276,11 @@ class CSVUploadAccept(FormView):
                     else:
                         indexed.append('column')
 
-                if datatype not in ['CharField','IntegerField','FloatField','BooleanField']:
-                    raise ValueError("datatype for column '{colname}' was '{dtype}', but must be in the set [CharField, IntegerField, FloatField, or BooleanField]".format(
+                if loader.parse_datatype(datatype)[0] not in loadable_types:
+                    raise ValueError("datatype for column '{colname}' was '{dtype}', but must be in the set [{types}]".format(
                         colname = column_verbose_names[col_num],
-                        dtype = datatype
+                        dtype = datatype,
+                        types = ', '.join(loadable_types)
                     ))
 
             return shortcuts.render_to_response('ga_dynamic_models/upload_spotcheck.template.html', {
@@ -255,3 +296,36 @@ class CSVUploadAccept(FormView):
         return shortcuts.render_to_response('ga_dynamic_models/upload_error.template.html', {'errors' : ["No file or empty file uploaded"] })
 
 
+class CSVValidationReportView(View):
+    """
+    The last upload's validation report as JSON, a page at a time.  Each object is one column and rule, with its error
+    count and examples.  Page with ``offset`` and ``limit`` as in the API.
+    """
+
+    def get(self, request, *args, **kwargs):
+        report = request.session.get('validation_report')
+        if report is None:
+            return HttpResponseNotFound(json.dumps({'error' : 'no validation report'}), content_type='application/json')
+
+        try:
+            offset = max(int(request.GET.get('offset', 0)), 0)
+            limit = max(int(request.GET.get('limit', 20)), 1)
+        except ValueError:
+            return HttpResponseBadRequest(json.dumps({'error' : 'offset and limit must be integers'}),
+                content_type='application/json')
+
+        columns = report['columns']
+        page = {
+            'meta' : {
+                'offset' : offset,
+                'limit' : limit,
+                'total_count' : len(columns),
+                'next' : '?offset={o}&limit={l}'.format(o=offset + limit, l=limit)
+                         if offset + limit < len(columns) else None,
+                'errors' : report['errors'],
+                'rows_checked' : report['rows_checked'],
+                'aborted' : report['aborted'],
+            },
+            'objects' : columns[offset:offset + limit],
+        }
+        return HttpResponse(json.dumps(page), content_type='application/json')
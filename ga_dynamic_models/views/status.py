@@ -0,0 +1,47 @@
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.views.generic import View
+import json
+import os
+import time
+
+#
+# Identifies this process's lifetime.  The reload coordinator in ga_dynamic_models.reloader compares it before and
+# after a restart to know that it is talking to a new worker.
+#
+BOOT_ID = '{pid}-{started}'.format(pid=os.getpid(), started=repr(time.time()))
+
+class ReadyView(View):
+    """Answers 200 once this worker has built its dynamic models and API resources."""
+
+    def get(self, request, *args, **kwargs):
+        from ga_dynamic_models import models, api
+
+        return HttpResponse(json.dumps({
+            'boot_id' : BOOT_ID,
+            'models' : len(models.__all__),
+            'resources' : len(api.__all__)
+        }), content_type='application/json')
+
+
+def metrics_public():
+    return getattr(settings, 'GA_DYNAMIC_MODELS_METRICS_PUBLIC', False)
+
+
+class MetricsView(View):
+    """
+    Serves the timings and counters this worker has recorded, and the state of its class cache.  See
+    :py:mod:`ga_dynamic_models.metrics` and :py:mod:`ga_dynamic_models.classcache`.  They name models and resources,
+    so only staff may see them, unless ``GA_DYNAMIC_MODELS_METRICS_PUBLIC = True`` is in settings for a scraper that
+    can't log in.
+    """
+
+    def get(self, request, *args, **kwargs):
+        from ga_dynamic_models import metrics, classcache
+
+        user = getattr(request, 'user', None)
+        if not metrics_public() and not (user is not None and user.is_active and user.is_staff):
+            return HttpResponseForbidden()
+
+        return HttpResponse(json.dumps(dict(metrics.snapshot(), class_cache=classcache.stats())),
+            content_type='application/json')
@@ -18,7 +18,8 @@
 
 name = 'ga_dynamic_models'
 version = '0.1'
-packages = ['ga_dynamic_models', 'ga_dynamic_models.views']
+packages = ['ga_dynamic_models', 'ga_dynamic_models.views', 'ga_dynamic_models.management',
+    'ga_dynamic_models.management.commands']
 author = 'Jeff Heard'
 author_email = 'jeff@renci.org'
 description = 'Geoanalytics core application for uploading data'